@@ -1,10 +1,12 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth.models import User
 from import_export import resources
 from import_export.admin import ImportExportModelAdmin
-from .models import Broker, UserProfile, TaxQualification, AuditLog
+from .models import Broker, UserProfile, TaxQualification, AuditLog, ExchangeRate, FactorRun, OutboxEvent, ExportSnapshot, ApiToken
 from .resources import TaxQualificationResource
+from .search import broker_index, filter_qualifications
+from .outbox import enqueue_qualification
 
 # ==============================================================================
 # 1. RECURSOS DE EXPORTACIÓN (Define cómo se ve el Excel)
@@ -22,10 +24,17 @@ class TaxQualificationResource(resources.ModelResource):
 
 @admin.register(Broker)
 class BrokerAdmin(admin.ModelAdmin):
-    list_display = ('name', 'code', 'id')
+    list_display = ('name', 'code', 'country', 'id')
+    list_filter = ('country',)
     search_fields = ('name', 'code')  # <--- CRÍTICO: Habilita la barra de búsqueda y el autocomplete
     ordering = ('name',)
 
+    # Búsqueda y autocomplete desde el índice de prefijos en memoria (sin icontains por tecla)
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term.strip():
+            return queryset, False
+        return queryset.filter(id__in=broker_index.search(search_term, limit=None)), False
+
 # 2. Inline Mejorado con Autocomplete
 class UserProfileInline(admin.StackedInline):
     model = UserProfile
@@ -39,6 +48,7 @@ class UserProfileInline(admin.StackedInline):
 class UserAdmin(BaseUserAdmin):
     inlines = (UserProfileInline,)
     list_display = ('username', 'email', 'get_broker', 'is_staff')
+    list_select_related = ('userprofile__broker',)  # get_broker sin 2 consultas por fila
 
     def get_broker(self, instance):
         try:
@@ -60,11 +70,15 @@ class TaxQualificationAdmin(ImportExportModelAdmin):
     resource_class = TaxQualificationResource
     
     # Lista de visualización
-    list_display = ('instrument', 'payment_date', 'broker', 'exercise_year', 'source', 'short_financial_data')
+    list_display = ('instrument', 'payment_date', 'broker', 'exercise_year', 'source', 'monto_base', 'factor_credito', 'short_financial_data')
     list_filter = ('broker', 'source', 'exercise_year')
     search_fields = ('instrument', 'broker__name')
     date_hierarchy = 'payment_date' # Navegación por fechas rápida
 
+    # Trigram sobre el instrumento + prefijo de corredor (ver api/search.py)
+    def get_search_results(self, request, queryset, search_term):
+        return filter_qualifications(queryset, search_term), False
+
     # --- CARGA MANUAL AVANZADA (FIELDSETS) ---
     # Esto organiza el formulario en secciones visuales para facilitar el ingreso manual
     fieldsets = (
@@ -77,10 +91,17 @@ class TaxQualificationAdmin(ImportExportModelAdmin):
         }),
         ('Cálculo y Factores (JSON)', {
             'classes': ('collapse',), # Hace que esta sección sea colapsable
-            'fields': ('financial_data',),
+            'fields': ('financial_data', 'monto_base', 'factor_credito', 'factor_incremento'),
             'description': 'Ingrese aquí el objeto JSON con los factores calculados o montos brutos.'
         }),
     )
+    # Columnas tipadas: se derivan del JSON al guardar
+    readonly_fields = ('monto_base', 'factor_credito', 'factor_incremento')
+
+    # El changeform del admin ya corre en una transacción: dato y evento se confirman juntos
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        enqueue_qualification(obj, created=not change)
 
     # Helper para no llenar la tabla con un JSON gigante
     def short_financial_data(self, obj):
@@ -91,11 +112,54 @@ class TaxQualificationAdmin(ImportExportModelAdmin):
     short_financial_data.short_description = "Datos (Vista Previa)"
 
 # ==============================================================================
-# 4. AUDITORÍA (SOLO LECTURA)
+# 4. TIPOS DE CAMBIO (Reportes consolidados multi-moneda)
+# ==============================================================================
+@admin.register(ExchangeRate)
+class ExchangeRateAdmin(ImportExportModelAdmin):
+    list_display = ('date', 'currency', 'rate_usd', 'updated_at')
+    list_filter = ('currency',)
+    date_hierarchy = 'date'
+
+@admin.register(FactorRun)
+class FactorRunAdmin(admin.ModelAdmin):
+    list_display = ('started_at', 'broker', 'exercise_year', 'full', 'selected', 'updated', 'rejected', 'skipped')
+    list_filter = ('broker', 'exercise_year', 'full')
+    # Resumen de ejecución: solo lectura
+    readonly_fields = ('broker', 'exercise_year', 'started_at', 'finished_at', 'full', 'selected', 'updated', 'rejected', 'skipped')
+
+@admin.register(ExportSnapshot)
+class ExportSnapshotAdmin(admin.ModelAdmin):
+    list_display = ('broker', 'format', 'version', 'size', 'data_updated_at', 'generated_at')
+    list_filter = ('format',)
+    readonly_fields = ('broker', 'format', 'version', 'path', 'size', 'data_updated_at', 'generated_at')
+
+@admin.register(OutboxEvent)
+class OutboxEventAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'event_type', 'key', 'published_at', 'attempts', 'next_attempt_at')
+    list_filter = ('event_type', ('published_at', admin.EmptyFieldListFilter))
+    # Los escribe el backend y los publica el relay: solo lectura
+    readonly_fields = ('event_id', 'event_type', 'topic', 'key', 'payload', 'created_at', 'published_at', 'attempts', 'next_attempt_at', 'last_error')
+
+@admin.register(ApiToken)
+class ApiTokenAdmin(admin.ModelAdmin):
+    list_display = ('name', 'broker', 'prefix', 'is_active', 'created_at', 'last_used_at')
+    list_filter = ('is_active', 'broker')
+    readonly_fields = ('prefix', 'created_at', 'last_used_at')
+
+    def save_model(self, request, obj, form, change):
+        raw = None if change else obj.set_key()
+        super().save_model(request, obj, form, change)
+        if raw:
+            # Solo se guarda el hash: esta es la única vez que se ve el token
+            messages.warning(request, f"Token para {obj.broker.code}: {raw} (cópielo ahora, no se volverá a mostrar)")
+
+# ==============================================================================
+# 5. AUDITORÍA (SOLO LECTURA)
 # ==============================================================================
 @admin.register(AuditLog)
 class AuditLogAdmin(admin.ModelAdmin):
     list_display = ('timestamp', 'user', 'action', 'details_short')
+    list_select_related = ('user',)  # FK nullable: el select_related() automático del admin no la sigue
     list_filter = ('action', 'user')
     # Importante: Los logs no deben poder editarse, solo leerse
     readonly_fields = ('timestamp', 'user', 'action', 'details')
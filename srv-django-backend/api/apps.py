@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from . import signals  # noqa: F401 (registra los receptores)
+        from nuam import profiling
+        profiling.install_signal_handler()  # kill -USR2 <pid>: muestreo del proceso (nuam/profiling.py)
@@ -0,0 +1,124 @@
+"""
+Recálculo masivo de factores tributarios.
+
+Las calificaciones que llegan desde la bolsa traen montos pero no factores ("se calcularán
+después"). Este motor toma todas las de un corredor/año, calcula en bloque (NumPy)
+
+    factor_credito    = montos.credito    / monto_base
+    factor_incremento = montos.incremento / monto_base
+
+valida los límites [0, 1] con la misma regla del formulario manual y escribe por lotes
+(bulk_update) solo las filas cuyo resultado cambió. Cada ejecución queda en FactorRun;
+la siguiente corrida incremental revisa solo lo modificado desde entonces.
+"""
+import numpy as np
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+
+from .financial import FACTOR_MAX, FACTOR_MIN, HASH_FIELDS, TYPED_COLUMNS, row_content_hash, to_decimal
+from .models import AuditLog, FactorRun, TaxQualification
+
+CHUNK_SIZE = 5000
+_, FACTOR_PLACES, FACTOR_DIGITS = TYPED_COLUMNS['factor_credito']
+
+
+def _component(data, key):
+    montos = data.get('montos') if isinstance(data, dict) else None
+    value = montos.get(key) if isinstance(montos, dict) else None
+    return value if isinstance(value, (int, float)) and not isinstance(value, bool) else np.nan
+
+
+def compute_factors(monto_base, credito, incremento):
+    """
+    Vectorizado: devuelve (factor_credito, factor_incremento, válido, con_datos).
+    Sin monto de incremento se asume 0 (igual que el formulario manual).
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        has_data = np.isfinite(monto_base) & (monto_base > 0) & np.isfinite(credito)
+        factor_credito = np.round(credito / monto_base, FACTOR_PLACES)
+        factor_incremento = np.round(np.where(np.isfinite(incremento), incremento, 0.0) / monto_base, FACTOR_PLACES)
+    low, high = float(FACTOR_MIN), float(FACTOR_MAX)
+    valid = (has_data
+             & (factor_credito >= low) & (factor_credito <= high)
+             & (factor_incremento >= low) & (factor_incremento <= high))
+    return factor_credito, factor_incremento, valid, has_data
+
+
+def _process_chunk(rows, now):
+    """Calcula un lote y devuelve (objetos a actualizar, fuera de rango, sin datos)."""
+    monto_base = np.array([float(r.monto_base) if r.monto_base is not None else np.nan for r in rows])
+    credito = np.array([_component(r.financial_data, 'credito') for r in rows], dtype=np.float64)
+    incremento = np.array([_component(r.financial_data, 'incremento') for r in rows], dtype=np.float64)
+    factor_credito, factor_incremento, valid, has_data = compute_factors(monto_base, credito, incremento)
+
+    changed = []
+    for i in np.flatnonzero(valid):
+        row = rows[i]
+        new_credito = to_decimal(float(factor_credito[i]), FACTOR_PLACES, FACTOR_DIGITS)
+        new_incremento = to_decimal(float(factor_incremento[i]), FACTOR_PLACES, FACTOR_DIGITS)
+        if row.factor_credito == new_credito and row.factor_incremento == new_incremento:
+            continue  # Sin cambios: no se reescribe (evita churn en updated_at)
+        data = dict(row.financial_data or {})
+        data['factores'] = {'credito': float(new_credito), 'incremento': float(new_incremento)}
+        data['calculado_automatico'] = True
+        row.financial_data = data
+        row.factor_credito = new_credito
+        row.factor_incremento = new_incremento
+        row.content_hash = row_content_hash(row)
+        row.updated_at = now
+        changed.append(row)
+
+    rejected = [rows[i].id for i in np.flatnonzero(has_data & ~valid)]
+    return changed, rejected, int((~has_data).sum())
+
+
+def recalculate_factors(broker, exercise_year, full=False, chunk_size=CHUNK_SIZE):
+    """
+    Recalcula los factores de un corredor/año. Incremental por defecto: solo filas
+    modificadas desde la última corrida; con full=True, todas las que aún no tienen factor.
+    """
+    started_at = timezone.now()
+    last_run = (FactorRun.objects.filter(broker=broker, exercise_year=exercise_year, finished_at__isnull=False)
+                .order_by('-started_at').first())
+
+    queryset = TaxQualification.objects.filter(broker=broker, exercise_year=exercise_year, monto_base__isnull=False)
+    if full or last_run is None:
+        queryset = queryset.filter(factor_credito__isnull=True)
+    else:
+        queryset = queryset.filter(updated_at__gt=last_run.started_at)
+
+    run = FactorRun.objects.create(broker=broker, exercise_year=exercise_year, started_at=started_at,
+                                   full=full or last_run is None)
+    rejected_ids = []
+    last_id = 0
+    while True:
+        # Paginación por id (keyset): cada lote es una consulta indexada y una transacción corta
+        rows = list(queryset.filter(id__gt=last_id).order_by('id')
+                    .only('id', 'financial_data', *HASH_FIELDS)[:chunk_size])
+        if not rows:
+            break
+        last_id = rows[-1].id
+        changed, rejected, skipped = _process_chunk(rows, timezone.now())
+        with transaction.atomic():
+            TaxQualification.objects.bulk_update(
+                changed, ['financial_data', 'factor_credito', 'factor_incremento', 'content_hash', 'updated_at']
+            )
+        run.selected += len(rows)
+        run.updated += len(changed)
+        run.rejected += len(rejected)
+        run.skipped += skipped
+        rejected_ids.extend(rejected)
+
+    run.finished_at = timezone.now()
+    run.save()
+
+    sample = f" Fuera de rango (ids): {rejected_ids[:20]}" if rejected_ids else ""
+    AuditLog.objects.create(
+        user=User.objects.filter(is_superuser=True).first(),
+        action='FACTOR_RECALC',
+        details=(f"Recálculo {'completo' if run.full else 'incremental'} {broker.code}/{exercise_year}: "
+                 f"{run.selected} revisadas, {run.updated} actualizadas, {run.rejected} fuera de rango, "
+                 f"{run.skipped} sin datos.{sample}")
+    )
+    return run
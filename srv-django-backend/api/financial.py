@@ -0,0 +1,131 @@
+"""
+Columnas tipadas extraídas de TaxQualification.financial_data.
+
+El JSON sigue siendo la fuente de verdad; estas columnas son un espejo Decimal indexado
+para poder filtrar, ordenar y agregar por monto/factor sin parsear JSONB fila a fila.
+La misma regla existe en Python (save() del modelo) y en SQL (cargas set-based).
+Lo mismo vale para content_hash, la huella de los valores de negocio de cada fila que usa
+la reconciliación (api/reconciliation.py).
+"""
+import datetime
+import hashlib
+import re
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+# columna -> (ruta dentro del JSON, decimales, dígitos totales)
+TYPED_COLUMNS = {
+    'monto_base': (('monto_base',), 2, 18),
+    'factor_credito': (('factores', 'credito'), 4, 6),
+    'factor_incremento': (('factores', 'incremento'), 4, 6),
+}
+
+NUMERIC_RE = re.compile(r'^\s*-?[0-9]+(\.[0-9]+)?\s*$')
+CURRENCIES = ('CLP', 'COP', 'PEN', 'USD')
+
+# --- LÍMITES DE FACTORES (misma regla en el formulario y en el recálculo masivo) ---
+FACTOR_MIN = Decimal('0')
+FACTOR_MAX = Decimal('1')
+
+
+def factor_bounds_error(value, label):
+    """Mensaje de error si el factor está fuera de [0, 1]; None si es válido (o no viene)."""
+    if value is None:
+        return None
+    if value > FACTOR_MAX:
+        return f"El Factor de {label} no puede ser mayor a 1.0."
+    if value < FACTOR_MIN:
+        return "El factor no puede ser negativo."
+    return None
+
+
+def to_decimal(value, places, max_digits):
+    """Convierte un valor JSON a Decimal redondeado; None si no es numérico o no cabe en la columna."""
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, str):
+        if not NUMERIC_RE.match(value):
+            return None
+        value = value.strip()
+    elif not isinstance(value, (int, float)):
+        return None
+    try:
+        number = Decimal(str(value))
+    except InvalidOperation:
+        return None
+    if not number.is_finite():
+        return None
+    number = number.quantize(Decimal(1).scaleb(-places), rounding=ROUND_HALF_UP)
+    if abs(number) >= Decimal(10) ** (max_digits - places):
+        return None
+    return number
+
+
+def extract_typed_columns(financial_data):
+    """Devuelve {columna: Decimal|None} (y 'currency' si el JSON trae una 'moneda' válida)."""
+    data = financial_data if isinstance(financial_data, dict) else {}
+    values = {}
+    for column, (path, places, max_digits) in TYPED_COLUMNS.items():
+        node = data
+        for key in path:
+            node = node.get(key) if isinstance(node, dict) else None
+        values[column] = to_decimal(node, places, max_digits)
+
+    moneda = data.get('moneda')
+    if isinstance(moneda, str) and moneda.upper() in CURRENCIES:
+        values['currency'] = moneda.upper()
+    return values
+
+
+def typed_column_sql(column, source='financial_data'):
+    """Expresión PostgreSQL equivalente a extract_typed_columns para una columna (source es jsonb)."""
+    path, places, max_digits = TYPED_COLUMNS[column]
+    parents = ''.join(f"->'{key}'" for key in path[:-1])
+    node = f"{source}{parents}->'{path[-1]}'"
+    text = f"trim({source}{parents}->>'{path[-1]}')"
+    rounded = f"round(({text})::numeric, {places})"
+    return (
+        f"CASE WHEN jsonb_typeof({node}) = 'number' "
+        f"OR (jsonb_typeof({node}) = 'string' AND {text} ~ '{NUMERIC_RE.pattern}') "
+        f"THEN CASE WHEN abs({rounded}) < 1e{max_digits - places} THEN {rounded} END END"
+    )
+
+
+def currency_sql(fallback, source='financial_data'):
+    """Moneda desde el JSON si es válida; si no, la columna/valor 'fallback'."""
+    options = ', '.join(f"'{c}'" for c in CURRENCIES)
+    moneda = f"upper({source}->>'moneda')"
+    return f"CASE WHEN {moneda} IN ({options}) THEN {moneda} ELSE {fallback} END"
+
+
+# --- HUELLA DE CONTENIDO (reconciliación) ---
+HASH_MASK = (1 << 63) - 1  # 63 bits: cabe positivo en un bigint con signo
+HASH_FIELDS = ('instrument', 'payment_date', 'exercise_year', 'currency', *TYPED_COLUMNS)
+
+
+def content_hash(instrument, payment_date, exercise_year, currency, *typed_values):
+    """
+    Hash de los valores de negocio de una fila (no del JSON crudo: dos orígenes con distinta
+    forma de financial_data pero iguales montos, factores y moneda coinciden). Los valores
+    tipados van en el orden de TYPED_COLUMNS, ya redondeados (extract_typed_columns).
+    """
+    if isinstance(payment_date, str):
+        payment_date = datetime.date.fromisoformat(payment_date)
+    text = '|'.join([
+        instrument, payment_date.isoformat(), str(int(exercise_year)), currency,
+        *('' if value is None else str(value) for value in typed_values),
+    ])
+    return int(hashlib.md5(text.encode('utf-8')).hexdigest()[:16], 16) & HASH_MASK
+
+
+def row_content_hash(row):
+    """content_hash de un dict o instancia con los campos de HASH_FIELDS."""
+    get = row.get if isinstance(row, dict) else lambda name: getattr(row, name)
+    return content_hash(*(get(name) for name in HASH_FIELDS))
+
+
+def content_hash_sql(alias):
+    """Expresión PostgreSQL equivalente a content_hash sobre las columnas de `alias`."""
+    typed = ', '.join(f"coalesce({alias}.{column}::text, '')" for column in TYPED_COLUMNS)
+    text = (f"concat_ws('|', {alias}.instrument, to_char({alias}.payment_date, 'YYYY-MM-DD'), "
+            f"{alias}.exercise_year::text, {alias}.currency, {typed})")
+    return f"((('x' || substr(md5({text}), 1, 16))::bit(64)::bigint) & {HASH_MASK})"
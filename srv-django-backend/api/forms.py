@@ -1,6 +1,7 @@
 from django import forms
 from django.core.exceptions import ValidationError
 from .models import TaxQualification
+from .financial import factor_bounds_error
 import json
 
 class ManualEntryForm(forms.ModelForm):
@@ -41,18 +42,19 @@ class ManualEntryForm(forms.ModelForm):
         }
 
     # --- VALIDACIONES Y LOGICA JSON ---
+    # Los límites [0, 1] son los mismos que aplica el recálculo masivo (api/factors.py)
     def clean_factor_credito(self):
         factor = self.cleaned_data['factor_credito']
-        if factor > 1:
-            raise ValidationError("El Factor de Crédito no puede ser mayor a 1.0.")
-        if factor < 0:
-            raise ValidationError("El factor no puede ser negativo.")
+        error = factor_bounds_error(factor, "Crédito")
+        if error:
+            raise ValidationError(error)
         return factor
 
     def clean_factor_incremento(self):
         factor = self.cleaned_data.get('factor_incremento')
-        if factor and factor > 1:
-            raise ValidationError("El Factor de Incremento no puede ser mayor a 1.0.")
+        error = factor_bounds_error(factor, "Incremento")
+        if error:
+            raise ValidationError(error)
         return factor
 
     def save(self, commit=True):
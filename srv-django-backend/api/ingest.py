@@ -0,0 +1,265 @@
+"""
+Ingesta NDJSON por streaming para integraciones de corredores (POST /api/v1/qualifications/bulk/).
+
+El cuerpo (una calificación JSON por línea, opcionalmente con Content-Encoding: gzip) se
+lee en bloques de READ_SIZE a medida que llega. Las líneas se agrupan en lotes de
+BATCH_SIZE registros que se validan por columnas (mismas reglas que la carga CSV, ver
+api/validation.py) y se upsertean con un solo INSERT ... ON CONFLICT por lote, junto a su
+evento resumen de outbox y en su propia transacción.
+
+La respuesta también es NDJSON: una línea por lote, emitida en cuanto el lote se confirma,
+y una línea final con los totales. La memoria depende del tamaño del lote, no del cuerpo.
+Un lote confirmado queda confirmado: si la conexión se corta o la BD falla (el lote en curso
+se revierte y la línea final trae "done": false), el cliente reenvía desde el último lote
+informado (el upsert es idempotente). La auditoría se registra siempre, aun si el cliente corta.
+
+Formato de cada línea:
+    {"instrument": "BCH", "payment_date": "2025-05-30", "exercise_year": 2025,
+     "currency": "CLP", "financial_data": {"monto_base": 1000, "factores": {"credito": 0.1}}}
+El corredor lo fija el token; un "broker_code" distinto al del token se rechaza.
+
+load_csv aplica el mismo upsert por lotes a la carga CSV de la web.
+"""
+import json
+import time
+import zlib
+from itertools import islice
+
+from django.db import DatabaseError, connection, transaction
+from django.utils import timezone
+
+from nuam import tracing
+
+from .models import AuditLog, TaxQualification
+from .outbox import enqueue_bulk_load, enqueue_qualification_rows
+from .reconciliation import bucket_key, mark_stale
+from .financial import TYPED_COLUMNS, extract_typed_columns, row_content_hash
+from .validation import MAX_REPORT_VALUE, iter_validated_csv, loads_many, validate_records
+
+READ_SIZE = 64 * 1024
+BATCH_SIZE = 2000
+MAX_LINE_BYTES = 1024 * 1024
+CSV_CHUNK_ROWS = 20_000  # Bloque de la carga web: ~3 KB de pico por fila, ~60 MB por worker
+MAX_BATCH_ERRORS = 100  # Errores detallados por línea de respuesta (el conteo siempre es completo)
+SOURCE = 'API'
+
+UNIQUE_FIELDS = ['broker', 'instrument', 'payment_date']
+INSERT_FIELDS = ['broker', 'instrument', 'payment_date', 'exercise_year', 'currency', 'financial_data', 'source',
+                 *TYPED_COLUMNS, 'content_hash', 'created_at', 'updated_at']
+UPSERT_FIELDS = ['exercise_year', 'currency', 'financial_data', 'source', *TYPED_COLUMNS, 'content_hash', 'updated_at']
+
+
+class IngestError(ValueError):
+    """El cuerpo no se puede seguir leyendo (gzip corrupto o truncado, línea demasiado larga)."""
+
+
+# --- LECTURA INCREMENTAL DEL CUERPO ---
+def body_chunks(stream, gzipped=False, read_size=READ_SIZE):
+    """Bloques de bytes del cuerpo, ya descomprimidos si viene en gzip."""
+    inflater = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+    while True:
+        data = stream.read(read_size)
+        if not data:
+            break
+        if inflater is None:
+            yield data
+            continue
+        try:
+            while data:
+                # max_length: un gzip muy comprimido no se expande entero en memoria
+                yield inflater.decompress(data, read_size * 4)
+                data = inflater.unconsumed_tail
+        except zlib.error as e:
+            raise IngestError(f"gzip inválido: {e}")
+    if inflater is not None and not inflater.eof:
+        raise IngestError("gzip truncado")
+
+
+def ndjson_lines(chunks, max_line=MAX_LINE_BYTES):
+    """(número de línea, bytes) de cada línea no vacía."""
+    pending, number = b'', 0
+    for chunk in chunks:
+        pending += chunk
+        lines = pending.split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            number += 1
+            if len(line) > max_line:
+                raise IngestError(f"Línea {number} supera {max_line} bytes")
+            if line.strip():
+                yield number, line
+        if len(pending) > max_line:
+            raise IngestError(f"Línea {number + 1} supera {max_line} bytes")
+    if pending.strip():
+        yield number + 1, pending
+
+
+def batches(lines, size=BATCH_SIZE):
+    while True:
+        batch = list(islice(lines, size))
+        if not batch:
+            return
+        yield batch
+
+
+# --- LOTE: PARSEO, VALIDACIÓN Y UPSERT ---
+def parse_batch(batch, broker):
+    """(registros, sus números de línea, errores) de un lote de líneas."""
+    texts = [raw.decode('utf-8', 'replace') for _, raw in batch]
+    records, lines, errors = [], [], []
+    for (number, _), text, obj in zip(batch, texts, loads_many(texts)):
+        if obj.__class__ is not dict:
+            errors.append((number, '', text[:MAX_REPORT_VALUE], "La línea no es un objeto JSON válido"))
+        elif obj.get('broker_code') not in (None, broker.code):
+            errors.append((number, 'broker_code', str(obj['broker_code'])[:MAX_REPORT_VALUE],
+                           "El corredor no corresponde al token"))
+        else:
+            records.append(obj)
+            lines.append(number)
+    return records, lines, errors
+
+
+def _upsert_sql(rows):
+    meta = TaxQualification._meta
+
+    def column(name):
+        return connection.ops.quote_name(meta.get_field(name).column)
+
+    placeholders = '(' + ', '.join(['%s'] * len(INSERT_FIELDS)) + ')'
+    return (
+        f"INSERT INTO {connection.ops.quote_name(meta.db_table)} ({', '.join(map(column, INSERT_FIELDS))}) "
+        f"VALUES {', '.join([placeholders] * rows)} "
+        f"ON CONFLICT ({', '.join(map(column, UNIQUE_FIELDS))}) DO UPDATE SET "
+        + ', '.join(f"{column(name)} = EXCLUDED.{column(name)}" for name in UPSERT_FIELDS)
+    )
+
+
+def upsert_rows(broker, rows, source=SOURCE):
+    """
+    Upsert de un lote con INSERT ... ON CONFLICT de varias filas por sentencia.
+    SQL directo y no bulk_create: preparar cada valor por el ORM costaba más que la BD misma.
+    Completa cada fila con sus columnas tipadas (y la moneda final) y devuelve, por fila,
+    si fue creada. Las filas que cambian de año de ejercicio marcan su hoja de reconciliación
+    anterior (el ON CONFLICT no pasa por la señal post_save).
+    """
+    if not rows:
+        return []
+    dates = [row['payment_date'] for row in rows]
+    existing = {
+        (instrument, payment_date): year
+        for instrument, payment_date, year in TaxQualification.objects.filter(
+            broker=broker,
+            instrument__in={row['instrument'] for row in rows},
+            payment_date__range=(min(dates), max(dates)),
+        ).values_list('instrument', 'payment_date', 'exercise_year')
+    }
+    adapt_json = connection.ops.adapt_json_value
+    now = connection.ops.adapt_datetimefield_value(timezone.now())
+    params = []
+    for row in rows:
+        row.update(extract_typed_columns(row['financial_data']))  # Lo mismo que save() vía sync_financial_columns
+        params.append((
+            broker.id, row['instrument'], row['payment_date'], row['exercise_year'], row['currency'],
+            adapt_json(row['financial_data'], None), source, *(row[name] for name in TYPED_COLUMNS),
+            row_content_hash(row), now, now,
+        ))
+
+    size = connection.ops.bulk_batch_size(INSERT_FIELDS, params)
+    with connection.cursor() as cursor:
+        for start in range(0, len(params), size):
+            chunk = params[start:start + size]
+            cursor.execute(_upsert_sql(len(chunk)), [value for values in chunk for value in values])
+    moved = {
+        bucket_key(existing[key], row['payment_date'])
+        for row in rows
+        if (key := (row['instrument'], row['payment_date'])) in existing and existing[key] != int(row['exercise_year'])
+    }
+    for year, month in moved:
+        mark_stale(broker.id, year, month)
+    return [(row['instrument'], row['payment_date']) not in existing for row in rows]
+
+
+def ingest_batch(broker, batch):
+    """Valida y persiste un lote; devuelve su resultado (una línea de la respuesta)."""
+    with tracing.span('ingest.decode', lines=len(batch)):
+        records, lines, errors = parse_batch(batch, broker)
+        rows, record_errors = validate_records(records, lines) if records else ([], [])
+        errors = sorted(errors + record_errors)
+    with tracing.span('ingest.db_upsert', rows=len(rows)), transaction.atomic():
+        created = sum(upsert_rows(broker, rows))
+        if rows:
+            amount = float(sum(row['monto_base'] or 0 for row in rows))
+            enqueue_bulk_load(broker.code, len(rows), created, amount, SOURCE)
+    return {
+        'received': len(batch),
+        'upserted': len(rows),
+        'created': created,
+        'rejected': len({line for line, *_ in errors}),
+        'errors': [dict(zip(('line', 'column', 'value', 'error'), error)) for error in errors[:MAX_BATCH_ERRORS]],
+    }
+
+
+def load_csv(stream, broker, report, chunk_rows=CSV_CHUNK_ROWS):
+    """
+    Carga CSV (vista upload_csv): cada bloque validado se upsertea antes de leer el siguiente,
+    con un evento de outbox por fila; los errores van al ErrorReport. Debe correr dentro de
+    una transacción. Devuelve (filas leídas, filas cargadas).
+    """
+    total = loaded = 0
+    for rows, errors, count in iter_validated_csv(stream, chunk_rows):
+        for start in range(0, len(rows), BATCH_SIZE):
+            batch = rows[start:start + BATCH_SIZE]
+            with tracing.span('csv.db_upsert', rows=len(batch)):
+                enqueue_qualification_rows(broker, batch, upsert_rows(broker, batch, source='CSV'), 'CSV')
+        report.add(errors)
+        total += count
+        loaded += len(rows)
+        del rows, errors  # Que el bloque anterior no siga vivo mientras se lee el siguiente
+    return total, loaded
+
+
+# --- RESPUESTA EN STREAMING ---
+def audit_ingest(token, totals, error):
+    try:
+        with tracing.span('ingest.audit_write'):
+            AuditLog.objects.create(
+                user=None,
+                action='API_BULK',
+                details=f"Ingesta API '{token.name}' ({token.broker.code}): {totals['upserted']} filas, "
+                        f"{totals['rejected']} rechazadas{f', cortada: {error}' if error else ''}",
+            )
+    except DatabaseError as e:
+        print(f"🔥 Ingesta API: no se pudo registrar la auditoría: {e}")
+
+
+def ingest_stream(stream, token, gzipped=False, batch_size=BATCH_SIZE):
+    """Genera la respuesta NDJSON mientras consume el cuerpo: una línea por lote y el resumen final."""
+    broker = token.broker
+    totals = {'received': 0, 'upserted': 0, 'created': 0, 'rejected': 0}
+    started = time.perf_counter()
+    error = None
+    finished = False
+    number = 0
+    try:
+        try:
+            for number, batch in enumerate(batches(ndjson_lines(body_chunks(stream, gzipped)), batch_size), 1):
+                result = ingest_batch(broker, batch)
+                for key in totals:
+                    totals[key] += result[key]
+                yield json.dumps({'batch': number, **result}, ensure_ascii=False) + '\n'
+            finished = True
+        except IngestError as e:
+            error = str(e)
+        except DatabaseError as e:
+            # El lote en curso se revirtió: los anteriores ya están confirmados e informados
+            error = f"error de base de datos en el lote {number}: {e}"
+    finally:
+        # También si el cliente cierra la conexión a mitad (el generador se cierra sin terminar)
+        audit_ingest(token, totals, error if finished or error else "conexión cerrada por el cliente")
+
+    elapsed = time.perf_counter() - started
+    summary = {'done': finished, **totals, 'seconds': round(elapsed, 3),
+               'records_per_second': round(totals['received'] / max(elapsed, 1e-9))}
+    if error:
+        summary['error'] = error
+    yield json.dumps(summary, ensure_ascii=False) + '\n'
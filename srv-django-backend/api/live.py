@@ -0,0 +1,342 @@
+"""
+Actualizaciones en vivo del dashboard por Server-Sent Events.
+
+Un ÚNICO hilo por proceso (LiveHub) consulta una vez por segundo lo nuevo en
+TaxQualification (updated_at) y AuditLog (timestamp) y lo deja en un buffer circular
+numerado. Cada dashboard abierto solo espera en memoria y recibe los eventos de su
+tenant: con cientos de pestañas la BD sigue viendo dos consultas indexadas por segundo,
+en vez de cientos de recargas completas del dashboard.
+
+Bajo ASGI (imagen Docker: gunicorn con workers de uvicorn, nuam/asgi.py) cada dashboard es
+una corrutina que espera en el event loop (astream): cientos de pestañas no ocupan hilos.
+Bajo WSGI (runserver_plus en desarrollo) stream() ocupa un hilo del servidor por dashboard
+abierto: solo sirve con un servidor multi-hilo y pocas pestañas.
+
+Las escrituras llegan por cualquier vía (consumer, CSV, ingreso manual, admin, carga
+masiva) porque se detectan en la BD, no en la vista que las hizo. Cada pasada re-escanea
+una ventana corta (LOOKBACK) y deduplica. Una transacción larga (bulk_load, upload_csv)
+confirma filas con instantes muy anteriores a esa ventana: el poller anota las transacciones
+de escritura abiertas (pg_stat_activity) y, cuando una termina, re-escanea una vez desde su
+inicio. El orden lo da la confirmación, no el reloj de las filas.
+
+Una ráfaga (carga masiva) se recorre en bloques de POLL_BATCH. El dueño (corredor o usuario)
+que supera POLL_BATCH cambios en una pasada recibe un único 'resync' (recargar) en vez de
+miles de filas, y sus filas restantes ya no se leen; los demás tenants siguen recibiendo
+sus cambios fila a fila y no recargan.
+"""
+import asyncio
+import json
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from datetime import timedelta
+
+from django.db import close_old_connections, connection
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from .models import AuditLog, TaxQualification
+
+POLL_INTERVAL = 1.0
+LOOKBACK = timedelta(seconds=5)
+POLL_BATCH = 500
+BUFFER_SIZE = 2000
+HEARTBEAT_SECONDS = 15
+
+OPEN_TRANSACTIONS_SQL = (
+    "SELECT pid, backend_xid::text, xact_start FROM pg_stat_activity "
+    "WHERE backend_xid IS NOT NULL AND datname = current_database() AND pid <> pg_backend_pid()"
+)
+
+
+def serialize_qualification(q):
+    return {
+        'id': q.id,
+        'instrument': q.instrument,
+        'payment_date': q.payment_date.strftime('%d/%m/%Y'),
+        'exercise_year': q.exercise_year,
+        'source': q.source,
+        'broker': q.broker.name,
+        'financial_data': q.financial_data,
+        'updated_at': timezone.localtime(q.updated_at).strftime('%H:%M:%S'),
+    }
+
+
+def serialize_log(log):
+    return {
+        'id': log.id,
+        'timestamp': timezone.localtime(log.timestamp).strftime('%Y-%m-%d %H:%M:%S'),
+        'user': str(log.user) if log.user_id else 'None',
+        'action': log.action,
+        'details': log.details,
+    }
+
+
+# tipo -> (queryset, campo de cambio, columna del dueño, (broker, usuario) del registro, serializador)
+SOURCES = {
+    'qualification': (
+        lambda: TaxQualification.objects.select_related('broker'), 'updated_at', 'broker_id',
+        lambda q: (q.broker_id, None), serialize_qualification,
+    ),
+    'audit': (
+        lambda: AuditLog.objects.select_related('user'), 'timestamp', 'user_id',
+        lambda log: (None, log.user_id), serialize_log,
+    ),
+}
+
+
+def owners_q(owner_field, owners):
+    """Filtro de las filas cuyo dueño está en `owners` (None = sin dueño, p. ej. acciones del sistema)."""
+    q = Q(**{f"{owner_field}__in": [who for who in owners if who is not None]})
+    return q | Q(**{f"{owner_field}__isnull": True}) if None in owners else q
+
+
+class Scope:
+    """Qué ve un dashboard: el admin todo; un operador su corredor y sus propias acciones."""
+
+    def __init__(self, user):
+        self.is_superuser = user.is_superuser
+        self.user_id = user.id
+        try:
+            self.broker_id = user.userprofile.broker_id
+        except Exception:
+            self.broker_id = None
+
+    def allows(self, kind, broker_id, user_id):
+        if self.is_superuser:
+            return True
+        if kind == 'qualification' or (kind == 'resync' and broker_id is not None):
+            return broker_id is not None and broker_id == self.broker_id
+        return user_id == self.user_id
+
+
+class LiveHub:
+    def __init__(self, poll_interval=POLL_INTERVAL, buffer_size=BUFFER_SIZE, autostart=True):
+        self.poll_interval = poll_interval
+        self.autostart = autostart  # False: sin hilo propio, se llama poll_once() a mano (tests)
+        self.token = uuid.uuid4().hex[:8]  # Distingue procesos/reinicios en el Last-Event-ID
+        self._cond = threading.Condition()
+        self._events = deque(maxlen=buffer_size)  # (seq, kind, broker_id, user_id, payload)
+        self._seq = 0
+        self._subscribers = 0
+        self._waiters = set()  # (event loop, asyncio.Event) de los dashboards ASGI en espera
+        self._thread = None
+        self._floor = {}      # tipo -> nada <= este instante se publica (lo anterior al arranque)
+        self._watermark = {}  # tipo -> último instante visto
+        self._seen = {}       # tipo -> {(id, instante)} dentro de la ventana de re-escaneo
+        self._flooded = {}    # tipo -> {dueño: último instante ya cubierto por su 'resync'}
+        self._open = {}       # (pid, xid) -> inicio de las transacciones de escritura abiertas
+
+    # --- PRODUCCIÓN (hilo poller) ---
+    def _publish(self, kind, broker_id, user_id, payload):
+        with self._cond:
+            self._seq += 1
+            self._events.append((self._seq, kind, broker_id, user_id, payload))
+            self._cond.notify_all()
+            for loop, wakeup in self._waiters:
+                try:
+                    loop.call_soon_threadsafe(wakeup.set)
+                except RuntimeError:  # Event loop ya cerrado
+                    pass
+
+    def _poll_source(self, kind, rescan_from=None):
+        get_queryset, field, owner_field, owner, serialize = SOURCES[kind]
+        queryset = get_queryset()
+        if kind not in self._watermark:
+            # Primera pasada: solo se marca lo existente (los dashboards ya lo muestran)
+            now = timezone.now()
+            self._floor[kind] = self._watermark[kind] = now
+            self._seen[kind] = set()
+            self._flooded[kind] = {}
+            return 0
+
+        since = self._watermark[kind] - LOOKBACK
+        if rescan_from is not None:
+            # Confirmó una transacción larga: sus filas traen instantes anteriores a la ventana
+            since = min(since, rescan_from)
+            self._flooded[kind] = {}  # Sus filas pueden ser de un dueño ya recargado: que vuelva a recargar
+        since = max(since, self._floor[kind])
+        pending = queryset.filter(**{f"{field}__gte": since, f"{field}__gt": self._floor[kind]}).order_by(field, 'id')
+        page = pending
+        counts = Counter()  # dueño -> cambios en esta pasada
+        flooded = set()     # dueños que ya recibieron 'resync': sus filas no se leen más
+        published = 0
+        while True:
+            rows = list(page[:POLL_BATCH])
+            for row in rows:
+                changed_at = getattr(row, field)
+                self._watermark[kind] = max(self._watermark[kind], changed_at)
+                key = (row.id, changed_at)
+                who = getattr(row, owner_field)
+                covered = self._flooded[kind].get(who)
+                if key in self._seen[kind] or who in flooded or (covered is not None and changed_at <= covered):
+                    continue
+                counts[who] += 1
+                if counts[who] > POLL_BATCH:
+                    # Ráfaga de un dueño (p. ej. bulk_load): más barato que recargue que empujarle miles de filas
+                    flooded.add(who)
+                    self._publish('resync', *owner(row), {'reason': kind})
+                else:
+                    self._seen[kind].add(key)
+                    self._publish(kind, *owner(row), serialize(row))
+                published += 1
+            if len(rows) < POLL_BATCH:
+                break
+            if flooded:
+                pending = pending.exclude(owners_q(owner_field, flooded))
+            last = rows[-1]
+            page = pending.filter(Q(**{f"{field}__gt": getattr(last, field)}) | Q(**{field: getattr(last, field), 'id__gt': last.id}))
+
+        if flooded:
+            # Las filas omitidas no están en _seen: los próximos re-escaneos las saltan hasta su último instante
+            last_by_owner = (queryset.filter(owners_q(owner_field, flooded)).order_by()
+                             .values_list(owner_field).annotate(last=Max(field)))
+            for who, last in last_by_owner:
+                self._flooded[kind][who] = last
+                self._watermark[kind] = max(self._watermark[kind], last)
+        horizon = self._watermark[kind] - LOOKBACK
+        if self._open:
+            # Lo visto desde el inicio de una transacción abierta se conserva: su re-escaneo no duplica
+            horizon = min(horizon, min(self._open.values()) - LOOKBACK)
+        self._seen[kind] = {key for key in self._seen[kind] if key[1] >= horizon}
+        self._flooded[kind] = {who: last for who, last in self._flooded[kind].items() if last >= horizon}
+        return published
+
+    def _open_transactions(self):
+        """
+        {(pid, xid): inicio} de las transacciones de escritura en curso (pg_stat_activity; los
+        servicios comparten usuario de BD, así que se ven todas). Fuera de PostgreSQL: {}.
+        """
+        if connection.vendor != 'postgresql':
+            return {}
+        with connection.cursor() as cursor:
+            cursor.execute(OPEN_TRANSACTIONS_SQL)
+            return {(pid, xid): started for pid, xid, started in cursor.fetchall()}
+
+    def poll_once(self):
+        """Una pasada sobre todas las fuentes; devuelve cuántos eventos publicó."""
+        # Antes de leer: una transacción que confirme durante esta pasada sigue en _open y se re-escanea en la próxima
+        current = self._open_transactions()
+        finished = [started for key, started in self._open.items() if key not in current]
+        self._open = current
+        rescan_from = min(finished) - LOOKBACK if finished else None
+        return sum(self._poll_source(kind, rescan_from) for kind in SOURCES)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                # Sin dashboards abiertos no se consulta la BD
+                self._cond.wait_for(lambda: self._subscribers > 0)
+            try:
+                self.poll_once()
+            except Exception as e:
+                print(f"🔥 LiveHub: error consultando cambios: {e}")
+            finally:
+                close_old_connections()
+            time.sleep(self.poll_interval)
+
+    def _ensure_thread(self):
+        if not self.autostart:
+            return
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='live-hub', daemon=True)
+            self._thread.start()
+
+    # --- CONSUMO (un generador por dashboard conectado) ---
+    def _pending(self, after):
+        """Eventos con seq > after, sin esperar; llamar con self._cond tomado."""
+        if after > self._seq:
+            return [], self._seq, True
+        lost = bool(self._events) and self._events[0][0] > after + 1
+        return [e for e in self._events if e[0] > after], self._seq, lost
+
+    def read(self, after, timeout):
+        """Eventos con seq > after (espera hasta `timeout`). lost=True si el buffer ya los descartó."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._seq > after, timeout=timeout)
+            return self._pending(after)
+
+    async def aread(self, after, timeout):
+        """read() sin ocupar un hilo: el poller despierta al event loop (ASGI) al publicar."""
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._cond:
+            waiting = self._seq <= after
+            if waiting:
+                self._waiters.add(waiter)
+        try:
+            if waiting:
+                await asyncio.wait_for(waiter[1].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self._cond:
+                self._waiters.discard(waiter)
+        with self._cond:
+            return self._pending(after)
+
+    def parse_last_event_id(self, value):
+        """'token:seq' del navegador al reconectar; None si es de otro proceso o inválido."""
+        token, _, seq = (value or '').partition(':')
+        return int(seq) if token == self.token and seq.isdigit() else None
+
+    def _subscribe(self):
+        with self._cond:
+            self._subscribers += 1
+            self._cond.notify_all()
+            self._ensure_thread()
+            return self._seq
+
+    def _unsubscribe(self):
+        with self._cond:
+            self._subscribers -= 1
+
+    def _opening(self, last_event_id, current):
+        """(seq desde el que se envía, primeros mensajes SSE)."""
+        after = self.parse_last_event_id(last_event_id)
+        chunks = []
+        if after is None:
+            if last_event_id:
+                chunks.append("event: resync\ndata: {}\n\n")  # Reconexión a otro proceso: recargar
+            after = current
+        chunks.append(f"retry: 3000\nid: {self.token}:{after}\n\n")
+        return after, chunks
+
+    def _message(self, scope, events, after, lost):
+        if lost:
+            return f"id: {self.token}:{after}\nevent: resync\ndata: {{}}\n\n"
+        chunks = [
+            f"id: {self.token}:{seq}\nevent: {kind}\ndata: {json.dumps(payload, default=str)}\n\n"
+            for seq, kind, broker_id, user_id, payload in events
+            if scope.allows(kind, broker_id, user_id)
+        ]
+        # Comentario SSE como heartbeat: mantiene viva la conexión y detecta clientes caídos
+        return ''.join(chunks) if chunks else ": ping\n\n"
+
+    def stream(self, scope, last_event_id=None):
+        """Generador SSE para un dashboard (WSGI: ocupa un hilo del servidor mientras está abierto)."""
+        current = self._subscribe()
+        try:
+            after, opening = self._opening(last_event_id, current)
+            yield from opening
+            while True:
+                events, after, lost = self.read(after, HEARTBEAT_SECONDS)
+                yield self._message(scope, events, after, lost)
+        finally:
+            self._unsubscribe()
+
+    async def astream(self, scope, last_event_id=None):
+        """stream() asíncrono (ASGI): un dashboard abierto es una corrutina en espera, no un hilo."""
+        current = self._subscribe()
+        try:
+            after, opening = self._opening(last_event_id, current)
+            for chunk in opening:
+                yield chunk
+            while True:
+                events, after, lost = await self.aread(after, HEARTBEAT_SECONDS)
+                yield self._message(scope, events, after, lost)
+        finally:
+            self._unsubscribe()
+
+
+hub = LiveHub()
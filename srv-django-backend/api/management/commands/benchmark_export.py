@@ -0,0 +1,43 @@
+"""
+Compara XLSX contra Parquet/Arrow sobre los datos reales de un corredor (solo lectura).
+
+Uso:
+    python manage.py benchmark_export --broker DEFAULT
+"""
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api import columnar
+from api.models import Broker, TaxQualification
+from api.resources import TaxQualificationResource
+
+
+class Command(BaseCommand):
+    help = "Mide tiempo de generación y tamaño del export XLSX vs. Parquet/Arrow para un corredor."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--broker', required=True, help="Código del corredor")
+        parser.add_argument('--skip-xlsx', action='store_true', help="Omite XLSX (lento en tenants grandes)")
+
+    def handle(self, *args, **options):
+        broker = Broker.objects.filter(code=options['broker']).first()
+        if broker is None:
+            raise CommandError(f"Corredor inexistente: {options['broker']}")
+        queryset = TaxQualification.objects.filter(broker=broker)
+        self.stdout.write(f"📊 {broker.code}: {queryset.count()} calificaciones")
+
+        formats = [] if options['skip_xlsx'] else ['xlsx']
+        if columnar.available():
+            formats += list(columnar.FORMATS)
+        else:
+            self.stderr.write("pyarrow no está instalado: solo se mide XLSX.")
+
+        for fmt in formats:
+            started = time.perf_counter()
+            if fmt == 'xlsx':
+                size = len(TaxQualificationResource().export(queryset=queryset).xlsx)
+            else:
+                size = sum(len(chunk) for chunk in columnar.stream_export(queryset, fmt))
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f"   {fmt:<8} {elapsed:8.2f}s {size / 1024:12.1f} KB")
@@ -0,0 +1,74 @@
+"""
+Memoria pico de la carga CSV (decodificación + validación + upsert) según el tamaño del archivo.
+
+Uso:
+    python manage.py benchmark_upload                              # 25k y 100k filas
+    python manage.py benchmark_upload --rows 50000 500000 --latin1
+
+Cada CSV sintético se sube por el mismo camino que la vista upload_csv (archivo temporal
+→ open_csv_text → ingest.load_csv → ErrorReport) dentro de una transacción que se revierte:
+no deja datos. Reporta el pico de memoria de Python (tracemalloc, incluye numpy), que debe
+mantenerse casi plano aunque el archivo crezca.
+"""
+import random
+import time
+import tracemalloc
+
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.ingest import CSV_CHUNK_ROWS, load_csv
+from api.models import Broker
+from api.validation import ErrorReport, open_csv_text
+
+HEADER = 'instrument,payment_date,exercise_year,currency,financial_data\r\n'
+
+
+def write_csv(out, rows, encoding, seed=7):
+    rng = random.Random(seed)
+    out.write(HEADER.encode(encoding))
+    for i in range(rows):
+        year = 2025 if rng.random() > 0.01 else 'dos mil'  # ~1% de filas con error
+        line = (f'ACCIÓN{i:07d},2025-{1 + i % 12:02d}-{1 + i % 28:02d},{year},CLP,'
+                f'"{{""monto_base"": {rng.uniform(100, 1e6):.2f}, ""factores"": {{""credito"": 0.1}}}}"\r\n')
+        out.write(line.encode(encoding))
+
+
+class Command(BaseCommand):
+    help = "Mide el pico de memoria de la carga CSV para distintos tamaños de archivo (transacción revertida)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[25_000, 100_000])
+        parser.add_argument('--chunk-rows', type=int, default=CSV_CHUNK_ROWS)
+        parser.add_argument('--latin1', action='store_true', help="Genera los archivos en Windows-1252")
+
+    def handle(self, *args, **options):
+        encoding = 'cp1252' if options['latin1'] else 'utf-8'
+        self.stdout.write(f"📊 Carga CSV ({encoding}, bloques de {options['chunk_rows']} filas)")
+        self.stdout.write(f"   {'filas':>10} {'archivo MB':>11} {'pico MB':>9} {'pico/archivo':>13} {'segundos':>9}")
+        self.load(1000, encoding, options['chunk_rows'])  # Calentamiento: imports perezosos fuera de la medición
+        for rows in options['rows']:
+            size, peak, elapsed, detected, loaded, rejected = self.load(rows, encoding, options['chunk_rows'])
+            self.stdout.write(f"   {rows:>10} {size / 1e6:>11.1f} {peak / 1e6:>9.1f} {peak / size:>13.2f} {elapsed:>9.1f}"
+                              f"   ({detected}; {loaded} cargadas, {rejected} rechazadas)")
+
+    def load(self, rows, encoding, chunk_rows):
+        """(bytes del archivo, pico de memoria, segundos, codificación detectada, cargadas, rechazadas)."""
+        upload = TemporaryUploadedFile('bench.csv', 'text/csv', 0, None)
+        write_csv(upload, rows, encoding)
+        size = upload.tell()
+        upload.seek(0)
+
+        tracemalloc.start()
+        started = time.perf_counter()
+        with transaction.atomic(), ErrorReport() as report:
+            broker = Broker.objects.create(name="Benchmark Carga CSV", code="BENCHCSV")
+            text, detected = open_csv_text(upload)
+            _, loaded = load_csv(text, broker, report, chunk_rows)
+            transaction.set_rollback(True)
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        upload.close()
+        return size, peak, elapsed, detected, loaded, report.rejected
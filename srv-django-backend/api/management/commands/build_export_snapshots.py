@@ -0,0 +1,45 @@
+"""
+Genera en segundo plano los snapshots de exportación (ver api/snapshots.py).
+
+Uso:
+    python manage.py build_export_snapshots                   # una pasada, todos los corredores
+    python manage.py build_export_snapshots --interval 300    # proceso permanente
+"""
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from api import snapshots
+from api.models import Broker
+
+
+class Command(BaseCommand):
+    help = "Regenera los snapshots de exportación de los corredores cuya versión de datos cambió."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--broker', help="Código de corredor (por defecto: todos)")
+        parser.add_argument('--format', action='append', choices=list(snapshots.FORMATS),
+                            help="Formato a generar (repetible; por defecto: todos los disponibles)")
+        parser.add_argument('--interval', type=int, help="Repite cada N segundos")
+
+    def handle(self, *args, **options):
+        brokers = Broker.objects.order_by('code')
+        if options['broker']:
+            brokers = brokers.filter(code=options['broker'])
+            if not brokers.exists():
+                raise CommandError(f"Corredor inexistente: {options['broker']}")
+        formats = [f for f in options['format'] or snapshots.FORMATS if f in snapshots.available_formats()]
+
+        while True:
+            for broker in brokers:
+                for fmt in formats:
+                    started = time.perf_counter()
+                    snapshot, regenerated = snapshots.generate(broker, fmt)
+                    if regenerated:
+                        self.stdout.write(f"📦 {broker.code}/{fmt}: {snapshot.size / 1024:.1f} KB "
+                                          f"en {time.perf_counter() - started:.2f}s")
+            if not options['interval']:
+                break
+            close_old_connections()
+            time.sleep(options['interval'])
@@ -0,0 +1,434 @@
+"""
+Carga masiva OFFLINE de archivos tributarios (multi-GB) usando PostgreSQL COPY.
+
+Uso:
+    python manage.py bulk_load /datos/anual_2025.csv --broker DEFAULT --workers 8
+
+Flujo:
+    1. El archivo se divide en rangos de bytes alineados a fin de registro (un campo entre
+       comillas, p. ej. el JSON de financial_data, puede contener saltos de línea).
+    2. Un pool de procesos parsea y valida cada rango en paralelo.
+    3. Cada rango válido se transmite con COPY a una tabla staging (UNLOGGED).
+    4. Una única sentencia INSERT ... ON CONFLICT fusiona el staging en TaxQualification
+       (y deja en el outbox un evento resumen por corredor, en la misma transacción). Antes,
+       las hojas de reconciliación de las filas que cambian de año se marcan desactualizadas.
+
+Los rangos ya copiados quedan registrados en la BD: si la carga se corta, basta con
+volver a ejecutar el mismo comando sobre el mismo archivo para retomarla.
+"""
+import csv
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from api.financial import TYPED_COLUMNS, content_hash_sql, currency_sql, typed_column_sql
+from api.models import AuditLog, Broker, ReconciliationBucket, TaxQualification
+from api.outbox import enqueue_bulk_load
+
+STAGING_TABLE = 'api_bulkload_staging'
+CHUNKS_TABLE = 'api_bulkload_chunk'
+TARGET_TABLE = TaxQualification._meta.db_table
+
+REQUIRED_COLUMNS = ('instrument', 'payment_date', 'exercise_year')
+CURRENCIES = {code for code, _ in TaxQualification.CURRENCY_CHOICES}
+STAGING_COLUMNS = (
+    'load_id', 'chunk_no', 'line_no', 'broker_id', 'instrument',
+    'payment_date', 'exercise_year', 'currency', 'financial_data',
+)
+
+# El staging es UNLOGGED (sin WAL): rápido, pero Postgres lo vacía tras una caída.
+# Por eso la tabla de chunks guarda cuántas filas se copiaron y al retomar se verifica.
+STAGING_DDL = f"""
+CREATE UNLOGGED TABLE IF NOT EXISTS {STAGING_TABLE} (
+    load_id varchar(64) NOT NULL,
+    chunk_no integer NOT NULL,
+    line_no bigint NOT NULL,
+    broker_id bigint NOT NULL,
+    instrument varchar(120) NOT NULL,
+    payment_date date NOT NULL,
+    exercise_year integer NOT NULL,
+    currency varchar(3) NOT NULL,
+    financial_data jsonb NOT NULL
+);
+CREATE TABLE IF NOT EXISTS {CHUNKS_TABLE} (
+    load_id varchar(64) NOT NULL,
+    chunk_no integer NOT NULL,
+    loaded integer NOT NULL,
+    rejected integer NOT NULL,
+    PRIMARY KEY (load_id, chunk_no)
+);
+"""
+
+COPY_SQL = f"COPY {STAGING_TABLE} ({', '.join(STAGING_COLUMNS)}) FROM STDIN WITH (FORMAT csv)"
+
+# Si el archivo trae la misma clave varias veces, gana la última ocurrencia.
+# Las columnas tipadas (monto/factores/moneda) se derivan del JSON con la misma regla que save().
+MERGE_SQL = f"""
+INSERT INTO {TARGET_TABLE}
+    (broker_id, instrument, payment_date, exercise_year, currency, financial_data, source,
+     {', '.join(TYPED_COLUMNS)}, content_hash, created_at, updated_at)
+SELECT merged.*, {content_hash_sql('merged')}, now(), now()
+FROM (
+    SELECT DISTINCT ON (broker_id, instrument, payment_date)
+        broker_id, instrument, payment_date, exercise_year, {currency_sql('currency')} AS currency, financial_data,
+        %s AS source, {', '.join(f"{typed_column_sql(column)} AS {column}" for column in TYPED_COLUMNS)}
+    FROM {STAGING_TABLE}
+    WHERE load_id = %s
+    ORDER BY broker_id, instrument, payment_date, chunk_no DESC, line_no DESC
+) merged
+ON CONFLICT (broker_id, instrument, payment_date) DO UPDATE SET
+    exercise_year = EXCLUDED.exercise_year,
+    currency = EXCLUDED.currency,
+    financial_data = EXCLUDED.financial_data,
+    source = EXCLUDED.source,
+    {''.join(f"{column} = EXCLUDED.{column}, " for column in TYPED_COLUMNS)}content_hash = EXCLUDED.content_hash,
+    updated_at = EXCLUDED.updated_at
+RETURNING broker_id, monto_base, (xmax = 0) AS inserted
+"""
+
+# Resumen por corredor de lo fusionado (agregado en el servidor, sin traer millones de filas):
+# alimenta el evento de outbox de la carga, que viaja en la misma transacción que el merge.
+MERGE_SUMMARY_SQL = f"""
+WITH merged AS ({MERGE_SQL})
+SELECT b.code, count(*), count(*) FILTER (WHERE m.inserted), COALESCE(sum(m.monto_base), 0)
+FROM merged m JOIN {Broker._meta.db_table} b ON b.id = m.broker_id
+GROUP BY b.code
+"""
+
+# Filas existentes que el merge cambia de año de ejercicio: su hoja de reconciliación anterior
+# cambia sin que updated_at lo delate (como la señal post_save para los cambios vía ORM).
+MARK_MOVED_STALE_SQL = f"""
+UPDATE {ReconciliationBucket._meta.db_table} bucket SET stale = true
+FROM (
+    SELECT DISTINCT t.broker_id, t.exercise_year, EXTRACT(MONTH FROM t.payment_date)::integer AS month
+    FROM {TARGET_TABLE} t
+    JOIN {STAGING_TABLE} s ON s.broker_id = t.broker_id AND s.instrument = t.instrument
+        AND s.payment_date = t.payment_date
+    WHERE s.load_id = %s AND s.exercise_year <> t.exercise_year
+) moved
+WHERE bucket.broker_id = moved.broker_id AND bucket.exercise_year = moved.exercise_year
+    AND bucket.month = moved.month
+"""
+
+
+# --- FUNCIONES DE NIVEL MÓDULO (deben ser 'picklables' para el pool de procesos) ---
+
+def split_ranges(path, data_start, chunk_bytes, block_size=8 * 1024 * 1024):
+    """
+    Divide el archivo en rangos [inicio, fin) de ~chunk_bytes que terminan en fin de registro:
+    un salto de línea fuera de comillas. Recorre el archivo una vez contando comillas (la
+    paridad dice si se está dentro de un campo; "" escapado suma dos y no la cambia).
+    """
+    size = os.path.getsize(path)
+    ranges = []
+    start = data_start
+    target = start + chunk_bytes
+    quoted = False
+    data, i, base = b'', 0, data_start  # data[i] es el byte base + i del archivo
+    with open(path, 'rb') as f:
+        f.seek(data_start)
+        while target < size:
+            if i >= len(data):
+                base += len(data)
+                data, i = f.read(block_size), 0
+                if not data:
+                    break
+            if base + i < target:
+                stop = min(len(data), target - base)
+                quoted ^= bool(data.count(b'"', i, stop) & 1)
+                i = stop
+                continue
+            newline = data.find(b'\n', i)
+            if newline < 0:
+                quoted ^= bool(data.count(b'"', i) & 1)
+                i = len(data)
+                continue
+            quoted ^= bool(data.count(b'"', i, newline) & 1)
+            i = newline + 1
+            if not quoted:
+                ranges.append((start, base + i))
+                start = base + i
+                target = start + chunk_bytes
+    if start < size:
+        ranges.append((start, size))
+    return ranges
+
+
+def iter_records(src, start, end):
+    """(offset, bytes) de cada registro de [start, end): líneas unidas mientras haya comillas abiertas."""
+    src.seek(start)
+    offset = start
+    while offset < end:
+        record_offset, parts, quotes = offset, [], 0
+        while offset < end:
+            raw = src.readline()
+            if not raw:
+                break
+            offset += len(raw)
+            parts.append(raw)
+            quotes += raw.count(b'"')
+            if quotes % 2 == 0:
+                break
+        if not parts:
+            return
+        yield record_offset, b''.join(parts)
+
+
+def clean_row(values, index, broker_ids, default_broker_id):
+    """Valida una fila y la devuelve lista para COPY. Lanza ValueError con el motivo del rechazo."""
+    def col(name):
+        pos = index.get(name)
+        return values[pos].strip() if pos is not None and pos < len(values) else ''
+
+    code = col('broker_code')
+    if code:
+        broker_id = broker_ids.get(code)
+        if broker_id is None:
+            raise ValueError(f"Corredor desconocido: {code}")
+    elif default_broker_id:
+        broker_id = default_broker_id
+    else:
+        raise ValueError("Fila sin broker_code y sin --broker por defecto")
+
+    instrument = col('instrument')
+    if not instrument or len(instrument) > 120:
+        raise ValueError("Instrumento vacío o mayor a 120 caracteres")
+
+    payment_date = date.fromisoformat(col('payment_date'))
+    exercise_year = int(col('exercise_year'))
+
+    currency = (col('currency') or 'CLP').upper()
+    if currency not in CURRENCIES:
+        raise ValueError(f"Moneda no soportada: {currency}")
+
+    financial_data = json.loads(col('financial_data') or '{}')
+    if not isinstance(financial_data, dict):
+        raise ValueError("financial_data debe ser un objeto JSON")
+
+    return (broker_id, instrument, payment_date.isoformat(), exercise_year, currency,
+            json.dumps(financial_data, separators=(',', ':')))
+
+
+def parse_chunk(path, load_id, chunk_no, start, end, header, broker_ids, default_broker_id, encoding, workdir):
+    """
+    Worker: parsea el rango [start, end) y escribe dos archivos temporales,
+    uno con filas listas para COPY y otro con los rechazos.
+    """
+    index = {name: pos for pos, name in enumerate(header)}
+    copy_path = os.path.join(workdir, f'chunk_{chunk_no}.csv')
+    rejects_path = os.path.join(workdir, f'chunk_{chunk_no}.rejects.csv')
+    loaded = rejected = 0
+
+    with open(path, 'rb') as src, \
+            open(copy_path, 'w', newline='', encoding='utf-8') as out, \
+            open(rejects_path, 'w', newline='', encoding='utf-8') as rej:
+        writer = csv.writer(out)
+        rejects = csv.writer(rej)
+        current = {}
+
+        def texts():
+            """Registros decodificados para un único csv.reader (los de codificación inválida se rechazan acá)."""
+            nonlocal rejected
+            for line_no, (record_offset, raw) in enumerate(iter_records(src, start, end), 1):
+                try:
+                    text = raw.decode(encoding)
+                except UnicodeDecodeError as exc:
+                    rejects.writerow([chunk_no, record_offset, f"Codificación inválida: {exc}", raw.hex()])
+                    rejected += 1
+                    continue
+                if not text.strip():
+                    continue
+                current.update(line_no=line_no, offset=record_offset, text=text.rstrip('\r\n'))
+                yield text
+
+        reader = csv.reader(texts())
+        while True:
+            try:
+                values = next(reader)
+            except StopIteration:
+                break
+            except csv.Error as exc:
+                rejects.writerow([chunk_no, current['offset'], str(exc), current['text']])
+                rejected += 1
+                continue
+            try:
+                record = clean_row(values, index, broker_ids, default_broker_id)
+            except ValueError as exc:
+                rejects.writerow([chunk_no, current['offset'], str(exc), current['text']])
+                rejected += 1
+                continue
+
+            writer.writerow((load_id, chunk_no, current['line_no']) + record)
+            loaded += 1
+
+    return chunk_no, copy_path, rejects_path, loaded, rejected
+
+
+class Command(BaseCommand):
+    help = "Carga masiva offline de calificaciones (CSV multi-GB) vía COPY + merge set-based. Retomable."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Archivo CSV con cabeceras (instrument, payment_date, exercise_year, ...)")
+        parser.add_argument('--broker', help="Código de corredor por defecto para filas sin broker_code")
+        parser.add_argument('--broker-map', help="CSV 'codigo_origen,codigo_nuam' para traducir códigos de la bolsa")
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--chunk-mb', type=int, default=64, help="Tamaño aproximado de cada rango (MB)")
+        parser.add_argument('--encoding', default='utf-8')
+        parser.add_argument('--rejects', help="Archivo de rechazos (por defecto <archivo>.rejects.csv)")
+        parser.add_argument('--source', default='CSV', choices=[code for code, _ in TaxQualification.SOURCE_CHOICES])
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError("bulk_load requiere PostgreSQL (usa COPY y tablas UNLOGGED).")
+
+        path = os.path.abspath(options['path'])
+        if not os.path.isfile(path):
+            raise CommandError(f"No existe el archivo: {path}")
+        encoding = options['encoding']
+        rejects_path = options['rejects'] or f"{path}.rejects.csv"
+
+        # 1. Cabecera y rangos
+        with open(path, 'rb') as f:
+            header_line = f.readline()
+            data_start = f.tell()
+        header = [h.strip() for h in next(csv.reader([header_line.decode(encoding).lstrip('\ufeff')]))]
+        missing = [c for c in REQUIRED_COLUMNS if c not in header]
+        if missing:
+            raise CommandError(f"Faltan columnas obligatorias: {', '.join(missing)}")
+
+        ranges = split_ranges(path, data_start, options['chunk_mb'] * 1024 * 1024)
+        load_id = self._load_id(path)
+
+        # 2. Mapeo de corredores (una sola consulta; el dict viaja a cada worker)
+        broker_ids, default_broker_id = self._broker_mapping(options['broker'], options['broker_map'])
+        if 'broker_code' not in header and not default_broker_id:
+            raise CommandError("El archivo no trae broker_code: indique --broker.")
+
+        # 3. Retomar: saltar rangos ya copiados al staging
+        with connection.cursor() as cursor:
+            cursor.execute(STAGING_DDL)
+        done = self._completed_chunks(load_id)
+        pending = [(n, start, end) for n, (start, end) in enumerate(ranges) if n not in done]
+        self.stdout.write(
+            f"📦 Carga {load_id[:12]}: {len(ranges)} rangos, {len(done)} ya copiados, {len(pending)} pendientes."
+        )
+
+        # 4. Parseo paralelo + COPY secuencial a medida que terminan los workers
+        # Cerramos la conexión antes de forkear para no compartir el socket con los hijos.
+        connection.close()
+        workdir = tempfile.mkdtemp(prefix='nuam_bulk_')
+        try:
+            with ProcessPoolExecutor(max_workers=options['workers']) as pool, \
+                    open(rejects_path, 'a', newline='', encoding='utf-8') as rejects_out:
+                futures = [
+                    pool.submit(parse_chunk, path, load_id, n, start, end, header,
+                                broker_ids, default_broker_id, encoding, workdir)
+                    for n, start, end in pending
+                ]
+                for i, future in enumerate(as_completed(futures), start=1):
+                    chunk_no, copy_path, chunk_rejects, loaded, rejected = future.result()
+                    with open(chunk_rejects, encoding='utf-8') as src:
+                        shutil.copyfileobj(src, rejects_out)
+                    rejects_out.flush()
+                    self._copy_chunk(load_id, chunk_no, copy_path, loaded, rejected)
+                    os.remove(copy_path)
+                    os.remove(chunk_rejects)
+                    self.stdout.write(f"   [{i}/{len(pending)}] rango {chunk_no}: {loaded} filas, {rejected} rechazos")
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        # 5. Merge set-based y limpieza del staging (misma transacción)
+        merged, loaded, rejected = self._merge(load_id, options['source'])
+
+        AuditLog.objects.create(
+            user=User.objects.filter(is_superuser=True).first(),
+            action='BULK_LOAD',
+            details=(f"Carga masiva {os.path.basename(path)}: {loaded} filas válidas, "
+                     f"{merged} fusionadas, {rejected} rechazadas ({rejects_path})")
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ {merged} calificaciones fusionadas. {rejected} rechazos en {rejects_path}"
+        ))
+
+    # --- HELPERS ---
+    def _load_id(self, path):
+        """Identifica la carga por ruta + tamaño + mtime: el mismo archivo retoma, uno distinto empieza de cero."""
+        stat = os.stat(path)
+        return hashlib.sha1(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()
+
+    def _broker_mapping(self, default_code, map_path):
+        ids = dict(Broker.objects.values_list('code', 'id'))
+        broker_ids = dict(ids)
+        if map_path:
+            with open(map_path, newline='', encoding='utf-8') as f:
+                for row in csv.reader(f):
+                    if len(row) < 2 or not row[0].strip():
+                        continue
+                    origin, target = row[0].strip(), row[1].strip()
+                    if target not in ids:
+                        raise CommandError(f"--broker-map apunta a un corredor inexistente: {target}")
+                    broker_ids[origin] = ids[target]
+
+        default_broker_id = None
+        if default_code:
+            default_broker_id = broker_ids.get(default_code)
+            if default_broker_id is None:
+                raise CommandError(f"Corredor por defecto inexistente: {default_code}")
+        return broker_ids, default_broker_id
+
+    def _completed_chunks(self, load_id):
+        """Rangos cuyo conteo en staging coincide con lo registrado (el UNLOGGED pudo vaciarse tras una caída)."""
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                SELECT c.chunk_no
+                FROM {CHUNKS_TABLE} c
+                LEFT JOIN (
+                    SELECT chunk_no, count(*) AS n FROM {STAGING_TABLE} WHERE load_id = %s GROUP BY chunk_no
+                ) s ON s.chunk_no = c.chunk_no
+                WHERE c.load_id = %s AND COALESCE(s.n, 0) = c.loaded
+                """,
+                [load_id, load_id],
+            )
+            return {row[0] for row in cursor.fetchall()}
+
+    def _copy_chunk(self, load_id, chunk_no, copy_path, loaded, rejected):
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute("SET LOCAL synchronous_commit = off")
+            # Restos de un intento anterior interrumpido de este mismo rango
+            cursor.execute(f"DELETE FROM {STAGING_TABLE} WHERE load_id = %s AND chunk_no = %s", [load_id, chunk_no])
+            with open(copy_path, encoding='utf-8') as f:
+                cursor.copy_expert(COPY_SQL, f)
+            cursor.execute(
+                f"""
+                INSERT INTO {CHUNKS_TABLE} (load_id, chunk_no, loaded, rejected) VALUES (%s, %s, %s, %s)
+                ON CONFLICT (load_id, chunk_no) DO UPDATE SET loaded = EXCLUDED.loaded, rejected = EXCLUDED.rejected
+                """,
+                [load_id, chunk_no, loaded, rejected],
+            )
+
+    def _merge(self, load_id, source):
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute("SET LOCAL work_mem = '256MB'")
+            cursor.execute(
+                f"SELECT COALESCE(sum(loaded), 0), COALESCE(sum(rejected), 0) FROM {CHUNKS_TABLE} WHERE load_id = %s",
+                [load_id],
+            )
+            loaded, rejected = cursor.fetchone()
+            cursor.execute(MARK_MOVED_STALE_SQL, [load_id])
+            cursor.execute(MERGE_SUMMARY_SQL, [source, load_id])
+            summary = cursor.fetchall()
+            merged = sum(rows for _, rows, _, _ in summary)
+            for broker_code, rows, created, amount in summary:
+                enqueue_bulk_load(broker_code, rows, created, float(amount), source)
+            cursor.execute(f"DELETE FROM {STAGING_TABLE} WHERE load_id = %s", [load_id])
+            cursor.execute(f"DELETE FROM {CHUNKS_TABLE} WHERE load_id = %s", [load_id])
+        return merged, loaded, rejected
@@ -0,0 +1,25 @@
+"""
+Emite un token de API para la integración de un corredor (ingesta NDJSON, ver api/ingest.py).
+
+Uso:
+    python manage.py create_api_token --broker BCS --name "Integración Bolsa"
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from api.models import ApiToken, Broker
+
+
+class Command(BaseCommand):
+    help = "Crea un token de API para un corredor y lo muestra una única vez."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--broker', required=True, help="Código de corredor")
+        parser.add_argument('--name', required=True, help="Nombre de la integración")
+
+    def handle(self, *args, **options):
+        broker = Broker.objects.filter(code=options['broker']).first()
+        if broker is None:
+            raise CommandError(f"Corredor inexistente: {options['broker']}")
+        token, raw = ApiToken.issue(broker, options['name'])
+        self.stdout.write(f"🔑 Token '{token.name}' para {broker.code} (guárdelo, no se vuelve a mostrar):")
+        self.stdout.write(raw)
@@ -0,0 +1,34 @@
+"""
+Purga las lápidas de sincronización vencidas (ver api/sync.py).
+
+Uso:
+    python manage.py prune_tombstones                   # una pasada (cron)
+    python manage.py prune_tombstones --interval 3600   # proceso permanente (servicio srv-sync-maintenance)
+"""
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from api.sync import TOMBSTONE_RETENTION_DAYS, prune_tombstones
+
+
+class Command(BaseCommand):
+    help = "Borra las lápidas más viejas que la retención: los sync_token que las necesitaban ya expiraron."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=TOMBSTONE_RETENTION_DAYS,
+                            help="Retención en días (no menor a la de los sync_token)")
+        parser.add_argument('--interval', type=int, help="Repite cada N segundos")
+
+    def handle(self, *args, **options):
+        if options['days'] < TOMBSTONE_RETENTION_DAYS:
+            # Un token aún válido pediría borrados que ya no estarían
+            raise CommandError(f"--days no puede ser menor a {TOMBSTONE_RETENTION_DAYS} (vigencia de los sync_token)")
+        while True:
+            pruned = prune_tombstones(options['days'])
+            self.stdout.write(f"🧹 {pruned} lápidas de sincronización purgadas")
+            if not options['interval']:
+                break
+            close_old_connections()
+            time.sleep(options['interval'])
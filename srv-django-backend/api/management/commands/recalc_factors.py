@@ -0,0 +1,39 @@
+"""
+Recálculo masivo de factores (ver api/factors.py).
+
+Uso:
+    python manage.py recalc_factors --broker DEFAULT --year 2025   # incremental
+    python manage.py recalc_factors --full                          # todos los corredores/años
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from api.factors import CHUNK_SIZE, recalculate_factors
+from api.models import Broker, TaxQualification
+
+
+class Command(BaseCommand):
+    help = "Calcula en bloque los factores de crédito/incremento pendientes o modificados desde la última corrida."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--broker', help="Código de corredor (por defecto: todos)")
+        parser.add_argument('--year', type=int, help="Año de ejercicio (por defecto: todos)")
+        parser.add_argument('--full', action='store_true', help="Revisa todas las filas sin factor, no solo las modificadas")
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        pairs = TaxQualification.objects.order_by().values_list('broker_id', 'exercise_year').distinct()
+        if options['broker']:
+            broker = Broker.objects.filter(code=options['broker']).first()
+            if broker is None:
+                raise CommandError(f"Corredor inexistente: {options['broker']}")
+            pairs = pairs.filter(broker=broker)
+        if options['year']:
+            pairs = pairs.filter(exercise_year=options['year'])
+
+        brokers = Broker.objects.in_bulk()
+        for broker_id, year in sorted(pairs):
+            run = recalculate_factors(brokers[broker_id], year, full=options['full'], chunk_size=options['chunk_size'])
+            self.stdout.write(
+                f"🧮 {brokers[broker_id].code}/{year}: {run.selected} revisadas, {run.updated} actualizadas, "
+                f"{run.rejected} fuera de rango, {run.skipped} sin datos"
+            )
@@ -0,0 +1,107 @@
+"""
+Reconciliación por árbol de hashes (ver api/reconciliation.py).
+
+Uso:
+    python manage.py reconcile refresh                        # hojas cambiadas, todos los corredores
+    python manage.py reconcile refresh --full --broker DEFAULT
+    python manage.py reconcile refresh --interval 60          # proceso permanente
+    python manage.py reconcile diff --broker DEFAULT --file carga.csv --out diferencias.csv
+    python manage.py reconcile diff --broker DEFAULT --remote https://staging/api/v1/reconciliation/ --token XXX
+    python manage.py reconcile diff --broker DEFAULT --using replica
+
+En diff, 'a' es la BD local y 'b' el otro lado (archivo, ambiente remoto u otro alias).
+"""
+import csv
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from api import reconciliation
+from api.models import Broker, ReconciliationTree
+
+
+class Command(BaseCommand):
+    help = "Mantiene el árbol de hashes de las calificaciones y lo compara contra un CSV u otro ambiente."
+
+    def add_arguments(self, parser):
+        sub = parser.add_subparsers(dest='action', required=True)
+
+        refresh = sub.add_parser('refresh', help="Recalcula las hojas que cambiaron")
+        refresh.add_argument('--broker', help="Código de corredor (por defecto: todos)")
+        refresh.add_argument('--full', action='store_true', help="Recalcula todas las hojas")
+        refresh.add_argument('--interval', type=int, help="Repite cada N segundos")
+
+        compare = sub.add_parser('diff', help="Compara la BD local contra otro lado")
+        compare.add_argument('--broker', required=True)
+        other = compare.add_mutually_exclusive_group(required=True)
+        other.add_argument('--file', help="CSV del corredor (mismo formato que la carga web)")
+        other.add_argument('--remote', help="URL del endpoint de reconciliación del otro ambiente")
+        other.add_argument('--using', help="Alias de BD configurado en settings.DATABASES")
+        compare.add_argument('--token', help="Token de API del corredor en el ambiente remoto")
+        compare.add_argument('--limit', type=int, help="Corta al encontrar N diferencias")
+        compare.add_argument('--out', help="Escribe todas las diferencias en este CSV")
+
+    def handle(self, *args, **options):
+        if options['action'] == 'refresh':
+            self.refresh(options)
+        else:
+            self.diff(options)
+
+    def refresh(self, options):
+        brokers = Broker.objects.order_by('code')
+        if options['broker']:
+            brokers = brokers.filter(code=options['broker'])
+            if not brokers.exists():
+                raise CommandError(f"Corredor inexistente: {options['broker']}")
+
+        while True:
+            for broker in brokers:
+                started = time.perf_counter()
+                leaves = reconciliation.refresh(broker, full=options['full'])
+                if leaves:
+                    tree = ReconciliationTree.objects.get(broker=broker)
+                    self.stdout.write(f"🌳 {broker.code}: {leaves} hojas recalculadas en "
+                                      f"{time.perf_counter() - started:.2f}s ({tree.rows} filas, {tree.digest})")
+            if not options['interval']:
+                break
+            close_old_connections()
+            time.sleep(options['interval'])
+
+    def diff(self, options):
+        started = time.perf_counter()
+        try:
+            local = reconciliation.DatabaseTree(options['broker'])
+        except Broker.DoesNotExist:
+            raise CommandError(f"Corredor inexistente: {options['broker']}")
+
+        if options['file']:
+            with open(options['file'], 'rb') as f:
+                other = reconciliation.FileTree.from_csv(f)
+            if other.rejected:
+                self.stdout.write(f"⚠️ {other.rejected} filas inválidas del archivo no entran en la comparación")
+        elif options['remote']:
+            if not options['token']:
+                raise CommandError("--remote requiere --token")
+            other = reconciliation.RemoteTree(options['remote'], options['token'])
+        else:
+            other = reconciliation.DatabaseTree(options['broker'], using=options['using'])
+
+        result = reconciliation.diff(local, other, limit=options['limit'])
+        elapsed = time.perf_counter() - started
+        if result.matches:
+            self.stdout.write(self.style.SUCCESS(
+                f"✅ {options['broker']}: sin diferencias ({result.nodes_compared} nodos comparados, {elapsed:.2f}s)"))
+            return
+
+        self.stdout.write(f"🔍 {len(result.differences)} diferencias{' (cortado en --limit)' if result.truncated else ''}: "
+                          f"{result.nodes_compared} nodos comparados, {result.leaves_descended} hojas abiertas, "
+                          f"{result.rows_compared} filas comparadas en {elapsed:.2f}s")
+        for kind, year, month, instrument, payment_date in result.differences[:20]:
+            self.stdout.write(f"   {kind:<8} {year}-{month:02d} {instrument} {payment_date}")
+        if options['out']:
+            with open(options['out'], 'w', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f)
+                writer.writerow(['tipo', 'exercise_year', 'mes', 'instrument', 'payment_date'])
+                writer.writerows(result.differences)
+            self.stdout.write(f"📝 Diferencias completas en {options['out']}")
@@ -0,0 +1,61 @@
+"""
+Relay del outbox transaccional (ver api/outbox.py): publica en Kafka los eventos pendientes.
+
+Uso:
+    python manage.py relay_outbox              # proceso permanente (servicio srv-outbox-relay)
+    python manage.py relay_outbox --once       # vacía lo pendiente y termina
+"""
+import os
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from api.outbox import BATCH_SIZE, PRODUCER_CONFIG, PUBLISHED_RETENTION_DAYS, prune_published, relay_batch
+from nuam.transport import Producer
+
+PRUNE_EVERY_SECONDS = 60 * 60
+
+
+class Command(BaseCommand):
+    help = "Publica en Kafka, por lotes comprimidos, los eventos del outbox escritos por el backend."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Publica lo pendiente y termina")
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument('--interval', type=float, default=1.0, help="Espera (s) cuando no hay pendientes")
+        parser.add_argument('--retention-days', type=int, default=PUBLISHED_RETENTION_DAYS)
+
+    def handle(self, *args, **options):
+        servers = os.environ.get('KAFKA_BOOTSTRAP_SERVERS', 'kafka:9092')
+        producer = Producer({'bootstrap.servers': servers, **PRODUCER_CONFIG})
+        self.stdout.write(f"📤 Outbox relay → {servers} (lotes de {options['batch_size']})")
+
+        last_prune = 0.0
+        try:
+            while True:
+                if time.monotonic() - last_prune > PRUNE_EVERY_SECONDS:
+                    pruned = prune_published(options['retention_days'])
+                    if pruned:
+                        self.stdout.write(f"🧹 {pruned} eventos publicados purgados")
+                    last_prune = time.monotonic()
+
+                try:
+                    published, failed = relay_batch(producer, options['batch_size'])
+                except Exception as e:
+                    # BD o Kafka caídos: los eventos siguen pendientes, se reintenta en el próximo ciclo
+                    self.stderr.write(f"🔥 Error en el relay: {e}")
+                    connection.close_if_unusable_or_obsolete()
+                    published, failed = 0, 0
+
+                if published or failed:
+                    self.stdout.write(f"🚀 {published} eventos publicados, {failed} pendientes por error")
+                if published == options['batch_size'] and not failed:
+                    continue  # Hay más cola: siguiente lote sin esperar
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+        except KeyboardInterrupt:
+            self.stdout.write("🛑 Deteniendo relay...")
+        finally:
+            producer.flush(10)
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_alter_taxqualification_source'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessedEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(max_length=64, unique=True, verbose_name='ID Evento')),
+                ('topic', models.CharField(max_length=255, verbose_name='Tópico')),
+                ('partition', models.IntegerField(verbose_name='Partición')),
+                ('offset', models.BigIntegerField(verbose_name='Offset')),
+                ('processed_at', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Procesado el')),
+            ],
+            options={
+                'verbose_name': 'Evento Procesado',
+                'verbose_name_plural': 'Eventos Procesados',
+            },
+        ),
+        migrations.CreateModel(
+            name='ConsumerOffset',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('consumer', models.CharField(max_length=100, verbose_name='Consumidor')),
+                ('topic', models.CharField(max_length=255, verbose_name='Tópico')),
+                ('partition', models.IntegerField(verbose_name='Partición')),
+                ('offset', models.BigIntegerField(verbose_name='Próximo Offset')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Actualizado el')),
+            ],
+            options={
+                'verbose_name': 'Offset de Consumidor',
+                'verbose_name_plural': 'Offsets de Consumidores',
+                'unique_together': {('consumer', 'topic', 'partition')},
+            },
+        ),
+    ]
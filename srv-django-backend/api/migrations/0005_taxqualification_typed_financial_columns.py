@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_processedevent_consumeroffset'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='taxqualification',
+            name='factor_credito',
+            field=models.DecimalField(blank=True, decimal_places=4, editable=False, max_digits=6, null=True, verbose_name='Factor Crédito'),
+        ),
+        migrations.AddField(
+            model_name='taxqualification',
+            name='factor_incremento',
+            field=models.DecimalField(blank=True, decimal_places=4, editable=False, max_digits=6, null=True, verbose_name='Factor Incremento'),
+        ),
+        migrations.AddField(
+            model_name='taxqualification',
+            name='monto_base',
+            field=models.DecimalField(blank=True, decimal_places=2, editable=False, max_digits=18, null=True, verbose_name='Monto Base'),
+        ),
+    ]
@@ -0,0 +1,121 @@
+# Relleno de las columnas tipadas en lotes + índices CONCURRENTLY.
+# atomic = False: cada lote confirma por separado, así nunca se bloquea la tabla completa.
+
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+import re
+
+from django.db import migrations, models, transaction
+
+from api.operations import AddIndexOnline
+
+BATCH_SIZE = 5000
+
+# Copia congelada de api/financial.py (las migraciones no deben depender del código vivo)
+TYPED_COLUMNS = {
+    'monto_base': (('monto_base',), 2, 18),
+    'factor_credito': (('factores', 'credito'), 4, 6),
+    'factor_incremento': (('factores', 'incremento'), 4, 6),
+}
+NUMERIC_RE = r'^\s*-?[0-9]+(\.[0-9]+)?\s*$'
+CURRENCIES = ('CLP', 'COP', 'PEN', 'USD')
+
+
+def _to_decimal(value, places, max_digits):
+    if isinstance(value, bool) or value is None:
+        return None
+    if isinstance(value, str):
+        if not re.match(NUMERIC_RE, value):
+            return None
+        value = value.strip()
+    elif not isinstance(value, (int, float)):
+        return None
+    try:
+        number = Decimal(str(value))
+    except InvalidOperation:
+        return None
+    if not number.is_finite():
+        return None
+    number = number.quantize(Decimal(1).scaleb(-places), rounding=ROUND_HALF_UP)
+    if abs(number) >= Decimal(10) ** (max_digits - places):
+        return None
+    return number
+
+
+def _numeric_sql(path, places, max_digits):
+    parents = ''.join(f"->'{key}'" for key in path[:-1])
+    node = f"financial_data{parents}->'{path[-1]}'"
+    text = f"trim(financial_data{parents}->>'{path[-1]}')"
+    rounded = f"round(({text})::numeric, {places})"
+    return (
+        f"CASE WHEN jsonb_typeof({node}) = 'number' "
+        f"OR (jsonb_typeof({node}) = 'string' AND {text} ~ '{NUMERIC_RE}') "
+        f"THEN CASE WHEN abs({rounded}) < 1e{max_digits - places} THEN {rounded} END END"
+    )
+
+
+def backfill(apps, schema_editor):
+    TaxQualification = apps.get_model('api', 'TaxQualification')
+    connection = schema_editor.connection
+    bounds = TaxQualification.objects.aggregate(low=models.Min('id'), high=models.Max('id'))
+    if bounds['low'] is None:
+        return
+
+    if connection.vendor == 'postgresql':
+        table = TaxQualification._meta.db_table
+        assignments = ', '.join(
+            f"{column} = {_numeric_sql(path, places, digits)}"
+            for column, (path, places, digits) in TYPED_COLUMNS.items()
+        )
+        options = ', '.join(f"'{c}'" for c in CURRENCIES)
+        sql = (
+            f"UPDATE {table} SET {assignments}, "
+            f"currency = CASE WHEN upper(financial_data->>'moneda') IN ({options}) "
+            f"THEN upper(financial_data->>'moneda') ELSE currency END "
+            f"WHERE id >= %s AND id < %s"
+        )
+        for start in range(bounds['low'], bounds['high'] + 1, BATCH_SIZE):
+            with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+                cursor.execute(sql, [start, start + BATCH_SIZE])
+        return
+
+    # Otros motores: misma regla en Python
+    for start in range(bounds['low'], bounds['high'] + 1, BATCH_SIZE):
+        with transaction.atomic(using=connection.alias):
+            rows = list(TaxQualification.objects.filter(id__gte=start, id__lt=start + BATCH_SIZE)
+                        .only('id', 'financial_data', 'currency'))
+            for row in rows:
+                data = row.financial_data if isinstance(row.financial_data, dict) else {}
+                for column, (path, places, digits) in TYPED_COLUMNS.items():
+                    node = data
+                    for key in path:
+                        node = node.get(key) if isinstance(node, dict) else None
+                    setattr(row, column, _to_decimal(node, places, digits))
+                moneda = data.get('moneda')
+                if isinstance(moneda, str) and moneda.upper() in CURRENCIES:
+                    row.currency = moneda.upper()
+            TaxQualification.objects.bulk_update(rows, list(TYPED_COLUMNS) + ['currency'])
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('api', '0005_taxqualification_typed_financial_columns'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+        AddIndexOnline(
+            model_name='taxqualification',
+            index=models.Index(fields=['broker', 'monto_base'], name='taxq_broker_monto_idx'),
+        ),
+        AddIndexOnline(
+            model_name='taxqualification',
+            index=models.Index(fields=['broker', 'factor_credito'], name='taxq_broker_fcredito_idx'),
+        ),
+        AddIndexOnline(
+            model_name='taxqualification',
+            index=models.Index(fields=['broker', 'factor_incremento'], name='taxq_broker_fincr_idx'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Búsqueda de instrumentos con pg_trgm. Índice GIN creado CONCURRENTLY (sin bloquear la tabla).
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import BtreeGinExtension, TrigramExtension
+from django.db import migrations
+
+from api.operations import AddIndexOnline
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('api', '0006_backfill_typed_financial_columns'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        BtreeGinExtension(),
+        AddIndexOnline(
+            model_name='taxqualification',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['broker', 'instrument'], name='taxq_broker_instr_trgm_idx', opclasses=['int8_ops', 'gin_trgm_ops']),
+        ),
+    ]
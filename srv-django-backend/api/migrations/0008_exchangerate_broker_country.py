@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:38
+
+from django.db import migrations, models
+
+from api.operations import AddIndexOnline
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('api', '0007_trigram_instrument_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExchangeRate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('currency', models.CharField(choices=[('CLP', 'CLP - Peso Chileno'), ('COP', 'COP - Peso Colombiano'), ('PEN', 'PEN - Sol Peruano'), ('USD', 'USD - Dólar Estadounidense')], max_length=3, verbose_name='Moneda')),
+                ('date', models.DateField(verbose_name='Fecha')),
+                ('rate_usd', models.DecimalField(decimal_places=10, max_digits=20, verbose_name='Valor en USD')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Actualizado el')),
+            ],
+            options={
+                'verbose_name': 'Tipo de Cambio',
+                'verbose_name_plural': 'Tipos de Cambio',
+                'ordering': ['currency', '-date'],
+            },
+        ),
+        migrations.AddField(
+            model_name='broker',
+            name='country',
+            field=models.CharField(blank=True, choices=[('CL', 'Chile'), ('CO', 'Colombia'), ('PE', 'Perú')], default='', max_length=2, verbose_name='País'),
+        ),
+        AddIndexOnline(
+            model_name='taxqualification',
+            index=models.Index(fields=['broker', 'exercise_year', 'updated_at'], name='taxq_broker_year_upd_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='exchangerate',
+            unique_together={('currency', 'date')},
+        ),
+    ]
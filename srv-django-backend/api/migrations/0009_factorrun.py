@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:39
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_exchangerate_broker_country'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FactorRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('exercise_year', models.IntegerField(verbose_name='Año Ejercicio')),
+                ('started_at', models.DateTimeField(verbose_name='Inicio')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Término')),
+                ('full', models.BooleanField(default=False, verbose_name='Recálculo Completo')),
+                ('selected', models.IntegerField(default=0, verbose_name='Filas Revisadas')),
+                ('updated', models.IntegerField(default=0, verbose_name='Filas Actualizadas')),
+                ('rejected', models.IntegerField(default=0, verbose_name='Fuera de Rango')),
+                ('skipped', models.IntegerField(default=0, verbose_name='Sin Datos')),
+                ('broker', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='factor_runs', to='api.broker', verbose_name='Corredor')),
+            ],
+            options={
+                'verbose_name': 'Recálculo de Factores',
+                'verbose_name_plural': 'Recálculos de Factores',
+                'ordering': ['-started_at'],
+            },
+        ),
+    ]
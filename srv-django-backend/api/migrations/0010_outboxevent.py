@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:44
+
+import api.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_factorrun'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(default=api.models.new_event_id, max_length=64, unique=True, verbose_name='ID Evento')),
+                ('event_type', models.CharField(max_length=50, verbose_name='Tipo de Evento')),
+                ('topic', models.CharField(max_length=255, verbose_name='Tópico')),
+                ('key', models.CharField(blank=True, max_length=255, verbose_name='Clave de Partición')),
+                ('payload', models.JSONField(verbose_name='Contenido')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Creado el')),
+                ('published_at', models.DateTimeField(blank=True, null=True, verbose_name='Publicado el')),
+                ('attempts', models.IntegerField(default=0, verbose_name='Intentos Fallidos')),
+                ('last_error', models.TextField(blank=True, verbose_name='Último Error')),
+            ],
+            options={
+                'verbose_name': 'Evento de Outbox',
+                'verbose_name_plural': 'Eventos de Outbox',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(condition=models.Q(('published_at__isnull', True)), fields=['id'], name='outbox_pending_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:52
+
+from django.db import migrations, models
+
+from api.operations import AddIndexOnline
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('api', '0010_outboxevent'),
+    ]
+
+    operations = [
+        AddIndexOnline(
+            model_name='taxqualification',
+            index=models.Index(fields=['updated_at'], name='taxq_updated_idx'),
+        ),
+        AddIndexOnline(
+            model_name='auditlog',
+            index=models.Index(fields=['timestamp'], name='audit_timestamp_idx'),
+        ),
+    ]
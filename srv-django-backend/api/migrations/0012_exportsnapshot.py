@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:52
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_live_dashboard_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('format', models.CharField(choices=[('xlsx', 'Excel (XLSX)'), ('csv', 'CSV (gzip)'), ('parquet', 'Parquet'), ('arrow', 'Arrow IPC')], max_length=10, verbose_name='Formato')),
+                ('version', models.CharField(max_length=16, verbose_name='Versión de Datos')),
+                ('path', models.CharField(max_length=255, verbose_name='Archivo')),
+                ('size', models.BigIntegerField(default=0, verbose_name='Tamaño (bytes)')),
+                ('data_updated_at', models.DateTimeField(blank=True, null=True, verbose_name='Datos Modificados el')),
+                ('generated_at', models.DateTimeField(verbose_name='Generado el')),
+                ('broker', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='export_snapshots', to='api.broker', verbose_name='Corredor')),
+            ],
+            options={
+                'verbose_name': 'Snapshot de Exportación',
+                'verbose_name_plural': 'Snapshots de Exportación',
+                'ordering': ['broker', 'format'],
+                'unique_together': {('broker', 'format')},
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-19 19:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_exportsnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ApiToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, verbose_name='Nombre Integración')),
+                ('prefix', models.CharField(editable=False, max_length=8, verbose_name='Prefijo')),
+                ('key_hash', models.CharField(editable=False, max_length=64, unique=True, verbose_name='Hash')),
+                ('is_active', models.BooleanField(default=True, verbose_name='Activo')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Creado el')),
+                ('last_used_at', models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Último Uso')),
+                ('broker', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='api_tokens', to='api.broker', verbose_name='Corredor')),
+            ],
+            options={
+                'verbose_name': 'Token de API',
+                'verbose_name_plural': 'Tokens de API',
+                'ordering': ['broker', 'name'],
+            },
+        ),
+    ]
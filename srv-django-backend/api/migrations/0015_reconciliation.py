@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-19 19:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_outboxevent_trace_parent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='taxqualification',
+            name='content_hash',
+            field=models.BigIntegerField(default=0, editable=False, verbose_name='Hash de Contenido'),
+        ),
+        migrations.CreateModel(
+            name='ReconciliationTree',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rows', models.BigIntegerField(default=0, verbose_name='Filas')),
+                ('digest', models.CharField(default='0000000000000000', max_length=16, verbose_name='Resumen')),
+                ('watermark', models.DateTimeField(blank=True, null=True, verbose_name='Cambios Hasta')),
+                ('refreshed_at', models.DateTimeField(blank=True, null=True, verbose_name='Refrescado el')),
+                ('broker', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='reconciliation_tree', to='api.broker', verbose_name='Corredor')),
+            ],
+            options={
+                'verbose_name': 'Árbol de Reconciliación',
+                'verbose_name_plural': 'Árboles de Reconciliación',
+            },
+        ),
+        migrations.CreateModel(
+            name='ReconciliationBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('exercise_year', models.IntegerField(verbose_name='Año Ejercicio')),
+                ('month', models.PositiveSmallIntegerField(verbose_name='Mes de Pago')),
+                ('rows', models.BigIntegerField(default=0, verbose_name='Filas')),
+                ('digest', models.CharField(max_length=16, verbose_name='Resumen')),
+                ('stale', models.BooleanField(default=False, verbose_name='Desactualizada')),
+                ('refreshed_at', models.DateTimeField(auto_now=True, verbose_name='Refrescado el')),
+                ('broker', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reconciliation_buckets', to='api.broker', verbose_name='Corredor')),
+            ],
+            options={
+                'verbose_name': 'Hoja de Reconciliación',
+                'verbose_name_plural': 'Hojas de Reconciliación',
+                'ordering': ['broker', 'exercise_year', 'month'],
+                'unique_together': {('broker', 'exercise_year', 'month')},
+            },
+        ),
+    ]
@@ -0,0 +1,64 @@
+# Relleno de content_hash en lotes (atomic = False: cada lote confirma por separado).
+# Los árboles de reconciliación se construyen después con: manage.py reconcile refresh
+
+import hashlib
+
+from django.db import migrations, models, transaction
+
+BATCH_SIZE = 5000
+
+# Copia congelada de api/financial.py (las migraciones no deben depender del código vivo)
+TYPED_COLUMNS = ('monto_base', 'factor_credito', 'factor_incremento')
+HASH_MASK = (1 << 63) - 1
+
+
+def _content_hash(row):
+    text = '|'.join([
+        row.instrument, row.payment_date.isoformat(), str(row.exercise_year), row.currency,
+        *('' if getattr(row, column) is None else str(getattr(row, column)) for column in TYPED_COLUMNS),
+    ])
+    return int(hashlib.md5(text.encode('utf-8')).hexdigest()[:16], 16) & HASH_MASK
+
+
+def _content_hash_sql():
+    typed = ', '.join(f"coalesce({column}::text, '')" for column in TYPED_COLUMNS)
+    text = f"concat_ws('|', instrument, to_char(payment_date, 'YYYY-MM-DD'), exercise_year::text, currency, {typed})"
+    return f"((('x' || substr(md5({text}), 1, 16))::bit(64)::bigint) & {HASH_MASK})"
+
+
+def backfill(apps, schema_editor):
+    TaxQualification = apps.get_model('api', 'TaxQualification')
+    connection = schema_editor.connection
+    bounds = TaxQualification.objects.aggregate(low=models.Min('id'), high=models.Max('id'))
+    if bounds['low'] is None:
+        return
+
+    if connection.vendor == 'postgresql':
+        sql = (f"UPDATE {TaxQualification._meta.db_table} SET content_hash = {_content_hash_sql()} "
+               f"WHERE id >= %s AND id < %s")
+        for start in range(bounds['low'], bounds['high'] + 1, BATCH_SIZE):
+            with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+                cursor.execute(sql, [start, start + BATCH_SIZE])
+        return
+
+    # Otros motores: misma regla en Python
+    for start in range(bounds['low'], bounds['high'] + 1, BATCH_SIZE):
+        with transaction.atomic(using=connection.alias):
+            rows = list(TaxQualification.objects.filter(id__gte=start, id__lt=start + BATCH_SIZE)
+                        .only('id', 'instrument', 'payment_date', 'exercise_year', 'currency', *TYPED_COLUMNS))
+            for row in rows:
+                row.content_hash = _content_hash(row)
+            TaxQualification.objects.bulk_update(rows, ['content_hash'])
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('api', '0015_reconciliation'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
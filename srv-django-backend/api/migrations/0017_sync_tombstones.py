@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-19 19:51
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+from api.operations import AddIndexOnline
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('api', '0016_backfill_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QualificationTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('instrument', models.CharField(max_length=120, verbose_name='Instrumento / Nemotécnico')),
+                ('payment_date', models.DateField(verbose_name='Fecha de Pago')),
+                ('exercise_year', models.IntegerField(verbose_name='Año Ejercicio')),
+                ('deleted_at', models.DateTimeField(auto_now_add=True, verbose_name='Borrado el')),
+            ],
+            options={
+                'verbose_name': 'Calificación Borrada',
+                'verbose_name_plural': 'Calificaciones Borradas',
+                'ordering': ['-deleted_at'],
+            },
+        ),
+        AddIndexOnline(
+            model_name='taxqualification',
+            index=models.Index(fields=['broker', 'updated_at', 'id'], name='taxq_broker_upd_id_idx'),
+        ),
+        migrations.AddField(
+            model_name='qualificationtombstone',
+            name='broker',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='tombstones', to='api.broker', verbose_name='Corredor'),
+        ),
+        migrations.AddIndex(
+            model_name='qualificationtombstone',
+            index=models.Index(fields=['broker', 'deleted_at', 'id'], name='tomb_broker_del_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='qualificationtombstone',
+            index=models.Index(fields=['deleted_at'], name='tomb_deleted_idx'),
+        ),
+    ]
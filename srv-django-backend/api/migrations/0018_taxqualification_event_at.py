@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 20:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0017_sync_tombstones'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='taxqualification',
+            name='event_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Hora Evento Bolsa'),
+        ),
+    ]
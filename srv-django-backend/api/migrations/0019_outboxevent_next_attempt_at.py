@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 20:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0018_taxqualification_event_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboxevent',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Próximo Intento'),
+        ),
+    ]
@@ -1,10 +1,24 @@
+import hashlib
+import secrets
+import uuid
+
 from django.db import models
 from django.contrib.auth.models import User
+from django.contrib.postgres.indexes import GinIndex
+from .financial import extract_typed_columns, row_content_hash, HASH_FIELDS, TYPED_COLUMNS
 
 class Broker(models.Model):
     """El 'Tenant' o Corredor (Entidad Financiera)."""
+    COUNTRY_CHOICES = [
+        ('CL', 'Chile'),
+        ('CO', 'Colombia'),
+        ('PE', 'Perú'),
+    ]
+
     name = models.CharField(max_length=255, unique=True, verbose_name="Nombre Corredor")
     code = models.CharField(max_length=50, unique=True, verbose_name="Código Bolsa")
+    # Región del holding a la que pertenece (reportes consolidados por país)
+    country = models.CharField(max_length=2, choices=COUNTRY_CHOICES, blank=True, default='', verbose_name="País")
 
     def __str__(self):
         return self.name
@@ -74,9 +88,19 @@ class TaxQualification(models.Model):
         verbose_name="Origen Dato"
     )
 
+    # --- COLUMNAS TIPADAS (espejo indexado de financial_data) ---
+    # Se sincronizan solas en save(); no se editan a mano.
+    monto_base = models.DecimalField(max_digits=18, decimal_places=2, null=True, blank=True, editable=False, verbose_name="Monto Base")
+    factor_credito = models.DecimalField(max_digits=6, decimal_places=4, null=True, blank=True, editable=False, verbose_name="Factor Crédito")
+    factor_incremento = models.DecimalField(max_digits=6, decimal_places=4, null=True, blank=True, editable=False, verbose_name="Factor Incremento")
+    # Huella de los valores de negocio (financial.content_hash): hojas del árbol de reconciliación
+    content_hash = models.BigIntegerField(default=0, editable=False, verbose_name="Hash de Contenido")
+
     # Auditoría interna del registro
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Creado el")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Actualizado el")
+    # Hora de producción del último evento de la bolsa aplicado: un reintento más viejo no lo pisa
+    event_at = models.DateTimeField(null=True, blank=True, editable=False, verbose_name="Hora Evento Bolsa")
 
     class Meta:
         # Evita duplicados: Un broker no puede tener dos registros para el mismo instrumento en la misma fecha
@@ -84,10 +108,115 @@ class TaxQualification(models.Model):
         verbose_name = "Calificación Tributaria"
         verbose_name_plural = "Calificaciones Tributarias"
         ordering = ['-payment_date']
+        # Filtros por rango/orden siempre van acotados al corredor (multi-tenancy)
+        indexes = [
+            models.Index(fields=['broker', 'monto_base'], name='taxq_broker_monto_idx'),
+            models.Index(fields=['broker', 'factor_credito'], name='taxq_broker_fcredito_idx'),
+            models.Index(fields=['broker', 'factor_incremento'], name='taxq_broker_fincr_idx'),
+            # Versión de datos por (corredor, año) para invalidar reportes: count + max(updated_at)
+            models.Index(fields=['broker', 'exercise_year', 'updated_at'], name='taxq_broker_year_upd_idx'),
+            # Cambios recientes de todos los corredores: poller del dashboard en vivo (api/live.py)
+            models.Index(fields=['updated_at'], name='taxq_updated_idx'),
+            # Cambios desde un cursor (updated_at, id) de un corredor: sincronización incremental (api/sync.py)
+            models.Index(fields=['broker', 'updated_at', 'id'], name='taxq_broker_upd_id_idx'),
+            # Búsqueda por similitud (pg_trgm + btree_gin): sirve tanto global (admin) como por corredor
+            GinIndex(fields=['broker', 'instrument'], opclasses=['int8_ops', 'gin_trgm_ops'], name='taxq_broker_instr_trgm_idx'),
+        ]
 
     def __str__(self):
         return f"{self.instrument} ({self.currency}) - {self.exercise_year}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Hoja de reconciliación con la que se leyó: si save() la cambia, la anterior queda desactualizada
+        if 'exercise_year' in field_names and 'payment_date' in field_names:
+            instance._loaded_bucket = (instance.exercise_year, instance.payment_date.month)
+        # Clave de sincronización con la que se leyó: si save() la cambia, los espejos necesitan una lápida
+        if {'broker_id', 'instrument', 'payment_date', 'exercise_year'} <= set(field_names):
+            instance._loaded_key = (instance.broker_id, instance.instrument, instance.payment_date, instance.exercise_year)
+        return instance
+
+    def sync_financial_columns(self):
+        """Copia monto/factores/moneda del JSON a las columnas tipadas y recalcula content_hash."""
+        for field, value in extract_typed_columns(self.financial_data).items():
+            setattr(self, field, value)
+        self.content_hash = row_content_hash(self)
+
+    def save(self, *args, **kwargs):
+        self.sync_financial_columns()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            update_fields = set(update_fields)
+            if 'financial_data' in update_fields:
+                update_fields |= set(TYPED_COLUMNS) | {'currency'}
+            if update_fields & set(HASH_FIELDS):
+                update_fields.add('content_hash')
+            kwargs['update_fields'] = update_fields
+        super().save(*args, **kwargs)
+
+class ExchangeRate(models.Model):
+    """Tipo de cambio diario: valor en USD de 1 unidad de la moneda (USD = 1)."""
+    currency = models.CharField(max_length=3, choices=TaxQualification.CURRENCY_CHOICES, verbose_name="Moneda")
+    date = models.DateField(verbose_name="Fecha")
+    rate_usd = models.DecimalField(max_digits=20, decimal_places=10, verbose_name="Valor en USD")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Actualizado el")
+
+    def __str__(self):
+        return f"{self.currency} {self.date}: {self.rate_usd} USD"
+
+    class Meta:
+        unique_together = ('currency', 'date')
+        verbose_name = "Tipo de Cambio"
+        verbose_name_plural = "Tipos de Cambio"
+        ordering = ['currency', '-date']
+
+class FactorRun(models.Model):
+    """Ejecución del recálculo masivo de factores (resumen + marca de agua para el modo incremental)."""
+    broker = models.ForeignKey(Broker, on_delete=models.CASCADE, related_name='factor_runs', verbose_name="Corredor")
+    exercise_year = models.IntegerField(verbose_name="Año Ejercicio")
+    started_at = models.DateTimeField(verbose_name="Inicio")
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name="Término")
+    full = models.BooleanField(default=False, verbose_name="Recálculo Completo")
+    selected = models.IntegerField(default=0, verbose_name="Filas Revisadas")
+    updated = models.IntegerField(default=0, verbose_name="Filas Actualizadas")
+    rejected = models.IntegerField(default=0, verbose_name="Fuera de Rango")
+    skipped = models.IntegerField(default=0, verbose_name="Sin Datos")
+
+    def __str__(self):
+        return f"{self.broker} {self.exercise_year} @ {self.started_at:%Y-%m-%d %H:%M}"
+
+    class Meta:
+        verbose_name = "Recálculo de Factores"
+        verbose_name_plural = "Recálculos de Factores"
+        ordering = ['-started_at']
+
+class ExportSnapshot(models.Model):
+    """Exportación completa pre-generada de un corredor en un formato (ver api/snapshots.py)."""
+    FORMAT_CHOICES = [
+        ('xlsx', 'Excel (XLSX)'),
+        ('csv', 'CSV (gzip)'),
+        ('parquet', 'Parquet'),
+        ('arrow', 'Arrow IPC'),
+    ]
+
+    broker = models.ForeignKey(Broker, on_delete=models.CASCADE, related_name='export_snapshots', verbose_name="Corredor")
+    format = models.CharField(max_length=10, choices=FORMAT_CHOICES, verbose_name="Formato")
+    version = models.CharField(max_length=16, verbose_name="Versión de Datos")
+    path = models.CharField(max_length=255, verbose_name="Archivo")
+    size = models.BigIntegerField(default=0, verbose_name="Tamaño (bytes)")
+    data_updated_at = models.DateTimeField(null=True, blank=True, verbose_name="Datos Modificados el")
+    generated_at = models.DateTimeField(verbose_name="Generado el")
+
+    def __str__(self):
+        return f"{self.broker} {self.format} ({self.version})"
+
+    class Meta:
+        unique_together = ('broker', 'format')
+        verbose_name = "Snapshot de Exportación"
+        verbose_name_plural = "Snapshots de Exportación"
+        ordering = ['broker', 'format']
+
 class AuditLog(models.Model):
     """El Ojo que Todo lo Ve (Trazabilidad Inmutable)."""
     user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, verbose_name="Operador")
@@ -101,4 +230,184 @@ class AuditLog(models.Model):
     class Meta:
         verbose_name = "Log de Auditoría"
         verbose_name_plural = "Logs de Auditoría"
-        ordering = ['-timestamp']
\ No newline at end of file
+        ordering = ['-timestamp']
+        indexes = [
+            models.Index(fields=['timestamp'], name='audit_timestamp_idx'),
+        ]
+
+# ==============================================================================
+# INGESTA EXACTLY-ONCE (Consumer Kafka)
+# ==============================================================================
+class ConsumerOffset(models.Model):
+    """Offset de Kafka guardado en la MISMA transacción que los datos que produjo."""
+    consumer = models.CharField(max_length=100, verbose_name="Consumidor")
+    topic = models.CharField(max_length=255, verbose_name="Tópico")
+    partition = models.IntegerField(verbose_name="Partición")
+    offset = models.BigIntegerField(verbose_name="Próximo Offset")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Actualizado el")
+
+    def __str__(self):
+        return f"{self.consumer} {self.topic}[{self.partition}] @ {self.offset}"
+
+    class Meta:
+        unique_together = ('consumer', 'topic', 'partition')
+        verbose_name = "Offset de Consumidor"
+        verbose_name_plural = "Offsets de Consumidores"
+
+
+class ProcessedEvent(models.Model):
+    """Clave de idempotencia: un evento re-entregado por Kafka se descarta sin re-aplicarse."""
+    event_id = models.CharField(max_length=64, unique=True, verbose_name="ID Evento")
+    topic = models.CharField(max_length=255, verbose_name="Tópico")
+    partition = models.IntegerField(verbose_name="Partición")
+    offset = models.BigIntegerField(verbose_name="Offset")
+    processed_at = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name="Procesado el")
+
+    def __str__(self):
+        return f"{self.event_id} ({self.topic}[{self.partition}]@{self.offset})"
+
+    class Meta:
+        verbose_name = "Evento Procesado"
+        verbose_name_plural = "Eventos Procesados"
+
+# ==============================================================================
+# OUTBOX TRANSACCIONAL (eventos de dominio hacia Kafka)
+# ==============================================================================
+def new_event_id():
+    return uuid.uuid4().hex
+
+
+class OutboxEvent(models.Model):
+    """Evento escrito en la MISMA transacción que el cambio; el relay lo publica después en Kafka."""
+    event_id = models.CharField(max_length=64, unique=True, default=new_event_id, verbose_name="ID Evento")
+    event_type = models.CharField(max_length=50, verbose_name="Tipo de Evento")
+    topic = models.CharField(max_length=255, verbose_name="Tópico")
+    key = models.CharField(max_length=255, blank=True, verbose_name="Clave de Partición")
+    payload = models.JSONField(verbose_name="Contenido")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Creado el")
+    published_at = models.DateTimeField(null=True, blank=True, verbose_name="Publicado el")
+    attempts = models.IntegerField(default=0, verbose_name="Intentos Fallidos")
+    last_error = models.TextField(blank=True, verbose_name="Último Error")
+    # Tras un fallo el evento espera (backoff exponencial) y no bloquea al resto de la cola
+    next_attempt_at = models.DateTimeField(null=True, blank=True, verbose_name="Próximo Intento")
+    # Contexto de traza de la petición que lo generó (nuam/tracing.py); el relay lo propaga a Kafka
+    trace_parent = models.CharField(max_length=55, blank=True, verbose_name="Traza")
+
+    def __str__(self):
+        return f"{self.event_type} {self.event_id[:12]} ({'publicado' if self.published_at else 'pendiente'})"
+
+    class Meta:
+        verbose_name = "Evento de Outbox"
+        verbose_name_plural = "Eventos de Outbox"
+        ordering = ['-created_at']
+        indexes = [
+            # El relay solo recorre los pendientes: índice parcial pequeño aunque la tabla crezca
+            models.Index(fields=['id'], name='outbox_pending_idx', condition=models.Q(published_at__isnull=True)),
+        ]
+
+# ==============================================================================
+# INTEGRACIONES DE CORREDORES (API de carga masiva)
+# ==============================================================================
+def hash_token(raw):
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class ApiToken(models.Model):
+    """Credencial de una integración: acota la carga al corredor. Solo se guarda el hash."""
+    broker = models.ForeignKey(Broker, on_delete=models.CASCADE, related_name='api_tokens', verbose_name="Corredor")
+    name = models.CharField(max_length=100, verbose_name="Nombre Integración")
+    prefix = models.CharField(max_length=8, editable=False, verbose_name="Prefijo")
+    key_hash = models.CharField(max_length=64, unique=True, editable=False, verbose_name="Hash")
+    is_active = models.BooleanField(default=True, verbose_name="Activo")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Creado el")
+    last_used_at = models.DateTimeField(null=True, blank=True, editable=False, verbose_name="Último Uso")
+
+    def __str__(self):
+        return f"{self.broker} - {self.name} ({self.prefix}…)"
+
+    def set_key(self):
+        """Genera un token nuevo; el valor en claro solo existe en el retorno."""
+        raw = secrets.token_urlsafe(32)
+        self.prefix = raw[:8]
+        self.key_hash = hash_token(raw)
+        return raw
+
+    @classmethod
+    def issue(cls, broker, name):
+        token = cls(broker=broker, name=name)
+        raw = token.set_key()
+        token.save()
+        return token, raw
+
+    @classmethod
+    def authenticate(cls, raw):
+        if not raw:
+            return None
+        return cls.objects.select_related('broker').filter(key_hash=hash_token(raw), is_active=True).first()
+
+    class Meta:
+        verbose_name = "Token de API"
+        verbose_name_plural = "Tokens de API"
+        ordering = ['broker', 'name']
+
+# ==============================================================================
+# RECONCILIACIÓN (árbol de hashes, ver api/reconciliation.py)
+# ==============================================================================
+class ReconciliationTree(models.Model):
+    """Raíz del árbol de un corredor: resumen total y marca de agua del refresco incremental."""
+    broker = models.OneToOneField(Broker, on_delete=models.CASCADE, related_name='reconciliation_tree', verbose_name="Corredor")
+    rows = models.BigIntegerField(default=0, verbose_name="Filas")
+    digest = models.CharField(max_length=16, default='0' * 16, verbose_name="Resumen")
+    watermark = models.DateTimeField(null=True, blank=True, verbose_name="Cambios Hasta")
+    refreshed_at = models.DateTimeField(null=True, blank=True, verbose_name="Refrescado el")
+
+    def __str__(self):
+        return f"{self.broker.code}: {self.rows} filas ({self.digest})"
+
+    class Meta:
+        verbose_name = "Árbol de Reconciliación"
+        verbose_name_plural = "Árboles de Reconciliación"
+
+class ReconciliationBucket(models.Model):
+    """Hoja (corredor, año de ejercicio, mes de pago): cantidad de filas y suma de sus content_hash."""
+    broker = models.ForeignKey(Broker, on_delete=models.CASCADE, related_name='reconciliation_buckets', verbose_name="Corredor")
+    exercise_year = models.IntegerField(verbose_name="Año Ejercicio")
+    month = models.PositiveSmallIntegerField(verbose_name="Mes de Pago")
+    rows = models.BigIntegerField(default=0, verbose_name="Filas")
+    digest = models.CharField(max_length=16, verbose_name="Resumen")
+    # Marcada por borrados o cambios de fecha/año (no se detectan por updated_at): se recalcula en el próximo refresco
+    stale = models.BooleanField(default=False, verbose_name="Desactualizada")
+    refreshed_at = models.DateTimeField(auto_now=True, verbose_name="Refrescado el")
+
+    def __str__(self):
+        return f"{self.broker_id}/{self.exercise_year}-{self.month:02d}: {self.rows} filas"
+
+    class Meta:
+        unique_together = ('broker', 'exercise_year', 'month')
+        verbose_name = "Hoja de Reconciliación"
+        verbose_name_plural = "Hojas de Reconciliación"
+        ordering = ['broker', 'exercise_year', 'month']
+
+# ==============================================================================
+# SINCRONIZACIÓN INCREMENTAL (lápidas de borrados, ver api/sync.py)
+# ==============================================================================
+class QualificationTombstone(models.Model):
+    """Calificación borrada: la sincronización incremental la informa para que el espejo también la borre."""
+    broker = models.ForeignKey(Broker, on_delete=models.CASCADE, related_name='tombstones', verbose_name="Corredor")
+    instrument = models.CharField(max_length=120, verbose_name="Instrumento / Nemotécnico")
+    payment_date = models.DateField(verbose_name="Fecha de Pago")
+    exercise_year = models.IntegerField(verbose_name="Año Ejercicio")
+    deleted_at = models.DateTimeField(auto_now_add=True, verbose_name="Borrado el")
+
+    def __str__(self):
+        return f"{self.instrument} {self.payment_date} (borrada {self.deleted_at:%Y-%m-%d %H:%M})"
+
+    class Meta:
+        verbose_name = "Calificación Borrada"
+        verbose_name_plural = "Calificaciones Borradas"
+        ordering = ['-deleted_at']
+        indexes = [
+            # Recorrido por cursor (deleted_at, id) de la sincronización; también la purga por antigüedad
+            models.Index(fields=['broker', 'deleted_at', 'id'], name='tomb_broker_del_id_idx'),
+            models.Index(fields=['deleted_at'], name='tomb_deleted_idx'),
+        ]
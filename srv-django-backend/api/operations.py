@@ -0,0 +1,24 @@
+"""Operaciones de migración propias (cambios de esquema sin bloquear tablas en producción)."""
+from django.contrib.postgres.indexes import PostgresIndex
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db.migrations.operations import AddIndex
+
+
+class AddIndexOnline(AddIndexConcurrently):
+    """
+    CREATE INDEX CONCURRENTLY en PostgreSQL (no bloquea escrituras); índice normal en
+    otros motores (tests con SQLite), salvo los índices exclusivos de Postgres (GIN, GiST...),
+    que allí se omiten. La migración que lo use debe declarar atomic = False.
+    """
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            return super().database_forwards(app_label, schema_editor, from_state, to_state)
+        if not isinstance(self.index, PostgresIndex):
+            return AddIndex.database_forwards(self, app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor == 'postgresql':
+            return super().database_backwards(app_label, schema_editor, from_state, to_state)
+        if not isinstance(self.index, PostgresIndex):
+            return AddIndex.database_backwards(self, app_label, schema_editor, from_state, to_state)
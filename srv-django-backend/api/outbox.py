@@ -0,0 +1,187 @@
+"""
+Outbox transaccional: eventos de dominio del backend hacia Kafka.
+
+Las vistas (ingreso manual, CSV, admin) y la carga masiva NO publican en Kafka durante la
+petición: escriben un OutboxEvent en la misma transacción que el cambio. Si la transacción
+hace rollback, el evento desaparece con ella; si hace commit, el relay
+(manage.py relay_outbox) lo publicará aunque Kafka esté caído en ese momento.
+
+Entrega at-least-once: cada mensaje lleva el header 'event_id' para deduplicar y el
+header 'origin' = backend para que el consumer de ingesta no lo re-aplique a la BD.
+Un evento que falla se reintenta con backoff exponencial (next_attempt_at): mientras espera,
+los lotes siguientes toman los que vienen detrás, así que uno que falla siempre no frena la
+cola (a cambio, dentro de una misma clave puede publicarse después de eventos posteriores).
+Cada evento guarda el contexto de traza de la petición que lo generó; el relay lo publica
+en el header 'traceparent' como hijo de un span 'outbox.relay' (espera en el outbox).
+"""
+import json
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from nuam import tracing
+
+from .models import OutboxEvent
+
+OUTBOX_TOPIC = 'nuam_events'
+ORIGIN = 'backend'
+BATCH_SIZE = 500
+PUBLISHED_RETENTION_DAYS = 7
+RETRY_BASE_SECONDS = 5
+RETRY_MAX_SECONDS = 5 * 60
+
+# Productor del relay: lotes comprimidos; idempotente para no duplicar en reintentos internos
+PRODUCER_CONFIG = {
+    'enable.idempotence': True,
+    'compression.type': 'lz4',
+    'linger.ms': 50,
+    'batch.num.messages': 10000,
+}
+
+
+def enqueue(event_type, payload, key=''):
+    """Registra un evento; debe llamarse dentro de la transacción que hizo el cambio."""
+    return OutboxEvent.objects.create(event_type=event_type, topic=OUTBOX_TOPIC, key=key, payload=payload,
+                                      trace_parent=tracing.traceparent())
+
+
+def qualification_payload(broker_code, instrument, payment_date, year, currency, monto_base, source):
+    return {
+        'broker_code': broker_code,
+        'instrument': instrument,
+        'date': str(payment_date),
+        'year': year,
+        'currency': currency,
+        'amount': float(monto_base) if monto_base is not None else None,
+        'source': source,
+    }
+
+
+def enqueue_qualification(qualification, created):
+    """Evento por calificación, con el mismo formato que los eventos de la bolsa (broker_code, amount...)."""
+    return enqueue(
+        'qualification.created' if created else 'qualification.updated',
+        qualification_payload(
+            qualification.broker.code, qualification.instrument, qualification.payment_date,
+            qualification.exercise_year, qualification.currency, qualification.monto_base, qualification.source,
+        ),
+        key=qualification.broker.code,
+    )
+
+
+def enqueue_qualification_rows(broker, rows, created, source):
+    """
+    enqueue_qualification para muchas filas ya upserteadas (ver ingest.upsert_rows, que las
+    completa con sus columnas tipadas): un INSERT por lote de eventos, no uno por fila.
+    """
+    trace_parent = tracing.traceparent()
+    return OutboxEvent.objects.bulk_create([
+        OutboxEvent(
+            event_type='qualification.created' if is_new else 'qualification.updated',
+            topic=OUTBOX_TOPIC,
+            key=broker.code,
+            payload=qualification_payload(broker.code, row['instrument'], row['payment_date'], row['exercise_year'],
+                                          row['currency'], row['monto_base'], source),
+            trace_parent=trace_parent,
+        )
+        for row, is_new in zip(rows, created)
+    ], batch_size=BATCH_SIZE)
+
+
+def enqueue_bulk_load(broker_code, rows, created, amount, source):
+    """Un evento resumen por corredor y carga masiva (no uno por fila de un archivo multi-GB)."""
+    return enqueue(
+        'qualification.bulk_loaded',
+        {'broker_code': broker_code, 'rows': rows, 'created': created, 'amount': amount, 'source': source},
+        key=broker_code,
+    )
+
+
+def _headers(event, span=None):
+    headers = [
+        ('event_id', event.event_id.encode()),
+        ('event_type', event.event_type.encode()),
+        ('origin', ORIGIN.encode()),
+    ]
+    return tracing.inject(headers, span) if span else headers
+
+
+def _relay_span(event):
+    """Span desde que se escribió el evento hasta que Kafka confirma su publicación (None si no viene de una traza)."""
+    parent = tracing.parse(event.trace_parent)
+    if parent is None:
+        return None
+    return tracing.Span('outbox.relay', parent=parent, service='relay', start=event.created_at.timestamp(),
+                        event_id=event.event_id, event_type=event.event_type)
+
+
+def retry_delay(attempts):
+    """Espera antes del intento siguiente al fallido número `attempts`."""
+    return timedelta(seconds=min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS))
+
+
+def relay_batch(producer, batch_size=BATCH_SIZE, flush_timeout=30):
+    """
+    Publica un lote de eventos pendientes y marca los confirmados por Kafka.
+    Devuelve (publicados, fallidos). Los fallidos quedan pendientes hasta su next_attempt_at.
+    """
+    with transaction.atomic():
+        # skip_locked: varios relays en paralelo nunca toman el mismo evento
+        events = list(
+            OutboxEvent.objects.select_for_update(skip_locked=True)
+            .filter(Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=timezone.now()), published_at__isnull=True)
+            .order_by('id')[:batch_size]
+        )
+        if not events:
+            return 0, 0
+
+        delivered, failed, spans = [], {}, {}
+
+        def on_delivery(event_id):
+            def callback(err, msg):
+                if err is None:
+                    delivered.append(event_id)
+                else:
+                    failed[event_id] = str(err)
+                    if event_id in spans:
+                        spans[event_id].fail(err)
+                if event_id in spans:
+                    spans.pop(event_id).finish()
+            return callback
+
+        for event in events:
+            span = _relay_span(event)
+            if span:
+                spans[event.id] = span
+            producer.produce(
+                event.topic,
+                json.dumps(event.payload).encode('utf-8'),
+                key=event.key.encode() if event.key else None,
+                headers=_headers(event, span),
+                on_delivery=on_delivery(event.id),
+            )
+        producer.flush(flush_timeout)
+        for event_id, span in spans.items():  # Sin confirmación del broker
+            span.fail('Sin confirmación del broker')
+            span.finish()
+
+        OutboxEvent.objects.filter(id__in=delivered).update(published_at=timezone.now())
+        # Sin confirmación (timeout) también cuenta como fallo: se reintenta tras su backoff
+        confirmed = set(delivered)
+        pending = [e for e in events if e.id not in confirmed]
+        now = timezone.now()
+        for event in pending:
+            event.attempts += 1
+            event.last_error = failed.get(event.id, 'Sin confirmación del broker')[:1000]
+            event.next_attempt_at = now + retry_delay(event.attempts)
+        OutboxEvent.objects.bulk_update(pending, ['attempts', 'last_error', 'next_attempt_at'])
+    return len(delivered), len(pending)
+
+
+def prune_published(days=PUBLISHED_RETENTION_DAYS):
+    """Borra los eventos ya publicados hace más de `days` días."""
+    cutoff = timezone.now() - timedelta(days=days)
+    deleted, _ = OutboxEvent.objects.filter(published_at__lt=cutoff).delete()
+    return deleted
@@ -0,0 +1,298 @@
+"""
+Reconciliación por árbol de hashes (estilo Merkle) de TaxQualification: corredor → año de
+ejercicio → mes de pago → filas.
+
+Cada fila guarda content_hash, la huella de sus valores de negocio (financial.content_hash):
+una calificación que llegó por la bolsa (consumer) y la misma en el CSV del corredor
+coinciden aunque el JSON tenga otra forma. Cada hoja (corredor, año, mes) guarda cuántas
+filas tiene y la suma de sus hashes módulo 2^64; un nodo superior es la suma de sus hijos.
+Suma y no hash encadenado: no depende del orden, la BD la calcula con un SUM y una hoja se
+puede recalcular sola cuando cambian sus filas.
+
+refresh() mantiene las hojas al día de forma incremental: solo recalcula las que tienen
+filas con updated_at posterior a la marca de agua del corredor o quedaron marcadas como
+desactualizadas (borrados y cambios de fecha/año, ver api/signals.py).
+
+diff() compara dos árboles desde la raíz y solo desciende en los subárboles cuyo resumen
+difiere; las filas se leen únicamente en las hojas distintas. Con millones de filas casi
+iguales, el costo depende de lo que difiere y no del total. Árboles disponibles:
+- DatabaseTree: el árbol persistido de un corredor (en 'default' u otro alias de BD).
+- FileTree: un CSV del corredor (mismo formato y validación que la carga web).
+- RemoteTree: otro ambiente, vía GET /api/v1/reconciliation/ con un token de API.
+"""
+import json
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from datetime import timedelta
+from functools import reduce
+from operator import or_
+
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import ExtractMonth
+from django.utils import timezone
+
+from .financial import extract_typed_columns, row_content_hash
+from .models import Broker, ReconciliationBucket, ReconciliationTree, TaxQualification
+from .validation import iter_validated_csv, open_csv_text
+
+DIGEST_MOD = 1 << 64
+LOW_MASK = (1 << 32) - 1
+EMPTY = (0, '0' * 16)
+# Margen de la marca de agua: una transacción larga (carga CSV) confirma filas con un
+# updated_at anterior al refresco; se vuelven a mirar los últimos minutos en cada pasada.
+WATERMARK_LAG = timedelta(minutes=10)
+
+ONLY_A, ONLY_B, DIFFERENT = 'solo_a', 'solo_b', 'distinto'
+
+
+def format_digest(value):
+    return f"{value % DIGEST_MOD:016x}"
+
+
+def combine(summaries):
+    """Resumen de un nodo a partir de los (filas, resumen) de sus hijos."""
+    rows = total = 0
+    for count, digest in summaries:
+        rows += count
+        total += int(digest, 16)
+    return rows, format_digest(total)
+
+
+def bucket_key(exercise_year, payment_date):
+    if isinstance(payment_date, str):
+        payment_date = TaxQualification._meta.get_field('payment_date').to_python(payment_date)
+    return int(exercise_year), payment_date.month
+
+
+# --- HOJAS PERSISTIDAS ---
+def leaf_aggregates(queryset):
+    """{(año, mes): (filas, resumen)} agregado en la BD. El hash se suma en dos mitades de 32 bits
+    para que la suma no desborde un bigint (SQLite falla en vez de envolver)."""
+    result = (
+        queryset.annotate(month=ExtractMonth('payment_date'))
+        .values('exercise_year', 'month')
+        .annotate(count=Count('id'), high=Sum(F('content_hash').bitrightshift(32)),
+                  low=Sum(F('content_hash').bitand(LOW_MASK)))
+        .order_by()
+    )
+    return {
+        (row['exercise_year'], row['month']): (row['count'], format_digest((int(row['high']) << 32) + int(row['low'])))
+        for row in result
+    }
+
+
+def mark_stale(broker_id, year, month):
+    """La hoja se recalcula en el próximo refresco (cambios que updated_at no delata)."""
+    ReconciliationBucket.objects.filter(broker_id=broker_id, exercise_year=year, month=month).update(stale=True)
+
+
+def refresh(broker, full=False):
+    """Recalcula las hojas que cambiaron desde el último refresco (todas con full). Devuelve cuántas."""
+    tree, _ = ReconciliationTree.objects.get_or_create(broker=broker)
+    rows = TaxQualification.objects.filter(broker=broker)
+    with transaction.atomic():
+        # Un refresco a la vez por corredor (varios procesos pueden llamarlo)
+        tree = ReconciliationTree.objects.select_for_update().get(pk=tree.pk)
+        started = timezone.now()
+        buckets = ReconciliationBucket.objects.filter(broker=broker)
+
+        if full or tree.watermark is None:
+            fresh = leaf_aggregates(rows)
+            buckets.delete()
+            targets = set(fresh)
+        else:
+            targets = set(
+                rows.filter(updated_at__gte=tree.watermark).annotate(month=ExtractMonth('payment_date'))
+                .values_list('exercise_year', 'month').distinct().order_by()
+            )
+            targets |= set(buckets.filter(stale=True).values_list('exercise_year', 'month'))
+            fresh = {}
+            if targets:
+                months = defaultdict(list)
+                for year, month in targets:
+                    months[year].append(month)
+                scope = reduce(or_, (Q(exercise_year=year, payment_date__month__in=values)
+                                     for year, values in months.items()))
+                fresh = leaf_aggregates(rows.filter(scope))
+                buckets.filter(reduce(or_, (Q(exercise_year=year, month__in=values)
+                                            for year, values in months.items()))).delete()
+
+        ReconciliationBucket.objects.bulk_create([
+            ReconciliationBucket(broker=broker, exercise_year=year, month=month, rows=count, digest=digest)
+            for (year, month), (count, digest) in fresh.items()
+        ], batch_size=1000)
+
+        if targets or tree.refreshed_at is None:
+            tree.rows, tree.digest = combine(buckets.values_list('rows', 'digest'))
+        tree.watermark = started - WATERMARK_LAG
+        tree.refreshed_at = timezone.now()
+        tree.save()
+    return len(targets)
+
+
+# --- ÁRBOLES ---
+class DatabaseTree:
+    """
+    Árbol persistido de un corredor; en 'default' se refresca antes de compararlo. Otro alias
+    (p. ej. una copia restaurada) se lee tal como está: se refresca en su propio ambiente.
+    """
+
+    def __init__(self, broker, using=None, refresh_first=True):
+        self.using = using or 'default'
+        # Corredor o su código (en otro alias el id puede ser distinto)
+        self.broker = broker if isinstance(broker, Broker) else Broker.objects.using(self.using).get(code=broker)
+        if refresh_first and self.using == 'default':
+            refresh(self.broker)
+        self._leaves = None
+
+    def leaves(self):
+        if self._leaves is None:
+            self._leaves = {
+                (year, month): (count, digest)
+                for year, month, count, digest in ReconciliationBucket.objects.using(self.using)
+                .filter(broker=self.broker).values_list('exercise_year', 'month', 'rows', 'digest')
+            }
+        return self._leaves
+
+    def children(self, path):
+        return children_of(self.leaves(), path)
+
+    def rows(self, path):
+        year, month = path
+        return {
+            (instrument, payment_date.isoformat()): value
+            for instrument, payment_date, value in TaxQualification.objects.using(self.using)
+            .filter(broker=self.broker, exercise_year=year, payment_date__month=month)
+            .values_list('instrument', 'payment_date', 'content_hash')
+        }
+
+
+class FileTree:
+    """Árbol de un CSV de calificaciones (en memoria). Las filas inválidas no entran al árbol."""
+
+    def __init__(self, rows=()):
+        self._rows = defaultdict(dict)
+        self.rejected = 0
+        for row in rows:
+            self.add(row)
+
+    def add(self, row):
+        row = {**row, **extract_typed_columns(row.get('financial_data'))}
+        key = bucket_key(row['exercise_year'], row['payment_date'])
+        self._rows[key][(row['instrument'], str(row['payment_date']))] = row_content_hash(row)
+
+    @classmethod
+    def from_csv(cls, binary):
+        text, _ = open_csv_text(binary)
+        tree = cls()
+        for rows, errors, _ in iter_validated_csv(text):
+            for row in rows:
+                tree.add(row)
+            tree.rejected += len({line for line, *_ in errors})
+        return tree
+
+    def leaves(self):
+        return {key: (len(rows), format_digest(sum(rows.values()))) for key, rows in self._rows.items()}
+
+    def children(self, path):
+        return children_of(self.leaves(), path)
+
+    def rows(self, path):
+        return self._rows.get(tuple(path), {})
+
+
+class RemoteTree:
+    """Árbol de otro ambiente, leído nodo a nodo desde su endpoint de reconciliación."""
+
+    def __init__(self, url, token, timeout=60):
+        self.url, self.token, self.timeout = url, token, timeout
+
+    def _get(self, path):
+        query = urllib.parse.urlencode(dict(zip(('year', 'month'), path)))
+        request = urllib.request.Request(f"{self.url}?{query}" if query else self.url,
+                                         headers={'Authorization': f"Bearer {self.token}"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.load(response)
+
+    def children(self, path):
+        return {int(key): tuple(value) for key, value in self._get(path)['children'].items()}
+
+    def rows(self, path):
+        return {(instrument, payment_date): value for instrument, payment_date, value in self._get(path)['rows']}
+
+
+def children_of(leaves, path):
+    """{clave: (filas, resumen)} de los hijos de `path` (() = años, (año,) = meses)."""
+    if path:
+        return {month: summary for (year, month), summary in leaves.items() if year == path[0]}
+    by_year = defaultdict(list)
+    for (year, _), summary in leaves.items():
+        by_year[year].append(summary)
+    return {year: combine(summaries) for year, summaries in by_year.items()}
+
+
+def node_payload(tree, path):
+    """Respuesta JSON del endpoint para un nodo: sus hijos, o las filas si es una hoja."""
+    if len(path) == 2:
+        return {'rows': sorted([instrument, payment_date, value]
+                               for (instrument, payment_date), value in tree.rows(path).items())}
+    children = tree.children(path)
+    rows, digest = combine(children.values())
+    return {'rows_total': rows, 'digest': digest, 'children': {str(key): list(value) for key, value in children.items()}}
+
+
+# --- COMPARACIÓN ---
+class Reconciliation:
+    """Resultado de diff(): diferencias fila a fila y cuánto del árbol hubo que recorrer."""
+
+    def __init__(self):
+        self.differences = []  # (tipo, año, mes, instrumento, fecha de pago)
+        self.nodes_compared = 0
+        self.leaves_descended = 0
+        self.rows_compared = 0
+        self.truncated = False
+
+    @property
+    def matches(self):
+        return not self.differences
+
+
+def diff(a, b, limit=None):
+    """Compara dos árboles descendiendo solo en los nodos distintos; corta en `limit` diferencias."""
+    result = Reconciliation()
+
+    def walk(path):
+        left, right = a.children(path), b.children(path)
+        for key in sorted(set(left) | set(right)):
+            if result.truncated:
+                return
+            result.nodes_compared += 1
+            if left.get(key, EMPTY) == right.get(key, EMPTY):
+                continue
+            child = (*path, key)
+            if len(child) < 2:
+                walk(child)
+            else:
+                compare_leaf(child, a.rows(child) if key in left else {}, b.rows(child) if key in right else {})
+
+    def compare_leaf(path, left, right):
+        result.leaves_descended += 1
+        result.rows_compared += len(left.keys() | right.keys())
+        for key in sorted(left.keys() | right.keys()):
+            if key not in right:
+                kind = ONLY_A
+            elif key not in left:
+                kind = ONLY_B
+            elif left[key] != right[key]:
+                kind = DIFFERENT
+            else:
+                continue
+            result.differences.append((kind, *path, *key))
+            if limit is not None and len(result.differences) >= limit:
+                result.truncated = True
+                return
+
+    walk(())
+    return result
@@ -0,0 +1,182 @@
+"""
+Motor de reportes consolidados multi-moneda (CLP/COP/PEN/USD).
+
+Las calificaciones de un corredor o región se cargan como arreglos columnares (NumPy) y
+monto_base se convierte a la moneda de reporte en una sola pasada vectorizada, usando el
+tipo de cambio vigente a la fecha de pago (as-of: el último tipo <= payment_date).
+
+Las columnas se leen sin pasar por tuplas del ORM: en PostgreSQL con COPY binario (filas de
+ancho fijo que np.frombuffer interpreta de una vez); en otros motores directo del cursor.
+
+Los resultados se cachean por (alcance, año, moneda). La clave incluye la versión de los
+datos (count + max(updated_at)) y de los tipos de cambio: cualquier cambio la invalida,
+venga del ORM, del consumer o de una carga masiva.
+"""
+import hashlib
+import io
+
+import numpy as np
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import Case, Count, FloatField, Func, IntegerField, Max, Value, When
+from django.db.models.functions import Cast
+
+from .models import ExchangeRate, TaxQualification
+
+CURRENCIES = np.array(sorted(code for code, _ in TaxQualification.CURRENCY_CHOICES))  # CLP, COP, PEN, USD
+CACHE_TIMEOUT = 60 * 60
+EMPTY_DATES = np.array([], dtype='datetime64[D]')
+
+# COPY ... (FORMAT binary) de (float8, int4, int4): cabecera de 19 bytes, filas de 30 bytes
+# (n° de campos int16 + largo int32 antes de cada valor, big-endian) y un int16 -1 al final
+COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+COPY_ROW = np.dtype([('fields', '>i2'), ('_l1', '>i4'), ('amount', '>f8'), ('_l2', '>i4'), ('code', '>i4'),
+                     ('_l3', '>i4'), ('days', '>i4')])
+CURSOR_ROW = np.dtype([('amount', np.float64), ('code', np.int8), ('days', np.int64)])
+
+
+def scope_queryset(scope, year):
+    """scope = ('broker', broker_id) | ('region', 'CL'|'CO'|'PE'|'ALL')."""
+    kind, value = scope
+    queryset = TaxQualification.objects.filter(exercise_year=year)
+    if kind == 'broker':
+        return queryset.filter(broker_id=value)
+    if kind == 'region':
+        return queryset if value == 'ALL' else queryset.filter(broker__country=value)
+    raise ValueError(f"Alcance desconocido: {kind}")
+
+
+def _version(queryset, field):
+    stats = queryset.order_by().aggregate(n=Count('id'), last=Max(field))
+    return f"{stats['n']}:{stats['last']}"
+
+
+class EpochDays(Func):
+    """Días desde 1970-01-01: la fecha llega como entero listo para datetime64[D]."""
+    template = "(%(expressions)s - DATE '1970-01-01')"
+    output_field = IntegerField()
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return self.as_sql(compiler, connection, template="CAST(julianday(%(expressions)s) - 2440587.5 AS INTEGER)",
+                           **extra_context)
+
+
+def columns_sql(queryset):
+    """(sql, params) de (monto float, índice de moneda en CURRENCIES o -1, días desde 1970) por fila."""
+    codes = Case(*[When(currency=str(code), then=Value(i)) for i, code in enumerate(CURRENCIES)],
+                 default=Value(-1), output_field=IntegerField())  # -1: moneda fuera del catálogo
+    return (
+        queryset.filter(monto_base__isnull=False)
+        .order_by()
+        .annotate(amount=Cast('monto_base', FloatField()), code=codes, days=EpochDays('payment_date'))
+        .values_list('amount', 'code', 'days')
+        .query.sql_with_params()
+    )
+
+
+def _copy_rows(connection, sql, params):
+    buffer = io.BytesIO()
+    with connection.cursor() as cursor:
+        query = cursor.mogrify(sql, params).decode()
+        cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT binary)", buffer)
+    data = buffer.getbuffer()
+    if bytes(data[:11]) != COPY_SIGNATURE:
+        raise ValueError("COPY binario con firma inesperada")
+    header = 19 + int.from_bytes(data[15:19], 'big')  # + largo de la extensión de cabecera
+    rows = np.frombuffer(data[header:len(data) - 2], dtype=COPY_ROW)
+    return rows['amount'].astype(np.float64), rows['code'].astype(np.int8), rows['days'].astype(np.int64)
+
+
+def _cursor_rows(connection, sql, params):
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = np.fromiter(cursor, dtype=CURSOR_ROW)
+    return rows['amount'], rows['code'], rows['days']
+
+
+def load_columns(queryset):
+    """(montos float64, índice de moneda int8, fechas datetime64[D]) de las filas con monto_base."""
+    connection = connections[queryset.db]
+    sql, params = columns_sql(queryset)
+    load = _copy_rows if connection.vendor == 'postgresql' else _cursor_rows
+    amounts, codes, days = load(connection, sql, params)
+    return amounts, codes, days.astype('datetime64[D]')
+
+
+def load_rates():
+    """{moneda: (fechas ordenadas datetime64[D], valor en USD float64)} desde ExchangeRate."""
+    rates = {}
+    rows = list(ExchangeRate.objects.order_by('currency', 'date').values_list('currency', 'date', 'rate_usd'))
+    for currency in CURRENCIES:
+        series = [(d, float(r)) for c, d, r in rows if c == currency]
+        if series:
+            dates, values = zip(*series)
+            rates[currency] = (np.array(dates, dtype='datetime64[D]'), np.array(values, dtype=np.float64))
+    return rates
+
+
+def usd_factors(codes, dates, rates):
+    """Valor en USD de 1 unidad de la moneda de cada fila, a su fecha (NaN si no hay tipo previo)."""
+    factors = np.full(len(codes), np.nan)
+    for index, currency in enumerate(CURRENCIES):
+        mask = codes == index
+        if not mask.any():
+            continue
+        if currency == 'USD':
+            factors[mask] = 1.0
+            continue
+        rate_dates, rate_values = rates.get(currency, (EMPTY_DATES, None))
+        if not len(rate_dates):
+            continue
+        pos = np.searchsorted(rate_dates, dates[mask], side='right') - 1
+        factors[mask] = np.where(pos >= 0, rate_values[np.clip(pos, 0, None)], np.nan)
+    return factors
+
+
+def consolidate(amounts, codes, dates, rates, target):
+    """Convierte todos los montos a `target` y agrega por moneda de origen y por mes (vectorizado)."""
+    target_index = int(np.searchsorted(CURRENCIES, target))
+    source = usd_factors(codes, dates, rates)
+    destination = usd_factors(np.full(len(codes), target_index, dtype=np.int8), dates, rates)
+    converted = amounts * source / destination
+    ok = np.isfinite(converted)
+
+    valid_codes = np.where(codes >= 0, codes, len(CURRENCIES))
+    rows_by_currency = np.bincount(valid_codes, minlength=len(CURRENCIES) + 1)
+    original_by_currency = np.bincount(valid_codes, weights=amounts, minlength=len(CURRENCIES) + 1)
+    converted_by_currency = np.bincount(valid_codes[ok], weights=converted[ok], minlength=len(CURRENCIES) + 1)
+    months = dates[ok].astype('datetime64[M]').astype(np.int64) % 12
+    by_month = np.bincount(months, weights=converted[ok], minlength=12)
+
+    return {
+        'currency': target,
+        'total': round(float(converted[ok].sum()), 2),
+        'rows': int(len(amounts)),
+        'unconverted_rows': int((~ok).sum()),
+        'by_currency': {
+            str(currency): {
+                'rows': int(rows_by_currency[i]),
+                'original': round(float(original_by_currency[i]), 2),
+                'converted': round(float(converted_by_currency[i]), 2),
+            }
+            for i, currency in enumerate(CURRENCIES) if rows_by_currency[i]
+        },
+        'by_month': [round(float(v), 2) for v in by_month],
+    }
+
+
+def consolidated_report(scope, year, currency):
+    """Reporte consolidado cacheado; la clave cambia sola si cambian los datos o los tipos de cambio."""
+    if currency not in CURRENCIES:
+        raise ValueError(f"Moneda de reporte no soportada: {currency}")
+    queryset = scope_queryset(scope, year)
+    version = f"{_version(queryset, 'updated_at')}|{_version(ExchangeRate.objects.all(), 'updated_at')}"
+    key = "report:{}:{}:{}:{}:{}".format(
+        scope[0], scope[1], year, currency, hashlib.md5(version.encode()).hexdigest()
+    )
+    result = cache.get(key)
+    if result is None:
+        result = consolidate(*load_columns(queryset), load_rates(), currency)
+        result.update({'scope': f"{scope[0]}:{scope[1]}", 'year': year})
+        cache.set(key, result, CACHE_TIMEOUT)
+    return result
@@ -0,0 +1,119 @@
+"""
+Búsqueda de instrumentos y corredores.
+
+- Instrumentos: similitud trigram (pg_trgm) servida por el índice GIN (broker_id, instrument).
+  Con términos de menos de 3 caracteres, o fuera de PostgreSQL, se usa prefijo/contiene.
+- Corredores: la tabla es pequeña, así que se busca en un índice de prefijos en memoria
+  (sin ir a la BD en cada tecla del autocomplete).
+"""
+import bisect
+import threading
+import time
+
+from django.contrib.postgres.search import TrigramWordSimilarity
+from django.db import connections
+from django.db.models import Case, Count, FloatField, Max, Q, Value, When
+
+SEARCH_LIMIT = 20
+MIN_TRIGRAM_LENGTH = 3
+
+
+def _uses_trigram(queryset, term):
+    return connections[queryset.db].vendor == 'postgresql' and len(term) >= MIN_TRIGRAM_LENGTH
+
+
+def filter_instruments(queryset, term):
+    """Filtra (sin ordenar ni limitar) las calificaciones cuyo instrumento coincide con el término."""
+    if _uses_trigram(queryset, term):
+        return queryset.filter(instrument__trigram_word_similar=term)
+    return queryset.filter(instrument__icontains=term)
+
+
+def search_instruments(queryset, term, limit=SEARCH_LIMIT):
+    """
+    Instrumentos distintos que coinciden con el término, ordenados por relevancia.
+    Devuelve [{'instrument', 'score', 'total'}] con a lo más `limit` elementos.
+    """
+    term = (term or '').strip()
+    if not term:
+        return []
+
+    matches = filter_instruments(queryset, term)
+    if _uses_trigram(queryset, term):
+        rank = TrigramWordSimilarity(term, 'instrument')
+    else:
+        rank = Case(When(instrument__istartswith=term, then=Value(1.0)), default=Value(0.5), output_field=FloatField())
+
+    return list(
+        matches.annotate(rank=rank)
+        .values('instrument')
+        .annotate(score=Max('rank'), total=Count('id'))
+        .order_by('-score', 'instrument')[:limit]
+    )
+
+
+class BrokerPrefixIndex:
+    """
+    Índice de prefijos en memoria sobre código y palabras del nombre de cada corredor.
+    Se invalida con las señales de Broker y, como red de seguridad entre procesos, por TTL.
+    """
+
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = None  # lista ordenada de (token, prioridad, broker_id)
+        self._built_at = 0.0
+
+    def invalidate(self):
+        with self._lock:
+            self._entries = None
+
+    def _build(self):
+        from .models import Broker
+
+        entries = []
+        for broker_id, name, code in Broker.objects.values_list('id', 'name', 'code'):
+            entries.append((code.lower(), 0, broker_id))          # Código: máxima prioridad
+            entries.append((name.lower(), 1, broker_id))          # Nombre completo
+            for word in name.lower().split()[1:]:
+                entries.append((word, 2, broker_id))              # Palabras internas del nombre
+        entries.sort()
+        return entries
+
+    def _get_entries(self):
+        with self._lock:
+            if self._entries is None or time.monotonic() - self._built_at > self.ttl:
+                self._entries = self._build()
+                self._built_at = time.monotonic()
+            return self._entries
+
+    def search(self, term, limit=SEARCH_LIMIT):
+        """IDs de corredores cuyo código o alguna palabra del nombre empieza con el término, por relevancia."""
+        term = (term or '').strip().lower()
+        if not term:
+            return []
+        entries = self._get_entries()
+        start = bisect.bisect_left(entries, (term,))
+        best = {}
+        for token, priority, broker_id in entries[start:]:
+            if not token.startswith(term):
+                break
+            exact = 0 if token == term else 1
+            best[broker_id] = min(best.get(broker_id, (9, 9)), (exact, priority))
+        ranked = sorted(best, key=lambda broker_id: best[broker_id])
+        return ranked[:limit] if limit else ranked
+
+
+broker_index = BrokerPrefixIndex()
+
+
+def filter_qualifications(queryset, term):
+    """Búsqueda del admin: instrumento por similitud O corredor por prefijo (sin JOIN ni icontains)."""
+    term = (term or '').strip()
+    if not term:
+        return queryset
+    matches = filter_instruments(queryset, term)
+    broker_ids = broker_index.search(term, limit=None)
+    if broker_ids:
+        matches = matches | queryset.filter(Q(broker_id__in=broker_ids))
+    return matches
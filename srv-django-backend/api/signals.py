@@ -0,0 +1,52 @@
+"""Señales del módulo api (invalidación de cachés en memoria, etc.)."""
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import Broker, QualificationTombstone, TaxQualification
+from .reconciliation import bucket_key, mark_stale
+from .search import broker_index
+
+
+@receiver([post_save, post_delete], sender=Broker)
+def invalidate_broker_index(sender, **kwargs):
+    broker_index.invalidate()
+
+
+# --- RECONCILIACIÓN: hojas que updated_at no delata (api/reconciliation.py) ---
+@receiver(post_delete, sender=TaxQualification)
+def mark_deleted_bucket_stale(sender, instance, **kwargs):
+    mark_stale(instance.broker_id, *bucket_key(instance.exercise_year, instance.payment_date))
+
+
+@receiver(post_save, sender=TaxQualification)
+def mark_moved_bucket_stale(sender, instance, **kwargs):
+    """Si la fila cambió de año o mes, su hoja anterior también cambió (la nueva la ve updated_at)."""
+    current = bucket_key(instance.exercise_year, instance.payment_date)
+    loaded = getattr(instance, '_loaded_bucket', None)
+    if loaded is not None and loaded != current:
+        mark_stale(instance.broker_id, *loaded)
+    instance._loaded_bucket = current
+
+
+# --- SINCRONIZACIÓN INCREMENTAL: lápidas de borrados y cambios de clave (api/sync.py) ---
+@receiver(post_delete, sender=TaxQualification)
+def record_tombstone(sender, instance, origin=None, **kwargs):
+    """Cada borrado deja una lápida para los espejos, salvo en cascada al borrar el corredor entero."""
+    origin_model = origin.model if isinstance(origin, QuerySet) else type(origin)
+    if origin_model is Broker:
+        return
+    QualificationTombstone.objects.create(broker_id=instance.broker_id, instrument=instance.instrument,
+                                          payment_date=instance.payment_date, exercise_year=instance.exercise_year)
+
+
+@receiver(post_save, sender=TaxQualification)
+def record_moved_key_tombstone(sender, instance, **kwargs):
+    """Si save() cambió corredor, instrumento o fecha de pago, la clave anterior desaparece para los espejos."""
+    payment_date = TaxQualification._meta.get_field('payment_date').to_python(instance.payment_date)
+    loaded = getattr(instance, '_loaded_key', None)
+    if loaded is not None and loaded[:3] != (instance.broker_id, instance.instrument, payment_date):
+        broker_id, instrument, loaded_date, exercise_year = loaded
+        QualificationTombstone.objects.create(broker_id=broker_id, instrument=instrument,
+                                              payment_date=loaded_date, exercise_year=exercise_year)
+    instance._loaded_key = (instance.broker_id, instance.instrument, payment_date, instance.exercise_year)
@@ -0,0 +1,116 @@
+"""
+Snapshots pre-generados de la exportación completa de cada corredor.
+
+Cada snapshot (corredor, formato) guarda la versión de datos con que se generó
+(count + max(updated_at) de las calificaciones del corredor). Mientras la versión no
+cambie, la descarga se sirve desde el archivo ya generado, con ETag / Last-Modified
+para que el navegador reciba un 304 sin volver a bajar nada. Solo se regenera cuando
+cambian los datos del tenant.
+
+La generación corre siempre en la primaria (una réplica atrasada guardaría una versión vieja
+como vigente) y con la fila ExportSnapshot del (corredor, formato) bloqueada: dos descargas
+que encuentran el snapshot desactualizado no generan ni borran archivos en paralelo; la
+segunda espera y sirve lo que dejó la primera.
+
+El almacenamiento es un backend de Storage de Django (settings.EXPORT_SNAPSHOT_STORAGE):
+disco local por defecto, intercambiable por un almacenamiento de objetos.
+"""
+import gzip
+import hashlib
+import tempfile
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.db.models import Count, Max
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from nuam.db_router import use_primary
+
+from . import columnar
+from .models import ExportSnapshot, TaxQualification
+from .resources import TaxQualificationResource
+
+# formato -> (content type, extensión, se guarda gzip)
+FORMATS = {
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'xlsx', False),
+    'csv': ('text/csv; charset=utf-8', 'csv', True),  # Texto plano: se guarda y se transfiere comprimido
+    'parquet': (columnar.FORMATS['parquet'][0], columnar.FORMATS['parquet'][1], False),
+    'arrow': (columnar.FORMATS['arrow'][0], columnar.FORMATS['arrow'][1], False),
+}
+
+
+def snapshot_storage():
+    config = settings.EXPORT_SNAPSHOT_STORAGE
+    return import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+
+
+def available_formats():
+    return [fmt for fmt in FORMATS if fmt not in columnar.FORMATS or columnar.available()]
+
+
+def data_version(broker):
+    """(versión, última modificación) de los datos del corredor."""
+    stats = (TaxQualification.objects.filter(broker=broker).order_by()
+             .aggregate(n=Count('id'), last=Max('updated_at')))
+    version = hashlib.sha1(f"{stats['n']}:{stats['last']}".encode()).hexdigest()[:16]
+    return version, stats['last']
+
+
+def _write(fmt, queryset, out):
+    if fmt in columnar.FORMATS:
+        for chunk in columnar.stream_export(queryset, fmt):
+            out.write(chunk)
+        return
+    dataset = TaxQualificationResource().export(queryset=queryset)
+    out.write(dataset.xlsx if fmt == 'xlsx' else dataset.csv.encode('utf-8'))
+
+
+def generate(broker, fmt):
+    """(snapshot vigente, regenerado) del corredor en ese formato; solo genera si cambió la versión."""
+    storage = snapshot_storage()
+    with use_primary(), transaction.atomic():
+        # Lock por (corredor, formato); la primera vez la fila se crea vacía dentro de esta transacción
+        snapshot, _ = ExportSnapshot.objects.select_for_update().get_or_create(
+            broker=broker, format=fmt, defaults={'version': '', 'path': '', 'generated_at': timezone.now()},
+        )
+        version, last_modified = data_version(broker)
+        if snapshot.version == version and storage.exists(snapshot.path):
+            return snapshot, False
+
+        _, extension, gzipped = FORMATS[fmt]
+        name = f"{broker.code}/{fmt}-{version}.{extension}{'.gz' if gzipped else ''}"
+        queryset = TaxQualification.objects.filter(broker=broker)
+
+        # Se escribe a un temporal y recién completo se sube al storage (nunca un archivo a medias)
+        with tempfile.TemporaryFile() as tmp:
+            if gzipped:
+                with gzip.GzipFile(fileobj=tmp, mode='wb', mtime=0) as gz:
+                    _write(fmt, queryset, gz)
+            else:
+                _write(fmt, queryset, tmp)
+            size = tmp.tell()
+            tmp.seek(0)
+            if storage.exists(name):  # Resto de una generación interrumpida (con el lock nadie más lo usa)
+                storage.delete(name)
+            saved_name = storage.save(name, File(tmp))
+
+        previous = snapshot.path
+        snapshot.version, snapshot.path, snapshot.size = version, saved_name, size
+        snapshot.data_updated_at, snapshot.generated_at = last_modified, timezone.now()
+        snapshot.save()
+        if previous and previous != saved_name:
+            # Recién confirmado el cambio: si la transacción falla, la fila sigue apuntando al anterior
+            transaction.on_commit(lambda: storage.delete(previous) if storage.exists(previous) else None)
+    return snapshot, True
+
+
+def open_snapshot(snapshot, accept_gzip):
+    """(archivo, Content-Encoding) listo para servir; si el cliente no acepta gzip se descomprime al vuelo."""
+    handle = snapshot_storage().open(snapshot.path, 'rb')
+    if not FORMATS[snapshot.format][2]:
+        return handle, None
+    if accept_gzip:
+        return handle, 'gzip'
+    return gzip.GzipFile(fileobj=handle, mode='rb'), None
@@ -0,0 +1,186 @@
+"""
+Sincronización incremental para espejos de corredores (GET /api/v1/sync/).
+
+En vez de descargar la exportación completa cada vez, el espejo pide "lo que cambió desde
+mi último sync_token". La respuesta es NDJSON en streaming:
+    {"op": "delete", "instrument": "BCH", "payment_date": "2025-05-30", "deleted_at": "..."}
+    {"op": "upsert", "instrument": "BCH", "payment_date": "2025-05-30", "exercise_year": 2025,
+     "currency": "CLP", "financial_data": {...}, "updated_at": "..."}
+    {"checkpoint": "<token>"}                  # tras cada bloque: permite retomar si se corta
+    {"done": true, "upserts": 1, "deletes": 1, "has_more": false, "sync_token": "<token>", ...}
+Las filas "upsert" tienen el mismo formato que la ingesta NDJSON (api/ingest.py). Sin token
+se entrega todo el corredor (espejo nuevo).
+
+Filas y lápidas (QualificationTombstone, registradas al borrar o al cambiar la clave de una
+fila desde el ORM, p. ej. en el admin, ver api/signals.py) se
+recorren por cursor (updated_at, id) / (deleted_at, id) con el índice (corredor, fecha, id):
+el costo depende de lo que cambió, no del total del corredor. Una lápida cuya clave volvió
+a existir se omite (la fila viaja como upsert), así que el orden de aplicación no importa.
+
+El token es opaco (firmado con SECRET_KEY, ligado al corredor) y guarda la posición de
+ambos cursores. Una transacción larga (carga CSV) confirma filas con un updated_at anterior
+a la sincronización: al completar una pasada el cursor retrocede SYNC_LAG, por lo que los
+últimos minutos se reenvían en la siguiente (el upsert es idempotente). El mismo margen
+cubre el atraso de la réplica de lectura, de la que lee la vista. Un token más viejo que la
+retención de lápidas ya no sirve (410): el espejo debe sincronizar desde cero.
+"""
+import json
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.core import signing
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from nuam import tracing
+
+from .models import QualificationTombstone, TaxQualification
+
+CHUNK_SIZE = 2000
+# Duración máxima esperada de una transacción de escritura (mismo margen que la reconciliación)
+SYNC_LAG = timedelta(minutes=10)
+TOMBSTONE_RETENTION_DAYS = 30
+TOKEN_SALT = 'api.sync'
+START = (datetime(1970, 1, 1, tzinfo=dt_timezone.utc), 0)
+
+ROW_FIELDS = ('updated_at', 'id', 'instrument', 'payment_date', 'exercise_year', 'currency', 'financial_data')
+TOMBSTONE_FIELDS = ('deleted_at', 'id', 'instrument', 'payment_date')
+
+
+class InvalidSyncToken(ValueError):
+    """El sync_token no es válido (alterado, de otro corredor o mal formado)."""
+
+
+class ExpiredSyncToken(InvalidSyncToken):
+    """El sync_token es anterior a la retención de lápidas: hay borrados que ya no se pueden informar."""
+
+
+# --- TOKEN ---
+class SyncCursor:
+    """Posición (fecha, id) de cada recorrido; `floor` solo en tokens de una pasada incompleta."""
+
+    def __init__(self, rows, deletes, floor=None):
+        self.rows, self.deletes, self.floor = rows, deletes, floor
+
+    def dumps(self, broker):
+        payload = {'b': broker.id, 'u': [self.rows[0].isoformat(), self.rows[1]],
+                   'd': [self.deletes[0].isoformat(), self.deletes[1]]}
+        if self.floor is not None:
+            payload['f'] = self.floor.isoformat()
+        return signing.dumps(payload, salt=TOKEN_SALT, compress=True)
+
+    @classmethod
+    def loads(cls, token, broker):
+        try:
+            payload = signing.loads(token, salt=TOKEN_SALT)
+        except signing.BadSignature:
+            raise InvalidSyncToken("sync_token inválido")
+        if payload.get('b') != broker.id:
+            raise InvalidSyncToken("El sync_token no corresponde al corredor del token de API")
+        try:
+            cursor = cls(
+                rows=(datetime.fromisoformat(payload['u'][0]), int(payload['u'][1])),
+                deletes=(datetime.fromisoformat(payload['d'][0]), int(payload['d'][1])),
+                floor=datetime.fromisoformat(payload['f']) if 'f' in payload else None,
+            )
+        except (KeyError, IndexError, TypeError, ValueError):
+            raise InvalidSyncToken("sync_token mal formado")
+        if cursor.deletes[0] < timezone.now() - timedelta(days=TOMBSTONE_RETENTION_DAYS):
+            raise ExpiredSyncToken(f"sync_token anterior a {TOMBSTONE_RETENTION_DAYS} días: sincronice desde cero")
+        return cursor
+
+
+# --- RECORRIDO POR CURSOR ---
+def _after(field, stamp, pk):
+    return Q(**{f'{field}__gt': stamp}) | Q(**{field: stamp, 'id__gt': pk})
+
+
+def keyset_chunks(queryset, field, after, until, fields, chunk_size, limit=None):
+    """Bloques de `fields` (empiezan por field e id) con (field, id) > after y field <= until, en orden."""
+    stamp, pk = after
+    queryset = queryset.filter(**{f'{field}__lte': until}).order_by(field, 'id')
+    remaining = float('inf') if limit is None else limit
+    while remaining > 0:
+        size = min(chunk_size, remaining)
+        with tracing.span('sync.db_read', table=queryset.model._meta.db_table):
+            chunk = list(
+                queryset.filter(_after(field, stamp, pk))
+                .values_list(*fields)[:size]
+            )
+        if not chunk:
+            return
+        yield chunk
+        if len(chunk) < size:
+            return
+        remaining -= len(chunk)
+        stamp, pk = chunk[-1][0], chunk[-1][1]
+
+
+def changed_rows(broker):
+    return TaxQualification.objects.filter(broker=broker)
+
+
+def pending_tombstones(broker):
+    """Lápidas del corredor cuya clave no volvió a existir."""
+    alive = TaxQualification.objects.filter(broker_id=OuterRef('broker_id'), instrument=OuterRef('instrument'),
+                                            payment_date=OuterRef('payment_date'))
+    return QualificationTombstone.objects.filter(broker=broker).exclude(Exists(alive))
+
+
+def _line(data):
+    return json.dumps(data, ensure_ascii=False) + '\n'
+
+
+def sync_stream(broker, cursor=None, limit=None, chunk_size=CHUNK_SIZE):
+    """Genera la respuesta NDJSON: borrados, filas cambiadas, checkpoints y el resumen final."""
+    started = timezone.now()
+    floor = started - SYNC_LAG
+    if cursor is None:
+        # Espejo nuevo: todas las filas; de los borrados solo importan los que ocurran desde ahora
+        cursor = SyncCursor(rows=START, deletes=(floor, 0))
+    # Pasada en curso (token de checkpoint): el retroceso final es al inicio de la primera parte
+    session_floor = min(cursor.floor, floor) if cursor.floor is not None else floor
+    position = SyncCursor(cursor.rows, cursor.deletes, session_floor)
+    counts = {'upserts': 0, 'deletes': 0}
+    remaining = float('inf') if limit is None else limit
+    clock = time.perf_counter()
+
+    for chunk in keyset_chunks(pending_tombstones(broker), 'deleted_at', cursor.deletes, started,
+                               TOMBSTONE_FIELDS, chunk_size, remaining):
+        for deleted_at, _, instrument, payment_date in chunk:
+            yield _line({'op': 'delete', 'instrument': instrument, 'payment_date': payment_date.isoformat(),
+                         'deleted_at': deleted_at.isoformat()})
+        counts['deletes'] += len(chunk)
+        remaining -= len(chunk)
+        position.deletes = chunk[-1][:2]
+        yield _line({'checkpoint': position.dumps(broker)})
+
+    for chunk in keyset_chunks(changed_rows(broker), 'updated_at', cursor.rows, started,
+                               ROW_FIELDS, chunk_size, remaining):
+        for updated_at, _, instrument, payment_date, exercise_year, currency, financial_data in chunk:
+            yield _line({'op': 'upsert', 'instrument': instrument, 'payment_date': payment_date.isoformat(),
+                         'exercise_year': exercise_year, 'currency': currency, 'financial_data': financial_data,
+                         'updated_at': updated_at.isoformat()})
+        counts['upserts'] += len(chunk)
+        remaining -= len(chunk)
+        position.rows = chunk[-1][:2]
+        yield _line({'checkpoint': position.dumps(broker)})
+
+    # Con el límite justo agotado: ¿queda algo tras la posición? (la fila limit + 1)
+    has_more = remaining <= 0 and (
+        pending_tombstones(broker).filter(_after('deleted_at', *position.deletes), deleted_at__lte=started).exists()
+        or changed_rows(broker).filter(_after('updated_at', *position.rows), updated_at__lte=started).exists()
+    )
+    if not has_more:
+        # Pasada completa: todo lo anterior a session_floor ya fue entregado
+        position = SyncCursor(rows=(session_floor, 0), deletes=(session_floor, 0))
+    elapsed = time.perf_counter() - clock
+    yield _line({'done': True, **counts, 'has_more': has_more, 'sync_token': position.dumps(broker),
+                 'seconds': round(elapsed, 3)})
+
+
+def prune_tombstones(days=TOMBSTONE_RETENTION_DAYS):
+    """Borra las lápidas de más de `days` días (los tokens que las necesitaban ya expiraron)."""
+    cutoff = timezone.now() - timedelta(days=days)
+    deleted, _ = QualificationTombstone.objects.filter(deleted_at__lt=cutoff).delete()
+    return deleted
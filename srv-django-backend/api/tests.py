@@ -1,7 +1,46 @@
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase, AsyncRequestFactory, RequestFactory, override_settings
+from django.http import HttpResponse
+from django.db import OperationalError, connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.management import CommandError, call_command
+from django.utils import timezone
 from django.contrib.auth.models import User
-from .models import Broker, UserProfile, TaxQualification
+from .models import AuditLog, Broker, UserProfile, TaxQualification, ExchangeRate, OutboxEvent
+from .management.commands import bulk_load
+from .views import apply_range_filters, live_events_view
+from .search import broker_index
+from .reporting import consolidated_report
+from .factors import recalculate_factors
+from .forms import ManualEntryForm
+from .outbox import relay_batch
+from .validation import detect_encoding, parse_json_objects, validate_csv
+from .live import LiveHub, Scope
+from .models import (ExportSnapshot, ApiToken, ConsumerOffset, FactorRun, ProcessedEvent, QualificationTombstone,
+                     ReconciliationBucket, ReconciliationTree)
+from .ingest import ingest_stream, upsert_rows
+from . import columnar, outbox, reconciliation, reporting, sync
+from unittest import mock, skipUnless
+import io
+from django.core.files.uploadedfile import SimpleUploadedFile
+from nuam.db_router import PIN_COOKIE, PrimaryReplicaRouter, ReplicaRoutingMiddleware, use_replica
+from nuam import profiling, tracing, transport
+from django.urls import reverse
+from decimal import Decimal
+import asyncio
+import time
+import csv
 import datetime
+import gzip
+import json
+import os
+import shutil
+import smtplib
+import struct
+import sys
+import tempfile
+import threading
 
 class MultiTenancyTestCase(TestCase):
     def setUp(self):
@@ -33,4 +72,1631 @@ class MultiTenancyTestCase(TestCase):
         
         self.assertIn(self.tax_a, queryset)
         self.assertNotIn(self.tax_b, queryset)
-        print("✅ SEGREGACIÓN CONFIRMADA")
\ No newline at end of file
+        print("✅ SEGREGACIÓN CONFIRMADA")
+
+class BulkLoadParsingTestCase(TestCase):
+    """Parseo por rangos del comando bulk_load (no requiere PostgreSQL)."""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.workdir, 'anual.csv')
+        lines = ['instrument,payment_date,exercise_year,financial_data,broker_code']
+        for i in range(200):
+            lines.append(f'INST{i},2025-01-{(i % 28) + 1:02d},2025,"{{""monto_base"": {i}}}",BRA')
+        lines.append('MALO,2025-13-01,2025,{},BRA')       # Fecha inválida
+        lines.append('OTRO,2025-01-01,2025,{},NOEXISTE')  # Corredor desconocido
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def test_ranges_cover_every_line_once(self):
+        with open(self.path, 'rb') as f:
+            header = f.readline()
+        ranges = bulk_load.split_ranges(self.path, len(header), 512)
+        self.assertGreater(len(ranges), 1)
+
+        loaded = rejected = 0
+        for n, (start, end) in enumerate(ranges):
+            _, copy_path, _, ok, bad = bulk_load.parse_chunk(
+                self.path, 'test', n, start, end,
+                ['instrument', 'payment_date', 'exercise_year', 'financial_data', 'broker_code'],
+                {'BRA': 1}, None, 'utf-8', self.workdir,
+            )
+            loaded += ok
+            rejected += bad
+        self.assertEqual(loaded, 200)
+        self.assertEqual(rejected, 2)
+
+    def test_quoted_newlines_stay_inside_their_record(self):
+        lines = ['instrument,payment_date,exercise_year,financial_data,broker_code']
+        for i in range(120):
+            lines.append(f'MULTI{i},2025-02-01,2025,"{{""nota"": ""linea 1\\nlinea 2"",\n ""monto_base"": {i}}}",BRA')
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        with open(self.path, 'rb') as f:
+            header = f.readline()
+        ranges = bulk_load.split_ranges(self.path, len(header), 300, block_size=64)
+        self.assertGreater(len(ranges), 10)
+
+        rows = []
+        for n, (start, end) in enumerate(ranges):
+            _, copy_path, _, ok, bad = bulk_load.parse_chunk(
+                self.path, 'test', n, start, end,
+                ['instrument', 'payment_date', 'exercise_year', 'financial_data', 'broker_code'],
+                {'BRA': 1}, None, 'utf-8', self.workdir,
+            )
+            self.assertEqual(bad, 0)
+            with open(copy_path, encoding='utf-8') as f:
+                rows += list(csv.reader(f))
+        self.assertEqual(len(rows), 120)
+        self.assertEqual(json.loads(rows[7][-1]), {'nota': 'linea 1\nlinea 2', 'monto_base': 7})
+
+
+class TypedFinancialColumnsTestCase(TestCase):
+    """Las columnas Decimal se mantienen sincronizadas con financial_data."""
+
+    def setUp(self):
+        self.broker = Broker.objects.create(name="Broker Gamma", code="BRG")
+
+    def test_save_extracts_decimals_from_json(self):
+        tax = TaxQualification.objects.create(
+            broker=self.broker, instrument="COPEC", payment_date=datetime.date(2025, 5, 10),
+            exercise_year=2025,
+            financial_data={"moneda": "USD", "monto_base": 1250.505, "factores": {"credito": 0.12345, "incremento": "0.5"}},
+        )
+        tax.refresh_from_db()
+        self.assertEqual(tax.monto_base, Decimal('1250.51'))
+        self.assertEqual(tax.factor_credito, Decimal('0.1235'))
+        self.assertEqual(tax.factor_incremento, Decimal('0.5000'))
+        self.assertEqual(tax.currency, 'USD')
+
+        tax.financial_data = {"monto_base": "no-numerico"}
+        tax.save(update_fields=['financial_data'])
+        tax.refresh_from_db()
+        self.assertIsNone(tax.monto_base)
+        self.assertIsNone(tax.factor_credito)
+
+    def test_range_filters_use_typed_columns(self):
+        for i, monto in enumerate([100, 5000, 90000]):
+            TaxQualification.objects.create(
+                broker=self.broker, instrument=f"INST{i}", payment_date=datetime.date(2025, 1, i + 1),
+                exercise_year=2023 + i, financial_data={"monto_base": monto},
+            )
+        qs = apply_range_filters(TaxQualification.objects.all(), {'monto_min': '1000', 'monto_max': '50000'})
+        self.assertEqual(list(qs.values_list('instrument', flat=True)), ['INST1'])
+        qs = apply_range_filters(TaxQualification.objects.all(), {'year_min': '2024', 'year_max': 'x'})
+        self.assertEqual(sorted(qs.values_list('instrument', flat=True)), ['INST1', 'INST2'])
+        qs = apply_range_filters(TaxQualification.objects.all(), {'year_max': '2024', 'monto_max': '1000'})
+        self.assertEqual(list(qs.values_list('instrument', flat=True)), ['INST0'])
+
+
+class SearchTestCase(TestCase):
+    """Búsqueda de instrumentos (acotada al corredor) y de corredores (índice en memoria)."""
+
+    def setUp(self):
+        self.broker_a = Broker.objects.create(name="Larrain Vial", code="LV")
+        self.broker_b = Broker.objects.create(name="Banchile Corredores", code="BCH")
+        self.user_a = User.objects.create_user(username="lv_user", password="password123")
+        UserProfile.objects.create(user=self.user_a, broker=self.broker_a)
+        for i, name in enumerate(["FALABELLA", "FALABELLA", "CENCOSUD"]):
+            TaxQualification.objects.create(broker=self.broker_a, instrument=name,
+                                            payment_date=datetime.date(2025, 1, i + 1), exercise_year=2025)
+        TaxQualification.objects.create(broker=self.broker_b, instrument="FALP",
+                                        payment_date=datetime.date(2025, 1, 1), exercise_year=2025)
+
+    def test_instrument_search_is_tenant_scoped_and_distinct(self):
+        self.client.force_login(self.user_a)
+        response = self.client.get(reverse('search_instruments'), {'q': 'fal'})
+        results = response.json()['results']
+        self.assertEqual([r['instrument'] for r in results], ['FALABELLA'])
+        self.assertEqual(results[0]['total'], 2)
+
+    def test_broker_prefix_index_ranks_code_first(self):
+        self.assertEqual(broker_index.search('lv'), [self.broker_a.id])
+        self.assertEqual(broker_index.search('corr'), [self.broker_b.id])
+        Broker.objects.create(name="Corredora Nueva", code="CN")  # La señal invalida el índice
+        self.assertEqual(len(broker_index.search('corr')), 2)
+
+
+class ConsolidatedReportTestCase(TestCase):
+    """Conversión vectorizada a moneda de reporte con tipo de cambio as-of."""
+
+    def setUp(self):
+        self.broker = Broker.objects.create(name="Broker Delta", code="BRD", country="CL")
+        self.admin = User.objects.create_superuser('admin_rep', 'admin@nuam.cl', 'admin')
+        ExchangeRate.objects.create(currency='CLP', date=datetime.date(2025, 1, 1), rate_usd=Decimal('0.001'))
+        ExchangeRate.objects.create(currency='CLP', date=datetime.date(2025, 6, 1), rate_usd=Decimal('0.002'))
+        ExchangeRate.objects.create(currency='PEN', date=datetime.date(2025, 1, 1), rate_usd=Decimal('0.25'))
+        rows = [
+            ('A', datetime.date(2025, 3, 1), 'CLP', 100000),   # 100 USD (tipo de enero)
+            ('B', datetime.date(2025, 7, 1), 'CLP', 100000),   # 200 USD (tipo de junio)
+            ('C', datetime.date(2025, 7, 1), 'USD', 50),       # 50 USD
+            ('D', datetime.date(2025, 7, 1), 'COP', 1000),     # Sin tipo COP: no convertible
+        ]
+        for instrument, day, currency, monto in rows:
+            TaxQualification.objects.create(broker=self.broker, instrument=instrument, payment_date=day,
+                                            exercise_year=2025, currency=currency,
+                                            financial_data={"monto_base": monto})
+
+    def test_report_converts_with_as_of_rates(self):
+        report = consolidated_report(('broker', self.broker.id), 2025, 'USD')
+        self.assertEqual(report['total'], 350.0)
+        self.assertEqual(report['unconverted_rows'], 1)
+        self.assertEqual(report['by_month'][2], 100.0)
+        self.assertEqual(report['by_currency']['CLP']['converted'], 300.0)
+
+        # Reporte en PEN: 350 USD / 0.25
+        self.assertEqual(consolidated_report(('region', 'CL'), 2025, 'PEN')['total'], 1400.0)
+
+    def test_cache_is_invalidated_by_new_rates(self):
+        self.assertEqual(consolidated_report(('broker', self.broker.id), 2025, 'USD')['unconverted_rows'], 1)
+        ExchangeRate.objects.create(currency='COP', date=datetime.date(2025, 1, 1), rate_usd=Decimal('0.0002'))
+        report = consolidated_report(('broker', self.broker.id), 2025, 'USD')
+        self.assertEqual(report['unconverted_rows'], 0)
+        self.assertEqual(report['total'], 350.2)
+
+    def test_binary_copy_is_decoded_in_one_pass(self):
+        # Lo que PostgreSQL entrega para COPY (SELECT float8, int4, int4) TO STDOUT (FORMAT binary)
+        payload = reporting.COPY_SIGNATURE + struct.pack('>ii', 0, 0)
+        for amount, code, days in [(1.5, 0, 20089), (2.25, -1, 20270)]:
+            payload += struct.pack('>hidiiii', 3, 8, amount, 4, code, 4, days)
+        payload += struct.pack('>h', -1)
+        cursor = mock.MagicMock()
+        cursor.__enter__.return_value.mogrify.return_value = b'SELECT 1'
+        cursor.__enter__.return_value.copy_expert.side_effect = lambda sql, buffer: buffer.write(payload)
+        amounts, codes, days = reporting._copy_rows(mock.Mock(cursor=lambda: cursor), 'SELECT 1', ())
+        self.assertEqual(amounts.tolist(), [1.5, 2.25])
+        self.assertEqual(codes.tolist(), [0, -1])
+        self.assertEqual(days.astype('datetime64[D]').tolist(), [datetime.date(2025, 1, 1), datetime.date(2025, 7, 1)])
+
+    def test_view_requires_known_currency(self):
+        self.client.force_login(self.admin)
+        response = self.client.get(reverse('consolidated_report'), {'currency': 'EUR', 'year': 2025})
+        self.assertEqual(response.status_code, 400)
+
+
+class FactorRecalculationTestCase(TestCase):
+    """Recálculo masivo: vectorizado, límites [0, 1] y modo incremental."""
+
+    def setUp(self):
+        self.broker = Broker.objects.create(name="Broker Epsilon", code="BRE")
+        User.objects.create_superuser('admin_fx', 'admin@nuam.cl', 'admin')
+
+    def _create(self, instrument, monto, credito, incremento=None):
+        montos = {'credito': credito}
+        if incremento is not None:
+            montos['incremento'] = incremento
+        return TaxQualification.objects.create(
+            broker=self.broker, instrument=instrument, payment_date=datetime.date(2025, 4, 1),
+            exercise_year=2025, financial_data={'monto_base': monto, 'montos': montos, 'factores': {}},
+        )
+
+    def test_full_then_incremental_run(self):
+        ok = self._create('OK', 1000, 250, 100)
+        over = self._create('FUERA', 1000, 1500)
+        self._create('SIN_DATOS', 1000, None)
+
+        run = recalculate_factors(self.broker, 2025, chunk_size=2)
+        self.assertEqual((run.selected, run.updated, run.rejected, run.skipped), (3, 1, 1, 1))
+        ok.refresh_from_db()
+        self.assertEqual(ok.factor_credito, Decimal('0.2500'))
+        self.assertEqual(ok.factor_incremento, Decimal('0.1000'))
+        self.assertEqual(ok.financial_data['factores'], {'credito': 0.25, 'incremento': 0.1})
+        self.assertIsNone(TaxQualification.objects.get(id=over.id).factor_credito)
+
+        # Incremental: solo lo modificado desde la corrida anterior
+        over.financial_data = {'monto_base': 1000, 'montos': {'credito': 500}}
+        over.save()
+        run = recalculate_factors(self.broker, 2025)
+        self.assertFalse(run.full)
+        self.assertEqual((run.selected, run.updated), (2, 1))  # 'OK' fue reescrita por la corrida previa pero no cambia
+        self.assertEqual(TaxQualification.objects.get(id=over.id).factor_credito, Decimal('0.5000'))
+
+    def test_manual_form_uses_same_bounds(self):
+        form = ManualEntryForm(data={
+            'instrument': 'X', 'payment_date': '2025-01-01', 'exercise_year': 2025, 'source': 'MANUAL',
+            'currency': 'CLP', 'monto_base': '1000', 'factor_credito': '0.5', 'factor_incremento': '-0.1',
+        })
+        self.assertFalse(form.is_valid())
+        self.assertIn('factor_incremento', form.errors)
+
+
+@override_settings(DATABASE_REPLICA='replica', REPLICA_PIN_SECONDS=5)
+class ReplicaRoutingTestCase(SimpleTestCase):
+    """Lecturas GET a la réplica, escrituras y sesiones recién escritas a la primaria."""
+    databases = {'default'}  # Sin transacción envolvente: la de cada test debe ser "real"
+
+    def setUp(self):
+        self.router = PrimaryReplicaRouter()
+        self.factory = RequestFactory()
+
+    def _route(self, request):
+        seen = {}
+
+        def view(req):
+            seen['read'] = self.router.db_for_read(TaxQualification)
+            seen['write'] = self.router.db_for_write(TaxQualification)
+            return HttpResponse('ok')
+
+        response = ReplicaRoutingMiddleware(view)(request)
+        return seen, response
+
+    def test_get_reads_replica_and_post_pins_primary(self):
+        seen, _ = self._route(self.factory.get('/'))
+        self.assertEqual(seen, {'read': 'replica', 'write': 'default'})
+
+        seen, response = self._route(self.factory.post('/entry/manual/'))
+        self.assertIsNone(seen['read'])
+        self.assertIn(PIN_COOKIE, response.cookies)
+
+        # Read-your-writes: el GET siguiente (con la cookie) lee de la primaria
+        request = self.factory.get('/')
+        request.COOKIES[PIN_COOKIE] = response.cookies[PIN_COOKIE].value
+        seen, _ = self._route(request)
+        self.assertIsNone(seen['read'])
+
+    def test_reads_inside_write_transaction_use_primary(self):
+        with use_replica():
+            self.assertEqual(self.router.db_for_read(TaxQualification), 'replica')
+            with transaction.atomic():
+                self.assertEqual(self.router.db_for_read(TaxQualification), 'default')
+
+
+class LocalTransportTestCase(SimpleTestCase):
+    """Stand-in de Kafka (nuam/transport.py): particiones, grupos y offsets sin broker."""
+
+    def setUp(self):
+        self.broker = transport.LocalBroker(transport.MemoryStore(partitions=4))
+
+    def consumer(self, group='g', **config):
+        return transport.LocalConsumer({'group.id': group, 'auto.offset.reset': 'earliest',
+                                        'enable.auto.commit': False, **config}, self.broker)
+
+    def produce(self, count, topic='t'):
+        producer = transport.LocalProducer({}, self.broker)
+        delivered = []
+        for i in range(count):
+            producer.produce(topic, f"v{i}", key=f"BR{i % 3}", headers=[('event_id', f"e{i}")],
+                             on_delivery=lambda err, msg: delivered.append(msg))
+        producer.flush()
+        return delivered
+
+    def drain(self, consumer, timeout=0.05):
+        messages = []
+        while (msg := consumer.poll(timeout)) is not None:
+            messages.append(msg)
+        return messages
+
+    def test_same_key_same_partition_in_order(self):
+        delivered = self.produce(30)
+        self.assertEqual(len(delivered), 30)
+        by_key = {}
+        for msg in delivered:
+            by_key.setdefault(msg.key(), set()).add(msg.partition())
+        self.assertTrue(all(len(partitions) == 1 for partitions in by_key.values()))
+
+        consumer = self.consumer()
+        consumer.subscribe(['t'])
+        messages = self.drain(consumer)
+        self.assertEqual(len(messages), 30)
+        for key in by_key:
+            values = [m.value() for m in messages if m.key() == key]
+            self.assertEqual(values, sorted(values, key=lambda v: int(v[1:])))
+        self.assertEqual(messages[0].headers()[0][0], 'event_id')
+
+    def test_group_members_split_partitions_and_resume_from_commit(self):
+        self.produce(40)
+        first, second = self.consumer(), self.consumer()
+        first.subscribe(['t'])
+        second.subscribe(['t'])
+        seen_first, seen_second = self.drain(first), self.drain(second)
+        self.assertEqual(len(seen_first) + len(seen_second), 40)
+        self.assertFalse({m.partition() for m in seen_first} & {m.partition() for m in seen_second})
+
+        # Solo el primero confirma; al salir el segundo sus particiones se releen desde el inicio
+        first.commit(asynchronous=False)
+        second.close()
+        reread = self.drain(first)
+        self.assertEqual(len(reread), len(seen_second))
+
+        other_group = self.consumer('otro')
+        other_group.subscribe(['t'])
+        self.assertEqual(len(self.drain(other_group)), 40)
+
+    def test_on_assign_and_pause_seek_like_kafka(self):
+        self.produce(8)
+        consumer = self.consumer()
+        consumer.subscribe(['t'], on_assign=lambda c, partitions: c.assign(
+            [transport.LocalTopicPartition(p.topic, p.partition, transport.OFFSET_END) for p in partitions]))
+        self.assertIsNone(consumer.poll(0.05))  # Desde el final: nada que leer
+
+        self.produce(4)
+        msg = consumer.poll(0.05)
+        tp = transport.LocalTopicPartition(msg.topic(), msg.partition(), msg.offset())
+        consumer.pause([tp])
+        consumer.seek(tp)
+        others = self.drain(consumer)
+        self.assertNotIn(msg.partition(), {m.partition() for m in others})
+        consumer.resume([tp])
+        self.assertEqual(self.drain(consumer)[0].offset(), msg.offset())
+
+    def test_file_store_is_shared_between_brokers(self):
+        root = tempfile.mkdtemp(prefix='nuam_transport_test_')
+        self.addCleanup(shutil.rmtree, root)
+        self.broker = transport.LocalBroker(transport.FileStore(root, partitions=2))
+        self.produce(10)
+        consumer = self.consumer()
+        consumer.subscribe(['t'])
+        self.assertEqual(len(self.drain(consumer)), 10)
+        consumer.commit(asynchronous=False)
+
+        # Otro "proceso": mismo directorio, coordinador nuevo; retoma desde lo confirmado
+        self.broker = transport.LocalBroker(transport.FileStore(root))
+        self.produce(5)
+        consumer = self.consumer()
+        consumer.subscribe(['t'])
+        self.assertEqual(len(self.drain(consumer)), 5)
+        self.assertEqual(consumer.get_watermark_offsets(transport.LocalTopicPartition('t', 0))[0], 0)
+
+
+CONSUMER_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'srv-kafka-consumer')
+
+
+@skipUnless(os.path.isdir(CONSUMER_DIR), "srv-kafka-consumer no está junto al backend")
+class ConsumerRoutingTestCase(TestCase):
+    """Exactly-once, reintentos, DLQ y fallos transitorios del consumer sobre el bus en memoria."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        if CONSUMER_DIR not in sys.path:
+            sys.path.insert(0, CONSUMER_DIR)
+        import consumer
+        cls.kafka = consumer
+
+    def setUp(self):
+        self.enterContext(mock.patch.dict(os.environ, {'NUAM_TRANSPORT': 'memory'}))
+        transport.reset_memory()
+        self.addCleanup(transport.reset_memory)
+        # close_if_unusable_or_obsolete() cerraría la conexión dentro de la transacción del test
+        self.enterContext(mock.patch.object(connection, 'close_if_unusable_or_obsolete'))
+        self.broker = Broker.objects.create(name="Bolsa Delta", code="BRD")
+        self.producer = transport.Producer({})
+
+    def event(self, amount, code="BRD", **extra):
+        return {'broker_code': code, 'instrument': 'ACC', 'date': '2025-05-30', 'year': 2025, 'amount': amount, **extra}
+
+    def produce(self, data, topic=None, timestamp=0):
+        self.producer.produce(topic or self.kafka.TOPIC, json.dumps(data), key=data['broker_code'], timestamp=timestamp)
+        self.producer.flush()
+
+    def read(self, topic):
+        reader = transport.Consumer({'group.id': f"test-{topic}", 'auto.offset.reset': 'earliest'})
+        reader.subscribe([topic])
+        messages = []
+        while (msg := reader.poll(0.05)) is not None:
+            messages.append(msg)
+        reader.close()
+        return messages
+
+    def offset(self, partition):
+        return ConsumerOffset.objects.get(consumer=self.kafka.OFFSETS_KEY, topic=self.kafka.TOPIC, partition=partition).offset
+
+    def test_redelivered_event_is_applied_once(self):
+        self.produce(self.event(100, event_id='EV-1'))
+        self.produce(self.event(999, event_id='EV-1'))  # Re-entrega (p. ej. el productor reintentó)
+        first, second = self.read(self.kafka.TOPIC)
+        self.kafka.handle_message(first, self.producer)
+        self.kafka.handle_message(second, self.producer)
+        self.assertEqual(self.offset(first.partition()), second.offset() + 1)  # El duplicado también avanza
+        self.kafka.handle_message(first, self.producer)  # Y un rebalanceo que relee el primero
+
+        qual = TaxQualification.objects.get(broker=self.broker, instrument='ACC')
+        self.assertEqual(qual.financial_data['monto_base'], 100)
+        self.assertEqual(list(ProcessedEvent.objects.values_list('event_id', 'offset')), [('EV-1', first.offset())])
+
+    def test_offset_is_saved_in_the_same_transaction_as_the_data(self):
+        self.produce(self.event(100, event_id='EV-2'))
+        msg, = self.read(self.kafka.TOPIC)
+        with mock.patch.object(self.kafka, 'save_offset', side_effect=OperationalError("conexión perdida")):
+            with self.assertRaises(OperationalError):
+                self.kafka.handle_message(msg, self.producer)
+        # Sin offset no queda nada: ni el dato ni la clave de idempotencia (se re-lee y se aplica completo)
+        self.assertFalse(TaxQualification.objects.exists())
+        self.assertFalse(ProcessedEvent.objects.exists())
+        self.assertFalse(ConsumerOffset.objects.exists())
+
+        self.kafka.handle_message(msg, self.producer)
+        self.assertTrue(TaxQualification.objects.filter(broker=self.broker, instrument='ACC').exists())
+        self.assertTrue(ProcessedEvent.objects.filter(event_id='EV-2').exists())
+        self.assertEqual(self.offset(msg.partition()), msg.offset() + 1)
+
+    def test_assigned_partitions_resume_from_the_offset_in_the_database(self):
+        for i in range(3):
+            self.produce({**self.event(100 + i), 'instrument': f"ACC{i}"})
+        partition = self.read(self.kafka.TOPIC)[0].partition()
+        ConsumerOffset.objects.create(consumer=self.kafka.OFFSETS_KEY, topic=self.kafka.TOPIC, partition=partition, offset=2)
+
+        # Grupo nuevo con auto.offset.reset=earliest: igual retoma desde la BD, no desde el principio
+        fresh = transport.Consumer({'group.id': 'grupo-nuevo', 'auto.offset.reset': 'earliest'})
+        fresh.subscribe([self.kafka.TOPIC], on_assign=self.kafka.restore_offsets)
+        self.addCleanup(fresh.close)
+        msg = fresh.poll(1.0)
+        self.assertEqual((msg.partition(), msg.offset()), (partition, 2))
+        self.assertEqual(json.loads(msg.value())['instrument'], 'ACC2')
+
+    def test_failures_are_routed_and_old_retries_do_not_win(self):
+        self.produce(self.event(100), timestamp=1_000)
+        self.produce(self.event(5, code="NOPE"))
+        with mock.patch.object(self.kafka, 'process_message', side_effect=[ConnectionError("timeout"), mock.DEFAULT],
+                               wraps=self.kafka.process_message):
+            for msg in self.read(self.kafka.TOPIC):
+                self.kafka.handle_message(msg, self.producer)
+
+        retry, = self.read(self.kafka.RETRY_TOPICS[0])
+        self.assertEqual(self.kafka.header_value(retry, 'x-attempt'), '1')
+        self.assertEqual(self.kafka.header_value(retry, 'x-original-timestamp'), '1000')
+        dead, = self.read(self.kafka.DLQ_TOPIC)  # Corredor inexistente: directo a la DLQ
+        self.assertEqual(self.kafka.header_value(dead, 'x-error-type'), 'PermanentError')
+
+        # Un evento más nuevo se aplica antes de que venza el reintento del viejo
+        self.produce(self.event(200), timestamp=2_000)
+        self.kafka.handle_message(self.read(self.kafka.TOPIC)[-1], self.producer)
+        self.kafka.handle_message(retry, self.producer)
+        qual = TaxQualification.objects.get(broker=self.broker, instrument='ACC')
+        self.assertEqual(qual.financial_data['monto_base'], 200)
+
+        # Sin event_id la clave es la posición original: el reintento no se re-aplica como otro evento
+        self.assertEqual(self.kafka.event_key(retry, {}), f"{self.kafka.TOPIC}:{retry.partition()}:0")
+
+    def test_transient_errors_back_off_and_reread_the_offset(self):
+        self.produce(self.event(100))
+        stop = threading.Event()
+        applied = []
+        main = transport.Consumer({'group.id': 'test-main', 'auto.offset.reset': 'earliest'})
+        main.subscribe([self.kafka.TOPIC])
+        down = OperationalError("server closed the connection unexpectedly")
+        with mock.patch.object(self.kafka, 'BACKOFF_SECONDS', 0), \
+                mock.patch.object(self.kafka, 'claim_event', side_effect=[down, down, True]), \
+                mock.patch.object(self.kafka, 'rewind', wraps=self.kafka.rewind) as rewind:
+            self.kafka.consume(main, self.producer, stop, on_applied=lambda msg: (applied.append(msg.offset()), stop.set()))
+
+        self.assertEqual(applied, [0])
+        self.assertEqual([c.args[3] for c in rewind.call_args_list], [1, 2])  # Backoff creciente
+        self.assertTrue(TaxQualification.objects.filter(broker=self.broker, instrument='ACC').exists())
+        self.assertEqual(self.read(self.kafka.RETRY_TOPICS[0]), [])  # La BD caída no es culpa del mensaje
+
+    def test_dlq_replay_republishes_to_the_main_topic(self):
+        self.produce(self.event(100, code="BRN"))
+        msg, = self.read(self.kafka.TOPIC)
+        self.kafka.handle_message(msg, self.producer)
+        self.assertFalse(TaxQualification.objects.exists())
+
+        Broker.objects.create(name="Bolsa Nueva", code="BRN")
+        self.assertEqual(self.kafka.replay_dlq(), 1)
+        self.assertEqual(self.kafka.replay_dlq(), 0)  # El offset del replay quedó en la BD
+        replayed = self.read(self.kafka.TOPIC)[-1]
+        self.assertIsNone(self.kafka.header_value(replayed, 'x-attempt'))
+        self.kafka.handle_message(replayed, self.producer)
+        self.assertTrue(TaxQualification.objects.filter(broker__code="BRN", instrument='ACC').exists())
+
+@skipUnless(os.path.isdir(CONSUMER_DIR), "srv-kafka-consumer no está junto al backend")
+class SimulateBolsaTestCase(SimpleTestCase):
+    """Simulador de la bolsa: relleno del payload, replay de grabaciones y key por corredor."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        if CONSUMER_DIR not in sys.path:
+            sys.path.insert(0, CONSUMER_DIR)
+        import simulate_bolsa
+        cls.sim = simulate_bolsa
+
+    def setUp(self):
+        self.enterContext(mock.patch.dict(os.environ, {'NUAM_TRANSPORT': 'memory'}))
+        transport.reset_memory()
+        self.addCleanup(transport.reset_memory)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.recording = os.path.join(directory, 'rafaga.jsonl')
+        with open(self.recording, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'t': 1.0, 'event': {'event_id': 'orig-0', 'broker_code': 'BRA', 'amount': 1}}) + '\n')
+            f.write('\n')
+            f.write(json.dumps({'event_id': 'orig-2', 'broker_code': 'BRB', 'amount': 2}) + '\n')  # Evento suelto
+
+    def test_encode_pads_to_the_requested_size(self):
+        event = {'event_id': 'e', 'broker_code': 'BRA', 'amount': 10.5}
+        for size in (200, 1024):
+            encoded = self.sim.encode(event, size)
+            self.assertEqual(len(encoded), size)
+            self.assertEqual({k: v for k, v in json.loads(encoded).items() if k != 'padding'}, event)
+        self.assertEqual(self.sim.encode(event, 10), json.dumps(event, separators=(',', ':')).encode())
+
+    def test_replay_scales_time_and_rewrites_event_ids(self):
+        (t0, first), (t1, second) = self.sim.replayed_events(self.recording, speed=2)
+        self.assertEqual((t0, t1), (0.5, 0))
+        prefix = first['event_id'].rsplit('-', 1)[0]
+        self.assertTrue(prefix.startswith('replay-'))
+        self.assertEqual(second['event_id'], f"{prefix}-2")
+        other_run = next(self.sim.replayed_events(self.recording, speed=2))[1]['event_id']
+        self.assertNotEqual(other_run, first['event_id'])  # Cada corrida con IDs nuevos
+
+        self.assertEqual([at for at, _ in self.sim.replayed_events(self.recording, speed=0)], [0, 0])
+        kept = [event['event_id'] for _, event in self.sim.replayed_events(self.recording, 1, keep_event_ids=True)]
+        self.assertEqual(kept, ['orig-0', 'orig-2'])
+
+    def test_events_are_keyed_by_broker_code(self):
+        with mock.patch('sys.stdout', io.StringIO()):
+            self.sim.main(['--replay', self.recording, '--speed', '0'])
+        reader = transport.Consumer({'group.id': 'test-sim', 'auto.offset.reset': 'earliest'})
+        reader.subscribe([self.sim.TOPIC])
+        self.addCleanup(reader.close)
+        sent = []
+        while (msg := reader.poll(0.05)) is not None:
+            sent.append((msg.key(), json.loads(msg.value())['broker_code']))
+        self.assertEqual(sorted(sent), [(b'BRA', 'BRA'), (b'BRB', 'BRB')])
+
+    def test_zero_brokers_is_rejected_by_argparse(self):
+        with mock.patch('sys.stderr', io.StringIO()), self.assertRaises(SystemExit):
+            self.sim.main(['--brokers', '0'])
+
+
+NOTIFIER_DIR = os.path.join(os.path.dirname(CONSUMER_DIR), 'srv-notifier')
+
+
+@skipUnless(os.path.isdir(NOTIFIER_DIR), "srv-notifier no está junto al backend")
+class NotifierTestCase(SimpleTestCase):
+    """Entrega del notifier contra el SMTP local de prueba (benchmark.SMTPSink)."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        if NOTIFIER_DIR not in sys.path:
+            sys.path.insert(0, NOTIFIER_DIR)
+        import benchmark
+        import mailer
+        import main as notifier
+        cls.benchmark, cls.mailer, cls.notifier = benchmark, mailer, notifier
+
+    def setUp(self):
+        self.enterContext(mock.patch.dict(os.environ, {'NUAM_TRANSPORT': 'memory'}))
+        self.enterContext(mock.patch.object(self.mailer, 'FIRST_BACKOFF', 0.01))
+        self.enterContext(mock.patch('sys.stdout', io.StringIO()))
+
+    def with_sink(self, scenario):
+        """Corre scenario(sink, pool) con un SMTPSink local y un pool de una conexión."""
+        async def run():
+            sink = self.benchmark.SMTPSink()
+            server = await asyncio.start_server(sink.handle, '127.0.0.1', 0)
+            pool = self.mailer.SMTPPool('127.0.0.1', server.sockets[0].getsockname()[1], size=1, timeout=5)
+            try:
+                return await scenario(sink, pool)
+            finally:
+                await pool.close()
+                server.close()
+                await server.wait_closed()
+        return asyncio.run(run())
+
+    def test_offsets_are_committed_up_to_the_first_undelivered_message(self):
+        tracker = self.notifier.OffsetTracker()
+        for offset in (10, 11, 12):
+            tracker.start('nuam_events', 0, offset)
+        tracker.start('nuam_events', 1, 4)
+        tracker.done('nuam_events', 0, 11)
+        tracker.done('nuam_events', 0, 12)
+        tracker.done('nuam_events', 1, 4)
+        consumer = mock.Mock()
+        self.notifier.commit(consumer, tracker)
+        committed = {(tp.topic, tp.partition): tp.offset for tp in consumer.commit.call_args.kwargs['offsets']}
+        self.assertEqual(committed, {('nuam_events', 0): 10, ('nuam_events', 1): 5})  # El 10 sigue en vuelo
+
+        consumer.reset_mock()
+        self.notifier.commit(consumer, tracker)
+        consumer.commit.assert_not_called()  # Nada nuevo que confirmar
+        tracker.done('nuam_events', 0, 10)
+        self.assertEqual(tracker.committable(), [('nuam_events', 0, 13)])
+
+    def test_permanent_errors_are_dropped_and_transient_ones_retried(self):
+        async def scenario(sink, pool):
+            stage = self.mailer.DeliveryStage(pool, limiter=self.mailer.RateLimiter(rate=1e9, burst=1e9))
+            sink.script(b"550 Buzon inexistente")
+            dropped = await stage.deliver({'broker_code': 'BR1', 'amount': 1})
+            sink.script(b"451 Intente mas tarde", sink.DISCONNECT)
+            delivered = await stage.deliver({'broker_code': 'BR2', 'amount': 2})
+            return dropped, delivered, stage
+
+        dropped, delivered, stage = self.with_sink(scenario)
+        self.assertEqual((dropped, delivered), (False, True))
+        self.assertEqual((stage.delivered, stage.discarded), (1, 1))
+
+    def test_broken_pooled_connection_is_replaced(self):
+        async def scenario(sink, pool):
+            await pool.send('a@nuam.cl', 'uno@br.cl', b'Subject: 1\r\n\r\nuno\r\n')
+            sink.script(sink.DISCONNECT)
+            with self.assertRaises(smtplib.SMTPServerDisconnected):
+                await pool.send('a@nuam.cl', 'dos@br.cl', b'Subject: 2\r\n\r\ndos\r\n')
+            await pool.send('a@nuam.cl', 'tres@br.cl', b'Subject: 3\r\n\r\ntres\r\n')
+            return sink.received, sink.connections, pool._open_count
+
+        received, connections, open_count = self.with_sink(scenario)
+        self.assertEqual(received, ['uno@br.cl', 'tres@br.cl'])
+        self.assertEqual((connections, open_count), (2, 1))  # Una conexión nueva en lugar de la rota
+
+    def test_rate_limiter_paces_each_broker_separately(self):
+        async def scenario():
+            limiter = self.mailer.RateLimiter(rate=20, burst=2)
+            started = time.monotonic()
+            for _ in range(2):
+                await limiter.acquire('BR1')  # Ráfaga: sin espera
+            burst = time.monotonic() - started
+            await limiter.acquire('BR2')  # Otro corredor no espera al primero
+            other = time.monotonic() - started
+            for _ in range(2):
+                await limiter.acquire('BR1')  # Sin fichas: 1/20 s cada una
+            return burst, other, time.monotonic() - started
+
+        burst, other, paced = asyncio.run(scenario())
+        self.assertLess(burst, 0.03)
+        self.assertLess(other, 0.03)
+        self.assertGreaterEqual(paced, 0.09)
+
+
+class OutboxTestCase(TestCase):
+    """Eventos de dominio escritos junto al dato y publicados por el relay."""
+
+    class FakeProducer:
+        """Productor en memoria: confirma todo salvo las claves en `fail`."""
+
+        def __init__(self, fail=()):
+            self.fail, self.sent, self.pending = set(fail), [], []
+
+        def produce(self, topic, value, key=None, headers=None, on_delivery=None):
+            self.pending.append((topic, value, key, dict(headers), on_delivery))
+
+        def flush(self, timeout=None):
+            for topic, value, key, headers, on_delivery in self.pending:
+                if key in self.fail:
+                    on_delivery('Broker caído', None)
+                else:
+                    self.sent.append((topic, value, key, headers))
+                    on_delivery(None, None)
+            self.pending = []
+            return 0
+
+    def setUp(self):
+        self.broker = Broker.objects.create(name="Broker Zeta", code="BRZ")
+        self.user = User.objects.create_user(username="user_zeta", password="password123")
+        UserProfile.objects.create(user=self.user, broker=self.broker)
+
+    def test_csv_upload_writes_one_event_per_row(self):
+        self.client.force_login(self.user)
+        content = (
+            'instrument,payment_date,exercise_year,financial_data\n'
+            'SQM,2025-03-01,2025,"{""monto_base"": 1500}"\n'
+            'ENEL,2025-03-02,2025,"{}"\n'
+        )
+        self.client.post(reverse('upload_csv'), {'file': SimpleUploadedFile('carga.csv', content.encode())})
+
+        events = list(OutboxEvent.objects.order_by('id'))
+        self.assertEqual([e.event_type for e in events], ['qualification.created'] * 2)
+        self.assertEqual(events[0].payload['amount'], 1500.0)
+        self.assertEqual(events[0].key, 'BRZ')
+        self.assertTrue(all(e.published_at is None for e in events))
+
+    def test_relay_marks_confirmed_and_keeps_failed_pending(self):
+        ok = OutboxEvent.objects.create(event_type='qualification.created', topic='nuam_events', key='BRZ', payload={'a': 1})
+        ko = OutboxEvent.objects.create(event_type='qualification.created', topic='nuam_events', key='BRX', payload={'b': 2})
+
+        producer = self.FakeProducer(fail={b'BRX'})
+        self.assertEqual(relay_batch(producer), (1, 1))
+        self.assertEqual(producer.sent[0][3]['origin'], b'backend')
+        self.assertEqual(producer.sent[0][3]['event_id'], ok.event_id.encode())
+
+        ok.refresh_from_db()
+        ko.refresh_from_db()
+        self.assertIsNotNone(ok.published_at)
+        self.assertIsNone(ko.published_at)
+        self.assertEqual((ko.attempts, ko.last_error), (1, 'Broker caído'))
+        self.assertGreater(ko.next_attempt_at, timezone.now())
+
+        # En backoff no ocupa el lote: los eventos nuevos pasan delante
+        later = OutboxEvent.objects.create(event_type='qualification.created', topic='nuam_events', key='BRZ', payload={'c': 3})
+        producer = self.FakeProducer()
+        self.assertEqual(relay_batch(producer, batch_size=1), (1, 0))
+        self.assertEqual(producer.sent[0][3]['event_id'], later.event_id.encode())
+
+        # Vencida la espera (y con Kafka de vuelta) se publica el pendiente
+        OutboxEvent.objects.filter(pk=ko.pk).update(next_attempt_at=timezone.now())
+        self.assertEqual(relay_batch(self.FakeProducer()), (1, 0))
+        self.assertFalse(OutboxEvent.objects.filter(published_at__isnull=True).exists())
+
+    def test_retry_delay_grows_and_is_capped(self):
+        self.assertEqual([outbox.retry_delay(n).total_seconds() for n in (1, 2, 3)],
+                         [outbox.RETRY_BASE_SECONDS * f for f in (1, 2, 4)])
+        self.assertEqual(outbox.retry_delay(50).total_seconds(), outbox.RETRY_MAX_SECONDS)
+
+
+class TracingTestCase(TestCase):
+    """Contexto de traza: petición web → OutboxEvent → header Kafka del relay."""
+
+    def setUp(self):
+        self.exporter = tracing.configure('memory')
+        self.addCleanup(tracing.configure, '')
+        self.broker = Broker.objects.create(name="Broker Traza", code="BTR")
+        self.user = User.objects.create_user(username="user_traza", password="password123")
+        UserProfile.objects.create(user=self.user, broker=self.broker)
+
+    def test_spans_nest_and_propagate_through_headers(self):
+        with tracing.span('raiz', service='bolsa') as root:
+            headers = tracing.inject([('event_id', b'e1'), ('traceparent', b'viejo')])
+            with self.assertRaises(ValueError), tracing.span('hijo'):
+                raise ValueError("fallo")
+
+        self.assertEqual(dict(headers)['traceparent'], root.traceparent.encode())
+        self.assertEqual(len(headers), 2)
+        self.assertEqual(tracing.extract(headers), (root.trace_id, root.span_id))
+        self.assertIsNone(tracing.extract([('traceparent', b'00-basura')]))
+        self.assertIsNone(tracing.current())
+
+        child, parent = self.exporter.spans
+        self.assertEqual((child['parent_id'], child['service']), (root.span_id, 'bolsa'))
+        self.assertEqual(child['error'], "ValueError: fallo")
+        self.assertIsNone(parent['parent_id'])
+
+    def test_web_request_context_reaches_relayed_message(self):
+        incoming = '00-' + 'a' * 32 + '-' + 'b' * 16 + '-01'
+        self.client.force_login(self.user)
+        self.client.post(reverse('manual_entry'), {
+            'instrument': 'TRZ', 'payment_date': '2025-07-01', 'exercise_year': 2025, 'currency': 'CLP',
+            'source': 'MANUAL', 'monto_base': '1000', 'factor_credito': '0.1', 'factor_incremento': '0.1',
+        }, HTTP_TRACEPARENT=incoming)
+
+        event = OutboxEvent.objects.get()
+        self.assertTrue(event.trace_parent.startswith('00-' + 'a' * 32))
+
+        producer = OutboxTestCase.FakeProducer()
+        self.assertEqual(relay_batch(producer), (1, 0))
+        spans = {data['name']: data for data in self.exporter.spans}
+        request, upsert, relay = spans['http POST manual_entry'], spans['web.db_upsert'], spans['outbox.relay']
+        self.assertEqual(request['parent_id'], 'b' * 16)
+        self.assertEqual(upsert['parent_id'], request['span_id'])
+        self.assertEqual(event.trace_parent, f"00-{'a' * 32}-{upsert['span_id']}-01")
+        self.assertEqual(relay['parent_id'], upsert['span_id'])
+        self.assertEqual(producer.sent[0][3]['traceparent'], f"00-{'a' * 32}-{relay['span_id']}-01".encode())
+
+
+def _busy(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class ProfilingTestCase(TestCase):
+    """Perfilado bajo demanda: muestreo de pilas del worker y cProfile por ruta, en pilas colapsadas."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def test_endpoint_samples_other_threads_for_superusers_only(self):
+        stop = threading.Event()
+        worker = threading.Thread(target=_busy, args=(stop,), name='ocupado', daemon=True)
+        worker.start()
+        self.addCleanup(worker.join)
+        self.addCleanup(stop.set)
+
+        self.client.force_login(User.objects.create_user(username="perf_user", password="password123"))
+        self.assertEqual(self.client.get(reverse('profile'), {'seconds': '0.1'}).status_code, 403)
+        self.client.force_login(User.objects.create_superuser(username="perf_admin", password="password123"))
+        # Worker de un solo hilo (gunicorn sync): solo quedaría el propio hilo, no se bloquea el worker
+        self.assertEqual(self.client.get(reverse('profile'), {'seconds': '0.1'}).status_code, 501)
+        threaded = {'wsgi.multithread': True}
+        self.assertEqual(self.client.get(reverse('profile'), {'seconds': '0'}, **threaded).status_code, 400)
+        self.assertEqual(self.client.get(reverse('profile'), {'seconds': '0.1', 'mode': 'otro'}, **threaded).status_code, 400)
+
+        response = self.client.get(reverse('profile'), {'seconds': '0.5'}, **threaded)
+        stacks = [line.rpartition(' ')[0] for line in response.content.decode().splitlines()]
+        busy = [stack for stack in stacks if stack.startswith('ocupado;')]
+        self.assertTrue(busy)
+        self.assertTrue(all('_busy (api/tests.py:' in stack for stack in busy))
+        self.assertFalse([stack for stack in stacks if 'profile_view' in stack])  # El propio hilo no se muestrea
+
+    def test_middleware_profiles_only_matching_paths(self):
+        def view(request):
+            json.loads(json.dumps(list(range(50_000))))
+            return HttpResponse('ok')
+
+        with mock.patch.dict(os.environ):
+            os.environ.pop('NUAM_PROFILE_PATHS', None)
+            with self.assertRaises(MiddlewareNotUsed):  # Desactivado: ni siquiera entra a la cadena
+                profiling.ProfilingMiddleware(view)
+        with mock.patch.dict(os.environ, {'NUAM_PROFILE_PATHS': '^/perfilada/', 'NUAM_PROFILE_DIR': self.directory}):
+            middleware = profiling.ProfilingMiddleware(view)
+            middleware(RequestFactory().get('/otra/'))
+            self.assertEqual(os.listdir(self.directory), [])
+            middleware(RequestFactory().get('/perfilada/x/'))
+
+        prof, folded = sorted(os.listdir(self.directory), key=lambda name: not name.endswith('.prof'))
+        self.assertTrue(prof.startswith('perfilada_x-') and folded.endswith('.folded'))
+        counts = profiling.load_collapsed(os.path.join(self.directory, folded))
+        self.assertTrue(any('view (api/tests.py:' in stack and 'dumps (json/__init__.py:' in stack for stack in counts))
+        self.assertTrue(profiling.top(counts, 5))
+
+
+class LiveDashboardTestCase(TestCase):
+    """Un poller compartido; cada dashboard recibe solo los cambios de su tenant."""
+
+    def setUp(self):
+        self.broker_a = Broker.objects.create(name="Broker Eta", code="BRH")
+        self.broker_b = Broker.objects.create(name="Broker Theta", code="BRT")
+        self.user_a = User.objects.create_user(username="user_eta", password="password123")
+        UserProfile.objects.create(user=self.user_a, broker=self.broker_a)
+        TaxQualification.objects.create(broker=self.broker_a, instrument="PREVIA",
+                                        payment_date=datetime.date(2025, 1, 1), exercise_year=2025)
+        self.hub = LiveHub(autostart=False)
+        self.hub.poll_once()  # Lo existente no se re-envía
+
+    def test_stream_sends_only_tenant_deltas(self):
+        stream = self.hub.stream(Scope(self.user_a))
+        self.assertTrue(next(stream).startswith('retry:'))
+
+        TaxQualification.objects.create(broker=self.broker_a, instrument="PROPIA",
+                                        payment_date=datetime.date(2025, 2, 1), exercise_year=2025)
+        TaxQualification.objects.create(broker=self.broker_b, instrument="AJENA",
+                                        payment_date=datetime.date(2025, 2, 1), exercise_year=2025)
+        AuditLog.objects.create(user=self.user_a, action='UPLOAD_CSV', details='carga.csv')
+        self.assertEqual(self.hub.poll_once(), 3)
+        self.assertEqual(self.hub.poll_once(), 0)  # La ventana de re-escaneo no duplica
+
+        chunk = next(stream)
+        self.assertIn('event: qualification', chunk)
+        self.assertIn('PROPIA', chunk)
+        self.assertNotIn('AJENA', chunk)
+        self.assertNotIn('PREVIA', chunk)
+        self.assertIn('event: audit', chunk)
+        stream.close()
+
+    def test_burst_resyncs_only_its_broker(self):
+        user_b = User.objects.create_user(username="user_theta", password="password123")
+        UserProfile.objects.create(user=user_b, broker=self.broker_b)
+        TaxQualification.objects.bulk_create([
+            TaxQualification(broker=self.broker_b, instrument=f"MASIVA{i}", payment_date=datetime.date(2025, 3, 1),
+                             exercise_year=2025) for i in range(12)
+        ])
+        for i in range(3):
+            TaxQualification.objects.create(broker=self.broker_a, instrument=f"PROPIA{i}",
+                                            payment_date=datetime.date(2025, 3, 1), exercise_year=2025)
+        with mock.patch('api.live.POLL_BATCH', 3):
+            self.hub.poll_once()
+            self.assertEqual(self.hub.poll_once(), 0)  # La ráfaga no se vuelve a leer
+
+        events, _, _ = self.hub.read(0, 0)
+        def visible(user):
+            scope = Scope(user)
+            return [(kind, payload.get('instrument')) for _, kind, broker_id, user_id, payload in events
+                    if scope.allows(kind, broker_id, user_id)]
+        self.assertEqual(visible(self.user_a), [('qualification', f"PROPIA{i}") for i in range(3)])
+        self.assertEqual(visible(user_b)[-1], ('resync', None))
+        self.assertEqual(len(visible(user_b)), 4)  # POLL_BATCH filas y luego un único resync
+
+    def test_long_transaction_rows_are_published_when_it_commits(self):
+        started = self.hub._floor['qualification'] + datetime.timedelta(milliseconds=1)
+        transactions = [{(7, '900'): started}] * 3 + [{}]
+        with mock.patch.object(self.hub, '_open_transactions', side_effect=transactions):
+            self.hub.poll_once()  # bulk_load abierto desde `started`
+            # Otro tenant escribe y el watermark avanza muy por delante del inicio de la carga
+            TaxQualification.objects.create(broker=self.broker_a, instrument="CONSUMER",
+                                            payment_date=datetime.date(2025, 4, 1), exercise_year=2025)
+            TaxQualification.objects.filter(instrument="CONSUMER").update(
+                updated_at=timezone.now() + datetime.timedelta(minutes=1))
+            self.assertEqual(self.hub.poll_once(), 1)
+            # La carga confirma: sus filas llevan instantes de su inicio, fuera de la ventana LOOKBACK
+            TaxQualification.objects.create(broker=self.broker_b, instrument="CARGADA",
+                                            payment_date=datetime.date(2025, 4, 1), exercise_year=2025)
+            TaxQualification.objects.filter(instrument="CARGADA").update(updated_at=started)
+            self.assertEqual(self.hub.poll_once(), 0)  # Aún en _open: se ve recién al terminar
+            self.assertEqual(self.hub.poll_once(), 1)  # Terminó: re-escaneo desde su inicio, sin duplicar CONSUMER
+
+        events, _, _ = self.hub.read(0, 0)
+        self.assertEqual([payload['instrument'] for _, kind, _, _, payload in events], ["CONSUMER", "CARGADA"])
+
+    def test_async_stream_is_woken_by_the_poller_thread(self):
+        async def scenario():
+            stream = self.hub.astream(Scope(self.user_a))
+            opening = await stream.__anext__()
+            pending = asyncio.ensure_future(stream.__anext__())
+            await asyncio.sleep(0.05)  # Ya esperando en el event loop
+            threading.Thread(target=self.hub._publish,
+                             args=('qualification', self.broker_a.id, None, {'instrument': 'VIVA'})).start()
+            chunk = await asyncio.wait_for(pending, 2)
+            await stream.aclose()
+            return opening, chunk
+
+        opening, chunk = asyncio.run(scenario())
+        self.assertTrue(opening.startswith('retry:'))
+        self.assertIn('VIVA', chunk)
+        self.assertEqual(self.hub._subscribers, 0)
+
+        request = AsyncRequestFactory().get(reverse('live_events'))
+        request.user = self.user_a
+        self.assertTrue(live_events_view(request).is_async)  # ASGI: no retiene un hilo
+
+    def test_reconnect_from_unknown_process_forces_resync(self):
+        stream = self.hub.stream(Scope(self.user_a), last_event_id='otroproceso:42')
+        self.assertIn('event: resync', next(stream))
+        stream.close()
+
+
+SNAPSHOT_DIR = tempfile.mkdtemp(prefix='nuam_snapshots_test_')
+SNAPSHOT_STORAGE = {'BACKEND': 'django.core.files.storage.FileSystemStorage', 'OPTIONS': {'location': SNAPSHOT_DIR}}
+
+
+def tearDownModule():
+    shutil.rmtree(SNAPSHOT_DIR, ignore_errors=True)
+
+
+@skipUnless(columnar.available(), "pyarrow no instalado")
+@override_settings(EXPORT_SNAPSHOT_STORAGE=SNAPSHOT_STORAGE)
+class ColumnarExportTestCase(TestCase):
+    """Export Parquet/Arrow: por corredor, con financial_data aplanado en columnas tipadas."""
+
+    def setUp(self):
+        self.broker = Broker.objects.create(name="Broker Iota", code="BRI")
+        other = Broker.objects.create(name="Broker Kappa", code="BRK")
+        self.user = User.objects.create_user(username="user_iota", password="password123")
+        UserProfile.objects.create(user=self.user, broker=self.broker)
+        for i in range(5):
+            TaxQualification.objects.create(
+                broker=self.broker, instrument=f"IOTA{i}", payment_date=datetime.date(2025, 1, i + 1), exercise_year=2025,
+                financial_data={'monto_base': 1000 + i, 'montos': {'credito': 250}, 'factores': {'credito': 0.25}, 'nota': 'x'},
+            )
+        TaxQualification.objects.create(broker=other, instrument="AJENA", payment_date=datetime.date(2025, 1, 1),
+                                        exercise_year=2025)
+
+    def test_parquet_export_is_typed_and_tenant_scoped(self):
+        import pyarrow.parquet as pq
+
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('export_data'), {'format': 'parquet'})
+        self.assertEqual(response.status_code, 200)
+        table = pq.read_table(io.BytesIO(b''.join(response.streaming_content)))
+
+        self.assertEqual(table.num_rows, 5)
+        self.assertNotIn('AJENA', table.column('instrument').to_pylist())
+        first = table.slice(0, 1).to_pylist()[0]
+        self.assertEqual(first['monto_base'], Decimal('1000.00'))
+        self.assertEqual(first['factor_credito'], Decimal('0.2500'))
+        self.assertEqual(first['monto_credito'], 250.0)
+        self.assertEqual(first['financial_data_otros'], '{"nota": "x"}')
+
+    def test_row_groups_follow_batch_size(self):
+        import pyarrow.parquet as pq
+
+        data = b''.join(columnar.stream_export(TaxQualification.objects.filter(broker=self.broker), 'parquet', row_group_size=2))
+        self.assertEqual(pq.ParquetFile(io.BytesIO(data)).metadata.num_row_groups, 3)
+
+
+@override_settings(EXPORT_SNAPSHOT_STORAGE=SNAPSHOT_STORAGE)
+class ExportSnapshotTestCase(TestCase):
+    """La exportación completa se sirve desde un snapshot versionado con ETag."""
+
+    def setUp(self):
+        self.broker = Broker.objects.create(name="Broker Lambda", code="BRL")
+        self.user = User.objects.create_user(username="user_lambda", password="password123")
+        UserProfile.objects.create(user=self.user, broker=self.broker)
+        TaxQualification.objects.create(broker=self.broker, instrument="LAMBDA", payment_date=datetime.date(2025, 1, 1),
+                                        exercise_year=2025, financial_data={'monto_base': 1000})
+        self.client.force_login(self.user)
+
+    def test_conditional_get_and_regeneration_on_data_change(self):
+        url = reverse('export_data')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        b''.join(response.streaming_content)
+        etag = response['ETag']
+        generated_at = ExportSnapshot.objects.get(broker=self.broker, format='xlsx').generated_at
+
+        # Sin cambios: 304 y el snapshot no se regenera
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        response = self.client.get(url)
+        b''.join(response.streaming_content)
+        self.assertEqual(ExportSnapshot.objects.get(broker=self.broker, format='xlsx').generated_at, generated_at)
+
+        # Cambian los datos del tenant: nueva versión
+        TaxQualification.objects.create(broker=self.broker, instrument="NUEVA", payment_date=datetime.date(2025, 2, 1),
+                                        exercise_year=2025)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        b''.join(response.streaming_content)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_previous_file_is_removed_only_after_commit(self):
+        from . import snapshots
+
+        first, _ = snapshots.generate(self.broker, 'csv')
+        self.assertEqual(snapshots.generate(self.broker, 'csv'), (first, False))
+        TaxQualification.objects.create(broker=self.broker, instrument="NUEVA", payment_date=datetime.date(2025, 2, 1),
+                                        exercise_year=2025)
+        storage = snapshots.snapshot_storage()
+        with self.captureOnCommitCallbacks() as callbacks:
+            second, regenerated = snapshots.generate(self.broker, 'csv')
+        self.assertTrue(regenerated)
+        self.assertTrue(storage.exists(first.path))  # Aún sin confirmar: el archivo anterior sigue
+        for callback in callbacks:
+            callback()
+        self.assertFalse(storage.exists(first.path))
+        self.assertTrue(storage.exists(second.path))
+
+    def test_csv_snapshot_is_transferred_gzipped(self):
+        import gzip
+
+        response = self.client.get(reverse('export_data'), {'format': 'csv'}, HTTP_ACCEPT_ENCODING='gzip, br')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn(b'LAMBDA', gzip.decompress(b''.join(response.streaming_content)))
+
+        plain = self.client.get(reverse('export_data'), {'format': 'csv'})
+        self.assertFalse(plain.has_header('Content-Encoding'))
+        self.assertIn(b'LAMBDA', b''.join(plain.streaming_content))
+
+        # Con filtros el CSV se genera al vuelo (mismo formato que el snapshot)
+        filtered = self.client.get(reverse('export_data'), {'format': 'csv', 'year': '2025'})
+        self.assertEqual(filtered.status_code, 200)
+        self.assertTrue(filtered['Content-Disposition'].endswith('.csv"'))
+        self.assertIn(b'LAMBDA', filtered.content)
+        self.assertNotIn(b'LAMBDA', self.client.get(reverse('export_data'), {'format': 'csv', 'year': '2024'}).content)
+
+
+@override_settings(EXPORT_SNAPSHOT_STORAGE=SNAPSHOT_STORAGE)
+class CSVValidationTestCase(TestCase):
+    """Validación por columnas de la carga CSV: solo las filas válidas llegan a la BD."""
+
+    HEADER = 'instrument,payment_date,exercise_year,currency,financial_data\n'
+    ROWS = (
+        'OK1,2025-03-01,2025,usd,"{""monto_base"": 1500, ""factores"": {""credito"": 0.25}}"\n'  # 2: válida
+        'OK2,2024-02-29,2024,,\n'                                                                  # 3: válida (CLP, {})
+        'SIN_FECHA,,2025,CLP,{}\n'                                                                 # 4
+        'FECHA_MALA,2025-02-30,2025,CLP,{}\n'                                                      # 5
+        'ANIO,2025-03-01,dos mil,CLP,{}\n'                                                         # 6
+        'MONEDA,2025-03-01,2025,EUR,{}\n'                                                          # 7
+        'JSON,2025-03-01,2025,CLP,"{roto"\n'                                                       # 8
+        'FACTOR,2025-03-01,2025,CLP,"{""factores"": {""credito"": 1.5}}"\n'                       # 9
+        'MONTO,2025-03-01,2025,CLP,"{""monto_base"": ""mucho""}"\n'                               # 10
+        'OK1,2025-03-01,2025,CLP,{}\n'                                                             # 11: repetida
+    )
+
+    def setUp(self):
+        self.broker = Broker.objects.create(name="Broker Validación", code="BRV")
+        self.user = User.objects.create_user(username="user_val", password="password123")
+        UserProfile.objects.create(user=self.user, broker=self.broker)
+
+    def test_column_checks_report_every_bad_row(self):
+        rows, errors, total = validate_csv(io.StringIO(self.HEADER + self.ROWS))
+        self.assertEqual(total, 10)
+        self.assertEqual([r['instrument'] for r in rows], ['OK1', 'OK2'])
+        self.assertEqual(rows[0]['payment_date'], datetime.date(2025, 3, 1))
+        self.assertEqual((rows[0]['currency'], rows[1]['currency']), ('USD', 'CLP'))
+        self.assertEqual(rows[1]['financial_data'], {})
+        by_line = {line: column for line, column, _, _ in errors}
+        self.assertEqual(by_line, {
+            4: 'payment_date', 5: 'payment_date', 6: 'exercise_year', 7: 'currency', 8: 'financial_data',
+            9: 'financial_data.factores.credito', 10: 'financial_data.monto_base', 11: 'instrument+payment_date',
+        })
+        self.assertIn("mayor a 1.0", next(e for line, _, _, e in errors if line == 9))
+
+    def test_unicode_digits_in_year_are_rejected_rows(self):
+        content = self.HEADER + 'A,2025-01-01,²,,\nB,2025-01-01,٢٠٢٥,,\nC,2025-01-01,2025,,\n'
+        rows, errors, _ = validate_csv(io.StringIO(content))
+        self.assertEqual([r['instrument'] for r in rows], ['C'])
+        self.assertEqual([(line, column) for line, column, _, _ in errors], [(2, 'exercise_year'), (3, 'exercise_year')])
+
+    def test_duplicates_are_detected_across_chunks(self):
+        content = self.HEADER + 'A,2025-01-01,2025,,\nB,2025-01-01,2025,,\nC,2025-01-01,2025,,\nA,2025-01-01,2025,,\n'
+        rows, errors, _ = validate_csv(io.StringIO(content), chunk_rows=2)
+        self.assertEqual([r['instrument'] for r in rows], ['A', 'B', 'C'])
+        self.assertEqual([(line, column) for line, column, _, _ in errors], [(5, 'instrument+payment_date')])
+
+    def test_upload_persists_only_valid_rows_and_serves_report(self):
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('upload_csv'),
+                                    {'file': SimpleUploadedFile('carga.csv', (self.HEADER + self.ROWS).encode())})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['result']['loaded'], 2)
+        self.assertEqual(response.context['result']['rejected'], 8)
+        self.assertEqual(sorted(TaxQualification.objects.values_list('instrument', flat=True)), ['OK1', 'OK2'])
+        self.assertEqual(TaxQualification.objects.get(instrument='OK1').factor_credito, Decimal('0.2500'))
+
+        report = self.client.get(reverse('upload_csv_report'))
+        self.assertEqual(report.status_code, 200)
+        lines = b''.join(report.streaming_content).decode('utf-8-sig').splitlines()
+        self.assertEqual(lines[0], 'linea,columna,valor,error')
+        self.assertEqual(len(lines), 9)
+
+        # Una carga limpia borra el reporte anterior
+        self.client.post(reverse('upload_csv'),
+                         {'file': SimpleUploadedFile('ok.csv', (self.HEADER + 'OK3,2025-01-01,2025,,\n').encode())})
+        self.assertEqual(self.client.get(reverse('upload_csv_report')).status_code, 404)
+
+    def test_broken_json_cells_do_not_borrow_from_neighbours(self):
+        # Unidas con comas, estas celdas forman un arreglo válido de 3 elementos
+        parsed, invalid = parse_json_objects(['{"a":1},{"b":2}', '{"c":[1', '2]}'])
+        self.assertEqual(parsed, [None, None, None])
+        self.assertTrue(invalid.all())
+        parsed, invalid = parse_json_objects([' {"a": 1} ', '', '[1]', '{"b": 2}'])
+        self.assertEqual(parsed, [{'a': 1}, {}, [1], {'b': 2}])
+        self.assertEqual(invalid.tolist(), [False, False, True, False])
+
+    def test_encoding_detection(self):
+        def detect(content, block_size=4):
+            return detect_encoding(io.BytesIO(content), block_size)
+
+        self.assertEqual(detect(b'\xef\xbb\xbfinstrument'), 'utf-8-sig')
+        self.assertEqual(detect('ACCIÓN ÑANDÚ'.encode('utf-8')), 'utf-8')  # Caracteres cortados entre bloques
+        self.assertEqual(detect('ACCIÓN €'.encode('cp1252')), 'cp1252')
+        self.assertEqual(detect(b'ACCI\xd3N \x81'), 'latin-1')
+        # El único acento está después del primer bloque: igual se detecta cp1252
+        self.assertEqual(detect(b'A' * 64 + 'Ó'.encode('cp1252'), block_size=16), 'cp1252')
+
+    def test_cp1252_accent_after_the_first_megabyte(self):
+        self.client.force_login(self.user)
+        content = self.HEADER + ''.join(f'I{i:06d},2025-01-01,2025,,\n' for i in range(40_000)) + 'ACCIÓN,2025-01-02,2025,,\n'
+        response = self.client.post(reverse('upload_csv'),
+                                    {'file': SimpleUploadedFile('carga.csv', content.encode('cp1252'))})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(TaxQualification.objects.filter(instrument='ACCIÓN').exists())
+
+    def test_latin1_upload_is_decoded_in_chunks(self):
+        self.client.force_login(self.user)
+        content = self.HEADER + 'ACCIÓN,2025-01-01,2025,,\nAÑO,2025-01-02,2025,,\n'
+        response = self.client.post(reverse('upload_csv'),
+                                    {'file': SimpleUploadedFile('carga.csv', content.encode('cp1252'))})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(sorted(TaxQualification.objects.values_list('instrument', flat=True)), ['ACCIÓN', 'AÑO'])
+        self.assertIn('cp1252', AuditLog.objects.get(action='UPLOAD_CSV').details)
+
+    def test_missing_required_column_rejects_file(self):
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('upload_csv'), {'file': SimpleUploadedFile(
+            'carga.csv', b'instrument,exercise_year\nX,2025\n')})
+        self.assertIn('payment_date', str(response.context['form'].errors))
+        self.assertFalse(TaxQualification.objects.exists())
+
+
+class BulkIngestTestCase(TestCase):
+    def setUp(self):
+        self.broker = Broker.objects.create(name="Broker Integración", code="BRI")
+        self.token, self.raw = ApiToken.issue(self.broker, "Bolsa")
+        TaxQualification.objects.create(broker=self.broker, instrument='EXISTE', payment_date='2025-01-01',
+                                        exercise_year=2024, financial_data={})
+
+    def body(self, *records):
+        return ''.join((r if isinstance(r, str) else json.dumps(r)) + '\n' for r in records).encode()
+
+    def post(self, body, token=None, **headers):
+        return self.client.post(reverse('bulk_ingest'), body, content_type='application/x-ndjson',
+                                HTTP_AUTHORIZATION=f"Bearer {token or self.raw}", **headers)
+
+    def test_requires_active_token(self):
+        self.assertEqual(self.post(b'{}\n', token='otro').status_code, 401)
+        self.token.is_active = False
+        self.token.save()
+        self.assertEqual(self.post(b'{}\n').status_code, 401)
+        self.assertEqual(self.client.get(reverse('bulk_ingest')).status_code, 405)
+
+    def test_gzip_stream_upserts_and_reports_per_batch(self):
+        body = self.body(
+            {'instrument': 'EXISTE', 'payment_date': '2025-01-01', 'exercise_year': 2025,
+             'financial_data': {'monto_base': 500, 'factores': {'credito': 0.2}}},
+            {'instrument': 'NUEVO', 'payment_date': '2025-02-01', 'exercise_year': 2025, 'currency': 'usd'},
+            '{roto',
+            '',
+            {'broker_code': 'OTRO', 'instrument': 'AJENO', 'payment_date': '2025-02-01', 'exercise_year': 2025},
+            {'instrument': 'FECHA', 'payment_date': '2025-02-30', 'exercise_year': 2025},
+        )
+        response = self.post(gzip.compress(body), HTTP_CONTENT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(lines[-1]['done'], True)
+        self.assertEqual((lines[-1]['received'], lines[-1]['upserted'], lines[-1]['created'], lines[-1]['rejected']),
+                         (5, 2, 1, 3))
+        self.assertEqual([(e['line'], e['column']) for e in lines[0]['errors']],
+                         [(3, ''), (5, 'broker_code'), (6, 'payment_date')])
+
+        existing = TaxQualification.objects.get(instrument='EXISTE')
+        self.assertEqual((existing.exercise_year, existing.source, existing.factor_credito), (2025, 'API', Decimal('0.2000')))
+        self.assertEqual(TaxQualification.objects.get(instrument='NUEVO').currency, 'USD')
+        self.assertFalse(TaxQualification.objects.filter(instrument='AJENO').exists())
+        event = OutboxEvent.objects.get(event_type='qualification.bulk_loaded')
+        self.assertEqual((event.payload['rows'], event.payload['created'], event.payload['source']), (2, 1, 'API'))
+        self.assertIsNotNone(ApiToken.objects.get(pk=self.token.pk).last_used_at)
+
+    def test_unicode_digit_year_is_rejected_without_cutting_the_stream(self):
+        body = self.body({'instrument': 'RARO', 'payment_date': '2025-01-01', 'exercise_year': '²'},
+                         {'instrument': 'BIEN', 'payment_date': '2025-01-01', 'exercise_year': 2025})
+        lines = [json.loads(line) for line in ingest_stream(io.BytesIO(body), self.token)]
+        self.assertEqual((lines[-1]['done'], lines[-1]['upserted'], lines[-1]['rejected']), (True, 1, 1))
+        self.assertEqual([(e['line'], e['column']) for e in lines[0]['errors']], [(1, 'exercise_year')])
+
+    def test_batches_commit_independently_and_truncated_gzip_stops(self):
+        body = self.body(*({'instrument': f'I{i}', 'payment_date': '2025-03-01', 'exercise_year': 2025}
+                           for i in range(5)))
+        lines = [json.loads(line) for line in ingest_stream(io.BytesIO(body), self.token, batch_size=2)]
+        self.assertEqual([line.get('batch') for line in lines], [1, 2, 3, None])
+        self.assertEqual(OutboxEvent.objects.filter(event_type='qualification.bulk_loaded').count(), 3)
+
+        truncated = gzip.compress(body)[:-12]
+        summary = json.loads(list(ingest_stream(io.BytesIO(truncated), self.token, gzipped=True))[-1])
+        self.assertEqual(summary['done'], False)
+        self.assertIn('gzip truncado', summary['error'])
+
+    def test_database_error_ends_stream_with_summary_and_audit(self):
+        body = self.body(*({'instrument': f'I{i}', 'payment_date': '2025-03-01', 'exercise_year': 2025}
+                           for i in range(5)))
+        with mock.patch('api.ingest.upsert_rows', side_effect=[mock.DEFAULT, OperationalError("conexión perdida")],
+                        wraps=upsert_rows):
+            lines = [json.loads(line) for line in ingest_stream(io.BytesIO(body), self.token, batch_size=2)]
+        self.assertEqual([line.get('batch') for line in lines], [1, None])
+        self.assertEqual((lines[-1]['done'], lines[-1]['upserted']), (False, 2))
+        self.assertIn('lote 2', lines[-1]['error'])
+        self.assertIn('conexión perdida', AuditLog.objects.get(action='API_BULK').details)
+
+        # El cliente corta a mitad: la auditoría se escribe igual
+        stream = ingest_stream(io.BytesIO(body), self.token, batch_size=2)
+        next(stream)
+        stream.close()
+        self.assertIn('cerrada por el cliente', AuditLog.objects.filter(action='API_BULK').latest('timestamp').details)
+
+
+class ReconciliationTestCase(TestCase):
+    """Árbol de hashes corredor → año → mes: refresco incremental y diff que solo abre hojas distintas."""
+
+    CSV_HEADER = 'instrument,payment_date,exercise_year,currency,financial_data\n'
+
+    def setUp(self):
+        self.broker = Broker.objects.create(name="Broker Conciliación", code="BCN")
+        rows = [{'instrument': f"INS{i:03d}", 'payment_date': datetime.date(2025, 1 + i % 12, 1 + i % 28),
+                 'exercise_year': 2025, 'currency': 'CLP', 'financial_data': {'monto_base': 1000 + i}}
+                for i in range(60)]
+        upsert_rows(self.broker, rows, source='CSV')
+        # Misma fila por la vía del consumer (save()): otro JSON, mismos valores de negocio
+        TaxQualification.objects.create(
+            broker=self.broker, instrument='BOLSA', payment_date='2025-03-15', exercise_year=2025, source='API',
+            financial_data={'monto_base': 500, 'montos': {'credito': None, 'incremento': None}, 'factores': {}},
+        )
+        self.csv_lines = [f'INS{i:03d},2025-{1 + i % 12:02d}-{1 + i % 28:02d},2025,CLP,"{{""monto_base"": {1000 + i}}}"'
+                          for i in range(60)] + ['BOLSA,2025-03-15,2025,CLP,"{""monto_base"": 500.00}"']
+
+    def file_tree(self, lines):
+        return reconciliation.FileTree.from_csv(io.BytesIO((self.CSV_HEADER + '\n'.join(lines)).encode()))
+
+    def test_file_matches_database_and_diff_descends_only_into_changed_leaves(self):
+        self.assertEqual(reconciliation.refresh(self.broker), 12)
+        self.assertEqual(ReconciliationTree.objects.get(broker=self.broker).rows, 61)
+        result = reconciliation.diff(reconciliation.DatabaseTree(self.broker), self.file_tree(self.csv_lines))
+        self.assertTrue(result.matches)
+        self.assertEqual(result.leaves_descended, 0)
+
+        lines = list(self.csv_lines)
+        lines[0] = lines[0].replace('1000', '1001')  # INS000 (enero): otro monto
+        lines.append('NUEVO,2025-05-02,2025,CLP,"{}"')  # Solo en el archivo
+        TaxQualification.objects.get(instrument='INS013').delete()  # Febrero: solo en el archivo
+        qualification = TaxQualification.objects.get(instrument='INS040')  # Mayo → diciembre: cambia de hoja
+        qualification.payment_date = datetime.date(2025, 12, 20)
+        qualification.save()
+
+        tree = reconciliation.DatabaseTree(self.broker)
+        result = reconciliation.diff(tree, self.file_tree(lines))
+        self.assertEqual(sorted(result.differences), [
+            ('distinto', 2025, 1, 'INS000', '2025-01-01'),
+            ('solo_a', 2025, 12, 'INS040', '2025-12-20'),
+            ('solo_b', 2025, 2, 'INS013', '2025-02-14'),
+            ('solo_b', 2025, 5, 'INS040', '2025-05-13'),
+            ('solo_b', 2025, 5, 'NUEVO', '2025-05-02'),
+        ])
+        self.assertEqual(result.leaves_descended, 4)  # De 12 hojas solo se leen las distintas
+
+        # El refresco incremental deja exactamente el mismo árbol que uno completo
+        incremental = ReconciliationTree.objects.get(broker=self.broker)
+        reconciliation.refresh(self.broker, full=True)
+        full = ReconciliationTree.objects.get(broker=self.broker)
+        self.assertEqual((incremental.rows, incremental.digest), (full.rows, full.digest))
+        self.assertEqual(tree.leaves(), reconciliation.DatabaseTree(self.broker, refresh_first=False).leaves())
+
+    def test_upsert_that_changes_exercise_year_marks_old_leaf_stale(self):
+        reconciliation.refresh(self.broker)
+        moved = {'instrument': 'INS002', 'payment_date': datetime.date(2025, 3, 3), 'exercise_year': 2026,
+                 'currency': 'CLP', 'financial_data': {'monto_base': 1002}}
+        self.assertEqual(upsert_rows(self.broker, [moved], source='CSV'), [False])
+        self.assertTrue(ReconciliationBucket.objects.get(broker=self.broker, exercise_year=2025, month=3).stale)
+
+        reconciliation.refresh(self.broker)
+        buckets = dict(ReconciliationBucket.objects.filter(broker=self.broker, month=3)
+                       .values_list('exercise_year', 'rows'))
+        self.assertEqual(buckets, {2025: 5, 2026: 1})
+        incremental = ReconciliationTree.objects.get(broker=self.broker)
+        reconciliation.refresh(self.broker, full=True)
+        full = ReconciliationTree.objects.get(broker=self.broker)
+        self.assertEqual((incremental.rows, incremental.digest), (full.rows, full.digest))
+
+    def test_remote_tree_reads_nodes_through_endpoint(self):
+        token, raw = ApiToken.issue(self.broker, "Espejo")
+        client = self.client
+
+        class ClientTree(reconciliation.RemoteTree):
+            def _get(self, path):
+                response = client.get(self.url, dict(zip(('year', 'month'), path)),
+                                      headers={'Authorization': f"Bearer {self.token}"})
+                return response.json()
+
+        self.assertEqual(client.get(reverse('reconciliation')).status_code, 401)
+        self.assertEqual(client.get(reverse('reconciliation'), {'month': 1},
+                                    headers={'Authorization': f"Bearer {raw}"}).status_code, 400)
+        remote = ClientTree(reverse('reconciliation'), raw)
+        self.assertTrue(reconciliation.diff(reconciliation.DatabaseTree(self.broker), remote).matches)
+
+        lines = [line for line in self.csv_lines if not line.startswith('BOLSA')]
+        result = reconciliation.diff(remote, self.file_tree(lines))
+        self.assertEqual(result.differences, [('solo_a', 2025, 3, 'BOLSA', '2025-03-15')])
+
+
+class SyncTestCase(TestCase):
+    """Sincronización incremental: solo lo cambiado desde el token, con lápidas de borrados."""
+
+    def setUp(self):
+        self.broker = Broker.objects.create(name="Broker Espejo", code="BSY")
+        self.other = Broker.objects.create(name="Otro Broker", code="OTS")
+        for i in range(5):
+            for broker in (self.broker, self.other):
+                TaxQualification.objects.create(broker=broker, instrument=f"SYN{i}", payment_date=datetime.date(2025, 1, 1 + i),
+                                                exercise_year=2025, financial_data={'monto_base': 100 + i})
+        self.token, self.raw = ApiToken.issue(self.broker, "Espejo")
+
+    def pull(self, sync_token=None, **params):
+        if sync_token:
+            params['sync_token'] = sync_token
+        response = self.client.get(reverse('sync'), params, headers={'Authorization': f"Bearer {self.raw}"})
+        if response.status_code != 200:
+            return response.status_code, [], None
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        changes = [(line['op'], line['instrument']) for line in lines if 'op' in line]
+        return response.status_code, changes, lines[-1]
+
+    @mock.patch.object(sync, 'SYNC_LAG', datetime.timedelta(0))
+    def test_returns_only_changes_and_deletes_since_token(self):
+        _, changes, summary = self.pull()
+        self.assertEqual(sorted(changes), [('upsert', f"SYN{i}") for i in range(5)])  # Solo su corredor
+        self.assertEqual((summary['done'], summary['has_more']), (True, False))
+
+        qualification = TaxQualification.objects.get(broker=self.broker, instrument='SYN1')
+        qualification.financial_data = {'monto_base': 999}
+        qualification.save()
+        TaxQualification.objects.filter(broker=self.broker, instrument__in=['SYN2', 'SYN3']).delete()
+        TaxQualification.objects.create(broker=self.broker, instrument='SYN3', payment_date=datetime.date(2025, 1, 4),
+                                        exercise_year=2025, financial_data={})  # Borrada y vuelta a crear
+        TaxQualification.objects.filter(broker=self.other).delete()
+
+        _, changes, summary = self.pull(summary['sync_token'])
+        self.assertEqual(sorted(changes), [('delete', 'SYN2'), ('upsert', 'SYN1'), ('upsert', 'SYN3')])
+        self.assertEqual((summary['upserts'], summary['deletes']), (2, 1))
+        self.assertEqual(self.pull(summary['sync_token'])[1], [])
+
+        # Con limit: por partes, sin repetir ni perder cambios
+        for i in range(5, 10):
+            TaxQualification.objects.create(broker=self.broker, instrument=f"SYN{i}",
+                                            payment_date=datetime.date(2025, 2, i), exercise_year=2025, financial_data={})
+        token, seen = summary['sync_token'], []
+        while True:
+            _, changes, page = self.pull(token, limit=2)
+            seen += changes
+            token = page['sync_token']
+            if not page['has_more']:
+                break
+        self.assertEqual(seen, [('upsert', f"SYN{i}") for i in range(5, 10)])
+
+        # Exactamente `limit` cambios pendientes: la página los trae todos y no pide otra
+        TaxQualification.objects.filter(broker=self.broker, instrument='SYN9').delete()
+        TaxQualification.objects.create(broker=self.broker, instrument='SYN10', payment_date=datetime.date(2025, 2, 10),
+                                        exercise_year=2025, financial_data={})
+        _, changes, page = self.pull(token, limit=2)
+        self.assertEqual(changes, [('delete', 'SYN9'), ('upsert', 'SYN10')])
+        self.assertFalse(page['has_more'])
+
+    @mock.patch.object(sync, 'SYNC_LAG', datetime.timedelta(0))
+    def test_key_change_from_admin_leaves_tombstone_for_old_key(self):
+        _, _, summary = self.pull()
+        qualification = TaxQualification.objects.get(broker=self.broker, instrument='SYN1')
+        qualification.instrument = 'SYN1B'
+        qualification.save()
+        qualification.payment_date = datetime.date(2025, 6, 30)
+        qualification.save()
+
+        _, changes, summary = self.pull(summary['sync_token'])
+        self.assertEqual(sorted(changes), [('delete', 'SYN1'), ('delete', 'SYN1B'), ('upsert', 'SYN1B')])
+        self.assertEqual(QualificationTombstone.objects.get(instrument='SYN1B').payment_date, datetime.date(2025, 1, 2))
+
+    def test_rejects_invalid_and_expired_tokens(self):
+        self.assertEqual(self.client.get(reverse('sync')).status_code, 401)
+        _, _, summary = self.pull()
+        self.assertEqual(self.pull(summary['sync_token'][:-2] + 'xx')[0], 400)
+        self.assertEqual(self.pull('basura')[0], 400)
+        self.assertEqual(self.pull(limit='0')[0], 400)
+        old = timezone.now() - datetime.timedelta(days=sync.TOMBSTONE_RETENTION_DAYS + 1)
+        self.assertEqual(self.pull(sync.SyncCursor(sync.START, (old, 0)).dumps(self.broker))[0], 410)
+        foreign = sync.SyncCursor(sync.START, (timezone.now(), 0)).dumps(self.other)
+        self.assertEqual(self.pull(foreign)[0], 400)
+
+        # Borrar el corredor entero no deja lápidas (ni choca con su borrado en cascada)
+        self.other.delete()
+        self.assertFalse(QualificationTombstone.objects.exists())
+        self.assertEqual(sync.prune_tombstones(days=0), 0)
+
+    def test_prune_command_keeps_tombstones_within_token_lifetime(self):
+        TaxQualification.objects.filter(broker=self.broker, instrument__in=['SYN0', 'SYN1']).delete()
+        QualificationTombstone.objects.filter(instrument='SYN0').update(
+            deleted_at=timezone.now() - datetime.timedelta(days=sync.TOMBSTONE_RETENTION_DAYS + 1))
+        call_command('prune_tombstones', stdout=io.StringIO())
+        self.assertEqual(list(QualificationTombstone.objects.values_list('instrument', flat=True)), ['SYN1'])
+        with self.assertRaises(CommandError):
+            call_command('prune_tombstones', days=1, stdout=io.StringIO())
+
+
+@override_settings(EXPORT_SNAPSHOT_STORAGE=SNAPSHOT_STORAGE)
+class QueryBudgetTestCase(TestCase):
+    """
+    Presupuesto de consultas por URL (api/urls.py + changelists del admin): un número fijo
+    que NO depende del volumen. Cada caso se mide con SMALL y LARGE filas por corredor; si
+    el conteo cambia con los datos hay un N+1. Al fallar se imprime el SQL ejecutado.
+    """
+    SMALL, LARGE = 3, 25
+    BROKERS = 3
+
+    # (nombre, consultas): sesión + usuario van incluidas
+    BUDGETS = {
+        'home:broker': 8,
+        'home:admin': 7,
+        'upload_csv:get': 2,
+        'upload_csv:post': 10,
+        'upload_csv_report': 2,
+        'update_factor': 2,
+        'export_data:xlsx': 5,
+        'export_data:parquet': 5,
+        'export_data:snapshot': 14,
+        'manual_entry:get': 2,
+        'manual_entry:post': 8,
+        'search_instruments': 5,
+        'consolidated_report': 8,
+        'live_events': 3,
+        'bulk_ingest': 8,
+        'reconciliation': 15,
+        'sync': 4,
+        'profile': 2,
+        'admin:api_broker_changelist': 7,
+        'admin:auth_user_changelist': 8,
+        'admin:api_taxqualification_changelist': 11,
+        'admin:api_exchangerate_changelist': 9,
+        'admin:api_factorrun_changelist': 9,
+        'admin:api_exportsnapshot_changelist': 7,
+        'admin:api_outboxevent_changelist': 8,
+        'admin:api_apitoken_changelist': 8,
+        'admin:api_auditlog_changelist': 9,
+    }
+
+    def setUp(self):
+        self.brokers, self.users = [], []
+        for i in range(self.BROKERS):
+            broker = Broker.objects.create(name=f"Corredor Presupuesto {i}", code=f"QB{i}", country='CL')
+            user = User.objects.create_user(username=f"qb_user_{i}", password="password123")
+            UserProfile.objects.create(user=user, broker=broker)
+            self.brokers.append(broker)
+            self.users.append(user)
+        self.admin = User.objects.create_superuser(username="qb_admin", password="password123")
+        self.token, self.raw_token = ApiToken.issue(self.brokers[0], "Presupuesto")
+        self.seeded = 0
+        self.calls = 0
+
+    def seed(self, per_broker):
+        """Completa hasta per_broker filas por corredor en cada tabla que listan las vistas."""
+        for n in range(self.seeded, per_broker):
+            day = datetime.date(2025, 1, 1) + datetime.timedelta(days=n)
+            for broker, user in zip(self.brokers, self.users):
+                TaxQualification.objects.create(
+                    broker=broker, instrument=f"INS{n:03d}", payment_date=day, exercise_year=2025,
+                    financial_data={'monto_base': 100 + n, 'factores': {'credito': 0.1}},
+                )
+                AuditLog.objects.create(user=user, action='SEED', details=f"fila {n}")
+                OutboxEvent.objects.create(event_type='qualification.created', topic='nuam_events',
+                                           key=broker.code, payload={'n': n})
+                FactorRun.objects.create(broker=broker, exercise_year=2025,
+                                         started_at=datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc))
+                ApiToken.issue(broker, f"Integración {n}")
+                User.objects.create_user(username=f"qb_extra_{broker.code}_{n}")
+            ExchangeRate.objects.create(currency='CLP', date=day, rate_usd=Decimal('0.001'))
+        self.seeded = per_broker
+
+    def requests(self):
+        """(nombre, función que hace la petición y consume la respuesta)."""
+        self.calls += 1
+        call = self.calls
+        broker_user = self.users[0]
+        csv_rows = ''.join(f"CSV{call}_{n},2025-02-01,2025,,\n" for n in range(self.seeded))
+        ndjson = ''.join(json.dumps({'instrument': f"API{call}_{n}", 'payment_date': '2025-02-01',
+                                     'exercise_year': 2025}) + '\n' for n in range(self.seeded))
+
+        def get(name, user, *args, headers=None, environ=None, **params):
+            def run():
+                self.client.force_login(user)
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.client.get(reverse(name, args=args), params, headers=headers, **(environ or {}))
+                    if name != 'live_events':  # SSE infinito: el poller compartido consulta, no la petición
+                        self.consume(response)
+                return response, queries
+            return run
+
+        def post(name, user, data, **extra):
+            def run():
+                self.client.force_login(user)
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.client.post(reverse(name), data, **extra)
+                    self.consume(response)
+                return response, queries
+            return run
+
+        manual = {'instrument': f"MAN{call}", 'payment_date': '2025-03-01', 'exercise_year': 2025,
+                  'source': 'MANUAL', 'currency': 'CLP', 'monto_base': '1000', 'factor_credito': '0.1', 'factor_incremento': '0.1'}
+        return [
+            ('home:broker', get('home', broker_user)),
+            ('home:admin', get('home', self.admin)),
+            ('upload_csv:get', get('upload_csv', broker_user)),
+            ('upload_csv:post', post('upload_csv', broker_user, {'file': SimpleUploadedFile(
+                'carga.csv', ('instrument,payment_date,exercise_year,currency,financial_data\n' + csv_rows).encode())})),
+            ('upload_csv_report', get('upload_csv_report', broker_user)),
+            ('update_factor', get('update_factor', broker_user)),
+            ('export_data:xlsx', get('export_data', broker_user, year='2025')),
+            ('export_data:parquet', get('export_data', broker_user, year='2025', format='parquet')),
+            ('export_data:snapshot', get('export_data', broker_user, format='csv')),
+            ('manual_entry:get', get('manual_entry', broker_user)),
+            ('manual_entry:post', post('manual_entry', broker_user, manual)),
+            ('search_instruments', get('search_instruments', broker_user, q='INS')),
+            ('consolidated_report', get('consolidated_report', broker_user, currency='USD', year='2025')),
+            ('live_events', get('live_events', broker_user)),
+            ('bulk_ingest', post('bulk_ingest', broker_user, ndjson.encode(), content_type='application/x-ndjson',
+                                 HTTP_AUTHORIZATION=f"Bearer {self.raw_token}")),
+            ('reconciliation', get('reconciliation', broker_user, headers={'Authorization': f"Bearer {self.raw_token}"})),
+            ('sync', get('sync', broker_user, headers={'Authorization': f"Bearer {self.raw_token}"})),
+            ('profile', get('profile', self.admin, seconds='0.01', environ={'wsgi.multithread': True})),
+            *((name, get(name, self.admin)) for name in self.BUDGETS if name.startswith('admin:')),
+        ]
+
+    @staticmethod
+    def consume(response):
+        return b''.join(response.streaming_content) if response.streaming else response.content
+
+    def measure(self):
+        counts = {}
+        for name, run in self.requests():
+            if name == 'export_data:parquet' and not columnar.available():
+                continue
+            cache.clear()  # El reporte consolidado se cachea por versión de datos
+            ExportSnapshot.objects.all().delete()  # Siempre el camino de generación del snapshot
+            ReconciliationTree.objects.all().delete()  # Siempre el refresco completo del árbol
+            response, queries = run()
+            self.assertLess(response.status_code, 400 if name != 'upload_csv_report' else 500, name)
+            counts[name] = queries
+        return counts
+
+    def test_query_counts_are_fixed_and_independent_of_data_size(self):
+        self.seed(self.SMALL)
+        small = self.measure()
+        self.seed(self.LARGE)
+        large = self.measure()
+
+        failures = []
+        for name, queries in large.items():
+            budget = self.BUDGETS[name]
+            if len(small[name]) == len(queries) == budget:
+                continue
+            sql = '\n'.join(f"  {i}. {query['sql']}" for i, query in enumerate(queries.captured_queries, 1))
+            failures.append(f"{name}: {len(small[name])} consultas con {self.SMALL} filas/corredor, "
+                            f"{len(queries)} con {self.LARGE} (presupuesto {budget})\n{sql}")
+        if failures:
+            self.fail("\n\n".join(failures))
@@ -4,7 +4,15 @@ from . import views
 urlpatterns = [
     path('', views.home, name='home'),
     path('upload-csv/', views.upload_csv, name='upload_csv'),
+    path('upload-csv/report/', views.upload_csv_report, name='upload_csv_report'),
     path('update-factor/', views.update_factor, name='update_factor'),
     path('export/my-data/', views.export_users_data, name='export_data'),
     path('entry/manual/', views.manual_entry, name='manual_entry'),
+    path('search/instruments/', views.search_instruments_view, name='search_instruments'),
+    path('reports/consolidated/', views.consolidated_report_view, name='consolidated_report'),
+    path('live/events/', views.live_events_view, name='live_events'),
+    path('api/v1/qualifications/bulk/', views.bulk_ingest_view, name='bulk_ingest'),
+    path('api/v1/reconciliation/', views.reconciliation_view, name='reconciliation'),
+    path('api/v1/sync/', views.sync_view, name='sync'),
+    path('debug/profile/', views.profile_view, name='profile'),
 ]
\ No newline at end of file
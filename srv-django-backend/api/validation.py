@@ -0,0 +1,462 @@
+"""
+Validación de la carga CSV por columnas (numpy), antes de tocar la BD.
+
+El archivo se lee en bloques de CHUNK_ROWS filas; cada bloque se transpone a columnas y
+cada regla se evalúa sobre la columna completa (fechas, años, monedas, montos, límites de
+factores, claves repetidas). Solo se itera en Python sobre las filas que fallan, para
+armar el reporte. financial_data se decodifica sobre un único texto por bloque, cada celda
+desde su offset (raw_decode), sin copiar cada celda a un string aparte.
+
+Resultado: filas válidas listas para persistir + errores (línea, columna, valor, motivo).
+Las filas inválidas no se cargan; el reporte se descarga desde la página de carga.
+
+Memoria acotada: el archivo subido (Django lo deja en un temporal en disco sobre
+FILE_UPLOAD_MAX_MEMORY_SIZE) se recorre una vez para elegir la codificación y se decodifica
+de forma incremental (open_csv_text), se valida
+bloque a bloque (iter_validated_csv) y los errores van directo a un temporal (ErrorReport).
+Lo único que crece con el archivo son los hashes de claves ya vistas: 8 bytes por fila.
+"""
+import codecs
+import csv
+import gc
+import io
+import json
+import tempfile
+from contextlib import contextmanager
+from decimal import Decimal
+from itertools import islice, zip_longest
+
+import numpy as np
+
+from django.core.files import File
+
+from .financial import CURRENCIES, FACTOR_MAX, FACTOR_MIN, NUMERIC_RE, TYPED_COLUMNS, factor_bounds_error
+from .snapshots import snapshot_storage
+
+CHUNK_ROWS = 100_000
+REQUIRED_COLUMNS = ('instrument', 'payment_date', 'exercise_year')
+DEFAULT_CURRENCY = 'CLP'
+MAX_INSTRUMENT_LENGTH = 120
+MIN_YEAR, MAX_YEAR = 1900, 2100
+MAX_REPORT_VALUE = 200
+REPORT_HEADER = ('linea', 'columna', 'valor', 'error')
+REPORT_DIR = 'upload-reports'  # Dentro del storage de exportaciones; un reporte (el último) por usuario
+SCAN_BYTES = 1024 * 1024  # Bloque de lectura al detectar la codificación
+
+_DIGIT_POSITIONS = [0, 1, 2, 3, 5, 6, 8, 9]
+_DAYS_IN_MONTH = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+_MONTO_LIMIT = 10 ** (TYPED_COLUMNS['monto_base'][2] - TYPED_COLUMNS['monto_base'][1])
+
+# Campos numéricos de financial_data que se validan -> columna del reporte
+_NUMERIC_FIELDS = {
+    'monto_base': 'financial_data.monto_base',
+    'credito': 'financial_data.factores.credito',
+    'incremento': 'financial_data.factores.incremento',
+}
+
+
+class CSVValidationError(ValueError):
+    """El archivo completo es inválido (p. ej. faltan columnas obligatorias)."""
+
+
+# --- DECODIFICACIÓN INCREMENTAL ---
+def _decodes(binary, encoding, block_size):
+    """¿El archivo completo es válido en `encoding`? Lo recorre por bloques y vuelve al inicio."""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    binary.seek(0)
+    try:
+        while block := binary.read(block_size):
+            decoder.decode(block)  # Un carácter cortado entre bloques queda pendiente en el decodificador
+        decoder.decode(b'', final=True)
+        return True
+    except UnicodeDecodeError:
+        return False
+    finally:
+        binary.seek(0)
+
+
+def detect_encoding(binary, block_size=SCAN_BYTES):
+    """
+    Codificación de un CSV (archivo binario con seek): UTF-8 (con o sin BOM) y, si no es UTF-8
+    válido, Windows-1252 / Latin-1 (lo que envían algunas bolsas). Se valida el archivo entero,
+    no una muestra: un acento en la última fila de un archivo cp1252 no rompe la carga a mitad.
+    """
+    head = binary.read(len(codecs.BOM_UTF8))
+    binary.seek(0)
+    if _decodes(binary, 'utf-8', block_size):
+        return 'utf-8-sig' if head == codecs.BOM_UTF8 else 'utf-8'
+    if _decodes(binary, 'cp1252', block_size):
+        return 'cp1252'
+    return 'latin-1'  # Define los 256 bytes: nunca falla
+
+
+def open_csv_text(binary, block_size=SCAN_BYTES):
+    """(texto, codificación): envoltorio que decodifica el archivo binario a medida que se lee."""
+    encoding = detect_encoding(binary, block_size)
+    return io.TextIOWrapper(binary, encoding=encoding, newline=''), encoding
+
+
+# --- REGLAS POR COLUMNA (cada una devuelve una máscara de filas inválidas) ---
+def parse_iso_dates(values):
+    """(fechas datetime64[D], inválidas) para un arreglo de textos 'AAAA-MM-DD'."""
+    fixed = values.astype('U10')
+    # Cada carácter como código: dígito = 0..9 (el resto, incluido el relleno, queda fuera de rango)
+    codes = fixed.view(np.uint32).reshape(-1, 10).astype(np.int64) - ord('0')
+    digits = codes[:, _DIGIT_POSITIONS]
+    well_formed = (
+        (np.char.str_len(values) == 10)
+        & ((digits >= 0) & (digits <= 9)).all(axis=1)
+        & (codes[:, 4] == ord('-') - ord('0')) & (codes[:, 7] == ord('-') - ord('0'))
+    )
+    year = codes[:, 0] * 1000 + codes[:, 1] * 100 + codes[:, 2] * 10 + codes[:, 3]
+    month = codes[:, 5] * 10 + codes[:, 6]
+    day = codes[:, 8] * 10 + codes[:, 9]
+    valid_month = well_formed & (month >= 1) & (month <= 12)
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    days = np.where(valid_month, _DAYS_IN_MONTH[np.clip(month - 1, 0, 11)] + ((month == 2) & leap), 0)
+    valid = valid_month & (day >= 1) & (day <= days) & (year >= MIN_YEAR) & (year <= MAX_YEAR)
+
+    dates = np.full(len(values), np.datetime64('NaT'), dtype='datetime64[D]')
+    dates[valid] = fixed[valid].astype('datetime64[D]')
+    return dates, ~valid
+
+
+def parse_years(values):
+    """(años, inválidos): enteros de hasta 4 dígitos dentro de [MIN_YEAR, MAX_YEAR]."""
+    fixed = values.astype('U4')
+    # isdigit acepta dígitos Unicode ('²', '٣') que int() no convierte: solo ASCII
+    ascii_only = (fixed.view(np.uint32).reshape(-1, 4) < 128).all(axis=1)
+    numeric = np.char.isdigit(values) & ascii_only & (np.char.str_len(values) <= 4)
+    years = np.zeros(len(values), dtype=np.int64)
+    years[numeric] = fixed[numeric].astype(np.int64)
+    return years, ~(numeric & (years >= MIN_YEAR) & (years <= MAX_YEAR))
+
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = json.decoder.WHITESPACE
+
+
+def loads_many(texts):
+    """
+    json.loads de muchas celdas (None si la celda no es un JSON válido). Cada celda se decodifica
+    desde su offset en el bloque unido y debe terminar exactamente en su borde: una celda rota
+    no puede "completarse" con pedazos de la vecina (p. ej. '{"c":[1' seguida de '2]}').
+    """
+    block = ','.join(texts)
+    parsed = []
+    start = 0
+    for text in texts:
+        end = start + len(text)
+        try:
+            obj, stop = _DECODER.raw_decode(block, _WHITESPACE.match(block, start, end).end())
+        except ValueError:
+            obj, stop = None, -1
+        if stop > end or stop < 0 or _WHITESPACE.match(block, stop, end).end() != end:
+            obj = None
+        parsed.append(obj)
+        start = end + 1  # La coma que separa las celdas
+    return parsed
+
+
+def parse_json_objects(texts):
+    """(objetos, inválidos) de la columna financial_data; celda vacía = {}."""
+    parsed = loads_many(['{}' if not text or text.isspace() else text for text in texts])
+    invalid = np.array([obj.__class__ is not dict for obj in parsed], dtype=bool)
+    return parsed, invalid
+
+
+def numeric_field(values):
+    """
+    (valores float, no numéricos) de una lista de valores JSON; ausente (None) = nan y válido.
+    Números y textos numéricos se convierten en bloque; booleanos y textos no numéricos son inválidos.
+    """
+    missing = np.array([v is None for v in values], dtype=bool)
+    try:
+        numbers = np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+    except (TypeError, ValueError):
+        numbers = np.array([_as_float(v) for v in values], dtype=np.float64)
+    invalid = ~missing & ~np.isfinite(numbers)
+    invalid |= np.array([v.__class__ is bool for v in values], dtype=bool)
+    return np.where(invalid, np.nan, numbers), invalid
+
+
+def _as_float(value):
+    if value is None:
+        return np.nan
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if isinstance(value, str) and NUMERIC_RE.match(value):
+        return float(value)
+    return np.inf
+
+
+# --- VALIDACIÓN ---
+class SeenKeys:
+    """Hashes int64 de las claves ya aceptadas, ordenados: 8 bytes por fila (un set de Python usa ~70)."""
+
+    def __init__(self):
+        self.keys = np.empty(0, dtype=np.int64)
+
+    def contains(self, keys):
+        if not len(self.keys):
+            return np.zeros(len(keys), dtype=bool)
+        positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return self.keys[positions] == keys
+
+    def add(self, keys):
+        # Dos tramos ya ordenados: el sort estable (timsort) los mezcla en tiempo lineal
+        self.keys = np.concatenate([self.keys, np.sort(keys)])
+        self.keys.sort(kind='stable')
+
+
+class _Report:
+    """Acumula errores solo de las filas marcadas en cada máscara."""
+
+    def __init__(self):
+        self.errors = []
+
+    def add(self, mask, first_line, column, values, message):
+        for i in np.flatnonzero(mask):
+            value = values[i] if values is not None else ''
+            text = message(i) if callable(message) else message
+            self.errors.append((first_line + int(i), column, str(value)[:MAX_REPORT_VALUE], text))
+
+
+def validate_chunk(columns, first_line, seen_keys, report, objects=None):
+    """
+    Valida un bloque ya transpuesto ({columna: arreglo}) y devuelve sus filas válidas;
+    seen_keys (SeenKeys) acumula las claves de bloques anteriores para detectar repetidas.
+    first_line es la línea del archivo de la primera fila (la cabecera es la línea 1).
+    objects: financial_data ya parseado (ingesta NDJSON); si no, se parsea la columna de texto.
+    """
+    instrument = columns['instrument']
+    n = len(instrument)
+    bad = np.zeros(n, dtype=bool)
+
+    lengths = np.char.str_len(instrument)
+    mask = (lengths == 0) | (lengths > MAX_INSTRUMENT_LENGTH)
+    report.add(mask, first_line, 'instrument', instrument,
+               f"Instrumento vacío o mayor a {MAX_INSTRUMENT_LENGTH} caracteres")
+    bad |= mask
+
+    dates, mask = parse_iso_dates(columns['payment_date'])
+    report.add(mask, first_line, 'payment_date', columns['payment_date'],
+               lambda i: "Fecha de pago obligatoria" if not columns['payment_date'][i]
+               else f"Fecha inválida (AAAA-MM-DD entre {MIN_YEAR} y {MAX_YEAR})")
+    bad |= mask
+
+    years, mask = parse_years(columns['exercise_year'])
+    report.add(mask, first_line, 'exercise_year', columns['exercise_year'],
+               f"Año de ejercicio inválido (entero entre {MIN_YEAR} y {MAX_YEAR})")
+    bad |= mask
+
+    currency = np.char.upper(columns['currency'])
+    currency = np.where(np.char.str_len(currency) == 0, DEFAULT_CURRENCY, currency)
+    mask = ~np.logical_or.reduce([currency == code for code in CURRENCIES])
+    report.add(mask, first_line, 'currency', columns['currency'],
+               f"Moneda no soportada (use {', '.join(CURRENCIES)})")
+    bad |= mask
+
+    if objects is None:
+        objects, mask = parse_json_objects(columns['financial_data'])
+    else:
+        objects = [{} if obj is None else obj for obj in objects]
+        mask = np.array([obj.__class__ is not dict for obj in objects], dtype=bool)
+    report.add(mask, first_line, 'financial_data', columns['financial_data'], "financial_data debe ser un objeto JSON válido")
+    bad |= mask
+
+    empty = {}
+    factores = [obj.get('factores') if obj.__class__ is dict else None for obj in objects]
+    factores = [f if f.__class__ is dict else empty for f in factores]
+    fields = {
+        'monto_base': [obj.get('monto_base') if obj.__class__ is dict else None for obj in objects],
+        'credito': [f.get('credito') for f in factores],
+        'incremento': [f.get('incremento') for f in factores],
+    }
+    numbers = {}
+    for name, values in fields.items():
+        numbers[name], mask = numeric_field(values)
+        report.add(mask, first_line, _NUMERIC_FIELDS[name], values, "Debe ser numérico")
+        bad |= mask
+
+    monto = numbers['monto_base']
+    mask = np.isfinite(monto) & ((monto < 0) | (np.abs(monto) >= _MONTO_LIMIT))
+    report.add(mask, first_line, 'financial_data.monto_base', monto, "Monto base negativo o fuera de rango")
+    bad |= mask
+
+    # Mismos límites [0, 1] que ManualEntryForm y el recálculo masivo
+    for name, label in (('credito', 'Crédito'), ('incremento', 'Incremento')):
+        factor = numbers[name]
+        mask = np.isfinite(factor) & ((factor < float(FACTOR_MIN)) | (factor > float(FACTOR_MAX)))
+        report.add(mask, first_line, _NUMERIC_FIELDS[name], factor,
+                   lambda i, factor=factor, label=label: factor_bounds_error(Decimal(str(factor[i])), label))
+        bad |= mask
+
+    # Claves (instrumento, fecha) repetidas: vale la primera aparición válida del archivo.
+    # Se comparan hashes int64 de la tupla (ordenar enteros es mucho más barato que strings).
+    keys = np.fromiter(map(hash, zip(instrument.tolist(), columns['payment_date'].tolist())), dtype=np.int64, count=n)
+    candidates = np.flatnonzero(~bad)
+    _, first = np.unique(keys[candidates], return_index=True)
+    duplicate = np.ones(len(candidates), dtype=bool)
+    duplicate[first] = False
+    duplicate |= seen_keys.contains(keys[candidates])
+    mask = np.zeros(n, dtype=bool)
+    mask[candidates[duplicate]] = True
+    report.add(mask, first_line, 'instrument+payment_date', None,
+               lambda i: f"Clave repetida en el archivo: {instrument[i]} / {columns['payment_date'][i]}")
+    bad |= mask
+
+    valid = np.flatnonzero(~bad)
+    seen_keys.add(keys[valid])
+    rows = [
+        {'instrument': inst, 'payment_date': date, 'exercise_year': year, 'currency': cur, 'financial_data': objects[i]}
+        for i, inst, date, year, cur in zip(
+            valid.tolist(), instrument[valid].tolist(), dates[valid].astype(object).tolist(),
+            years[valid].tolist(), currency[valid].tolist(),
+        )
+    ]
+    return rows
+
+
+@contextmanager
+def _gc_paused():
+    """Millones de objetos recién creados (celdas, dicts) disparan el GC cíclico una y otra vez."""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def validate_csv(stream, chunk_rows=CHUNK_ROWS):
+    """
+    (filas válidas, errores, total de filas) de un CSV con cabecera, todo en memoria.
+    Lanza CSVValidationError si faltan columnas obligatorias.
+    """
+    valid_rows, errors, total = [], [], 0
+    for rows, chunk_errors, count in iter_validated_csv(stream, chunk_rows):
+        valid_rows.extend(rows)
+        errors.extend(chunk_errors)
+        total += count
+    return valid_rows, errors, total
+
+
+def iter_validated_csv(stream, chunk_rows=CHUNK_ROWS):
+    """
+    (filas válidas, errores ordenados, filas leídas) por bloque de chunk_rows filas, a medida
+    que se lee el stream. Lanza CSVValidationError si faltan columnas obligatorias.
+    """
+    reader = csv.reader(stream)
+    header = [name.strip().lstrip('\ufeff') for name in next(reader, [])]
+    missing = [name for name in REQUIRED_COLUMNS if name not in header]
+    if missing:
+        raise CSVValidationError(f"Faltan columnas obligatorias: {', '.join(missing)}")
+
+    positions = {name: header.index(name) for name in (*REQUIRED_COLUMNS, 'currency', 'financial_data') if name in header}
+    total = 0
+    seen_keys = SeenKeys()  # Claves válidas de bloques anteriores
+    while True:
+        # GC pausado solo mientras se valida: quien consume el bloque (ORM) sí genera ciclos
+        with _gc_paused():
+            chunk = list(islice(reader, chunk_rows))
+            if not chunk:
+                break
+            count = len(chunk)
+            rows, errors = _validate_rows(chunk, positions, total + 2, seen_keys)
+            del chunk
+        total += count
+        yield rows, errors, count
+        del rows, errors  # Con el generador suspendido, sus locales no deben retener el bloque anterior
+
+
+def _validate_rows(chunk, positions, first_line, seen_keys):
+    transposed = list(zip_longest(*chunk, fillvalue=''))  # Filas cortas: celdas vacías
+    columns = {}
+    for name in ('instrument', 'payment_date', 'exercise_year', 'currency'):
+        pos = positions.get(name)
+        cells = transposed[pos] if pos is not None and pos < len(transposed) else ('',) * len(chunk)
+        columns[name] = np.char.strip(np.array(cells, dtype=str))
+    pos = positions.get('financial_data')
+    columns['financial_data'] = (
+        transposed[pos] if pos is not None and pos < len(transposed) else [''] * len(chunk)
+    )
+    report = _Report()
+    rows = validate_chunk(columns, first_line, seen_keys, report)
+    return rows, sorted(report.errors)
+
+
+def validate_records(records, lines):
+    """
+    Variante para registros JSON ya parseados (ingesta NDJSON): mismas reglas que el CSV,
+    con las claves repetidas buscadas solo dentro del lote. lines: número de línea de cada
+    registro. Devuelve (filas válidas, errores).
+    """
+    columns = {
+        name: np.char.strip(np.array(['' if r.get(name) is None else str(r[name]) for r in records], dtype=str))
+        for name in ('instrument', 'payment_date', 'exercise_year', 'currency')
+    }
+    columns['financial_data'] = [r.get('financial_data') for r in records]
+    report = _Report()
+    rows = validate_chunk(columns, 0, SeenKeys(), report, objects=columns['financial_data'])
+    return rows, [(lines[i], *rest) for i, *rest in report.errors]
+
+
+def write_error_report(errors, out):
+    """Escribe el reporte de errores (CSV) en un archivo de texto."""
+    writer = csv.writer(out)
+    writer.writerow(REPORT_HEADER)
+    writer.writerows(errors)
+
+
+def error_report_path(user):
+    return f"{REPORT_DIR}/{user.id}.csv"
+
+
+class ErrorReport:
+    """
+    Reporte de errores escrito a un temporal a medida que se valida (no se acumula en memoria).
+    Guarda el total de errores, las filas rechazadas y los primeros `preview` para la pantalla.
+    """
+
+    def __init__(self, preview=0):
+        self.errors = self.rejected = 0
+        self.preview = []
+        self.preview_size = preview
+        self.file = tempfile.TemporaryFile('w+b')
+        self.text = io.TextIOWrapper(self.file, encoding='utf-8-sig', newline='')  # BOM: Excel lo abre con tildes
+        self.writer = csv.writer(self.text)
+        self.writer.writerow(REPORT_HEADER)
+
+    def add(self, errors):
+        """Errores de un bloque (todos los de una fila caen en el mismo bloque)."""
+        self.writer.writerows(errors)
+        self.errors += len(errors)
+        self.rejected += len({line for line, *_ in errors})
+        self.preview.extend(errors[:max(self.preview_size - len(self.preview), 0)])
+
+    def save(self, user):
+        """Guarda el reporte del usuario (reemplaza el anterior) en el storage de exportaciones."""
+        storage = snapshot_storage()
+        name = error_report_path(user)
+        self.text.flush()
+        self.file.seek(0)
+        if storage.exists(name):
+            storage.delete(name)
+        storage.save(name, File(self.file))
+
+    def close(self):
+        self.text.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def delete_error_report(user):
+    storage = snapshot_storage()
+    if storage.exists(error_report_path(user)):
+        storage.delete(error_report_path(user))
@@ -1,15 +1,30 @@
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from .models import AuditLog, TaxQualification, Broker, UserProfile
-from django.http import HttpResponse
+from .models import ApiToken, AuditLog, TaxQualification, Broker, UserProfile
+from django.core.handlers.asgi import ASGIRequest
+from django.http import FileResponse, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 from .resources import TaxQualificationResource
 from datetime import datetime
 from django.shortcuts import redirect
 from .forms import ManualEntryForm, CSVUploadForm
-import csv
-import io
-import json
+from .financial import TYPED_COLUMNS, to_decimal
+from .search import search_instruments, SEARCH_LIMIT
+from .reporting import consolidated_report
+from .outbox import enqueue_qualification
+from .live import Scope, hub
+from . import columnar, reconciliation, snapshots, sync
+from .ingest import ingest_stream, load_csv
+from .validation import CSVValidationError, ErrorReport, delete_error_report, error_report_path, open_csv_text
+from django.db import transaction
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+from nuam.db_router import primary_db
+from nuam import profiling, tracing
+import os
 
 # --- VISTA DASHBOARD (CON MULTI-TENANCY) ---
 @login_required
@@ -29,11 +44,11 @@ def home(request):
     # 2. Filtrar Calificaciones
     if user.is_superuser:
         # El admin ve todo (Modo Dios)
-        qualifications = TaxQualification.objects.all().order_by('-created_at')[:20]
+        qualifications = TaxQualification.objects.select_related('broker').order_by('-created_at')[:20]
         broker_name = "ADMINISTRADOR GLOBAL"
     elif user_broker:
         # El usuario normal SOLO ve lo de su broker
-        qualifications = TaxQualification.objects.filter(broker=user_broker).order_by('-created_at')[:20]
+        qualifications = TaxQualification.objects.select_related('broker').filter(broker=user_broker).order_by('-created_at')[:20]
         broker_name = user_broker.name
     else:
         # Usuario huérfano (sin broker asignado)
@@ -43,9 +58,9 @@ def home(request):
     # 3. Filtrar Logs (¿Quién hizo qué?)
     # El admin ve todo el historial; el usuario solo ve sus propias acciones.
     if user.is_superuser:
-        logs = AuditLog.objects.all().order_by('-timestamp')[:50]
+        logs = AuditLog.objects.select_related('user').order_by('-timestamp')[:50]
     else:
-        logs = AuditLog.objects.filter(user=user).order_by('-timestamp')[:20]
+        logs = AuditLog.objects.select_related('user').filter(user=user).order_by('-timestamp')[:20]
     
     context = {
         'logs': logs,
@@ -106,6 +121,34 @@ def update_factor(request):
     return redirect('home')
 
 
+# --- FILTROS POR RANGO (columnas tipadas e indexadas) ---
+RANGE_FILTERS = {
+    'monto_min': ('monto_base', 'gte'),
+    'monto_max': ('monto_base', 'lte'),
+    'credito_min': ('factor_credito', 'gte'),
+    'credito_max': ('factor_credito', 'lte'),
+    'incremento_min': ('factor_incremento', 'gte'),
+    'incremento_max': ('factor_incremento', 'lte'),
+    'year_min': ('exercise_year', 'gte'),
+    'year_max': ('exercise_year', 'lte'),
+}
+
+def apply_range_filters(queryset, params):
+    """Aplica ?monto_min=&monto_max=&credito_min=...&year_min=&year_max=&year= sobre columnas tipadas (sin parsear JSON)."""
+    for param, (column, lookup) in RANGE_FILTERS.items():
+        raw = params.get(param)
+        if column in TYPED_COLUMNS:
+            _, places, max_digits = TYPED_COLUMNS[column]
+            value = to_decimal(raw, places, max_digits)
+        else:
+            value = int(raw) if raw and raw.isdigit() else None
+        if value is not None:
+            queryset = queryset.filter(**{f"{column}__{lookup}": value})
+    year = params.get('year', '')
+    if year.isdigit():
+        queryset = queryset.filter(exercise_year=int(year))
+    return queryset
+
 @login_required
 def export_users_data(request):
     # 1. SEGURIDAD: Obtener el broker del usuario actual
@@ -114,20 +157,80 @@ def export_users_data(request):
     except:
         return HttpResponse("Error: Usuario sin perfil de corredor asignado.", status=403)
 
-    # 2. FILTRADO: Obtener solo los datos de ESTE corredor (Multi-tenancy)
-    dataset = TaxQualificationResource().export(
-        queryset=TaxQualification.objects.filter(broker=user_broker)
-    )
+    # 2. Exportación completa (sin filtros): se sirve el snapshot pre-generado (ETag / 304)
+    fmt = request.GET.get('format', 'xlsx').lower()
+    if not any(request.GET.get(param) for param in (*RANGE_FILTERS, 'year')):
+        return serve_export_snapshot(request, user_broker, fmt)
+
+    # 3. FILTRADO: Obtener solo los datos de ESTE corredor (Multi-tenancy)
+    queryset = apply_range_filters(TaxQualification.objects.filter(broker=user_broker), request.GET)
 
-    # 3. RESPUESTA: Generar archivo Excel (.xlsx)
-    response = HttpResponse(dataset.xlsx, content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+    # Formatos columnares (?format=parquet|arrow): streaming por row groups, sin pasar por XLSX
+    if fmt in columnar.FORMATS:
+        if not columnar.available():
+            return HttpResponse("Formato no disponible en este servidor (falta pyarrow).", status=501)
+        content_type, extension = columnar.FORMATS[fmt]
+        response = StreamingHttpResponse(columnar.stream_export(queryset, fmt), content_type=content_type)
+        filename = f"reporte_{user_broker.code}_{datetime.now().strftime('%Y-%m-%d')}.{extension}"
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+    if fmt not in ('xlsx', 'csv'):
+        return HttpResponse(f"Formato desconocido: {fmt}", status=400)
+
+    dataset = TaxQualificationResource().export(queryset=queryset)
+
+    # 4. RESPUESTA: Excel (.xlsx) o CSV, los mismos formatos que el snapshot
+    content_type, extension, _ = snapshots.FORMATS[fmt]
+    response = HttpResponse(dataset.xlsx if fmt == 'xlsx' else dataset.csv, content_type=content_type)
     
     # Nombre del archivo dinámico: "reporte_LarrainVial_2025-12-10.xlsx"
-    filename = f"reporte_{user_broker.code}_{datetime.now().strftime('%Y-%m-%d')}.xlsx"
+    filename = f"reporte_{user_broker.code}_{datetime.now().strftime('%Y-%m-%d')}.{extension}"
     response['Content-Disposition'] = f'attachment; filename="{filename}"'
     
     return response
 
+@primary_db
+def serve_export_snapshot(request, broker, fmt):
+    """
+    Descarga desde el snapshot del corredor; solo se regenera si cambió la versión de sus datos.
+    En la primaria: con una réplica atrasada el ETag (y el snapshot generado) serían de una versión vieja.
+    """
+    if fmt not in snapshots.FORMATS:
+        return HttpResponse(f"Formato desconocido: {fmt}", status=400)
+    if fmt not in snapshots.available_formats():
+        return HttpResponse("Formato no disponible en este servidor (falta pyarrow).", status=501)
+
+    def validators(version, last_modified):
+        headers = {'ETag': f'"{fmt}-{version}"', 'Cache-Control': 'private, no-cache'}  # Siempre revalidar (datos por tenant)
+        if last_modified:
+            headers['Last-Modified'] = http_date(last_modified.timestamp())
+        return headers
+
+    version, last_modified = snapshots.data_version(broker)
+    not_modified = get_conditional_response(
+        request, etag=f'"{fmt}-{version}"', last_modified=int(last_modified.timestamp()) if last_modified else None
+    )
+    if not_modified is not None:
+        for header, value in validators(version, last_modified).items():
+            not_modified[header] = value
+        return not_modified
+
+    # Los datos pueden cambiar entre la consulta y el lock: los validadores salen del snapshot servido
+    snapshot, _ = snapshots.generate(broker, fmt)
+    headers = validators(snapshot.version, snapshot.data_updated_at)
+    accepts_gzip = 'gzip' in request.headers.get('Accept-Encoding', '')
+    handle, encoding = snapshots.open_snapshot(snapshot, accepts_gzip)
+    content_type, extension, _ = snapshots.FORMATS[fmt]
+    response = FileResponse(handle, content_type=content_type, as_attachment=True,
+                            filename=f"reporte_{broker.code}_{datetime.now().strftime('%Y-%m-%d')}.{extension}")
+    if snapshots.FORMATS[fmt][2]:
+        response['Vary'] = 'Accept-Encoding'
+    if encoding:
+        response['Content-Encoding'] = encoding
+    for header, value in headers.items():
+        response[header] = value
+    return response
+
 @login_required
 def manual_entry(request):
     if request.method == 'POST':
@@ -136,40 +239,249 @@ def manual_entry(request):
             qualification = form.save(commit=False)
             # Asignar automáticamente el Broker del usuario (SEGURIDAD)
             qualification.broker = request.user.userprofile.broker
-            qualification.save()
+            # Dato + evento de dominio en la misma transacción (el relay lo publica en Kafka)
+            with tracing.span('web.db_upsert'), transaction.atomic():
+                qualification.save()
+                enqueue_qualification(qualification, created=True)
             return redirect('home')
     else:
         form = ManualEntryForm()
     
     return render(request, 'manual_entry.html', {'form': form})
 
+UPLOAD_ERROR_PREVIEW = 20  # Errores que se muestran en pantalla; el resto va en el reporte
+
 @login_required
 def upload_csv(request):
+    """
+    Carga CSV en una sola transacción: el archivo se decodifica y valida por bloques
+    (api/validation.py) y las filas válidas de cada bloque se persisten antes de leer el
+    siguiente (ingest.load_csv), con memoria acotada. Las inválidas quedan en un reporte descargable.
+    """
+    result = None
     if request.method == 'POST':
         form = CSVUploadForm(request.POST, request.FILES)
         if form.is_valid():
             csv_file = request.FILES['file']
-            decoded_file = csv_file.read().decode('utf-8')
-            io_string = io.StringIO(decoded_file)
-            reader = csv.DictReader(io_string)
-            
-            for row in reader:
-                # Usamos update_or_create para evitar duplicados (IntegrityError)
-                TaxQualification.objects.update_or_create(
-                    # 1. Campos para BUSCAR si ya existe (La clave única)
-                    broker=request.user.userprofile.broker,
-                    instrument=row.get('instrument', 'Unknown'),
-                    payment_date=row.get('payment_date', '2024-01-01'),
-                    
-                    # 2. Campos para ACTUALIZAR o CREAR
-                    defaults={
-                        'exercise_year': int(row.get('exercise_year', 2024)),
-                        'source': 'CSV',
-                        'financial_data': json.loads(row.get('financial_data', '{}'))
-                    }
-                )
-            return redirect('home')
+            text, encoding = open_csv_text(csv_file)
+            broker = request.user.userprofile.broker
+            with ErrorReport(preview=UPLOAD_ERROR_PREVIEW) as report:
+                try:
+                    with transaction.atomic():
+                        total, loaded = load_csv(text, broker, report)
+                        AuditLog.objects.create(
+                            user=request.user,
+                            action='UPLOAD_CSV',
+                            details=f"Archivo cargado: {csv_file.name} ({encoding}; {loaded} filas válidas, "
+                                    f"{report.rejected} rechazadas)"
+                        )
+                except (CSVValidationError, UnicodeDecodeError) as e:
+                    form.add_error('file', f"Archivo rechazado: {e}")
+                    return render(request, 'upload_csv.html', {'form': form})
+
+                if not report.errors:
+                    delete_error_report(request.user)
+                    return redirect('home')
+                report.save(request.user)
+            result = {'total': total, 'loaded': loaded, 'rejected': report.rejected, 'errors': report.errors,
+                      'preview': report.preview}
     else:
         form = CSVUploadForm()
     
-    return render(request, 'upload_csv.html', {'form': form})
\ No newline at end of file
+    return render(request, 'upload_csv.html', {'form': form, 'result': result})
+
+@login_required
+def upload_csv_report(request):
+    """Reporte de errores (CSV) de la última carga del usuario."""
+    storage = snapshots.snapshot_storage()
+    name = error_report_path(request.user)
+    if not storage.exists(name):
+        return HttpResponse("No hay reporte de errores pendiente.", status=404)
+    return FileResponse(storage.open(name, 'rb'), as_attachment=True, filename='errores_carga.csv',
+                        content_type='text/csv; charset=utf-8')
+
+@login_required
+def search_instruments_view(request):
+    """Autocomplete de instrumentos (?q=&limit=), acotado al corredor del usuario."""
+    user = request.user
+    if user.is_superuser:
+        queryset = TaxQualification.objects.all()
+    else:
+        try:
+            user_broker = user.userprofile.broker
+        except UserProfile.DoesNotExist:
+            user_broker = None
+        queryset = TaxQualification.objects.filter(broker=user_broker) if user_broker else TaxQualification.objects.none()
+
+    limit = request.GET.get('limit', '')
+    limit = min(int(limit), 100) if limit.isdigit() and int(limit) > 0 else SEARCH_LIMIT
+    results = search_instruments(queryset, request.GET.get('q', ''), limit=limit)
+    return JsonResponse({'results': results})
+
+@login_required
+def consolidated_report_view(request):
+    """
+    Reporte consolidado en una moneda (?currency=USD&year=2025).
+    Un corredor solo ve su propio alcance; el admin puede pedir ?broker=CODIGO o ?region=CL|CO|PE|ALL.
+    """
+    user = request.user
+    currency = request.GET.get('currency', 'USD').upper()
+    year = request.GET.get('year', '')
+    year = int(year) if year.isdigit() else datetime.now().year
+
+    if user.is_superuser:
+        if request.GET.get('broker'):
+            broker = Broker.objects.filter(code=request.GET['broker']).first()
+            if broker is None:
+                return JsonResponse({'error': 'Corredor inexistente'}, status=404)
+            scope = ('broker', broker.id)
+        else:
+            region = request.GET.get('region', 'ALL').upper()
+            if region not in {'ALL'} | {code for code, _ in Broker.COUNTRY_CHOICES}:
+                return JsonResponse({'error': 'Región inválida'}, status=400)
+            scope = ('region', region)
+    else:
+        try:
+            user_broker = user.userprofile.broker
+        except UserProfile.DoesNotExist:
+            user_broker = None
+        if user_broker is None:
+            return JsonResponse({'error': 'Usuario sin perfil de corredor asignado'}, status=403)
+        scope = ('broker', user_broker.id)
+
+    try:
+        report = consolidated_report(scope, year, currency)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse(report)
+
+@login_required
+def live_events_view(request):
+    """
+    Stream SSE del dashboard: calificaciones y auditorías nuevas del tenant del usuario.
+    El navegador reconecta solo (EventSource) y retoma desde Last-Event-ID. Bajo ASGI el stream
+    es asíncrono: un dashboard abierto no retiene un hilo del servidor.
+    """
+    stream = hub.astream if isinstance(request, ASGIRequest) else hub.stream
+    response = StreamingHttpResponse(
+        stream(Scope(request.user), request.headers.get('Last-Event-ID')),
+        content_type='text/event-stream',
+    )
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # Proxies (nginx): no bufferizar el stream
+    return response
+
+def _api_token(request):
+    """ApiToken de Authorization: Bearer <token> (None si falta o es inválido); registra su uso."""
+    scheme, _, raw = request.headers.get('Authorization', '').partition(' ')
+    token = ApiToken.authenticate(raw.strip()) if scheme.lower() == 'bearer' else None
+    if token is not None:
+        ApiToken.objects.filter(pk=token.pk).update(last_used_at=timezone.now())
+    return token
+
+def _unauthorized():
+    response = JsonResponse({'error': 'Token inválido o inactivo'}, status=401)
+    response['WWW-Authenticate'] = 'Bearer'
+    return response
+
+@csrf_exempt
+@require_POST
+def bulk_ingest_view(request):
+    """
+    Ingesta NDJSON para integraciones (api/ingest.py). Autenticación: Authorization: Bearer <token>;
+    el token fija el corredor. La respuesta se va emitiendo lote a lote mientras llega el cuerpo.
+    """
+    token = _api_token(request)
+    if token is None:
+        return _unauthorized()
+    encoding = request.headers.get('Content-Encoding', 'identity').lower()
+    if encoding not in ('identity', 'gzip'):
+        return JsonResponse({'error': f'Content-Encoding no soportado: {encoding}'}, status=415)
+
+    response = StreamingHttpResponse(ingest_stream(request, token, gzipped=encoding == 'gzip'),
+                                     content_type='application/x-ndjson')
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+@primary_db
+@require_GET
+def reconciliation_view(request):
+    """
+    Un nodo del árbol de reconciliación del corredor del token (api/reconciliation.py): sin
+    parámetros los años, con ?year= sus meses y con ?year=&month= las filas de esa hoja. Lo usa
+    RemoteTree para comparar ambientes; refresca el árbol (incremental) al pedir la raíz.
+    """
+    token = _api_token(request)
+    if token is None:
+        return _unauthorized()
+    try:
+        path = tuple(int(request.GET[name]) for name in ('year', 'month') if name in request.GET)
+    except ValueError:
+        return JsonResponse({'error': 'year y month deben ser enteros'}, status=400)
+    if 'month' in request.GET and 'year' not in request.GET:
+        return JsonResponse({'error': 'month requiere year'}, status=400)
+    tree = reconciliation.DatabaseTree(token.broker, refresh_first=not path)
+    return JsonResponse({'broker': token.broker.code, **reconciliation.node_payload(tree, path)})
+
+@require_GET
+def sync_view(request):
+    """
+    Cambios del corredor del token desde ?sync_token= (sin él, todo): NDJSON en streaming con
+    upserts, borrados (lápidas) y un token nuevo al final (api/sync.py). ?limit= corta la
+    respuesta en N cambios; el token final continúa desde ahí.
+    """
+    token = _api_token(request)
+    if token is None:
+        return _unauthorized()
+    try:
+        limit = int(request.GET['limit']) if request.GET.get('limit') else None
+    except ValueError:
+        limit = 0
+    if limit is not None and limit < 1:
+        return JsonResponse({'error': 'limit debe ser un entero positivo'}, status=400)
+    cursor = None
+    if request.GET.get('sync_token'):
+        try:
+            cursor = sync.SyncCursor.loads(request.GET['sync_token'], token.broker)
+        except sync.ExpiredSyncToken as e:
+            return JsonResponse({'error': str(e)}, status=410)
+        except sync.InvalidSyncToken as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+    response = StreamingHttpResponse(sync.sync_stream(token.broker, cursor, limit), content_type='application/x-ndjson')
+    response['X-Accel-Buffering'] = 'no'
+    response['Cache-Control'] = 'no-store'
+    return response
+
+# --- DIAGNÓSTICO: PERFILADO BAJO DEMANDA (nuam/profiling.py) ---
+@login_required
+@require_GET
+def profile_view(request):
+    """
+    Muestrea las pilas de este worker durante ?seconds= (defecto 10) y devuelve las pilas
+    colapsadas para un flamegraph. ?mode=cpu|wall, ?interval= en segundos. Solo superusuarios.
+    El muestreo corre en el hilo de esta petición: con un servidor de un solo hilo (gunicorn sync)
+    no quedaría nada que muestrear y el worker se bloquearía; ahí se usa SIGUSR2.
+    """
+    if not request.user.is_superuser:
+        return HttpResponse("Solo superusuarios.", status=403)
+    if not isinstance(request, ASGIRequest) and not request.META.get('wsgi.multithread'):
+        return HttpResponse("Servidor de un solo hilo: perfile el proceso con kill -USR2 <pid>.", status=501)
+    try:
+        seconds = float(request.GET.get('seconds', 10))
+        interval = float(request.GET.get('interval', profiling.DEFAULT_INTERVAL))
+    except ValueError:
+        return HttpResponse("seconds e interval deben ser números", status=400)
+    if not 0 < seconds <= profiling.MAX_SECONDS or not 0.001 <= interval <= 1:
+        return HttpResponse(f"seconds debe estar entre 0 y {profiling.MAX_SECONDS}, interval entre 0.001 y 1", status=400)
+
+    started = datetime.now()
+    try:
+        counts = profiling.sample(seconds, interval, request.GET.get('mode') or None)
+    except ValueError as e:
+        return HttpResponse(str(e), status=400)
+    if counts is None:
+        return HttpResponse("Ya hay un muestreo en curso en este worker.", status=409)
+    response = HttpResponse(''.join(profiling.collapsed_lines(counts)), content_type='text/plain; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="web-{os.getpid()}-{started:%Y%m%d-%H%M%S}.folded"'
+    return response
@@ -0,0 +1,103 @@
+"""
+Ruteo de lecturas a la réplica (settings.DATABASE_REPLICA) con read-your-writes.
+
+- Las peticiones de solo lectura (GET/HEAD/OPTIONS) leen de la réplica: dashboard,
+  exportaciones, reportes, changelists del admin.
+- Toda escritura va a 'default'. Tras un POST/PUT/PATCH/DELETE la sesión queda "anclada"
+  a la primaria REPLICA_PIN_SECONDS (cookie), para que el usuario vea lo que acaba de escribir.
+- Fuera de una petición (consumer, comandos) no hay réplica: todo va a 'default'.
+"""
+import contextvars
+import functools
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+PIN_COOKIE = 'nuam_db_pin'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_read_alias = contextvars.ContextVar('nuam_read_alias', default=None)
+
+
+def replica_alias():
+    return getattr(settings, 'DATABASE_REPLICA', None)
+
+
+@contextmanager
+def read_from(alias):
+    """Dirige las lecturas del bloque a `alias` (None = primaria)."""
+    token = _read_alias.set(alias)
+    try:
+        yield
+    finally:
+        _read_alias.reset(token)
+
+
+def use_replica():
+    return read_from(replica_alias())
+
+
+def use_primary():
+    return read_from(None)
+
+
+def primary_db(view):
+    """Decorador para vistas GET que escriben y luego leen lo escrito (deben ir a la primaria)."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        with use_primary():
+            return view(*args, **kwargs)
+    return wrapper
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        alias = _read_alias.get()
+        if alias is None:
+            return None
+        # Dentro de una transacción de escritura se lee de la primaria (ve sus propios cambios)
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return alias
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True  # Réplica y primaria tienen los mismos datos
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db != replica_alias()  # La réplica se sincroniza desde la primaria
+
+
+def _stream_with(alias, content):
+    with read_from(alias):
+        yield from content
+
+
+class ReplicaRoutingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        alias = replica_alias()
+        try:
+            pinned = float(request.COOKIES.get(PIN_COOKIE, 0)) > time.time()
+        except ValueError:
+            pinned = False
+        read_alias = alias if alias and request.method in SAFE_METHODS and not pinned else None
+
+        with read_from(read_alias):
+            response = self.get_response(request)
+
+        # Las respuestas streaming se consumen después: mantienen el mismo destino de lectura
+        if read_alias and response.streaming and not getattr(response, 'is_async', False):
+            response.streaming_content = _stream_with(read_alias, response.streaming_content)
+
+        if alias and request.method not in SAFE_METHODS:
+            pin_seconds = settings.REPLICA_PIN_SECONDS
+            response.set_cookie(PIN_COOKIE, f"{time.time() + pin_seconds:.3f}", max_age=pin_seconds,
+                                httponly=True, samesite='Lax')
+        return response
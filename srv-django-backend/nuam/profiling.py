@@ -0,0 +1,311 @@
+"""
+Perfilado bajo demanda de procesos en producción (web, consumer, notifier, comandos).
+
+La salida siempre es en pilas colapsadas ("hilo;f1 (archivo:línea);f2 (...) N" por línea),
+el formato que leen flamegraph.pl, inferno y speedscope:
+
+- Muestreo: un hilo aparte lee las pilas de todos los hilos del proceso cada `interval`
+  segundos durante N segundos. No instrumenta nada: fuera de esa ventana no existe.
+  * Web: GET /debug/profile/?seconds=10 (solo superusuarios) muestrea el worker que atiende
+    la petición y devuelve el .folded (con servidores multi-hilo, como runserver_plus).
+  * Cualquier proceso con install_signal_handler(): kill -USR2 <pid> deja
+    NUAM_PROFILE_DIR/<servicio>-<pid>-<fecha>.folded tras NUAM_PROFILE_SECONDS segundos.
+  En modo 'cpu' (defecto en Linux) cada muestra pesa los ticks de CPU que el hilo gastó desde
+  la anterior (/proc/self/task): los hilos bloqueados en I/O (poll de Kafka, socket) no
+  aparecen. En modo 'wall' cada muestra pesa 1 (latencia, esperas).
+- cProfile por petición: NUAM_PROFILE_PATHS=<regex> perfila las peticiones cuyo path coincide
+  (una a la vez) y deja <dir>/<path>-<fecha>-<ms>ms.prof (pstats, para snakeviz) y el .folded
+  equivalente. Sin la variable, ProfilingMiddleware se retira de la cadena al arrancar
+  (MiddlewareNotUsed): costo cero por petición.
+
+Solo usa la biblioteca estándar (lo importa el notifier, que no tiene Django). Resumen de un
+perfil (funciones con más tiempo propio y total):
+
+    python -m nuam.profiling perfil.folded --top 20
+    python -m nuam.profiling perfil.prof --collapse perfil.folded   # pstats → pilas colapsadas
+"""
+import argparse
+import cProfile
+import os
+import pstats
+import re
+import signal
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+DEFAULT_SERVICE = os.environ.get('NUAM_SERVICE_NAME', 'backend')
+DEFAULT_INTERVAL = 0.01
+DEFAULT_SECONDS = float(os.environ.get('NUAM_PROFILE_SECONDS', '30'))
+MAX_SECONDS = 300
+PROC_TASKS = '/proc/self/task'
+MIN_SHARE = 0.0005  # Conversión de pstats: ramas con menos de 0,05% del total no se expanden
+
+_sampling = threading.Lock()  # Un muestreo a la vez por proceso
+_labels = {}
+
+
+def profile_dir():
+    directory = os.environ.get('NUAM_PROFILE_DIR') or tempfile.gettempdir()
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def _short(filename):
+    return '/'.join(filename.replace('\\', '/').rsplit('/', 2)[-2:])
+
+
+def frame_label(code):
+    label = _labels.get(code)
+    if label is None:
+        label = _labels[code] = f"{code.co_name} ({_short(code.co_filename)}:{code.co_firstlineno})".replace(';', ':')
+    return label
+
+
+def stack_of(frame):
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame.f_code))
+        frame = frame.f_back
+    labels.reverse()
+    return ';'.join(labels)
+
+
+# --- MUESTREO ---
+def cpu_available():
+    return os.path.isdir(PROC_TASKS)
+
+
+def _cpu_ticks(native_id):
+    """utime + stime del hilo (ticks); None si ya terminó."""
+    try:
+        with open(f"{PROC_TASKS}/{native_id}/stat", 'rb') as f:
+            fields = f.read().rsplit(b')', 1)[1].split()
+    except OSError:
+        return None
+    return int(fields[11]) + int(fields[12])
+
+
+class Sampler:
+    """Cuenta las pilas de todos los hilos del proceso salvo el propio (ver docstring del módulo)."""
+
+    def __init__(self, interval=DEFAULT_INTERVAL, mode=None):
+        self.interval = interval
+        self.mode = mode or ('cpu' if cpu_available() else 'wall')
+        if self.mode not in ('cpu', 'wall'):
+            raise ValueError(f"Modo de muestreo desconocido: {self.mode}")
+        if self.mode == 'cpu' and not cpu_available():
+            raise ValueError("El modo 'cpu' requiere /proc (Linux)")
+        self.counts = Counter()
+        self.samples = 0
+
+    def run(self, seconds):
+        me = threading.get_ident()
+        ticks = {}
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            threads = {thread.ident: thread for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                thread = threads.get(ident)
+                weight = 1
+                if self.mode == 'cpu':
+                    current = _cpu_ticks(thread.native_id) if thread is not None else None
+                    previous = ticks.get(ident)
+                    ticks[ident] = current
+                    weight = current - previous if current is not None and previous is not None else 0
+                if weight:
+                    self.counts[f"{thread.name if thread else ident};{stack_of(frame)}"] += weight
+            self.samples += 1
+            time.sleep(self.interval)
+        return self.counts
+
+
+def sample(seconds, interval=DEFAULT_INTERVAL, mode=None):
+    """Pilas colapsadas de los próximos `seconds` segundos; None si ya hay un muestreo en curso."""
+    if not _sampling.acquire(blocking=False):
+        return None
+    try:
+        return Sampler(interval, mode).run(min(seconds, MAX_SECONDS))
+    finally:
+        _sampling.release()
+
+
+def collapsed_lines(counts):
+    return [f"{stack} {int(count)}\n" for stack, count in sorted(counts.items()) if int(count) > 0]
+
+
+def write_collapsed(counts, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.writelines(collapsed_lines(counts))
+    return path
+
+
+def _sample_to_file(service, seconds, interval, mode):
+    started = datetime.now()
+    counts = sample(seconds, interval, mode)
+    if counts is None:
+        print(f"⚠️ Perfilado de {service}: ya hay un muestreo en curso")
+        return
+    path = os.path.join(profile_dir(), f"{service}-{os.getpid()}-{started:%Y%m%d-%H%M%S}.folded")
+    write_collapsed(counts, path)
+    print(f"🔥 Perfil de {service} ({seconds:g}s, {sum(counts.values())} muestras): {path}")
+
+
+def install_signal_handler(service=DEFAULT_SERVICE, signum=None, seconds=None, interval=DEFAULT_INTERVAL, mode=None):
+    """
+    Al recibir `signum` (SIGUSR2) muestrea `seconds` segundos en un hilo aparte y escribe el
+    .folded. Solo desde el hilo principal (restricción de signal); devuelve si quedó instalado.
+    """
+    signum = signum if signum is not None else getattr(signal, 'SIGUSR2', None)
+    if signum is None or threading.current_thread() is not threading.main_thread():
+        return False
+    seconds = seconds or DEFAULT_SECONDS
+
+    def handler(received, frame):
+        threading.Thread(target=_sample_to_file, args=(service, seconds, interval, mode),
+                         name='nuam-profiler', daemon=True).start()
+
+    signal.signal(signum, handler)
+    return True
+
+
+# --- CPROFILE → PILAS COLAPSADAS ---
+def _pstats_label(func):
+    filename, line, name = func
+    if filename == '~':  # Función C: "<built-in method ...>"
+        return name.replace(';', ':')
+    return f"{name} ({_short(filename)}:{line})".replace(';', ':')
+
+
+def pstats_collapsed(stats, unit=1e-6):
+    """
+    Pilas aproximadas (en microsegundos) desde un pstats.Stats. cProfile solo guarda aristas
+    llamador → llamado: el tiempo de cada función se reparte entre sus llamados según el
+    tiempo acumulado de cada arista, como hacen flameprof y similares.
+    """
+    entries = stats.stats
+    callees = defaultdict(dict)
+    for func, (_, _, _, _, callers) in entries.items():
+        for caller, edge in callers.items():
+            callees[caller][func] = edge[3]
+    roots = [func for func, (_, _, _, _, callers) in entries.items() if not callers]
+    threshold = sum(entries[func][3] for func in roots) * MIN_SHARE
+    counts = Counter()
+
+    def walk(func, path, seen, spent):
+        _, _, own, total, _ = entries[func]
+        if total <= 0 or spent <= threshold:
+            return
+        path = f"{path};{_pstats_label(func)}" if path else _pstats_label(func)
+        scale = spent / total
+        counts[path] += own * scale / unit
+        for child, child_total in callees[func].items():
+            if child not in seen:
+                walk(child, path, seen | {child}, child_total * scale)
+
+    for root in roots:
+        walk(root, '', {root}, entries[root][3])
+    return counts
+
+
+def load_collapsed(path):
+    counts = Counter()
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            stack, _, count = line.rstrip('\n').rpartition(' ')
+            if stack:
+                counts[stack] += int(count)
+    return counts
+
+
+# --- DJANGO ---
+def _slug(path):
+    return re.sub(r'[^A-Za-z0-9]+', '_', path).strip('_')[:80] or 'root'
+
+
+class ProfilingMiddleware:
+    """
+    cProfile de las peticiones cuyo path coincide con NUAM_PROFILE_PATHS (regex). Una petición
+    a la vez: las concurrentes pasan sin perfilar. En las respuestas streaming el perfil sigue
+    hasta terminar de enviar el cuerpo.
+    """
+
+    def __init__(self, get_response):
+        pattern = os.environ.get('NUAM_PROFILE_PATHS', '')
+        if not pattern:
+            from django.core.exceptions import MiddlewareNotUsed
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.pattern = re.compile(pattern)
+        self.lock = threading.Lock()
+
+    def __call__(self, request):
+        if not self.pattern.search(request.path) or not self.lock.acquire(blocking=False):
+            return self.get_response(request)
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            response = self.get_response(request)
+        except BaseException:
+            self.finish(profiler, request, started)
+            raise
+        if response.streaming and not getattr(response, 'is_async', False):
+            response.streaming_content = self.stream(profiler, request, started, response.streaming_content)
+        else:
+            self.finish(profiler, request, started)
+        return response
+
+    def stream(self, profiler, request, started, content):
+        try:
+            yield from content
+        finally:
+            self.finish(profiler, request, started)
+
+    def finish(self, profiler, request, started):
+        try:
+            profiler.disable()
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            base = os.path.join(profile_dir(), f"{_slug(request.path)}-{datetime.now():%Y%m%d-%H%M%S-%f}-{elapsed_ms:.0f}ms")
+            profiler.dump_stats(f"{base}.prof")
+            write_collapsed(pstats_collapsed(pstats.Stats(profiler)), f"{base}.folded")
+        finally:
+            self.lock.release()
+
+
+# --- ANÁLISIS OFFLINE ---
+def top(counts, limit=25):
+    """[(función, % propio, % total)] ordenado por tiempo propio."""
+    grand = sum(counts.values()) or 1
+    own, inclusive = Counter(), Counter()
+    for stack, count in counts.items():
+        frames = stack.split(';')
+        own[frames[-1]] += count
+        for frame in set(frames):
+            inclusive[frame] += count
+    return [(frame, 100 * count / grand, 100 * inclusive[frame] / grand) for frame, count in own.most_common(limit)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m nuam.profiling', description="Resumen de un perfil (.folded o .prof)")
+    parser.add_argument('path')
+    parser.add_argument('--top', type=int, default=25, help="Funciones a listar")
+    parser.add_argument('--collapse', metavar='SALIDA', help="Escribe el .prof como pilas colapsadas")
+    args = parser.parse_args(argv)
+
+    counts = pstats_collapsed(pstats.Stats(args.path)) if args.path.endswith('.prof') else load_collapsed(args.path)
+    if args.collapse:
+        write_collapsed(counts, args.collapse)
+        print(f"📝 {len(counts)} pilas en {args.collapse}")
+    print(f"{'propio':>7} {'total':>7}  función")
+    for frame, own, total in top(counts, args.top):
+        print(f"{own:6.1f}% {total:6.1f}%  {frame}")
+
+
+if __name__ == '__main__':
+    main()
@@ -40,6 +40,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',  # Búsqueda trigram (pg_trgm)
     'api.apps.ApiConfig',
     'django_extensions',
     'import_export',
@@ -48,12 +49,15 @@ INSTALLED_APPS = [
 IMPORT_EXPORT_USE_TRANSACTIONS = True
 
 MIDDLEWARE = [
+    'nuam.tracing.TracingMiddleware',  # Span por petición (NUAM_TRACING, ver nuam/tracing.py)
+    'nuam.profiling.ProfilingMiddleware',  # cProfile de las rutas en NUAM_PROFILE_PATHS (sin ella no se instala)
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'nuam.db_router.ReplicaRoutingMiddleware',  # Lecturas GET -> réplica (si está configurada)
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -86,6 +90,20 @@ DATABASES = {
     'default': dj_database_url.config(conn_max_age=600)
 }
 
+# --- RÉPLICA DE LECTURA (opcional) ---
+# Dashboards, exportaciones y reportes leen de aquí; las escrituras siempre van a 'default'.
+# En local puede apuntar a un segundo Postgres o a la misma BD como stand-in.
+REPLICA_DATABASE_URL = os.environ.get('REPLICA_DATABASE_URL')
+DATABASE_REPLICA = None
+if REPLICA_DATABASE_URL:
+    DATABASE_REPLICA = 'replica'
+    DATABASES[DATABASE_REPLICA] = dj_database_url.parse(REPLICA_DATABASE_URL, conn_max_age=600)
+    DATABASES[DATABASE_REPLICA]['TEST'] = {'MIRROR': 'default'}
+
+DATABASE_ROUTERS = ['nuam.db_router.PrimaryReplicaRouter']
+# Segundos que un usuario lee de la primaria tras escribir (read-your-writes)
+REPLICA_PIN_SECONDS = int(os.environ.get('REPLICA_PIN_SECONDS', '5'))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
@@ -136,6 +154,13 @@ STATICFILES_DIRS = [
     BASE_DIR / "nuam" / "static",
 ]
 
+# --- SNAPSHOTS DE EXPORTACIÓN (api/snapshots.py) ---
+# Cualquier backend de Storage de Django (disco local por defecto; p. ej. S3 en producción)
+EXPORT_SNAPSHOT_STORAGE = {
+    'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    'OPTIONS': {'location': os.environ.get('EXPORT_SNAPSHOT_ROOT', str(BASE_DIR / 'exports'))},
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
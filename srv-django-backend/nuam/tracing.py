@@ -0,0 +1,408 @@
+"""
+Trazas distribuidas entre servicios: simulador/web → outbox (relay) → Kafka → consumer / notifier.
+
+El contexto viaja en formato W3C traceparent ("00-<trace_id>-<span_id>-01"): en el header
+Kafka 'traceparent' de cada mensaje y en el header HTTP del mismo nombre. Cada servicio
+abre sus spans como hijos del contexto recibido, así una calificación que llega tarde se
+puede descomponer en producción, espera en el outbox, cola de Kafka, escritura en BD,
+auditoría y entrega del correo.
+
+NUAM_TRACING elige a dónde se exportan los spans terminados (una línea JSON por span):
+- vacío u 'off' (defecto): no se exporta nada; la propagación de contexto sigue activa.
+- file:/ruta/trazas.jsonl: append al archivo. Varios procesos pueden compartirlo (cada span
+  es una sola escritura O_APPEND): hace de colector local.
+- memory: lista en memoria del proceso (tests y pipeline_bench.py).
+- stdout: una línea por span en la salida estándar.
+
+Solo usa la biblioteca estándar: también la importa el notifier, que no tiene Django.
+Análisis offline del archivo exportado:
+
+    python -m nuam.tracing trazas.jsonl                 # desglose de latencia por etapa
+    python -m nuam.tracing trazas.jsonl --slowest 5     # + las 5 trazas más lentas
+    python -m nuam.tracing trazas.jsonl --trace <id>    # árbol de spans de una traza
+"""
+import argparse
+import contextvars
+import json
+import os
+import re
+import secrets
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import NamedTuple
+
+HEADER = 'traceparent'
+DEFAULT_SERVICE = os.environ.get('NUAM_SERVICE_NAME', 'backend')
+
+_TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$')
+_current = contextvars.ContextVar('nuam_span', default=None)
+
+
+class SpanContext(NamedTuple):
+    """Contexto remoto (extraído de un header): solo identifica al padre."""
+    trace_id: str
+    span_id: str
+
+
+# --- SPANS ---
+class Span:
+    """
+    Un tramo de trabajo con inicio y fin (epoch en segundos). Sin padre explícito cuelga del
+    span activo del contexto; sin ninguno, inicia una traza nueva. Los hijos locales heredan
+    el servicio del padre.
+    """
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'service', 'start', 'end', 'attributes', 'error')
+
+    def __init__(self, name, parent=None, service=None, start=None, **attributes):
+        parent = parent if parent is not None else _current.get()
+        self.name = name
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else None
+        self.service = service or getattr(parent, 'service', None) or DEFAULT_SERVICE
+        self.start = time.time() if start is None else start
+        self.end = None
+        self.attributes = attributes
+        self.error = None
+
+    @property
+    def traceparent(self):
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def fail(self, error):
+        self.error = f"{type(error).__name__}: {error}"[:500] if isinstance(error, BaseException) else str(error)
+
+    def finish(self, end=None):
+        """Cierra el span y lo exporta (una sola vez)."""
+        if self.end is not None:
+            return
+        self.end = time.time() if end is None else end
+        target = exporter()
+        if target is not None:
+            target.export(self.to_dict())
+
+    def to_dict(self):
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'service': self.service,
+            'start': round(self.start, 6),
+            'end': round(self.end, 6),
+            'duration_ms': round((self.end - self.start) * 1000, 3),
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+@contextmanager
+def activate(span):
+    """Deja `span` como activo en el bloque (no lo cierra)."""
+    token = _current.set(span)
+    try:
+        yield span
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def span(name, parent=None, service=None, **attributes):
+    """Span hijo del activo (o de `parent`) que cubre el bloque; una excepción queda como error."""
+    current = Span(name, parent=parent, service=service, **attributes)
+    try:
+        with activate(current):
+            yield current
+    except BaseException as e:
+        current.fail(e)
+        raise
+    finally:
+        current.finish()
+
+
+def record(name, start, end, parent=None, service=None, **attributes):
+    """Span ya transcurrido, con instantes explícitos (p. ej. la espera de un mensaje en Kafka)."""
+    done = Span(name, parent=parent, service=service, start=start, **attributes)
+    done.finish(end)
+    return done
+
+
+def record_queue(msg, parent, service, name='kafka.queue'):
+    """Span desde que se produjo el mensaje (timestamp de Kafka) hasta que este consumidor lo leyó."""
+    timestamp_type, timestamp_ms = msg.timestamp()
+    if parent is None or not timestamp_type or timestamp_ms <= 0:
+        return None
+    return record(name, timestamp_ms / 1000, time.time(), parent=parent, service=service,
+                  topic=msg.topic(), partition=msg.partition(), offset=msg.offset())
+
+
+def current():
+    return _current.get()
+
+
+# --- PROPAGACIÓN ---
+def traceparent(span=None):
+    """Header traceparent del span dado o del activo ('' si no hay ninguno)."""
+    span = span or _current.get()
+    return f"00-{span.trace_id}-{span.span_id}-01" if span else ''
+
+
+def parse(value):
+    """SpanContext de un traceparent (str o bytes); None si falta o es inválido."""
+    if isinstance(value, bytes):
+        value = value.decode('ascii', 'replace')
+    match = _TRACEPARENT.match((value or '').strip().lower())
+    if not match or match.group(1) == '0' * 32 or match.group(2) == '0' * 16:
+        return None
+    return SpanContext(match.group(1), match.group(2))
+
+
+def extract(headers):
+    """Contexto del header traceparent: lista de (clave, bytes) de Kafka o dict (HTTP)."""
+    if not headers:
+        return None
+    if isinstance(headers, dict):
+        return parse(headers.get(HEADER))
+    for key, value in headers:
+        if key == HEADER:
+            return parse(value)
+    return None
+
+
+def inject(headers=None, span=None):
+    """Headers Kafka con el traceparent del span dado o del activo (reemplaza uno previo)."""
+    value = traceparent(span)
+    headers = [(k, v) for k, v in (headers or []) if not (value and k == HEADER)]
+    if value:
+        headers.append((HEADER, value.encode('ascii')))
+    return headers
+
+
+# --- EXPORTADORES ---
+class FileExporter:
+    """Append de una línea JSON por span; O_APPEND + una escritura por línea: seguro entre procesos."""
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def export(self, data):
+        os.write(self._fd, (json.dumps(data, ensure_ascii=False, default=str, separators=(',', ':')) + '\n')
+                 .encode('utf-8'))
+
+    def close(self):
+        os.close(self._fd)
+
+
+class StreamExporter:
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self._lock = threading.Lock()
+
+    def export(self, data):
+        with self._lock:
+            self.stream.write(json.dumps(data, ensure_ascii=False, default=str) + '\n')
+
+    def close(self):
+        self.stream.flush()
+
+
+class MemoryExporter:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, data):
+        self.spans.append(data)  # append es atómico bajo el GIL
+
+    def close(self):
+        pass
+
+
+_exporter = None
+_configured = False
+_exporter_lock = threading.Lock()
+
+
+def build_exporter(spec):
+    spec = (spec or '').strip()
+    if spec in ('', 'off', 'none'):
+        return None
+    if spec == 'memory':
+        return MemoryExporter()
+    if spec == 'stdout':
+        return StreamExporter()
+    if spec.startswith('file:'):
+        return FileExporter(spec[len('file:'):])
+    raise ValueError(f"NUAM_TRACING desconocido: {spec}")
+
+
+def configure(spec=None):
+    """(Re)configura el exportador del proceso; sin argumento lee NUAM_TRACING. Devuelve el exportador."""
+    global _exporter, _configured
+    with _exporter_lock:
+        if _exporter is not None:
+            _exporter.close()
+        _exporter = build_exporter(os.environ.get('NUAM_TRACING', '') if spec is None else spec)
+        _configured = True
+        return _exporter
+
+
+def exporter():
+    if not _configured:
+        configure()
+    return _exporter
+
+
+# --- DJANGO ---
+def _stream_within(span, content):
+    try:
+        with activate(span):
+            yield from content
+    except BaseException as e:
+        span.fail(e)
+        raise
+    finally:
+        span.finish()
+
+
+class TracingMiddleware:
+    """
+    Un span por petición, hijo del header traceparent entrante si lo hay. Los OutboxEvent que
+    escriba la vista guardan su contexto (api/outbox.py) y el relay lo propaga a Kafka.
+    En las respuestas streaming el span sigue abierto hasta terminar de enviar el cuerpo.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        current = Span('http', parent=parse(request.META.get('HTTP_TRACEPARENT')), service='web',
+                       method=request.method, path=request.path)
+        try:
+            with activate(current):
+                response = self.get_response(request)
+        except BaseException as e:
+            current.fail(e)
+            current.finish()
+            raise
+
+        match = getattr(request, 'resolver_match', None)
+        current.name = f"http {request.method} {match.view_name if match else request.path}"
+        current.set(status=response.status_code)
+        if response.streaming and not getattr(response, 'is_async', False):
+            response.streaming_content = _stream_within(current, response.streaming_content)
+        else:
+            current.finish()
+        return response
+
+
+# --- ANÁLISIS OFFLINE ---
+def load(path, trace_id=None):
+    spans = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                data = json.loads(line)
+                if trace_id is None or data['trace_id'] == trace_id:
+                    spans.append(data)
+    return spans
+
+
+def _percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, round(q / 100 * (len(ordered) - 1)))]
+
+
+def percentile(values, q):
+    """Percentil q (0-100) por rango más cercano; lo usan también simulate_bolsa y pipeline_bench."""
+    return _percentile(sorted(values), q)
+
+
+def breakdown(spans):
+    """[(servicio, nombre, cantidad, errores, p50, p95, p99, máx)] en ms, por etapa."""
+    stages = defaultdict(list)
+    errors = defaultdict(int)
+    for data in spans:
+        key = (data['service'], data['name'])
+        stages[key].append(data['duration_ms'])
+        errors[key] += bool(data.get('error'))
+    rows = []
+    for (service, name), durations in stages.items():
+        durations.sort()
+        rows.append((service, name, len(durations), errors[(service, name)], _percentile(durations, 50),
+                     _percentile(durations, 95), _percentile(durations, 99), durations[-1]))
+    return sorted(rows, key=lambda row: (row[0], row[1]))
+
+
+def traces(spans):
+    """{trace_id: (duración de punta a punta en ms, spans)}: del primer inicio al último fin."""
+    grouped = defaultdict(list)
+    for data in spans:
+        grouped[data['trace_id']].append(data)
+    return {
+        trace_id: ((max(s['end'] for s in members) - min(s['start'] for s in members)) * 1000, members)
+        for trace_id, members in grouped.items()
+    }
+
+
+def tree_lines(spans):
+    """Árbol indentado de una traza, con el desfase de cada span respecto del inicio."""
+    children = defaultdict(list)
+    ids = {data['span_id'] for data in spans}
+    for data in spans:
+        children[data['parent_id'] if data['parent_id'] in ids else None].append(data)
+    origin = min(data['start'] for data in spans)
+    lines = []
+
+    def walk(parent_id, depth):
+        for data in sorted(children[parent_id], key=lambda s: s['start']):
+            error = f"  ❌ {data['error']}" if data.get('error') else ''
+            lines.append(f"{'  ' * depth}{data['service']}/{data['name']}  +{(data['start'] - origin) * 1000:.1f}ms "
+                         f"{data['duration_ms']:.1f}ms{error}")
+            walk(data['span_id'], depth + 1)
+    walk(None, 0)
+    return lines
+
+
+def report(spans, slowest=0):
+    lines = [f"{'servicio':<10} {'etapa':<36} {'n':>7} {'err':>5} {'p50':>9} {'p95':>9} {'p99':>9} {'máx':>9}"]
+    for service, name, count, errors, p50, p95, p99, top in breakdown(spans):
+        lines.append(f"{service:<10} {name[:36]:<36} {count:>7} {errors:>5} {p50:>9.1f} {p95:>9.1f} "
+                     f"{p99:>9.1f} {top:>9.1f}")
+    by_trace = traces(spans)
+    if by_trace:
+        totals = sorted(duration for duration, _ in by_trace.values())
+        lines.append(f"punta a punta: {len(totals)} trazas, p50 {_percentile(totals, 50):.1f}ms, "
+                     f"p95 {_percentile(totals, 95):.1f}ms, p99 {_percentile(totals, 99):.1f}ms (ms)")
+    for trace_id, (duration, members) in sorted(by_trace.items(), key=lambda item: -item[1][0])[:slowest]:
+        lines.append(f"\n🐢 {trace_id} ({duration:.1f}ms)")
+        lines.extend(f"   {line}" for line in tree_lines(members))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Desglose de latencia de un archivo de trazas (NUAM_TRACING=file:...)")
+    parser.add_argument('path')
+    parser.add_argument('--trace', help="Muestra solo el árbol de esta traza")
+    parser.add_argument('--slowest', type=int, default=0, help="Muestra el árbol de las N trazas más lentas")
+    args = parser.parse_args(argv)
+
+    spans = load(args.path, args.trace)
+    if not spans:
+        print("Sin spans")
+    elif args.trace:
+        print('\n'.join(tree_lines(spans)))
+    else:
+        print(report(spans, args.slowest))
+
+
+if __name__ == '__main__':
+    main()
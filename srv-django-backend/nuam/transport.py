@@ -0,0 +1,583 @@
+"""
+Transporte de eventos con la API de confluent_kafka (Producer / Consumer / TopicPartition).
+
+NUAM_TRANSPORT elige la implementación:
+- kafka (defecto): confluent_kafka contra el bootstrap.servers de la configuración.
+- memory: bus en memoria del proceso (tests y benchmark end-to-end sin Kafka).
+- file:/ruta: un log append-only por partición en disco; productores y consumidores en
+  procesos distintos se ven entre sí (desarrollo local sin levantar Kafka).
+
+El stand-in local cubre lo que usan consumer, notifier, relay y simulador: particiones
+(crc32 de la key, como el particionador por defecto de librdkafka), grupos de consumo
+con rebalanceo entre miembros del mismo proceso, offsets confirmados por grupo,
+pause/resume/seek, watermarks y callbacks de entrega. No replica retención, réplicas
+ni transacciones. En modo file cada proceso coordina su propio grupo: correr un solo
+miembro por grupo (recibe todas las particiones).
+"""
+import base64
+import fcntl
+import json
+import os
+import threading
+import time
+import zlib
+from types import SimpleNamespace
+
+OFFSET_BEGINNING = -2
+OFFSET_END = -1
+OFFSET_INVALID = -1001
+TIMESTAMP_CREATE_TIME = 1
+
+DEFAULT_PARTITIONS = int(os.environ.get('NUAM_TRANSPORT_PARTITIONS', '3'))
+FILE_POLL_INTERVAL = 0.05  # Modo file: cada cuánto se revisa si otro proceso escribió
+
+
+def transport_name():
+    return os.environ.get('NUAM_TRANSPORT', 'kafka')
+
+
+# --- API PÚBLICA (mismos nombres que confluent_kafka: el reemplazo es un cambio de import) ---
+def Producer(config):
+    if transport_name() == 'kafka':
+        from confluent_kafka import Producer as KafkaProducer
+        return KafkaProducer(config)
+    return LocalProducer(config, local_broker())
+
+
+def Consumer(config):
+    if transport_name() == 'kafka':
+        from confluent_kafka import Consumer as KafkaConsumer
+        return KafkaConsumer(config)
+    return LocalConsumer(config, local_broker())
+
+
+def TopicPartition(topic, partition=-1, offset=OFFSET_INVALID):
+    if transport_name() == 'kafka':
+        from confluent_kafka import TopicPartition as KafkaTopicPartition
+        return KafkaTopicPartition(topic, partition, offset)
+    return LocalTopicPartition(topic, partition, offset)
+
+
+_brokers = {}
+_brokers_lock = threading.Lock()
+
+
+def local_broker(name=None):
+    """Broker local compartido por todo el proceso para ese transporte."""
+    name = name or transport_name()
+    with _brokers_lock:
+        if name not in _brokers:
+            if name == 'memory':
+                store = MemoryStore()
+            elif name.startswith('file:'):
+                store = FileStore(name[len('file:'):])
+            else:
+                raise ValueError(f"NUAM_TRANSPORT desconocido: {name}")
+            _brokers[name] = LocalBroker(store)
+        return _brokers[name]
+
+
+def reset_memory():
+    """Descarta el bus en memoria (tests)."""
+    with _brokers_lock:
+        _brokers.pop('memory', None)
+
+
+# --- MENSAJES ---
+def _bytes(value):
+    if value is None or isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    return bytes(value)
+
+
+def _headers(headers):
+    if not headers:
+        return None
+    items = headers.items() if isinstance(headers, dict) else headers
+    return [(k, _bytes(v)) for k, v in items]
+
+
+class LocalTopicPartition:
+    __slots__ = ('topic', 'partition', 'offset', 'error')
+
+    def __init__(self, topic, partition=-1, offset=OFFSET_INVALID):
+        self.topic = topic
+        self.partition = partition
+        self.offset = offset
+        self.error = None
+
+    def __repr__(self):
+        return f"TopicPartition({self.topic!r}, {self.partition}, {self.offset})"
+
+
+class LocalMessage:
+    """Registro (key, value, headers, timestamp ms) con los accesores de confluent_kafka.Message."""
+    __slots__ = ('_topic', '_partition', '_offset', '_record')
+
+    def __init__(self, topic, partition, offset, record):
+        self._topic, self._partition, self._offset, self._record = topic, partition, offset, record
+
+    def topic(self):
+        return self._topic
+
+    def partition(self):
+        return self._partition
+
+    def offset(self):
+        return self._offset
+
+    def key(self):
+        return self._record[0]
+
+    def value(self):
+        return self._record[1]
+
+    def headers(self):
+        return list(self._record[2]) if self._record[2] else None
+
+    def timestamp(self):
+        return TIMESTAMP_CREATE_TIME, self._record[3]
+
+    def error(self):
+        return None
+
+    def __len__(self):
+        return len(self._record[1] or b'')
+
+
+# --- ALMACENAMIENTO ---
+class MemoryStore:
+    def __init__(self, partitions=DEFAULT_PARTITIONS):
+        self.default_partitions = partitions
+        self._cond = threading.Condition()
+        self._logs = {}      # tópico -> [registros] por partición
+        self._offsets = {}   # (grupo, tópico, partición) -> offset confirmado
+        self._version = 0    # Cambia con cada escritura: despierta a los consumidores en espera
+
+    def topics(self):
+        with self._cond:
+            return sorted(self._logs)
+
+    def partitions(self, topic):
+        with self._cond:
+            return len(self._logs.setdefault(topic, [[] for _ in range(self.default_partitions)]))
+
+    def append(self, topic, partition, records):
+        with self._cond:
+            log = self._logs.setdefault(topic, [[] for _ in range(self.default_partitions)])[partition]
+            first = len(log)
+            log.extend(records)
+            self._version += 1
+            self._cond.notify_all()
+            return first
+
+    def read(self, topic, partition, offset, limit):
+        with self._cond:
+            logs = self._logs.get(topic)
+            return logs[partition][offset:offset + limit] if logs else []
+
+    def watermarks(self, topic, partition):
+        with self._cond:
+            logs = self._logs.get(topic)
+            return 0, len(logs[partition]) if logs else 0
+
+    def committed(self, group, topic, partition):
+        with self._cond:
+            return self._offsets.get((group, topic, partition))
+
+    def commit(self, group, offsets):
+        with self._cond:
+            for topic, partition, offset in offsets:
+                self._offsets[(group, topic, partition)] = offset
+
+    def version(self):
+        return self._version
+
+    def wait(self, version, timeout):
+        with self._cond:
+            self._cond.wait_for(lambda: self._version != version, timeout=timeout)
+
+    def touch(self):
+        with self._cond:
+            self._version += 1
+            self._cond.notify_all()
+
+
+def _b64(value):
+    return None if value is None else base64.b64encode(value).decode('ascii')
+
+
+def _unb64(value):
+    return None if value is None else base64.b64decode(value)
+
+
+def _encode(record):
+    key, value, headers, timestamp = record
+    line = {'k': _b64(key), 'v': _b64(value), 't': timestamp,
+            'h': [[k, _b64(v)] for k, v in headers] if headers else None}
+    return json.dumps(line, separators=(',', ':')).encode('ascii') + b'\n'
+
+
+def _decode(line):
+    data = json.loads(line)
+    headers = [(k, _unb64(v)) for k, v in data['h']] if data['h'] else None
+    return _unb64(data['k']), _unb64(data['v']), headers, data['t']
+
+
+class FileStore:
+    """
+    <root>/<tópico>/meta.json (nº de particiones), <root>/<tópico>/<partición>.log (JSONL)
+    y <root>/_offsets/<grupo>.json. Las escrituras toman flock: varios procesos pueden producir.
+    """
+
+    def __init__(self, root, partitions=DEFAULT_PARTITIONS):
+        self.root = root
+        self.default_partitions = partitions
+        self._lock = threading.Lock()
+        self._partitions = {}
+        self._index = {}    # (tópico, partición) -> posición en bytes de cada registro
+        self._scanned = {}  # (tópico, partición) -> bytes ya indexados
+        os.makedirs(os.path.join(root, '_offsets'), exist_ok=True)
+
+    def _log_path(self, topic, partition):
+        return os.path.join(self.root, topic, f"{partition}.log")
+
+    def _offsets_path(self, group):
+        return os.path.join(self.root, '_offsets', f"{group}.json")
+
+    def topics(self):
+        return sorted(name for name in os.listdir(self.root)
+                      if not name.startswith('_') and os.path.isdir(os.path.join(self.root, name)))
+
+    def partitions(self, topic):
+        if topic not in self._partitions:
+            meta = os.path.join(self.root, topic, 'meta.json')
+            if not os.path.exists(meta):
+                os.makedirs(os.path.dirname(meta), exist_ok=True)
+                tmp = f"{meta}.{os.getpid()}.{threading.get_ident()}"
+                with open(tmp, 'w') as f:
+                    json.dump({'partitions': self.default_partitions}, f)
+                try:
+                    os.link(tmp, meta)  # Atómico: si otro proceso lo creó primero, vale el suyo
+                except FileExistsError:
+                    pass
+                finally:
+                    os.unlink(tmp)
+            with open(meta) as f:
+                self._partitions[topic] = json.load(f)['partitions']
+        return self._partitions[topic]
+
+    def _refresh(self, topic, partition, handle):
+        """Indexa los registros que otros procesos agregaron desde la última lectura."""
+        tp = (topic, partition)
+        index = self._index.setdefault(tp, [])
+        position = self._scanned.get(tp, 0)
+        handle.seek(position)
+        for line in handle:
+            if not line.endswith(b'\n'):
+                break  # Escritura a medias de otro proceso: se indexa en la próxima vuelta
+            index.append(position)
+            position += len(line)
+        self._scanned[tp] = position
+        return index
+
+    def append(self, topic, partition, records):
+        self.partitions(topic)
+        data = b''.join(_encode(record) for record in records)
+        with self._lock, open(self._log_path(topic, partition), 'a+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                first = len(self._refresh(topic, partition, f))
+                f.write(data)
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return first
+
+    def read(self, topic, partition, offset, limit):
+        path = self._log_path(topic, partition)
+        with self._lock:
+            if not os.path.exists(path):
+                return []
+            with open(path, 'rb') as f:
+                index = self._refresh(topic, partition, f)
+                if offset >= len(index):
+                    return []
+                f.seek(index[offset])
+                return [_decode(f.readline()) for _ in range(min(limit, len(index) - offset))]
+
+    def watermarks(self, topic, partition):
+        path = self._log_path(topic, partition)
+        with self._lock:
+            if not os.path.exists(path):
+                return 0, 0
+            with open(path, 'rb') as f:
+                return 0, len(self._refresh(topic, partition, f))
+
+    def _load_offsets(self, group):
+        try:
+            with open(self._offsets_path(group)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def committed(self, group, topic, partition):
+        return self._load_offsets(group).get(f"{topic}:{partition}")
+
+    def commit(self, group, offsets):
+        path = self._offsets_path(group)
+        with self._lock, open(f"{path}.lock", 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            data = self._load_offsets(group)
+            for topic, partition, offset in offsets:
+                data[f"{topic}:{partition}"] = offset
+            with open(f"{path}.tmp", 'w') as f:
+                json.dump(data, f)
+            os.replace(f"{path}.tmp", path)
+
+    def version(self):
+        return None
+
+    def wait(self, version, timeout):
+        time.sleep(min(timeout, FILE_POLL_INTERVAL))
+
+    def touch(self):
+        pass
+
+
+# --- COORDINADOR DE GRUPOS ---
+class LocalBroker:
+    """Reparte las particiones de los tópicos suscritos entre los miembros de cada grupo."""
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self._groups = {}  # grupo -> [consumidores]
+
+    def join(self, consumer):
+        with self._lock:
+            members = self._groups.setdefault(consumer.group, [])
+            if consumer not in members:
+                members.append(consumer)
+            self._rebalance(consumer.group)
+
+    def leave(self, consumer):
+        with self._lock:
+            members = self._groups.get(consumer.group, [])
+            if consumer in members:
+                members.remove(consumer)
+                self._rebalance(consumer.group)
+
+    def _rebalance(self, group):
+        members = self._groups.get(group, [])
+        assignment = {member: [] for member in members}
+        for topic in sorted({t for member in members for t in member.subscription}):
+            subscribed = [member for member in members if topic in member.subscription]
+            for partition in range(self.store.partitions(topic)):
+                assignment[subscribed[partition % len(subscribed)]].append((topic, partition))
+        for member, partitions in assignment.items():
+            member._set_pending_assignment(partitions)
+        self.store.touch()
+
+
+# --- PRODUCTOR / CONSUMIDOR ---
+class LocalProducer:
+    """produce() escribe de inmediato; los callbacks de entrega corren en poll()/flush() como en Kafka."""
+
+    def __init__(self, config, broker):
+        self.store = broker.store
+        self._lock = threading.Lock()
+        self._callbacks = []  # (callback, mensaje) pendientes
+        self._counter = 0
+
+    def produce(self, topic, value=None, key=None, partition=-1, on_delivery=None, callback=None,
+                timestamp=0, headers=None):
+        key, value = _bytes(key), _bytes(value)
+        if partition < 0:
+            count = self.store.partitions(topic)
+            if key is not None:
+                partition = zlib.crc32(key) % count  # Misma key -> misma partición (orden por corredor)
+            else:
+                with self._lock:
+                    self._counter += 1
+                    partition = self._counter % count
+        record = (key, value, _headers(headers), timestamp or int(time.time() * 1000))
+        offset = self.store.append(topic, partition, [record])
+        report = on_delivery or callback
+        if report:
+            with self._lock:
+                self._callbacks.append((report, LocalMessage(topic, partition, offset, record)))
+
+    def poll(self, timeout=0):
+        with self._lock:
+            callbacks, self._callbacks = self._callbacks, []
+        for report, msg in callbacks:
+            report(None, msg)
+        return len(callbacks)
+
+    def flush(self, timeout=None):
+        self.poll()
+        return 0
+
+    def __len__(self):
+        return len(self._callbacks)
+
+
+class LocalConsumer:
+    def __init__(self, config, broker):
+        self.broker = broker
+        self.store = broker.store
+        self.group = config.get('group.id')
+        self.reset = config.get('auto.offset.reset', 'latest')
+        self.auto_commit = str(config.get('enable.auto.commit', True)).lower() == 'true'
+        self.auto_commit_interval = int(config.get('auto.commit.interval.ms', 5000)) / 1000
+        self.subscription = ()
+        self._on_assign = self._on_revoke = None
+        self._lock = threading.Lock()
+        self._pending = None        # Asignación nueva: se aplica en el próximo poll (como en Kafka)
+        self._assigned_in_callback = False
+        self._positions = {}        # (tópico, partición) -> próximo offset a leer
+        self._paused = set()
+        self._next_partition = 0
+        self._last_auto_commit = time.monotonic()
+
+    # --- Asignación ---
+    def subscribe(self, topics, on_assign=None, on_revoke=None, on_lost=None):
+        if not self.group:
+            raise ValueError("subscribe() requiere 'group.id'")
+        self.subscription = tuple(topics)
+        self._on_assign, self._on_revoke = on_assign, on_revoke
+        self.broker.join(self)
+
+    def _set_pending_assignment(self, partitions):
+        with self._lock:
+            self._pending = partitions
+
+    def _apply_rebalance(self):
+        with self._lock:
+            pending, self._pending = self._pending, None
+        if pending is None:
+            return
+        if self._positions:
+            revoked = [LocalTopicPartition(t, p, o) for (t, p), o in self._positions.items()]
+            if self._on_revoke:
+                self._on_revoke(self, revoked)
+            elif self.auto_commit:
+                self.commit()
+            self.unassign()
+        partitions = [LocalTopicPartition(t, p) for t, p in pending]
+        self._assigned_in_callback = False
+        if self._on_assign:
+            self._on_assign(self, partitions)
+        if not self._assigned_in_callback:
+            self.assign(partitions)
+
+    def _resolve(self, topic, partition, offset):
+        low, high = self.store.watermarks(topic, partition)
+        if offset == OFFSET_BEGINNING:
+            return low
+        if offset == OFFSET_END:
+            return high
+        if offset is not None and offset >= 0:
+            return offset
+        committed = self.store.committed(self.group, topic, partition) if self.group else None
+        if committed is not None:
+            return committed
+        return low if self.reset in ('earliest', 'smallest', 'beginning') else high
+
+    def assign(self, partitions):
+        self._assigned_in_callback = True
+        self._positions = {(p.topic, p.partition): self._resolve(p.topic, p.partition, p.offset)
+                           for p in partitions}
+        self._paused.clear()
+
+    def unassign(self):
+        self._positions = {}
+        self._paused.clear()
+
+    def assignment(self):
+        return [LocalTopicPartition(t, p) for t, p in self._positions]
+
+    # --- Lectura ---
+    def _next_message(self):
+        ready = [tp for tp in self._positions if tp not in self._paused]
+        for i in range(len(ready)):
+            tp = ready[(self._next_partition + i) % len(ready)]  # Round-robin entre particiones
+            records = self.store.read(tp[0], tp[1], self._positions[tp], 1)
+            if records:
+                self._next_partition = (self._next_partition + i + 1) % len(ready)
+                offset = self._positions[tp]
+                self._positions[tp] = offset + 1
+                return LocalMessage(tp[0], tp[1], offset, records[0])
+        return None
+
+    def poll(self, timeout=None):
+        deadline = time.monotonic() + (timeout if timeout is not None and timeout >= 0 else 1e9)
+        while True:
+            self._apply_rebalance()
+            if self.auto_commit and self.group and time.monotonic() - self._last_auto_commit >= self.auto_commit_interval:
+                self.commit()
+                self._last_auto_commit = time.monotonic()
+            version = self.store.version()
+            msg = self._next_message()
+            remaining = deadline - time.monotonic()
+            if msg is not None or remaining <= 0:
+                return msg
+            self.store.wait(version, remaining)
+
+    # --- Offsets ---
+    def commit(self, message=None, offsets=None, asynchronous=True):
+        if message is not None:
+            offsets = [(message.topic(), message.partition(), message.offset() + 1)]
+        elif offsets is not None:
+            offsets = [(p.topic, p.partition, p.offset) for p in offsets]
+        else:
+            offsets = [(t, p, o) for (t, p), o in self._positions.items()]
+        if not self.group:
+            raise ValueError("commit() requiere 'group.id'")
+        self.store.commit(self.group, offsets)
+        return None if asynchronous else [LocalTopicPartition(t, p, o) for t, p, o in offsets]
+
+    def committed(self, partitions, timeout=None):
+        result = []
+        for p in partitions:
+            offset = self.store.committed(self.group, p.topic, p.partition)
+            result.append(LocalTopicPartition(p.topic, p.partition, OFFSET_INVALID if offset is None else offset))
+        return result
+
+    def position(self, partitions):
+        return [LocalTopicPartition(p.topic, p.partition, self._positions.get((p.topic, p.partition), OFFSET_INVALID))
+                for p in partitions]
+
+    def seek(self, partition):
+        self._positions[(partition.topic, partition.partition)] = self._resolve(
+            partition.topic, partition.partition, partition.offset)
+
+    def pause(self, partitions):
+        self._paused.update((p.topic, p.partition) for p in partitions)
+
+    def resume(self, partitions):
+        self._paused.difference_update((p.topic, p.partition) for p in partitions)
+
+    # --- Metadatos ---
+    def get_watermark_offsets(self, partition, timeout=None, cached=False):
+        return self.store.watermarks(partition.topic, partition.partition)
+
+    def list_topics(self, topic=None, timeout=None):
+        names = [topic] if topic else self.store.topics()
+        return SimpleNamespace(topics={
+            name: SimpleNamespace(topic=name, partitions={
+                p: SimpleNamespace(id=p) for p in range(self.store.partitions(name))
+            })
+            for name in names
+        })
+
+    def close(self):
+        if self.auto_commit and self.group and self._positions:
+            self.commit()
+        if self.subscription:
+            self.broker.leave(self)
+            self.subscription = ()
+        self._positions = {}
@@ -2,42 +2,99 @@ import os
 import sys
 import time
 import json
+import argparse
+import threading
+from datetime import datetime, timedelta, timezone as dt_timezone
 import django
-from confluent_kafka import Consumer, KafkaError
 
 # --- H0P3: INICIALIZACIÓN DEL SISTEMA NERVIOSO DE DJANGO ---
 # Esto permite usar el ORM de Django desde este script externo
-sys.path.append('/app/backend') 
+sys.path.append(os.environ.get('NUAM_BACKEND_DIR', '/app/backend'))
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "nuam.settings")
 django.setup()
 
+# Kafka real o stand-in local según NUAM_TRANSPORT (ver nuam/transport.py)
+from nuam.transport import Consumer, Producer, TopicPartition
+# Trazas entre servicios (header 'traceparent', nuam/tracing.py) y perfilado bajo demanda (nuam/profiling.py)
+from nuam import profiling, tracing
+
 # Ahora sí podemos importar los modelos
-from api.models import TaxQualification, Broker, AuditLog, User
-from django.db import transaction
+from api.models import TaxQualification, Broker, AuditLog, User, ConsumerOffset, ProcessedEvent
+from django.db import transaction, connection, DatabaseError, IntegrityError, DataError, InterfaceError, OperationalError
+from django.core.exceptions import ValidationError
+from django.utils import timezone
 
 # Configuración Kafka
 KAFKA_BOOTSTRAP_SERVERS = os.environ.get('KAFKA_BOOTSTRAP_SERVERS', 'kafka:9092')
 TOPIC = 'nuam_events' # El tópico que escuchamos
+GROUP_ID = 'nuam_backend_group'
+SERVICE = 'consumer'  # Nombre de servicio en las trazas
+
+# --- EXACTLY-ONCE ---
+# Los offsets viven en la BD (tabla ConsumerOffset) bajo este nombre lógico, NO en el
+# group.id de Kafka: un grupo nuevo retoma donde quedó el anterior en vez de releer todo.
+OFFSETS_KEY = os.environ.get('CONSUMER_OFFSETS_KEY', GROUP_ID)
+DEDUP_RETENTION_DAYS = int(os.environ.get('EVENT_DEDUP_RETENTION_DAYS', '30'))
+
+# --- RETRY + DEAD-LETTER ---
+# Un tópico por nivel de reintento con demora fija: dentro de cada tópico los mensajes
+# vencen en orden FIFO, así el worker de reintentos nunca espera detrás de uno "más lento".
+RETRY_DELAYS = [int(d) for d in os.environ.get('RETRY_DELAYS_SECONDS', '5,30,120,600').split(',')]
+RETRY_TOPICS = [f"{TOPIC}.retry.{n}" for n in range(len(RETRY_DELAYS))]
+DLQ_TOPIC = f"{TOPIC}.dlq"
+RETRY_GROUP_ID = 'nuam_backend_retry_group'
+REPLAY_OFFSETS_KEY = f"{OFFSETS_KEY}.dlq_replay"
+
+# Los eventos que publica el propio backend (api/outbox.py) comparten tópico con los de la
+# bolsa para que el notifier vea todas las vías de ingesta; el consumer NO los re-aplica.
+BACKEND_ORIGIN = 'backend'
+
+# Errores de DATOS: reintentar no sirve, van directo a la DLQ
+PERMANENT_ERRORS = (ValueError, TypeError, KeyError, ValidationError, DataError)
+
+# Fallos de INFRAESTRUCTURA al desviar un mensaje (Kafka sin confirmar, BD caída): el loop no
+# muere; espera con backoff exponencial y vuelve a leer el mismo offset
+TRANSIENT_ERRORS = (RuntimeError, DatabaseError)
+BACKOFF_SECONDS = float(os.environ.get('CONSUMER_BACKOFF_SECONDS', '1'))
+BACKOFF_MAX_SECONDS = float(os.environ.get('CONSUMER_BACKOFF_MAX_SECONDS', '60'))
 
-def process_message(data):
+class PermanentError(Exception):
+    """El evento es inválido (no un fallo transitorio): se envía a la DLQ sin reintentos."""
+
+def process_message(data, event_at=None, retry=False):
     """
     Lógica de Negocio: Transforma el JSON de Kafka en registros de BD.
+    Los errores se propagan para que la transacción (datos + offset) haga rollback completo.
+    `event_at` es la hora en que la bolsa produjo el evento (ver event_time). Un reintento
+    llega fuera de orden: si la fila ya tiene aplicado un evento posterior, se descarta.
     """
-    try:
-        # data espera formato: 
-        # {"broker_code": "CLI01", "instrument": "APPLE", "date": "2025-12-01", "year": 2025, "amount": 100.50}
-        
-        print(f"🔧 Procesando datos: {data}")
+    # data espera formato: 
+    # {"broker_code": "CLI01", "instrument": "APPLE", "date": "2025-12-01", "year": 2025, "amount": 100.50,
+    #  "credit_amount": 12.5, "increment_amount": 3.0}   <- montos componentes opcionales
+    
+    print(f"🔧 Procesando datos: {data}")
 
-        # 1. Identificar al Corredor (Si no existe, fallamos o creamos uno default)
-        broker_code = data.get('broker_code')
+    # 1. Identificar al Corredor (Si no existe, fallamos o creamos uno default)
+    broker_code = data.get('broker_code')
+    with tracing.span('consumer.db_upsert', broker_code=broker_code) as span:
         try:
             broker = Broker.objects.get(code=broker_code)
         except Broker.DoesNotExist:
-            print(f"⚠️ Error: Corredor {broker_code} no existe. Ignorando.")
-            return
+            # A la DLQ: tras crear el corredor, el evento se recupera con 'replay-dlq'
+            raise PermanentError(f"Corredor {broker_code} no existe")
 
-        # 2. Crear o Actualizar la Calificación
+        # 2. Guardia de orden: un reintento viejo no pisa un evento más nuevo ya aplicado
+        if retry and event_at is not None:
+            applied_at = TaxQualification.objects.select_for_update().filter(
+                broker=broker, instrument=data.get('instrument'), payment_date=data.get('date')
+            ).values_list('event_at', flat=True).first()
+            if applied_at is not None and applied_at > event_at:
+                print(f"⏭️ Evento de {event_at:%H:%M:%S} para {data.get('instrument')} obsoleto "
+                      f"(ya se aplicó uno de {applied_at:%H:%M:%S}). Descartado.")
+                span.set(stale=True)
+                return
+
+        # 3. Crear o Actualizar la Calificación
         # Usamos update_or_create para evitar duplicados
         qual, created = TaxQualification.objects.update_or_create(
             broker=broker,
@@ -45,67 +102,382 @@ def process_message(data):
             payment_date=data.get('date'),
             defaults={
                 'exercise_year': data.get('year'),
-                'source': 'KAFKA', # Marcamos el origen
-                'amounts': {'incoming_amount': data.get('amount')}, # Guardamos en el JSONField
-                'factors': {} # Se calcularán después
+                'source': 'API', # Integración Bolsa (Automático)
+                'event_at': event_at,
+                'financial_data': {
+                    'monto_base': data.get('amount'),
+                    # Montos componentes (opcionales): insumo del recálculo masivo de factores
+                    'montos': {
+                        'credito': data.get('credit_amount'),
+                        'incremento': data.get('increment_amount'),
+                    },
+                    'factores': {} # Se calcularán después (manage.py recalc_factors)
+                }
             }
         )
+        span.set(created=created)
 
-        action = "CREATED" if created else "UPDATED"
-        print(f"✅ Calificación {action}: {qual.instrument} para {broker.name}")
+    action = "CREATED" if created else "UPDATED"
+    print(f"✅ Calificación {action}: {qual.instrument} para {broker.name}")
 
-        # 3. Generar Auditoría (El Ojo que todo lo ve)
-        # Asignamos al usuario 'system' o admin si no hay usuario real
+    # 4. Generar Auditoría (El Ojo que todo lo ve)
+    # Asignamos al usuario 'system' o admin si no hay usuario real
+    with tracing.span('consumer.audit_write'):
         system_user = User.objects.filter(is_superuser=True).first()
-        
+
         AuditLog.objects.create(
             user=system_user,
             action=f"KAFKA_{action}",
             details=f"Procesado evento externo para {qual.instrument}. Monto: {data.get('amount')}"
         )
 
-    except Exception as e:
-        print(f"🔥 Error procesando mensaje: {e}")
+# --- EXACTLY-ONCE: OFFSETS EN BD + IDEMPOTENCIA ---
+def event_key(msg, data):
+    """
+    Clave de idempotencia: header/campo 'event_id' si el productor lo envía; si no, la posición
+    del mensaje en el tópico original (un hash del payload descartaría repeticiones legítimas,
+    p. ej. un valor que vuelve a A tras A → B). Los reintentos conservan la posición original
+    en los headers x-original-*, así que un reintento se reconoce como el mismo evento.
+    """
+    for key, value in (msg.headers() or []):
+        if key == 'event_id' and value:
+            return value.decode('utf-8')[:64]
+    if isinstance(data, dict) and data.get('event_id'):
+        return str(data['event_id'])[:64]
+    topic = header_value(msg, 'x-original-topic', msg.topic())
+    partition = header_value(msg, 'x-original-partition', str(msg.partition()))
+    offset = header_value(msg, 'x-original-offset', str(msg.offset()))
+    return f"{topic}:{partition}:{offset}"[-64:]
 
-def start_consumer():
-    print("⏳ H0P3 Consumer: Esperando alineación de planetas (Kafka)...")
-    time.sleep(15) # Damos tiempo a que Kafka arranque bien
+def event_time(msg):
+    """Hora (UTC) en que se produjo el mensaje original; los reintentos la llevan en x-original-timestamp."""
+    ms = int(header_value(msg, 'x-original-timestamp', str(msg.timestamp()[1])))
+    return datetime.fromtimestamp(ms / 1000, tz=dt_timezone.utc) if ms > 0 else None
 
-    conf = {
-        'bootstrap.servers': KAFKA_BOOTSTRAP_SERVERS,
-        'group.id': 'nuam_backend_group',
-        'auto.offset.reset': 'earliest'
+def claim_event(event_id, msg):
+    """Reserva el evento dentro de la transacción en curso. False = ya fue aplicado (re-entrega)."""
+    try:
+        with transaction.atomic():  # Savepoint: un duplicado no invalida la transacción externa
+            ProcessedEvent.objects.create(
+                event_id=event_id, topic=msg.topic(), partition=msg.partition(), offset=msg.offset()
+            )
+        return True
+    except IntegrityError:
+        return False
+
+def save_offset(msg):
+    """Registra el PRÓXIMO offset a leer de la partición (misma transacción que los datos)."""
+    # UPDATE directo (1 query) en el caso normal; el INSERT solo ocurre la primera vez por partición
+    updated = ConsumerOffset.objects.filter(
+        consumer=OFFSETS_KEY, topic=msg.topic(), partition=msg.partition()
+    ).update(offset=msg.offset() + 1, updated_at=timezone.now())
+    if not updated:
+        ConsumerOffset.objects.create(
+            consumer=OFFSETS_KEY, topic=msg.topic(), partition=msg.partition(), offset=msg.offset() + 1
+        )
+
+def restore_offsets(consumer, partitions):
+    """Callback on_assign: cada partición asignada retoma desde el offset guardado en la BD."""
+    stored = {
+        (o.topic, o.partition): o.offset
+        for o in ConsumerOffset.objects.filter(consumer=OFFSETS_KEY, topic__in={p.topic for p in partitions})
     }
+    for p in partitions:
+        if (p.topic, p.partition) in stored:
+            p.offset = stored[(p.topic, p.partition)]
+    print(f"📌 Particiones asignadas: {[(p.topic, p.partition, p.offset) for p in partitions]}")
+    consumer.assign(partitions)
 
-    consumer = Consumer(conf)
-    consumer.subscribe([TOPIC])
+def prune_processed_events():
+    """Las claves viejas ya no pueden re-entregarse (el offset avanzó): se purgan al arrancar."""
+    cutoff = timezone.now() - timedelta(days=DEDUP_RETENTION_DAYS)
+    deleted, _ = ProcessedEvent.objects.filter(processed_at__lt=cutoff).delete()
+    if deleted:
+        print(f"🧹 {deleted} claves de idempotencia purgadas (> {DEDUP_RETENTION_DAYS} días)")
+
+def handle_message(msg, producer):
+    """Aplica un mensaje exactly-once: idempotencia + datos + offset en una sola transacción."""
+    # Traza: espera en Kafka + procesamiento, como hijos del span del productor
+    parent = tracing.extract(msg.headers())
+    tracing.record_queue(msg, parent, SERVICE)
+    with tracing.span('consumer.handle', parent=parent, service=SERVICE, topic=msg.topic(),
+                      partition=msg.partition(), offset=msg.offset()) as span:
+        if header_value(msg, 'origin') == BACKEND_ORIGIN:
+            # Evento del outbox del backend (ingreso manual/CSV/carga masiva): el dato ya está en la BD
+            span.set(skipped='origin')
+            skip_message(msg)
+            return
+
+        raw_data = msg.value().decode('utf-8', errors='replace')
+        try:
+            with tracing.span('consumer.decode', bytes=len(msg.value())):
+                data = json.loads(raw_data)
+        except json.JSONDecodeError as e:
+            print(f"🗑️ Mensaje basura recibido (No JSON): {raw_data[:200]}")
+            span.fail(e)
+            route_failure(msg, producer, PermanentError(f"JSON inválido: {e}"))
+            return
+
+        event_id = event_key(msg, data)
+        span.set(event_id=event_id)
+        try:
+            # La duración de este span menos upsert y auditoría es el costo de idempotencia + offset + commit
+            with tracing.span('consumer.transaction'), transaction.atomic():
+                if not claim_event(event_id, msg):
+                    print(f"♻️ Evento {event_id[:12]} ya aplicado (re-entrega). Saltando.")
+                    span.set(duplicate=True)
+                else:
+                    process_message(data, event_time(msg), retry=header_value(msg, 'x-attempt') is not None)
+                save_offset(msg)
+        except (OperationalError, InterfaceError):
+            # BD caída o conexión rota: no es culpa del mensaje, no se desvía (ver rewind)
+            raise
+        except Exception as e:
+            print(f"🔥 Error procesando mensaje: {e}")
+            span.fail(e)
+            route_failure(msg, producer, e)
+
+def skip_message(msg):
+    """El mensaje falló y se hizo rollback: solo avanzamos el offset para no bloquear la partición."""
+    with transaction.atomic():
+        save_offset(msg)
+
+# --- RETRY + DLQ ---
+def header_value(msg, name, default=None):
+    for key, value in (msg.headers() or []):
+        if key == name and value is not None:
+            return value.decode('utf-8')
+    return default
+
+def route_failure(msg, producer, error):
+    """
+    Reenvía el mensaje fallido al siguiente nivel de reintento o a la DLQ (con el error
+    adjunto en headers) y recién entonces avanza el offset: el evento nunca se pierde.
+    """
+    attempt = int(header_value(msg, 'x-attempt', '0'))
+    permanent = isinstance(error, (PermanentError,) + PERMANENT_ERRORS)
+
+    if permanent or attempt >= len(RETRY_TOPICS):
+        target = DLQ_TOPIC
+    else:
+        target = RETRY_TOPICS[attempt]
+
+    # Conservamos headers de negocio (event_id, trazas) y reemplazamos los de control;
+    # el reintento queda como hijo del intento fallido (span activo) en la misma traza
+    headers = tracing.inject([(k, v) for k, v in (msg.headers() or []) if not k.startswith('x-')])
+    headers += [
+        ('x-attempt', str(attempt + 1).encode()),
+        ('x-error', str(error)[:1000].encode('utf-8')),
+        ('x-error-type', type(error).__name__.encode()),
+        ('x-original-topic', header_value(msg, 'x-original-topic', msg.topic()).encode()),
+        ('x-original-partition', header_value(msg, 'x-original-partition', str(msg.partition())).encode()),
+        ('x-original-offset', header_value(msg, 'x-original-offset', str(msg.offset())).encode()),
+        ('x-original-timestamp', header_value(msg, 'x-original-timestamp', str(msg.timestamp()[1])).encode()),
+        ('x-failed-at', str(time.time()).encode()),
+    ]
+    if target != DLQ_TOPIC:
+        headers.append(('x-retry-at', str(time.time() + RETRY_DELAYS[attempt]).encode()))
+
+    producer.produce(target, msg.value(), key=msg.key(), headers=headers)
+    if producer.flush(10) > 0:
+        # Sin confirmación del broker no avanzamos: el mensaje se volverá a leer
+        raise RuntimeError(f"No se pudo publicar en {target}; el offset no avanza")
+
+    print(f"{'☠️ DLQ' if target == DLQ_TOPIC else '🔁 Reintento'} → {target} (intento {attempt + 1}): {error}")
+    # Un error de BD puede dejar la conexión inutilizable
+    connection.close_if_unusable_or_obsolete()
+    skip_message(msg)
+
+def rewind(consumer, msg, error, failures, stop_event):
+    """
+    Fallo transitorio (TRANSIENT_ERRORS) al aplicar o desviar `msg`: espera con backoff
+    exponencial y reposiciona la partición en el mensaje para volver a leerlo.
+    """
+    delay = min(BACKOFF_SECONDS * 2 ** (failures - 1), BACKOFF_MAX_SECONDS)
+    print(f"⏳ Fallo transitorio en {msg.topic()}[{msg.partition()}]@{msg.offset()} "
+          f"(intento {failures}): {error}. Reintentando en {delay:g}s")
+    connection.close_if_unusable_or_obsolete()
+    stop_event.wait(delay)
+    consumer.seek(TopicPartition(msg.topic(), msg.partition(), msg.offset()))
 
-    print(f"🟢 H0P3 Consumer ONLINE. Escuchando: {TOPIC}")
+def retry_worker(producer, stop_event):
+    """
+    Consume los tópicos de reintento en un hilo aparte del loop principal.
+    Si el mensaje en cabeza de una partición aún no vence, se PAUSA esa partición
+    (sin dormir) y se reanuda al vencer; las demás particiones siguen fluyendo.
+    """
+    consumer = Consumer({
+        'bootstrap.servers': KAFKA_BOOTSTRAP_SERVERS,
+        'group.id': RETRY_GROUP_ID,
+        'auto.offset.reset': 'earliest',
+        'enable.auto.commit': False,
+    })
+    consumer.subscribe(RETRY_TOPICS, on_assign=restore_offsets)
+    paused = {}  # (topic, partition) -> timestamp de vencimiento
+    failures = 0
 
     try:
-        while True:
-            msg = consumer.poll(1.0)
+        while not stop_event.is_set():
+            now = time.time()
+            due = [TopicPartition(t, p) for (t, p), at in paused.items() if at <= now]
+            if due:
+                consumer.resume(due)
+                for tp in due:
+                    del paused[(tp.topic, tp.partition)]
 
+            msg = consumer.poll(0.5)
             if msg is None:
                 continue
             if msg.error():
-                print(f"Consumer error: {msg.error()}")
+                print(f"Retry consumer error: {msg.error()}")
+                continue
+
+            retry_at = float(header_value(msg, 'x-retry-at', '0'))
+            if retry_at > time.time():
+                tp = TopicPartition(msg.topic(), msg.partition(), msg.offset())
+                consumer.pause([tp])
+                consumer.seek(tp)  # Se vuelve a leer este mismo mensaje al reanudar
+                paused[(msg.topic(), msg.partition())] = retry_at
                 continue
 
-            # Decodificar mensaje
-            raw_data = msg.value().decode('utf-8')
             try:
-                json_data = json.loads(raw_data)
-                # Ejecutar transacción atómica
+                handle_message(msg, producer)
+            except TRANSIENT_ERRORS as e:
+                failures += 1
+                rewind(consumer, msg, e, failures, stop_event)
+                continue
+            failures = 0
+            consumer.commit(message=msg, asynchronous=True)
+    finally:
+        consumer.close()
+
+def replay_dlq(limit=None, dry_run=False):
+    """
+    Re-publica en el tópico principal los eventos de la DLQ (tras corregir la causa).
+    Avanza desde el último replay (offset guardado en BD) hasta el final actual de la DLQ.
+    """
+    consumer = Consumer({
+        'bootstrap.servers': KAFKA_BOOTSTRAP_SERVERS,
+        'group.id': f"{GROUP_ID}_dlq_replay",
+        'enable.auto.commit': False,
+    })
+    producer = Producer({'bootstrap.servers': KAFKA_BOOTSTRAP_SERVERS, 'enable.idempotence': True})
+
+    partitions = consumer.list_topics(DLQ_TOPIC, timeout=10).topics[DLQ_TOPIC].partitions
+    stored = dict(ConsumerOffset.objects.filter(consumer=REPLAY_OFFSETS_KEY, topic=DLQ_TOPIC)
+                  .values_list('partition', 'offset'))
+    assignments, ends = [], {}
+    for p in partitions:
+        low, high = consumer.get_watermark_offsets(TopicPartition(DLQ_TOPIC, p), timeout=10)
+        start = max(stored.get(p, low), low)
+        if start < high:
+            assignments.append(TopicPartition(DLQ_TOPIC, p, start))
+            ends[p] = high
+    consumer.assign(assignments)
+
+    replayed = 0
+    try:
+        while ends and (limit is None or replayed < limit):
+            msg = consumer.poll(5.0)
+            if msg is None:
+                break
+            if msg.error():
+                print(f"DLQ error: {msg.error()}")
+                continue
+
+            print(f"⏪ Replay {msg.partition()}@{msg.offset()} ({header_value(msg, 'x-error-type')}): "
+                  f"{header_value(msg, 'x-error')}")
+            if not dry_run:
+                headers = [(k, v) for k, v in (msg.headers() or []) if not k.startswith('x-')]
+                producer.produce(header_value(msg, 'x-original-topic', TOPIC), msg.value(),
+                                 key=msg.key(), headers=headers)
+                if producer.flush(10) > 0:
+                    raise RuntimeError("No se pudo re-publicar el evento; replay detenido")
                 with transaction.atomic():
-                    process_message(json_data)
-            except json.JSONDecodeError:
-                print(f"🗑️ Mensaje basura recibido (No JSON): {raw_data}")
+                    ConsumerOffset.objects.update_or_create(
+                        consumer=REPLAY_OFFSETS_KEY, topic=DLQ_TOPIC, partition=msg.partition(),
+                        defaults={'offset': msg.offset() + 1}
+                    )
+            replayed += 1
+
+            if msg.offset() + 1 >= ends[msg.partition()]:
+                del ends[msg.partition()]
+    finally:
+        consumer.close()
+
+    print(f"✅ {replayed} eventos {'revisados' if dry_run else 're-publicados'} desde {DLQ_TOPIC}")
+    return replayed
+
+def consume(consumer, producer, stop_event, on_applied=None):
+    """Loop principal: cada mensaje se aplica en su transacción y luego se informa el offset a Kafka."""
+    failures = 0  # Fallos transitorios seguidos (backoff)
+    while not stop_event.is_set():
+        msg = consumer.poll(1.0)
+
+        if msg is None:
+            continue
+        if msg.error():
+            print(f"Consumer error: {msg.error()}")
+            continue
+
+        # Transacción atómica: idempotencia + datos + offset
+        try:
+            handle_message(msg, producer)
+        except TRANSIENT_ERRORS as e:
+            failures += 1
+            rewind(consumer, msg, e, failures, stop_event)
+            continue
+        failures = 0
+        consumer.commit(message=msg, asynchronous=True)
+        if on_applied:
+            on_applied(msg)
 
+def start_consumer():
+    print("⏳ H0P3 Consumer: Esperando alineación de planetas (Kafka)...")
+    time.sleep(15) # Damos tiempo a que Kafka arranque bien
+
+    conf = {
+        'bootstrap.servers': KAFKA_BOOTSTRAP_SERVERS,
+        'group.id': GROUP_ID,
+        # Solo aplica a particiones sin offset en la BD (primer arranque)
+        'auto.offset.reset': os.environ.get('KAFKA_OFFSET_RESET', 'earliest'),
+        # La fuente de verdad es la BD: Kafka solo recibe el offset para monitoreo de lag
+        'enable.auto.commit': False,
+    }
+
+    prune_processed_events()
+    profiling.install_signal_handler(SERVICE)  # kill -USR2 <pid>: perfil de CPU (nuam/profiling.py)
+
+    consumer = Consumer(conf)
+    consumer.subscribe([TOPIC], on_assign=restore_offsets)
+
+    # Productor compartido (thread-safe) para los reenvíos a retry/DLQ
+    producer = Producer({'bootstrap.servers': KAFKA_BOOTSTRAP_SERVERS, 'enable.idempotence': True})
+    stop_event = threading.Event()
+    retry_thread = threading.Thread(target=retry_worker, args=(producer, stop_event), daemon=True)
+    retry_thread.start()
+
+    print(f"🟢 H0P3 Consumer ONLINE. Escuchando: {TOPIC} (reintentos: {', '.join(RETRY_TOPICS)})")
+
+    try:
+        consume(consumer, producer, stop_event)
     except KeyboardInterrupt:
         print("🛑 Deteniendo consumidor...")
     finally:
+        stop_event.set()
+        retry_thread.join(timeout=5)
+        producer.flush(10)
         consumer.close()
 
 if __name__ == '__main__':
-    start_consumer()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Consumer NUAM (ingesta Kafka → BD)")
+    sub = parser.add_subparsers(dest='command')
+    replay = sub.add_parser('replay-dlq', help="Re-publica los eventos de la DLQ en el tópico principal")
+    replay.add_argument('--limit', type=int, help="Máximo de eventos a re-publicar")
+    replay.add_argument('--dry-run', action='store_true', help="Solo lista los eventos y sus errores")
+    args = parser.parse_args()
+
+    if args.command == 'replay-dlq':
+        replay_dlq(limit=args.limit, dry_run=args.dry_run)
+    else:
+        start_consumer()
\ No newline at end of file
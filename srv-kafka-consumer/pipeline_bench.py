@@ -0,0 +1,182 @@
+"""
+Benchmark end-to-end SIN Kafka: productor → consumer (BD) → notifier (SMTP de prueba).
+
+Todo corre en un proceso sobre el transporte en memoria (NUAM_TRANSPORT=memory, ver
+nuam/transport.py), con el loop real del consumer (consumer.consume) y del notifier
+(main.run) y una BD SQLite temporal salvo que se pase --database-url. Reporta
+throughput y percentiles de latencia desde que se produce cada evento hasta que:
+- el consumer lo confirmó en la BD (datos + offset en la misma transacción), y
+- el notifier entregó su correo al servidor SMTP de prueba (benchmark.SMTPSink).
+
+    python pipeline_bench.py --events 5000 --brokers 20
+    python pipeline_bench.py --events 2000 --rate 500 --smtp-latency 0.01
+    python pipeline_bench.py --events 2000 --trace /tmp/trazas.jsonl   # + desglose por etapa (nuam/tracing.py)
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+
+
+def configure(database_url, trace=None):
+    """Entorno offline; debe correr ANTES de importar consumer.py (hace django.setup()). Devuelve la SQLite temporal."""
+    os.environ['NUAM_TRANSPORT'] = 'memory'
+    if trace:
+        os.environ['NUAM_TRACING'] = f"file:{trace}"
+    os.environ.setdefault('NUAM_BACKEND_DIR', os.path.join(REPO, 'srv-django-backend'))
+    sys.path.insert(0, os.path.join(REPO, 'srv-notifier'))
+    if database_url:
+        os.environ['DATABASE_URL'] = database_url
+        return None
+    fd, path = tempfile.mkstemp(prefix='nuam_pipeline_', suffix='.sqlite3')
+    os.close(fd)
+    os.environ['DATABASE_URL'] = f"sqlite:///{path}"
+    return path
+
+
+def summary(name, latencies, started, finished):
+    from nuam.tracing import percentile
+
+    if not latencies:
+        return f"   {name}: sin eventos completados"
+    elapsed = max(finished - started, 1e-9)
+    return (f"   {name}: {len(latencies)} en {elapsed:.2f}s → {len(latencies) / elapsed:.0f} ev/s | latencia "
+            f"p50 {percentile(latencies, 50):.1f}ms, p95 {percentile(latencies, 95):.1f}ms, "
+            f"p99 {percentile(latencies, 99):.1f}ms")
+
+
+def run(args):
+    # Imports tardíos: consumer.py hace django.setup() con el entorno que dejó configure()
+    import consumer as backend_consumer
+    import main as notifier
+    from benchmark import SMTPSink
+    from django.core.management import call_command
+    from mailer import DeliveryStage, RateLimiter, SMTPPool
+
+    from api.models import Broker
+    from nuam import tracing
+    from nuam.transport import Consumer, Producer
+
+    call_command('migrate', verbosity=0)
+    codes = [f"BENCH{i:03d}" for i in range(args.brokers)]
+    for code in codes:
+        Broker.objects.get_or_create(code=code, defaults={'name': f"Corredor {code}"})
+
+    stop_event = threading.Event()
+    applied, delivered, finished = [], [], {}
+
+    def tracker(latencies, stage):
+        def record(msg):
+            now = time.time()
+            latencies.append(now * 1000 - msg.timestamp()[1])
+            finished[stage] = now
+        return record
+
+    # --- CONSUMER (BD) ---
+    consumer = Consumer({
+        'group.id': backend_consumer.GROUP_ID,
+        'auto.offset.reset': 'earliest',
+        'enable.auto.commit': False,
+    })
+    consumer.subscribe([backend_consumer.TOPIC], on_assign=backend_consumer.restore_offsets)
+    consumer_thread = threading.Thread(
+        target=backend_consumer.consume,
+        args=(consumer, Producer({}), stop_event, tracker(applied, 'consumer')),
+        name='bench-consumer',
+    )
+
+    # --- NOTIFIER (SMTP de prueba) ---
+    async def notifier_stage():
+        sink = SMTPSink(args.smtp_latency)
+        server = await asyncio.start_server(sink.handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        stage = DeliveryStage(SMTPPool('127.0.0.1', port, size=args.smtp_pool),
+                              limiter=RateLimiter(rate=1e9, burst=1e9))
+        try:
+            await notifier.run(stage, stop_event, tracker(delivered, 'notifier'))
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    notifier_thread = threading.Thread(target=asyncio.run, args=(notifier_stage(),), name='bench-notifier')
+
+    consumer_thread.start()
+    notifier_thread.start()
+
+    # --- PRODUCCIÓN ---
+    producer = Producer({})
+    run_id = uuid.uuid4().hex[:8]
+    interval = 1 / args.rate if args.rate else 0
+    started = time.time()
+    for i in range(args.events):
+        code = codes[i % len(codes)]
+        event = {'event_id': f"bench-{run_id}-{i}", 'broker_code': code, 'instrument': f"INST{i:06d}",
+                 'date': '2025-06-01', 'year': 2025, 'amount': 1000 + i}
+        with tracing.span('bench.produce', service='bench') as span:
+            producer.produce(backend_consumer.TOPIC, json.dumps(event).encode('utf-8'), key=code,
+                             headers=tracing.inject(span=span))
+        if interval:
+            delay = started + (i + 1) * interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+    producer.flush()
+    produced_at = time.time()
+
+    deadline = time.monotonic() + args.timeout
+    while (len(applied) < args.events or len(delivered) < args.events) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    stop_event.set()
+    consumer_thread.join(timeout=10)
+    notifier_thread.join(timeout=40)
+    return started, produced_at, applied, delivered, finished
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=2000)
+    parser.add_argument('--brokers', type=int, default=20, help="Corredores distintos (keys de partición)")
+    parser.add_argument('--rate', type=float, default=0, help="Eventos/s a producir (0 = lo más rápido posible)")
+    parser.add_argument('--smtp-pool', type=int, default=8)
+    parser.add_argument('--smtp-latency', type=float, default=0.0, help="Demora del SMTP de prueba por correo (s)")
+    parser.add_argument('--database-url', help="BD a usar (por defecto una SQLite temporal)")
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--trace', help="Exporta las trazas a este JSONL e imprime el desglose de latencia por etapa")
+    parser.add_argument('--verbose', action='store_true', help="Muestra los logs del consumer y notifier")
+    args = parser.parse_args()
+
+    temp_db = configure(args.database_url, args.trace)
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.ExitStack() as stack:
+            if not args.verbose:
+                stack.enter_context(contextlib.redirect_stdout(devnull))
+            started, produced_at, applied, delivered, finished = run(args)
+    finally:
+        if temp_db:
+            os.remove(temp_db)
+
+    print(f"📊 Pipeline end-to-end en memoria: {args.events} eventos, {args.brokers} corredores, "
+          f"rate={'máx' if not args.rate else f'{args.rate:.0f}/s'}")
+    print(f"   producción: {args.events} en {produced_at - started:.2f}s → "
+          f"{args.events / max(produced_at - started, 1e-9):.0f} ev/s")
+    print(summary("consumer → BD", applied, started, finished.get('consumer', started)))
+    print(summary("notifier → SMTP", delivered, started, finished.get('notifier', started)))
+    if args.trace:
+        from nuam import tracing
+        print(f"🔎 Trazas en {args.trace} (ms por etapa):")
+        print(tracing.report(tracing.load(args.trace)))
+    if len(applied) < args.events or len(delivered) < args.events:
+        print(f"⚠️ Incompleto tras {args.timeout:.0f}s: {len(applied)} aplicados, {len(delivered)} entregados")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
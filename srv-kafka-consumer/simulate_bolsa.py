@@ -1,40 +1,249 @@
+"""
+Simulador de la Bolsa: generador de carga hacia nuam_events.
+
+Produce eventos a una tasa objetivo, con la cardinalidad de corredores/instrumentos y el
+tamaño de payload pedidos, y reporta la tasa lograda y la latencia de entrega (desde
+produce() hasta la confirmación del broker). Cada evento va con key = broker_code: todos
+los eventos de un corredor caen en la misma partición y el consumer los aplica en orden.
+
+    python simulate_bolsa.py                                        # demo: 3 eventos, 1/s
+    python simulate_bolsa.py --rate 5000 --duration 60 --brokers 50 --instruments 2000
+    python simulate_bolsa.py --rate 0 --events 200000 --payload-bytes 1024 --record rafaga.jsonl
+    python simulate_bolsa.py --replay rafaga.jsonl --speed 2        # misma ráfaga, al doble de velocidad
+    python simulate_bolsa.py --rate 200 --duration 30 --trace /tmp/trazas.jsonl
+
+El replay reescribe el event_id de cada evento (prefijo nuevo por corrida): con los IDs
+grabados el consumer los descartaría como re-entregas (ProcessedEvent) y la corrida no
+mediría nada. --keep-event-ids re-envía los originales (p. ej. para probar la deduplicación).
+
+Cada evento abre una traza ('bolsa.produce', hasta la confirmación del broker) y viaja con
+su header traceparent; consumer y notifier cuelgan sus spans de ella (ver nuam/tracing.py).
+
+Con --brokers N los códigos son SIM000..; deben existir como corredores o el consumer
+enviará esos eventos a la DLQ. Sin Kafka: NUAM_TRANSPORT=file:/tmp/nuam-bus (ver nuam/transport.py).
+"""
+import argparse
 import json
-import time
 import os
-from confluent_kafka import Producer
+import random
+import sys
+import time
+import uuid
+from datetime import date, timedelta
+
+# nuam/transport.py del backend (en Docker: /app/backend; en local: el repo)
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.environ.get('NUAM_BACKEND_DIR', '/app/backend'))
+sys.path.append(os.path.join(os.path.dirname(HERE), 'srv-django-backend'))
+from nuam import tracing
+from nuam.tracing import percentile
+from nuam.transport import Producer
 
 # --- H0P3 FIX: Detección automática del entorno ---
 # Si estamos en Docker, usa la variable de entorno (kafka:9092).
 # Si estamos en local, usa localhost.
-bootstrap_servers = os.environ.get('KAFKA_BOOTSTRAP_SERVERS', 'localhost:9092')
+BOOTSTRAP_SERVERS = os.environ.get('KAFKA_BOOTSTRAP_SERVERS', 'localhost:9092')
+TOPIC = 'nuam_events'
+REPORT_INTERVAL = 1.0
+SERVICE = 'bolsa'  # Nombre de servicio en las trazas
+
+
+def producer_config(args):
+    """Productor afinado para volumen: lotes grandes, algo de linger y compresión."""
+    return {
+        'bootstrap.servers': BOOTSTRAP_SERVERS,
+        'enable.idempotence': True,  # Reintentos sin duplicar ni reordenar dentro de la partición
+        'acks': 'all',
+        'linger.ms': args.linger_ms,
+        'batch.num.messages': args.batch_messages,
+        'compression.type': args.compression,
+        'queue.buffering.max.messages': 500_000,
+    }
+
+
+# --- ORÍGENES DE EVENTOS ---
+def generated_events(args, rng):
+    """(instante relativo de envío, evento) según --rate/--events/--duration."""
+    codes = args.broker_codes.split(',') if args.broker_codes else [f"SIM{i:03d}" for i in range(args.brokers)]
+    instruments = [f"INST{i:05d}" for i in range(args.instruments)]
+    run_id = uuid.uuid4().hex[:8]
+    start_day = date(args.year, 1, 1)
+    interval = 1 / args.rate if args.rate else 0
+    i = 0
+    while args.events is None or i < args.events:
+        event = {
+            'event_id': f"sim-{run_id}-{i}",
+            'broker_code': rng.choice(codes),
+            'instrument': rng.choice(instruments),
+            'date': (start_day + timedelta(days=rng.randrange(365))).isoformat(),
+            'year': args.year,
+            'amount': round(rng.uniform(100, 100_000), 2),
+        }
+        if rng.random() < 0.5:
+            event['credit_amount'] = round(event['amount'] * rng.uniform(0, 0.3), 2)
+            event['increment_amount'] = round(event['amount'] * rng.uniform(0, 0.1), 2)
+        yield i * interval, event
+        i += 1
+
+
+def replayed_events(path, speed, keep_event_ids=False):
+    """
+    Eventos de un archivo JSONL: líneas de --record ({"t", "event"}) o un evento por línea.
+    Salvo keep_event_ids, cada evento recibe un event_id nuevo de esta corrida.
+    """
+    run_id = uuid.uuid4().hex[:8]
+    with open(path, encoding='utf-8') as f:
+        for i, line in enumerate(f):
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            if 'event' in data and 't' in data:
+                at, event = (data['t'] / speed if speed else 0), data['event']
+            else:
+                at, event = 0, data
+            if not keep_event_ids:
+                event['event_id'] = f"replay-{run_id}-{i}"
+            yield at, event
 
-print(f"🔧 Configurando Producer hacia: {bootstrap_servers}")
 
-conf = {'bootstrap.servers': bootstrap_servers}
-producer = Producer(conf)
-topic = 'nuam_events'
+def encode(event, payload_bytes):
+    """JSON del evento, rellenado con 'padding' hasta ~payload_bytes."""
+    payload = json.dumps(event, separators=(',', ':'))
+    missing = payload_bytes - len(payload) - len(',"padding":""')
+    if missing > 0:
+        payload = payload[:-1] + f',"padding":"{"x" * missing}"}}'
+    return payload.encode('utf-8')
 
-# Datos de prueba
-events = [
-    {"broker_code": "DEFAULT", "instrument": "FALABELLA", "date": "2025-05-10", "year": 2025, "amount": 5000.00},
-    {"broker_code": "DEFAULT", "instrument": "CENCOSUD", "date": "2025-06-15", "year": 2025, "amount": 1250.50},
-    {"broker_code": "DEFAULT", "instrument": "COPEC", "date": "2025-07-20", "year": 2025, "amount": 9999.99},
-]
 
-def delivery_report(err, msg):
-    if err is not None:
-        print(f'❌ Fallo en entrega: {err}')
+def positive_int(value):
+    """Tipo de argparse: entero >= 1 (con 0 corredores o instrumentos no hay de dónde elegir)."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"debe ser al menos 1: {value}")
+    return number
+
+
+# --- ENVÍO ---
+def run(args):
+    rng = random.Random(args.seed)
+    if args.replay:
+        events = replayed_events(args.replay, args.speed, args.keep_event_ids)
+        source = f"replay de {args.replay}{' (event_id originales)' if args.keep_event_ids else ''}"
     else:
-        print(f'🚀 Mensaje enviado a {msg.topic()} [{msg.partition()}]')
+        events = generated_events(args, rng)
+        source = f"{args.rate:.0f} ev/s" if args.rate else "tasa máxima"
+
+    print(f"🔧 Productor hacia {BOOTSTRAP_SERVERS} → {TOPIC} ({source}, linger={args.linger_ms}ms, "
+          f"compresión={args.compression})")
+    producer = Producer(producer_config(args))
+    record = open(args.record, 'w', encoding='utf-8') if args.record else None
+
+    latencies, stats = [], {'delivered': 0, 'failed': 0, 'bytes': 0}
+
+    def on_delivery(sent_at, span):
+        def report(err, msg):
+            if err is not None:
+                stats['failed'] += 1
+                span.fail(err)
+                if stats['failed'] <= 10:
+                    print(f"❌ Fallo en entrega: {err}")
+            else:
+                stats['delivered'] += 1
+                latencies.append((time.perf_counter() - sent_at) * 1000)
+                span.set(partition=msg.partition(), offset=msg.offset())
+            span.finish()
+        return report
+
+    sent = 0
+    started = time.perf_counter()
+    last_report, last_sent = started, 0
+    try:
+        for at, event in events:
+            if args.duration and (at >= args.duration or time.perf_counter() - started >= args.duration):
+                break
+            # Pacing sin deriva: cada evento tiene su instante objetivo desde el inicio
+            delay = started + at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            value = encode(event, args.payload_bytes)
+            key = str(event.get('broker_code', '')).encode('utf-8')
+            span = tracing.Span('bolsa.produce', service=SERVICE, event_id=event.get('event_id'),
+                                broker_code=event.get('broker_code'))
+            headers = tracing.inject(span=span)
+            while True:
+                try:
+                    producer.produce(TOPIC, value, key=key, headers=headers,
+                                     on_delivery=on_delivery(time.perf_counter(), span))
+                    break
+                except BufferError:
+                    producer.poll(0.1)  # Cola local llena: esperar a que el broker confirme lotes
+            producer.poll(0)
+            sent += 1
+            stats['bytes'] += len(value)
+            if record:
+                record.write(json.dumps({'t': round(time.perf_counter() - started, 6), 'event': event}) + '\n')
+
+            now = time.perf_counter()
+            if now - last_report >= REPORT_INTERVAL:
+                print(f"   ⏱️ {sent} enviados ({(sent - last_sent) / (now - last_report):.0f} ev/s), "
+                      f"{stats['delivered']} confirmados")
+                last_report, last_sent = now, sent
+    except KeyboardInterrupt:
+        print("🛑 Interrumpido, esperando confirmaciones pendientes...")
+    finally:
+        pending = producer.flush(30)
+        elapsed = time.perf_counter() - started
+        if record:
+            record.close()
+
+    print(f"📊 {sent} eventos en {elapsed:.2f}s → {sent / max(elapsed, 1e-9):.0f} ev/s "
+          f"({stats['bytes'] / max(elapsed, 1e-9) / 1e6:.1f} MB/s); confirmados {stats['delivered']}, "
+          f"fallidos {stats['failed']}, sin confirmar {pending}")
+    if latencies:
+        print(f"   Latencia de entrega: p50 {percentile(latencies, 50):.1f}ms, p95 {percentile(latencies, 95):.1f}ms, "
+              f"p99 {percentile(latencies, 99):.1f}ms, máx {max(latencies):.1f}ms")
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    load = parser.add_argument_group("carga")
+    load.add_argument('--rate', type=float, default=1, help="Eventos/s objetivo (0 = lo más rápido posible)")
+    load.add_argument('--events', type=int, help="Total de eventos (por defecto 3 si no se da --duration)")
+    load.add_argument('--duration', type=float, help="Segundos de carga")
+    load.add_argument('--broker-codes', help="Códigos de corredor separados por coma (por defecto DEFAULT)")
+    load.add_argument('--brokers', type=positive_int, help="Cantidad de corredores SIM000.. (alternativa a --broker-codes)")
+    load.add_argument('--instruments', type=positive_int, default=50, help="Instrumentos distintos")
+    load.add_argument('--payload-bytes', type=int, default=0, help="Tamaño mínimo de cada mensaje")
+    load.add_argument('--year', type=int, default=2025)
+    load.add_argument('--seed', type=int, help="Semilla para una carga reproducible")
+
+    tuning = parser.add_argument_group("productor")
+    tuning.add_argument('--linger-ms', type=int, default=20)
+    tuning.add_argument('--batch-messages', type=int, default=10_000)
+    tuning.add_argument('--compression', default='lz4', choices=['none', 'gzip', 'snappy', 'lz4', 'zstd'])
+
+    files = parser.add_argument_group("archivos")
+    files.add_argument('--record', help="Guarda los eventos enviados (JSONL) para repetir la carga")
+    files.add_argument('--replay', help="Re-envía un archivo JSONL grabado con --record (o un evento por línea)")
+    files.add_argument('--speed', type=float, default=1.0, help="Velocidad del replay (0 = lo más rápido posible)")
+    files.add_argument('--keep-event-ids', action='store_true',
+                       help="El replay re-envía los event_id grabados (el consumer los descarta como duplicados)")
+    files.add_argument('--trace', help="Exporta los spans del productor a este JSONL (por defecto según NUAM_TRACING)")
+    args = parser.parse_args(argv)
+
+    if args.trace:
+        tracing.configure(f"file:{args.trace}")
+
+    if args.brokers is None and not args.broker_codes:
+        args.broker_codes = 'DEFAULT'
+    if args.events is None and args.duration is None and not args.replay:
+        args.events = 3
 
-print("--- INICIANDO SIMULACIÓN DE BOLSA ---")
+    print("--- INICIANDO SIMULACIÓN DE BOLSA ---")
+    run(args)
+    print("--- SIMULACIÓN FINALIZADA ---")
 
-for event in events:
-    payload = json.dumps(event)
-    # Codificar a bytes antes de enviar
-    producer.produce(topic, payload.encode('utf-8'), callback=delivery_report)
-    producer.poll(0)
-    time.sleep(1)
 
-producer.flush()
-print("--- SIMULACIÓN FINALIZADA ---")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
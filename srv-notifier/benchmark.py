@@ -0,0 +1,119 @@
+"""
+Benchmark de la etapa de entrega contra un servidor SMTP local de prueba (sin Kafka).
+
+Levanta un "sumidero" SMTP en asyncio que acepta todo y tarda --latency segundos en
+responder cada DATA (como un servidor real), y mide correos/segundo sostenidos. El mismo
+sumidero sirve de stand-in en los tests del notifier (respuestas 4xx/5xx y cortes a pedido):
+
+    python benchmark.py --messages 2000 --pool 1 --in-flight 1     # línea base: uno a la vez
+    python benchmark.py --messages 2000 --pool 8 --in-flight 100   # pool + concurrencia
+"""
+import argparse
+import asyncio
+import time
+from collections import deque
+
+from mailer import DeliveryStage, RateLimiter, SMTPPool
+
+
+class SMTPSink:
+    """Servidor SMTP mínimo: EHLO/MAIL/RCPT/DATA/RSET/NOOP/QUIT. Cuenta mensajes y conexiones."""
+
+    DISCONNECT = object()  # En script(): corta la conexión en vez de responder el DATA
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.messages = 0
+        self.connections = 0
+        self.received = []      # Destinatarios de los correos aceptados, en orden
+        self._script = deque()  # Respuestas a los próximos DATA (b"451 ..." o DISCONNECT)
+
+    def script(self, *replies):
+        """Los próximos DATA reciben estas respuestas en vez de 250 (p. ej. b"550 No existe")."""
+        self._script.extend(replies)
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        writer.write(b"220 sink ESMTP\r\n")
+        recipient = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line[:4].upper()
+                if command == b'RCPT':
+                    recipient = line.decode().partition('<')[2].partition('>')[0]
+                if command in (b'EHLO', b'HELO'):
+                    writer.write(b"250-sink\r\n250 8BITMIME\r\n")
+                elif command == b'DATA':
+                    writer.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+                    await writer.drain()
+                    while (await reader.readline()) not in (b".\r\n", b""):
+                        pass
+                    if self.latency:
+                        await asyncio.sleep(self.latency)
+                    reply = self._script.popleft() if self._script else None
+                    if reply is self.DISCONNECT:
+                        break
+                    if reply is not None:
+                        writer.write(reply.rstrip(b"\r\n") + b"\r\n")
+                    else:
+                        self.messages += 1
+                        self.received.append(recipient)
+                        writer.write(b"250 OK queued\r\n")
+                elif command == b'QUIT':
+                    writer.write(b"221 Bye\r\n")
+                    await writer.drain()
+                    break
+                else:
+                    writer.write(b"250 OK\r\n")  # MAIL, RCPT, RSET, NOOP
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+async def benchmark(messages, brokers, pool_size, in_flight, latency):
+    sink = SMTPSink(latency)
+    server = await asyncio.start_server(sink.handle, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+
+    # Sin límite efectivo por corredor: se mide el throughput de la entrega
+    stage = DeliveryStage(SMTPPool('127.0.0.1', port, size=pool_size), limiter=RateLimiter(rate=1e9, burst=1e9))
+    slots = asyncio.Semaphore(in_flight)
+    events = [
+        {'broker_code': f"BR{i % brokers:03d}", 'instrument': f"INST{i}", 'date': '2025-06-01', 'amount': 1000 + i}
+        for i in range(messages)
+    ]
+
+    async def one(event):
+        async with slots:
+            await stage.deliver(event)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(event) for event in events))
+    elapsed = time.perf_counter() - started
+
+    await stage.close()
+    server.close()
+    await server.wait_closed()
+    return elapsed, sink
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--brokers', type=int, default=20)
+    parser.add_argument('--pool', type=int, default=8, help="Conexiones SMTP persistentes")
+    parser.add_argument('--in-flight', type=int, default=100, help="Correos concurrentes")
+    parser.add_argument('--latency', type=float, default=0.01, help="Demora del servidor por correo (s)")
+    args = parser.parse_args()
+
+    elapsed, sink = asyncio.run(benchmark(args.messages, args.brokers, args.pool, args.in_flight, args.latency))
+    print(f"📨 {sink.messages} correos en {elapsed:.2f}s → {sink.messages / elapsed:.0f} correos/s "
+          f"(pool={args.pool}, en vuelo={args.in_flight}, conexiones abiertas={sink.connections}, "
+          f"latencia={args.latency * 1000:.0f}ms)")
+
+
+if __name__ == '__main__':
+    main()
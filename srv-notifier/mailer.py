@@ -0,0 +1,234 @@
+"""
+Etapa de entrega de correos del Notifier (asyncio).
+
+- Pool de conexiones SMTP persistentes: cada conexión hace EHLO/STARTTLS/LOGIN una sola
+  vez y se reutiliza; los envíos bloqueantes de smtplib corren en un executor propio.
+- Plantillas precompiladas por tipo de evento: cabeceras + cuerpo se arman con una sola
+  sustitución y se envían como bytes (sin construir un EmailMessage por correo).
+- Límite de envíos por corredor (token bucket) para no saturar a un mismo destinatario.
+- Errores 5xx / destinatario rechazado = permanentes (se descartan con log); el resto se
+  reintenta con espera exponencial hasta entregarse.
+
+Sin SMTP_HOST configurado se usa la simulación por consola (comportamiento histórico).
+"""
+import asyncio
+import os
+import smtplib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate, make_msgid
+from string import Template
+
+SMTP_HOST = os.environ.get('SMTP_HOST', '')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', '25'))
+SMTP_USER = os.environ.get('SMTP_USER', '')
+SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD', '')
+SMTP_STARTTLS = os.environ.get('SMTP_STARTTLS', 'false').lower() == 'true'
+SMTP_POOL_SIZE = int(os.environ.get('SMTP_POOL_SIZE', '4'))
+MAIL_FROM = os.environ.get('MAIL_FROM', 'alertas@nuam.cl')
+
+# Correos por segundo (y ráfaga máxima) permitidos por corredor
+BROKER_RATE = float(os.environ.get('NOTIFIER_BROKER_RATE', '5'))
+BROKER_BURST = int(os.environ.get('NOTIFIER_BROKER_BURST', '20'))
+
+FIRST_BACKOFF = 1  # Segundos antes del primer reintento (luego se duplica hasta MAX_BACKOFF)
+MAX_BACKOFF = 60
+
+# --- PLANTILLAS (se compilan una sola vez al importar) ---
+HEADERS = (
+    "From: $sender\r\nTo: $recipient\r\nSubject: $subject\r\nDate: $date\r\nMessage-ID: $message_id\r\n"
+    "MIME-Version: 1.0\r\nContent-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: 8bit\r\n\r\n"
+)
+BODIES = {
+    'qualification.bulk_loaded': (
+        "Carga Masiva Procesada NUAM",
+        "Estimado $broker,\r\n\r\nSe procesó una carga masiva de $rows calificaciones "
+        "($created nuevas) por un monto total de $$$amount.\r\n",
+    ),
+    None: (
+        "Alerta de Movimiento Tributario NUAM",
+        "Estimado $broker,\r\n\r\nSe ha registrado un movimiento por $$$amount"
+        " ($instrument, $date_pago).\r\n",
+    ),
+}
+TEMPLATES = {
+    event_type: Template(HEADERS.replace('$subject', subject) + body)
+    for event_type, (subject, body) in BODIES.items()
+}
+
+
+def _clean(value):
+    """Evita inyección de cabeceras: nada de saltos de línea dentro de un valor."""
+    return str(value).replace('\r', ' ').replace('\n', ' ')
+
+
+def render(event, sender=MAIL_FROM):
+    """(destinatario, mensaje en bytes) para un evento de nuam_events."""
+    broker = _clean(event.get('broker_code') or 'UNKNOWN')
+    recipient = f"contacto@{broker.lower()}.cl"
+    template = TEMPLATES.get(event.get('event_type'), TEMPLATES[None])
+    message = template.safe_substitute(
+        sender=sender,
+        recipient=recipient,
+        date=formatdate(localtime=True),
+        message_id=make_msgid(domain='nuam.cl'),
+        broker=broker,
+        amount=_clean(event.get('amount', 0)),
+        instrument=_clean(event.get('instrument', '-')),
+        date_pago=_clean(event.get('date', '-')),
+        rows=_clean(event.get('rows', 0)),
+        created=_clean(event.get('created', 0)),
+    )
+    return recipient, message.encode('utf-8')
+
+
+# --- LÍMITE POR CORREDOR ---
+class RateLimiter:
+    """Token bucket por clave (corredor). Solo se usa desde el event loop: no necesita locks."""
+
+    def __init__(self, rate=BROKER_RATE, burst=BROKER_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}  # clave -> (tokens, instante)
+
+    async def acquire(self, key):
+        while True:
+            now = time.monotonic()
+            tokens, last = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                return
+            self._buckets[key] = (tokens, now)
+            await asyncio.sleep((1 - tokens) / self.rate)
+
+
+# --- POOL SMTP ---
+class SMTPPool:
+    """Hasta `size` conexiones SMTP persistentes; una conexión rota se descarta y se reabre."""
+
+    def __init__(self, host, port, size=SMTP_POOL_SIZE, user='', password='', starttls=False, timeout=30):
+        self.host, self.port, self.size = host, port, size
+        self.user, self.password, self.starttls, self.timeout = user, password, starttls, timeout
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='smtp')
+        self._idle = asyncio.Queue()
+        self._open_count = 0
+
+    def _connect(self):
+        conn = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        conn.ehlo()
+        if self.starttls:
+            conn.starttls()
+            conn.ehlo()
+        if self.user:
+            conn.login(self.user, self.password)
+        return conn
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def _acquire(self):
+        if self._idle.empty() and self._open_count < self.size:
+            self._open_count += 1
+            try:
+                return await self._run(self._connect)
+            except BaseException:
+                self._open_count -= 1
+                raise
+        return await self._idle.get()
+
+    def _discard(self, conn):
+        self._open_count -= 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    async def send(self, sender, recipient, message):
+        conn = await self._acquire()
+        try:
+            await self._run(conn.sendmail, sender, [recipient], message)
+        except (smtplib.SMTPServerDisconnected, OSError):
+            self._discard(conn)
+            raise
+        except smtplib.SMTPException:
+            # Error de protocolo en ESTE correo: la conexión sigue sirviendo tras un RSET
+            try:
+                await self._run(conn.rset)
+            except (smtplib.SMTPException, OSError):
+                self._discard(conn)
+                raise
+            self._idle.put_nowait(conn)
+            raise
+        self._idle.put_nowait(conn)
+
+    async def close(self):
+        while not self._idle.empty():
+            conn = self._idle.get_nowait()
+            self._open_count -= 1
+            try:
+                await self._run(conn.quit)
+            except (smtplib.SMTPException, OSError):
+                pass
+        self._executor.shutdown(wait=False)
+
+
+class ConsoleSender:
+    """Simulación por consola (sin servidor SMTP configurado)."""
+
+    async def send(self, sender, recipient, message):
+        print(f"\n[📧 EMAIL SERVICE] ----------------------------------------")
+        headers, body = message.decode('utf-8').split('\r\n\r\n', 1)
+        for line in headers.split('\r\n'):
+            if line.startswith(('To:', 'Subject:')):
+                print(line)
+        print(body.strip().replace('\r\n', '\n'))
+        print(f"----------------------------------------------------------\n")
+
+    async def close(self):
+        pass
+
+
+def is_permanent(error):
+    """5xx o destinatario rechazado: reintentar no sirve."""
+    if isinstance(error, (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused)):
+        return True
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+
+# --- ETAPA DE ENTREGA ---
+class DeliveryStage:
+    def __init__(self, sender, limiter=None, mail_from=MAIL_FROM):
+        self.sender = sender
+        self.limiter = limiter or RateLimiter()
+        self.mail_from = mail_from
+        self.delivered = 0
+        self.discarded = 0
+
+    @classmethod
+    def from_env(cls):
+        if not SMTP_HOST:
+            return cls(ConsoleSender())
+        return cls(SMTPPool(SMTP_HOST, SMTP_PORT, SMTP_POOL_SIZE, SMTP_USER, SMTP_PASSWORD, SMTP_STARTTLS))
+
+    async def deliver(self, event):
+        """True = entregado; False = descartado por error permanente. Los transitorios se reintentan."""
+        await self.limiter.acquire(event.get('broker_code') or 'UNKNOWN')
+        recipient, message = render(event, self.mail_from)
+        backoff = FIRST_BACKOFF
+        while True:
+            try:
+                await self.sender.send(self.mail_from, recipient, message)
+                self.delivered += 1
+                return True
+            except Exception as e:
+                if is_permanent(e):
+                    print(f"☠️ Correo a {recipient} descartado: {e}")
+                    self.discarded += 1
+                    return False
+                print(f"⏳ Fallo transitorio enviando a {recipient} ({e}); reintento en {backoff}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, MAX_BACKOFF)
+
+    async def close(self):
+        await self.sender.close()
@@ -1,44 +1,158 @@
 import os
+import sys
 import json
 import time
-from confluent_kafka import Consumer
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from mailer import DeliveryStage
+
+# nuam/transport.py del backend: Kafka real o stand-in local según NUAM_TRANSPORT
+sys.path.append(os.environ.get('NUAM_BACKEND_DIR', '/app/backend'))
+from nuam.transport import Consumer, TopicPartition
+from nuam import profiling, tracing  # Contexto de traza en el header 'traceparent'
 
 KAFKA_SERVER = os.environ.get('KAFKA_BOOTSTRAP_SERVERS', 'kafka:9092')
 TOPIC = 'nuam_events'
+MAX_IN_FLIGHT = int(os.environ.get('NOTIFIER_MAX_IN_FLIGHT', '100'))  # Correos en vuelo a la vez
+COMMIT_INTERVAL = 1.0
+SERVICE = 'notifier'  # Nombre de servicio en las trazas
 
-def send_email_simulation(broker, amount):
-    print(f"\n[📧 EMAIL SERVICE] ----------------------------------------")
-    print(f"To: contacto@{broker.lower()}.cl")
-    print(f"Subject: Alerta de Movimiento Tributario NUAM")
-    print(f"Body: Estimado {broker}, se ha registrado un movimiento por ${amount}.")
-    print(f"----------------------------------------------------------\n")
+class OffsetTracker:
+    """
+    Offsets por partición con entregas fuera de orden: solo se confirma hasta el primer
+    mensaje aún no entregado (un correo lento no deja avanzar a los que vienen después).
+    """
 
-def start():
+    def __init__(self):
+        self._lock = threading.Lock()  # on_revoke corre en el hilo de poll
+        self._pending = {}    # (topic, partition) -> offsets en vuelo
+        self._next = {}       # (topic, partition) -> mayor offset despachado + 1
+        self._committed = {}
+
+    def start(self, topic, partition, offset):
+        with self._lock:
+            self._pending.setdefault((topic, partition), set()).add(offset)
+            self._next[(topic, partition)] = max(self._next.get((topic, partition), 0), offset + 1)
+
+    def done(self, topic, partition, offset):
+        with self._lock:
+            self._pending.get((topic, partition), set()).discard(offset)
+
+    def committable(self, partitions=None):
+        """[(topic, partition, offset)] nuevos a confirmar (offset = próximo a leer)."""
+        result = []
+        with self._lock:
+            for tp, next_offset in self._next.items():
+                if partitions is not None and tp not in partitions:
+                    continue
+                pending = self._pending.get(tp)
+                offset = min(pending) if pending else next_offset
+                if self._committed.get(tp) != offset:
+                    result.append((tp[0], tp[1], offset))
+        return result
+
+    def mark_committed(self, offsets):
+        with self._lock:
+            for topic, partition, offset in offsets:
+                self._committed[(topic, partition)] = offset
+
+    def forget(self, partitions):
+        with self._lock:
+            for tp in partitions:
+                self._pending.pop(tp, None)
+                self._next.pop(tp, None)
+                self._committed.pop(tp, None)
+
+def commit(consumer, tracker, partitions=None, asynchronous=True):
+    offsets = tracker.committable(partitions)
+    if offsets:
+        consumer.commit(offsets=[TopicPartition(t, p, o) for t, p, o in offsets], asynchronous=asynchronous)
+        tracker.mark_committed(offsets)
+
+async def deliver(msg, stage, tracker, slots, on_delivered=None):
+    """Entrega un evento y recién entonces lo marca como confirmable."""
+    try:
+        # Cada tarea corre en su propia copia del contexto: el span activo no se mezcla entre entregas
+        parent = tracing.extract(msg.headers())
+        tracing.record_queue(msg, parent, SERVICE)
+        with tracing.span('notifier.handle', parent=parent, service=SERVICE, topic=msg.topic(),
+                          partition=msg.partition(), offset=msg.offset()):
+            with tracing.span('notifier.decode'):
+                data = json.loads(msg.value().decode('utf-8'))
+            with tracing.span('notifier.delivery') as span:  # Límite de tasa + render + SMTP con reintentos
+                span.set(delivered=await stage.deliver(data))
+        if on_delivered:
+            on_delivered(msg)
+    except (ValueError, AttributeError) as e:
+        print(f"🗑️ Evento ilegible en {msg.topic()}[{msg.partition()}]@{msg.offset()}: {e}")
+    finally:
+        tracker.done(msg.topic(), msg.partition(), msg.offset())
+        slots.release()
+
+async def run(stage=None, stop_event=None, on_delivered=None):
+    """Loop del notifier; stage/stop_event/on_delivered permiten correrlo embebido (pipeline_bench.py)."""
     print(f"📡 Notifier Service conectando a {KAFKA_SERVER}...")
     conf = {
         'bootstrap.servers': KAFKA_SERVER,
         'group.id': 'nuam_notifier_group', # Grupo distinto para que lea copia del mensaje
-        'auto.offset.reset': 'earliest'
+        'auto.offset.reset': 'earliest',
+        # El offset se confirma solo tras la entrega del correo (ver OffsetTracker)
+        'enable.auto.commit': False,
     }
     consumer = Consumer(conf)
-    consumer.subscribe([TOPIC])
-    
+    stop_event = stop_event or threading.Event()
+    tracker = OffsetTracker()
+
+    def on_revoke(consumer, partitions):
+        revoked = {(p.topic, p.partition) for p in partitions}
+        commit(consumer, tracker, revoked, asynchronous=False)
+        tracker.forget(revoked)
+
+    consumer.subscribe([TOPIC], on_revoke=on_revoke)
+
+    stage = stage or DeliveryStage.from_env()
+    slots = asyncio.Semaphore(MAX_IN_FLIGHT)
+    loop = asyncio.get_running_loop()
+    poller = ThreadPoolExecutor(max_workers=1, thread_name_prefix='kafka-poll')  # poll() bloquea
+    tasks = set()
+    last_commit = time.monotonic()
+
     try:
-        while True:
-            msg = consumer.poll(1.0)
-            if msg is None: continue
-            if msg.error():
-                print(f"Error: {msg.error()}")
-                continue
-                
-            data = json.loads(msg.value().decode('utf-8'))
-            # Simulamos reacción al evento
-            send_email_simulation(data.get('broker_code', 'UNKNOWN'), data.get('amount', 0))
-            
-    except KeyboardInterrupt:
-        pass
+        while not stop_event.is_set():
+            await slots.acquire()  # Backpressure: sin cupo no se lee más de Kafka
+            msg = await loop.run_in_executor(poller, consumer.poll, 0.5)
+
+            if msg is None or msg.error():
+                slots.release()
+                if msg is not None:
+                    print(f"Error: {msg.error()}")
+            else:
+                tracker.start(msg.topic(), msg.partition(), msg.offset())
+                task = asyncio.create_task(deliver(msg, stage, tracker, slots, on_delivered))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+            if time.monotonic() - last_commit >= COMMIT_INTERVAL:
+                commit(consumer, tracker)
+                last_commit = time.monotonic()
     finally:
+        # Terminar los correos en vuelo antes de confirmar y cerrar
+        if tasks:
+            await asyncio.wait(tasks, timeout=30)
+        commit(consumer, tracker, asynchronous=False)
+        await stage.close()
+        poller.shutdown(wait=True)
         consumer.close()
+        print(f"📊 Correos entregados: {stage.delivered}, descartados: {stage.discarded}")
+
+def start():
+    profiling.install_signal_handler(SERVICE)  # kill -USR2 <pid>: perfil de CPU (nuam/profiling.py)
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
 
 if __name__ == "__main__":
-    start()
\ No newline at end of file
+    start()